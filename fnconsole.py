@@ -460,8 +460,16 @@ class FakerNetConsole():
                 print_formatted_text(HTML('<ansired>Error: Got invalid module "{}"</ansired>'.format(module_name)))
 
             function_name = self.current_command['function_name']
+
+            # DATA parameters can be given as a path to a JSON or CSV file
+            args = dict(self.current_command['vars'])
+            for variable in args:
+                if self.current_command['function'][variable] == "DATA" and os.path.isfile(args[variable]):
+                    data_file = open(args[variable], "r")
+                    args[variable] = data_file.read()
+                    data_file.close()
             
-            self.run_module_function(module_name, function_name, self.current_command['vars'])
+            self.run_module_function(module_name, function_name, args)
 
         else:
             print_formatted_text(HTML('<ansired>Error: Invalid command "{}"</ansired>'.format(command)))
@@ -517,10 +525,68 @@ class FakerNetConsole():
         else:
             print_formatted_text(HTML('<ansired>Error: Invalid function "{}"</ansired>'.format(function)))
 
+# Run the commands in order. When connected to a server they are sent in one request
+def run_json_batch(console, lines):
+    json_lines = []
+    line_numbers = []
+    counter = 1
+    for line in lines:
+        line = line.strip()
+        if line != "":
+            json_lines.append(json.loads(line))
+            line_numbers.append(counter)
+        counter += 1
+
+    if console.mm.ip:
+        error, results = console.mm.run_batch(json_lines)
+        if error is not None:
+            print_formatted_text(HTML("<ansired>Batch error: {}</ansired>".format(error)))
+            return
+    else:
+        # Locally, show each result as soon as it's done
+        results = map(console.mm.run_json_command, json_lines)
+
+    for line_number, (error, result) in zip(line_numbers, results):
+        if error is not None:
+            print_formatted_text(HTML("<ansired>Line {} error: {}</ansired>".format(line_number, error)))
+        else:
+            console.print_result(error, result)
+
+# Submit every command as a job, then wait for them all
+def run_json_async(console, lines):
+    job_ids = []
+    line_numbers = []
+    counter = 1
+    for line in lines:
+        line = line.strip()
+        if line != "":
+            json_line = json.loads(line)
+            if 'module' not in json_line or 'func' not in json_line:
+                print_formatted_text(HTML("<ansired>Line {} error: Command needs keys 'module' and 'func'</ansired>".format(counter)))
+            elif json_line['module'] not in console.mm.list_modules():
+                print_formatted_text(HTML("<ansired>Line {} error: Invalid module '{}'</ansired>".format(counter, json_line['module'])))
+            else:
+                error, job_id = console.mm[json_line['module']].submit(json_line['func'], **json_line.get('args', {}))
+                if error is not None:
+                    print_formatted_text(HTML("<ansired>Line {} error: {}</ansired>".format(counter, error)))
+                else:
+                    job_ids.append(job_id)
+                    line_numbers.append(counter)
+        counter += 1
+
+    print("Submitted {} jobs, waiting for results".format(len(job_ids)))
+    results = console.mm.gather_jobs(job_ids)
+    for line_number, (error, result) in zip(line_numbers, results):
+        if error is not None:
+            print_formatted_text(HTML("<ansired>Line {} error: {}</ansired>".format(line_number, error)))
+        else:
+            console.print_result(error, result)
+
 def main():
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('-j', '--json', help='Run commands from a JSON file and go to the console')
     parser.add_argument('-s', '--server', help='Server to connect to (defaults to 127.0.0.1)')
+    parser.add_argument('-a', '--async', dest='run_async', action='store_true', help='With -j, run the commands as background jobs at the same time. Only for commands that do not depend on each other')
     args = parser.parse_args()
 
     console = None
@@ -536,17 +602,10 @@ def main():
             json_file = open(args.json, "r")
             lines = json_file.read().split("\n")
             json_file.close()
-            counter = 1
-            for line in lines:
-                line = line.strip()
-                json_line = json.loads(line)
-                
-                error, result = console.mm.run_json_command(json_line)
-                if error is not None:
-                    print_formatted_text(HTML("<ansired>Line {} error: {}</ansired>".format(counter, error)))
-                else:
-                    console.print_result(error, result)
-                counter += 1
+            if args.run_async:
+                run_json_async(console, lines)
+            else:
+                run_json_batch(console, lines)
         else:
             print_formatted_text(HTML("<ansired>!!! - ERROR: JSON file '{}' not found</ansired>".format(args.json)))
     console.start()
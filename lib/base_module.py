@@ -2,14 +2,53 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import subprocess 
 import os
 import time
 import re
+import socket
 
 import docker
 import pylxd
 
+from lib.jobs import report_progress
+import lib.validate as validate
+from lib.priv_helper import default_client
+
+# Polls condition() until it returns True, backing off exponentially between
+# attempts, so callers continue as soon as something is ready instead of
+# sleeping for the worst case. Exceptions from condition() count as not ready
+# yet. Returns the number of attempts, or an error once timeout seconds pass.
+def wait_for(condition, timeout=30, initial_delay=0.1, max_delay=2, clock=time.monotonic, sleep=time.sleep):
+    deadline = clock() + timeout
+    delay = initial_delay
+    attempts = 0
+    last_error = None
+    while True:
+        attempts += 1
+        try:
+            if condition():
+                return None, attempts
+        except Exception as e:
+            last_error = e
+
+        remaining = deadline - clock()
+        if remaining <= 0:
+            if last_error is not None:
+                return "Timed out after {} seconds: {}".format(timeout, last_error), None
+            return "Timed out after {} seconds".format(timeout), None
+
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+# Readiness probe for services that listen on a TCP port
+def port_open(ip_addr, port, timeout=1):
+    try:
+        conn = socket.create_connection((ip_addr, port), timeout=timeout)
+        conn.close()
+        return True
+    except OSError:
+        return False
+
 class BaseModule():
     __SHORTNAME__ = ""
     __FUNCS__ = {}
@@ -25,6 +64,16 @@ class BaseModule():
 
     def print(self, data):
         print("[" +  self.__SHORTNAME__ + "] " + data)
+        report_progress(data)
+
+    def wait_until(self, description, condition, timeout=30):
+        error, _ = wait_for(condition, timeout=timeout)
+        if error is not None:
+            return "Waiting for {}: {}".format(description, error), None
+        return None, True
+
+    def wait_for_port(self, ip_addr, port, timeout=30):
+        return self.wait_until("port {} on {}".format(port, ip_addr), lambda: port_open(ip_addr, port), timeout=timeout)
 
     def get_path(self):
         return __file__
@@ -33,7 +82,7 @@ class BaseModule():
     def build(self):
         pass
 
-    def get_list(self):
+    def get_list(self, snapshot=None):
         return []
 
     def save(self):
@@ -43,12 +92,16 @@ class BaseModule():
         pass
 
     # Adds status info for get_list. Passed list should have data in format ID, ip address, description
-    def _list_add_data(self, server_info, instance_template):
+    # If a StatusSnapshot is passed, status is read from it rather than asking Docker for each server
+    def _list_add_data(self, server_info, instance_template, snapshot=None):
         new_list = []
         for server in server_info:
             new_data = [self.__SHORTNAME__]
             new_data += [server[0], server[1], server[2]]
-            error, status = self.docker_status(instance_template.format(server[0]))
+            if snapshot is not None:
+                error, status = snapshot.docker_status(instance_template.format(server[0]))
+            else:
+                error, status = self.docker_status(instance_template.format(server[0]))
             if error is None:
                 new_data.append(status[1])
             else:
@@ -65,6 +118,70 @@ class BaseModule():
     def get_working_dir(self):
         return "{}/work/{}".format(os.getcwd(), self.__SHORTNAME__)
 
+    # Runs one of the tools in lib.priv_helper.TOOLS as root, through the
+    # privileged helper or with sudo. Returns the tool's output.
+    def run_privileged(self, tool, args):
+        return self._privileged().run(tool, args)
+
+    # Runs a list of (tool, args) as root in one request, stopping at the
+    # first that fails unless stop_on_error is False. Returns the results,
+    # each with code, output and error.
+    def run_privileged_batch(self, ops, stop_on_error=True):
+        return self._privileged().run_batch(ops, stop_on_error=stop_on_error)
+
+    def _privileged(self):
+        client = getattr(self.mm, "privileged", None)
+        if client is None:
+            client = default_client()
+        return client
+
+    # The ModuleManager's OVSDB client, if there is one and it is connected
+    def _ovsdb(self):
+        client = getattr(self.mm, "ovsdb", None)
+        if client is None or client.ensure_connected() is not None:
+            return None
+        return client
+
+    # Creates an OVS bridge unless it exists, returning whether it was created
+    def ovs_add_bridge(self, bridge):
+        client = self._ovsdb()
+        if client is not None:
+            if client.bridge_exists(bridge):
+                return None, False
+            transaction = client.transaction()
+            transaction.add_bridge(bridge)
+            err, _ = transaction.commit()
+            if err is not None:
+                return "Failed to create OVS bridge", None
+            return None, True
+
+        err, _ = self.run_privileged("ovs-vsctl", ["br-exists", bridge])
+        if err is None:
+            return None, False
+        err, _ = self.run_privileged("ovs-vsctl", ["add-br", bridge])
+        if err is not None:
+            return "Failed to create OVS bridge", None
+        return None, True
+
+    def ovs_del_bridge(self, bridge):
+        client = self._ovsdb()
+        if client is not None:
+            transaction = client.transaction()
+            if not transaction.del_bridge(bridge):
+                return "Switch {} does not exit".format(bridge), None
+            err, _ = transaction.commit()
+            if err is not None:
+                return "Could not delete switch {}".format(bridge), None
+            return None, True
+
+        err, _ = self.run_privileged("ovs-vsctl", ["br-exists", bridge])
+        if err is not None:
+            return "Switch {} does not exit".format(bridge), None
+        err, _ = self.run_privileged("ovs-vsctl", ["del-br", bridge])
+        if err is not None:
+            return "Could not delete switch {}".format(bridge), None
+        return None, True
+
     def validate_params(self, func_def, kwargs):
         for item in func_def:
             item_type = func_def[item]
@@ -97,6 +214,9 @@ class BaseModule():
             elif item_type == "BOOLEAN":
                 if item_val.lower() != "true" and item_val.lower() != "false":
                     return "'{}' is not a valid '{}' for {}".format(item_val, item_type, item), None
+            elif item_type == "DATA":
+                if not isinstance(kwargs[item], (list, str)) or len(kwargs[item]) == 0:
+                    return "'{}' should be a list, or JSON or CSV text".format(item), None
             elif item_type == "DECIMAL":
                 if re.fullmatch(r"[0-9]+\.{0,1}[0-9]*", item_val) == None:
                     return "'{}' is not a valid '{}' for {}".format(item_val, item_type, item), None
@@ -117,18 +237,94 @@ class DockerBaseModule(BaseModule):
 
     mm = Holder()
 
+    # The ModuleManager's ContainerPlumbing, if it can be used
+    def _plumbing(self):
+        plumbing = getattr(self.mm, "plumbing", None)
+        if plumbing is None or not plumbing.available():
+            return None
+        return plumbing
+
+    def _docker_pid(self, container):
+        try:
+            return None, self.mm.docker.containers.get(container).attrs['State']['Pid']
+        except docker.errors.NotFound:
+            return "Server not found in Docker", None
+
     def ovs_set_ip(self, container, bridge, interface, ip_addr, gateway):
+        plumbing = self._plumbing()
+        if plumbing is not None:
+            err, pid = self._docker_pid(container)
+            if err is not None:
+                return err, None
+            err, _ = plumbing.attach(container, pid, bridge, interface, ip_addr, gateway)
+            if err is not None:
+                return err, None
+            return None, True
+
+        args = ["add-port", bridge, interface, container, "--ipaddress={}".format(ip_addr)]
         if gateway is not None:
-            subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-docker", "add-port", bridge, interface, container, "--ipaddress={}".format(ip_addr), "--gateway={}".format(gateway)])
-        else:
-            subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-docker", "add-port", bridge, interface, container, "--ipaddress={}".format(ip_addr)])
+            args.append("--gateway={}".format(gateway))
+        err, _ = self.run_privileged("ovs-docker", args)
+        if err is not None:
+            return err, None
+        return None, True
+
+    # Like ovs_set_ip for a list of (container, bridge, interface, ip_addr,
+    # gateway), connecting them all in one go when ovs-docker isn't needed
+    def ovs_set_ips(self, attachments):
+        plumbing = self._plumbing()
+        if plumbing is None:
+            for attachment in attachments:
+                err, _ = self.ovs_set_ip(*attachment)
+                if err is not None:
+                    return err, None
+            return None, True
+
+        batch = []
+        for container, bridge, interface, ip_addr, gateway in attachments:
+            err, pid = self._docker_pid(container)
+            if err is not None:
+                return err, None
+            batch.append({
+                "container": container,
+                "pid": pid,
+                "bridge": bridge,
+                "interface": interface,
+                "ip_addr": ip_addr,
+                "gateway": gateway
+            })
+        err, _ = plumbing.attach_many(batch)
+        if err is not None:
+            return err, None
         return None, True
 
     def ovs_remove_ports(self, container, bridge):
-        subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-docker", "del-ports", bridge, container])
+        plumbing = self._plumbing()
+        if plumbing is not None:
+            err, _ = plumbing.detach(container, bridge)
+            if err is not None:
+                return err, None
+            return None, True
+
+        err, _ = self.run_privileged("ovs-docker", ["del-ports", bridge, container])
+        if err is not None:
+            return err, None
         return None, True
 
+    # The ModuleManager's ContainerStateCache, if there is one
+    def _container_cache(self):
+        return getattr(self.mm, "container_cache", None)
+
+    def _cache_set_status(self, container_name, status):
+        cache = self._container_cache()
+        if cache is not None:
+            cache.set_status(container_name, status)
+
     def docker_status(self, container):
+        cache = self._container_cache()
+        if cache is not None:
+            return cache.docker_status(container)
+
         try:
             container = self.mm.docker.containers.get(container)
             return None, ("yes", container.status)        
@@ -142,6 +338,7 @@ class DockerBaseModule(BaseModule):
 
         # Create the server in Docker
         self.mm.docker.containers.create(self.__SERVER_IMAGE_NAME__, volumes=vols, environment=environment, detach=True, name=container_name, network_mode="none", dns=[server_data['server_ip']])
+        self._cache_set_status(container_name, "created")
 
         return None, True
     
@@ -150,6 +347,7 @@ class DockerBaseModule(BaseModule):
         try:
             container = self.mm.docker.containers.get(container_name)
             container.remove()
+            self._cache_set_status(container_name, None)
         except docker.errors.NotFound:
             return "Server not found in Docker", None
         except docker.errors.APIError:
@@ -169,34 +367,75 @@ class DockerBaseModule(BaseModule):
         
         return None, True
 
-    def docker_start(self, container_name, server_ip):
-        # Get the server
+    def docker_wait_running(self, container_name, timeout=30):
+        def is_running():
+            return self.mm.docker.containers.get(container_name).status == "running"
+        return self.wait_until("{} to run".format(container_name), is_running, timeout=timeout)
+
+    # Waits until cmd exits successfully in the container
+    def docker_wait_exec(self, container_name, cmd, timeout=30):
+        def exec_ok():
+            code, _ = self.mm.docker.containers.get(container_name).exec_run(cmd)
+            return code == 0
+        return self.wait_until("'{}' in {}".format(cmd, container_name), exec_ok, timeout=timeout)
+
+    # Returns (switch, address with prefix length, gateway) for a server IP
+    def _server_network(self, server_ip):
+        err, switch = self.mm['netreserve'].run("get_ip_switch", ip_addr=server_ip)
+        if err:
+            return err, None
+
+        err, network = self.mm['netreserve'].run("get_ip_network", ip_addr=server_ip)
+        if err:
+            return err, None
+
+        return None, (switch, "{}/{}".format(server_ip, network.prefixlen), str(validate.get_gateway(network)))
+
+    def _docker_start_container(self, container_name):
         try:
             container = self.mm.docker.containers.get(container_name)
             container.start()
+            self._cache_set_status(container_name, "running")
         except docker.errors.NotFound:
             return "Server not found in Docker", None
         except 	docker.errors.APIError:
             return "Could not start server in Docker", None
+        return None, True
+
+    def docker_start(self, container_name, server_ip):
+        err, _ = self._docker_start_container(container_name)
+        if err is not None:
+            return err, None
 
         if server_ip is not None:
             # Configure networking
-            err, switch = self.mm['netreserve'].run("get_ip_switch", ip_addr=server_ip)
-            if err:
+            err, server_network = self._server_network(server_ip)
+            if err is not None:
                 return err, None
 
-            err, network = self.mm['netreserve'].run("get_ip_network", ip_addr=server_ip)
-            if err:
+            switch, ip_addr, gateway = server_network
+            err, _ = self.ovs_set_ip(container_name, switch, "eth0", ip_addr, gateway)
+            if err is not None:
                 return err, None
-            
-            mask = network.prefixlen
-            gateway = str(list(network.hosts())[0])
 
-            err, _ = self.ovs_set_ip(container_name, switch, "eth0", "{}/{}".format(server_ip, mask), gateway)
+        return None, True
+
+    # Starts a list of (container name, server IP) and then connects them to
+    # their switches together
+    def docker_start_many(self, servers):
+        attachments = []
+        for container_name, server_ip in servers:
+            err, _ = self._docker_start_container(container_name)
             if err is not None:
                 return err, None
+            if server_ip is not None:
+                err, server_network = self._server_network(server_ip)
+                if err is not None:
+                    return err, None
+                switch, ip_addr, gateway = server_network
+                attachments.append((container_name, switch, "eth0", ip_addr, gateway))
 
-        return None, True
+        return self.ovs_set_ips(attachments)
 
     def docker_stop(self, container_name, server_ip):
         if server_ip is not None:
@@ -211,6 +450,7 @@ class DockerBaseModule(BaseModule):
         try:
             container = self.mm.docker.containers.get(container_name)
             container.stop()
+            self._cache_set_status(container_name, "exited")
         except docker.errors.NotFound:
             return "Server not found in Docker", None
 
@@ -299,14 +539,31 @@ class LXDBaseModule(BaseModule):
         except pylxd.exceptions.LXDAPIException as e:
             return str(e), None
 
+    # Waits until the container is running and check succeeds inside it, which
+    # also means the LXD agent is answering
+    def lxd_wait_ready(self, container_name, check="ip link show eth0", timeout=60):
+        def is_ready():
+            container = self.mm.lxd.containers.get(container_name)
+            if container.state().status.lower() != "running":
+                return False
+            status, _, _ = container.execute(["/bin/sh", "-c", check])
+            return status == 0
+        return self.wait_until("{} to be ready".format(container_name), is_ready, timeout=timeout)
+
+    def lxd_wait_deleted(self, container_name, timeout=30):
+        return self.wait_until("{} to be deleted".format(container_name), lambda: not self.mm.lxd.containers.exists(container_name), timeout=timeout)
+
     def lxd_start(self, container_name, server_ip):
         try:
             container = self.mm.lxd.containers.get(container_name)
             container.start()
-            time.sleep(10)
         except pylxd.exceptions.LXDAPIException as e:
             return str(e), None
 
+        err, _ = self.lxd_wait_ready(container_name)
+        if err is not None:
+            return err, None
+
         # Configure networking
         err, switch = self.mm['netreserve'].run("get_ip_switch", ip_addr=server_ip)
         if err:
@@ -317,7 +574,7 @@ class LXDBaseModule(BaseModule):
             return err, None
         
         mask = network.prefixlen
-        gateway = str(list(network.hosts())[0])
+        gateway = str(validate.get_gateway(network))
 
         err, _ = self.lxd_execute(container_name, "ip addr add {}/{} dev eth0".format(server_ip, mask))
         if err is not None:
@@ -385,7 +642,10 @@ class LXDBaseModule(BaseModule):
             }, wait=True)
 
             temp_container.start(wait=True)
-            status, stdout, stderr = temp_container.execute(["/bin/sh", "-c", "sleep 5"])
+            # Commands usually need the network, so wait for DHCP to finish
+            err, _ = self.lxd_wait_ready(temp_container.name, check="ip route | grep -q default")
+            if err is not None:
+                self.print(err)
             for command in commands:
                 self.print("Ran: " + command)
                 status, stdout, stderr = temp_container.execute(["/bin/sh", "-c", command])
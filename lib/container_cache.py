@@ -0,0 +1,152 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+import threading
+
+import docker
+
+# Docker event action -> the container status it leaves behind. None means the
+# container is gone.
+EVENT_STATUS = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "stop": "exited",
+    "die": "exited",
+    "destroy": None
+}
+
+# Keeps the status of every Docker container in memory. It is filled with one
+# full listing, then kept up to date from the Docker events stream, so status
+# reads don't need to go to the daemon. If the stream is down and the last full
+# listing is older than max_age, reads fall back to asking Docker directly.
+class ContainerStateCache():
+
+    def __init__(self, docker_client, max_age=30, resync_interval=300, retry_delay=5, clock=time.monotonic, logger=None):
+        self._docker = docker_client
+        self.logger = logger
+        self.max_age = max_age
+        self.resync_interval = resync_interval
+        self.retry_delay = retry_delay
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._status = {}
+        # Goes up whenever a container's status changes
+        self.generation = 0
+        self._synced_at = None
+        self._streaming = False
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._watch, name="container-state-cache", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._streaming = False
+
+    def is_fresh(self):
+        with self._lock:
+            return self._is_fresh()
+
+    def _is_fresh(self):
+        if self._synced_at is None:
+            return False
+        if self._streaming:
+            return True
+        return self._clock() - self._synced_at <= self.max_age
+
+    # Do a full listing of containers, replacing everything in the cache.
+    # Returns the wall clock time the listing started, for use as the events 'since'.
+    def resync(self):
+        since = int(time.time())
+        containers = self._docker.containers.list(all=True, sparse=True)
+        new_status = {}
+        for container in containers:
+            for name in container.attrs.get('Names', []):
+                new_status[name.lstrip("/")] = container.status
+
+        with self._lock:
+            if new_status != self._status:
+                self.generation += 1
+            self._status = new_status
+            self._synced_at = self._clock()
+        return since
+
+    def apply_event(self, event):
+        if event.get('Type', 'container') != 'container':
+            return
+        action = event.get('Action', event.get('status', ''))
+        if action not in EVENT_STATUS:
+            return
+
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        name = attributes.get('name')
+        if name is None:
+            return
+
+        self.set_status(name, EVENT_STATUS[action])
+
+    # Used by the Docker helpers to record their own changes straight away,
+    # rather than waiting for the event to come back
+    def set_status(self, container_name, status):
+        with self._lock:
+            if self._status.get(container_name) == status:
+                return
+            if status is None:
+                self._status.pop(container_name, None)
+            else:
+                self._status[container_name] = status
+            self.generation += 1
+
+    # Same return format as DockerBaseModule.docker_status
+    def docker_status(self, container_name):
+        with self._lock:
+            if self._is_fresh():
+                if container_name in self._status:
+                    return None, ("yes", self._status[container_name])
+                return None, ("no", "n/a")
+
+        return self._query(container_name)
+
+    def _query(self, container_name):
+        try:
+            container = self._docker.containers.get(container_name)
+            self.set_status(container_name, container.status)
+            return None, ("yes", container.status)
+        except docker.errors.NotFound:
+            self.set_status(container_name, None)
+            return None, ("no", "n/a")
+
+    def _watch(self):
+        while self._running:
+            try:
+                since = self.resync()
+                self._streaming = True
+                try:
+                    # Bounding the stream with 'until' makes us do a full listing every
+                    # resync_interval, which catches anything the stream missed
+                    events = self._docker.events(decode=True, since=since, until=since + self.resync_interval, filters={"type": "container"})
+                    for event in events:
+                        if not self._running:
+                            break
+                        self.apply_event(event)
+                finally:
+                    self._streaming = False
+            # A broken stream can raise from docker, requests or urllib3, and the
+            # watcher has to outlive all of them
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error("Container event stream failed: %s", e)
+                if self._running:
+                    time.sleep(self.retry_delay)
+        self._streaming = False
@@ -0,0 +1,321 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import ctypes
+import errno
+import ipaddress
+import os
+import socket
+import struct
+import threading
+import uuid
+
+from lib.ovsdb import as_list
+
+NETLINK_ROUTE = 0
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_NEWROUTE = 24
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+IFF_UP = 0x1
+
+IFLA_IFNAME = 3
+IFLA_LINKINFO = 18
+IFLA_NET_NS_PID = 19
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+VETH_INFO_PEER = 1
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RTN_UNICAST = 1
+
+CLONE_NEWNET = 0x40000000
+CAP_NET_ADMIN = 12
+CAP_SYS_ADMIN = 21
+
+def _attr(attr_type, data):
+    length = 4 + len(data)
+    return struct.pack("=HH", length, attr_type) + data + b"\0" * ((4 - length % 4) % 4)
+
+def _name(name):
+    return name.encode() + b"\0"
+
+def _ifinfo(index=0, flags=0, change=0):
+    return struct.pack("=BxHiII", socket.AF_UNSPEC, 0, index, flags, change)
+
+# Talks rtnetlink to the kernel directly instead of running ip. Each call
+# sends all of its messages in one write and reads the acks back, so
+# creating any number of veth pairs is a single round trip. Needs
+# CAP_NET_ADMIN, and CAP_SYS_ADMIN to enter a container's namespace.
+class Netlink():
+
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self._seq = 0
+        self._seq_lock = threading.Lock()
+        self._available = None
+
+    def available(self):
+        if self._available is None:
+            self._available = False
+            try:
+                with open("/proc/self/status") as status_file:
+                    for line in status_file:
+                        if line.startswith("CapEff:"):
+                            caps = int(line.split()[1], 16)
+                            self._available = caps & (1 << CAP_NET_ADMIN) != 0 and caps & (1 << CAP_SYS_ADMIN) != 0
+            except OSError:
+                pass
+        return self._available
+
+    def _socket(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        sock.bind((0, 0))
+        sock.settimeout(self.timeout)
+        return sock
+
+    # A netlink socket stays in the namespace it was opened in, so one is
+    # opened from a thread that has joined the namespace of pid
+    def _netns_socket(self, pid):
+        result = {}
+
+        def enter():
+            libc = ctypes.CDLL(None, use_errno=True)
+            try:
+                with open("/proc/{}/ns/net".format(pid)) as target, open("/proc/thread-self/ns/net") as own:
+                    if libc.setns(target.fileno(), CLONE_NEWNET) != 0:
+                        error = ctypes.get_errno()
+                        raise OSError(error, os.strerror(error))
+                    try:
+                        result['socket'] = self._socket()
+                    finally:
+                        libc.setns(own.fileno(), CLONE_NEWNET)
+            except OSError as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=enter, name="netns-{}".format(pid))
+        thread.start()
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        return result['socket']
+
+    # Sends (type, flags, body) messages together. Returns (errno, replies)
+    # for each message, where errno is 0 if it worked.
+    def _request(self, sock, messages):
+        with self._seq_lock:
+            first = self._seq + 1
+            self._seq += len(messages)
+
+        data = b""
+        for i, (msg_type, flags, body) in enumerate(messages):
+            data += struct.pack("=LHHLL", 16 + len(body), msg_type, flags | NLM_F_REQUEST | NLM_F_ACK, first + i, 0) + body
+        sock.send(data)
+
+        results = dict([(first + i, [None, []]) for i in range(len(messages))])
+        remaining = len(messages)
+        while remaining > 0:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + 16 <= len(data):
+                length, msg_type, _, seq, _ = struct.unpack_from("=LHHLL", data, offset)
+                payload = data[offset + 16:offset + length]
+                offset += (length + 3) & ~3
+                if seq not in results or results[seq][0] is not None:
+                    continue
+                if msg_type == NLMSG_ERROR:
+                    results[seq][0] = -struct.unpack_from("=i", payload)[0]
+                    remaining -= 1
+                elif msg_type != NLMSG_DONE:
+                    results[seq][1].append(payload)
+        return [tuple(results[first + i]) for i in range(len(messages))]
+
+    def _link_index(self, sock, name):
+        [(code, replies)] = self._request(sock, [(RTM_GETLINK, 0, _ifinfo() + _attr(IFLA_IFNAME, _name(name)))])
+        if code != 0:
+            raise OSError(code, os.strerror(code))
+        return struct.unpack_from("=BxHiII", replies[0])[2]
+
+    # Creates a veth pair for each (name, peer name, pid), with the peer made
+    # inside the network namespace of pid and this end brought up
+    def create_veths(self, pairs):
+        messages = []
+        for name, peer_name, pid in pairs:
+            peer = _ifinfo() + _attr(IFLA_IFNAME, _name(peer_name)) + _attr(IFLA_NET_NS_PID, struct.pack("=I", pid))
+            link_info = _attr(IFLA_INFO_KIND, b"veth") + _attr(IFLA_INFO_DATA, _attr(VETH_INFO_PEER, peer))
+            body = _ifinfo(flags=IFF_UP, change=IFF_UP) + _attr(IFLA_IFNAME, _name(name)) + _attr(IFLA_LINKINFO, link_info)
+            messages.append((RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, body))
+
+        try:
+            with self._socket() as sock:
+                results = self._request(sock, messages)
+        except OSError as e:
+            return "Could not create veth pairs: {}".format(e), None
+
+        failed = [(pairs[i][0], code) for i, (code, _) in enumerate(results) if code != 0]
+        if len(failed) > 0:
+            created = [pairs[i][0] for i, (code, _) in enumerate(results) if code == 0]
+            self.delete_links(created)
+            return "Could not create veth {}: {}".format(failed[0][0], os.strerror(failed[0][1])), None
+        return None, True
+
+    # Brings up interface in the namespace of pid, gives it ip_addr (with
+    # its prefix length) and routes through gateway if there is one
+    def configure(self, pid, interface, ip_addr, gateway):
+        ip_interface = ipaddress.ip_interface(ip_addr)
+        family = socket.AF_INET if ip_interface.version == 4 else socket.AF_INET6
+        try:
+            with self._netns_socket(pid) as sock:
+                index = self._link_index(sock, interface)
+                address = ip_interface.ip.packed
+                messages = [
+                    (RTM_NEWLINK, 0, _ifinfo(index, IFF_UP, IFF_UP)),
+                    (RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, struct.pack("=BBBBI", family, ip_interface.network.prefixlen, 0, RT_SCOPE_UNIVERSE, index) +
+                        _attr(IFA_LOCAL, address) + _attr(IFA_ADDRESS, address))
+                ]
+                if gateway is not None:
+                    messages.append((RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, struct.pack("=BBBBBBBBI", family, 0, 0, 0, RT_TABLE_MAIN, RTPROT_BOOT, RT_SCOPE_UNIVERSE, RTN_UNICAST, 0) +
+                        _attr(RTA_GATEWAY, ipaddress.ip_address(gateway).packed) + _attr(RTA_OIF, struct.pack("=I", index))))
+                results = self._request(sock, messages)
+        except OSError as e:
+            return "Could not configure {} in process {}: {}".format(interface, pid, e), None
+
+        for code, _ in results:
+            if code != 0:
+                return "Could not configure {} in process {}: {}".format(interface, pid, os.strerror(code)), None
+        return None, True
+
+    # Deleting either end of a veth pair removes both. Links already gone are
+    # skipped.
+    def delete_links(self, names):
+        if len(names) == 0:
+            return None, True
+        messages = [(RTM_DELLINK, 0, _ifinfo() + _attr(IFLA_IFNAME, _name(name))) for name in names]
+        try:
+            with self._socket() as sock:
+                results = self._request(sock, messages)
+        except OSError as e:
+            return "Could not delete links: {}".format(e), None
+
+        for i, (code, _) in enumerate(results):
+            if code != 0 and code != errno.ENODEV:
+                return "Could not delete {}: {}".format(names[i], os.strerror(code)), None
+        return None, True
+
+# Connects containers to OVS bridges the way ovs-docker does, without
+# running it: a veth pair goes from the host into the container's network
+# namespace, the container end gets its address and default route, and the
+# host end is added to the bridge. Ports carry the same external_ids as
+# ovs-docker's, so ports made by either can be removed by the other. The
+# netlink and OVSDB layers are passed in so they can be replaced in tests.
+class ContainerPlumbing():
+
+    def __init__(self, ovsdb, netlink):
+        self.ovsdb = ovsdb
+        self.netlink = netlink
+
+    def available(self):
+        return self.ovsdb is not None and self.netlink.available() and self.ovsdb.ensure_connected() is None
+
+    def attach(self, container, pid, bridge, interface, ip_addr, gateway):
+        err, names = self.attach_many([{
+            "container": container,
+            "pid": pid,
+            "bridge": bridge,
+            "interface": interface,
+            "ip_addr": ip_addr,
+            "gateway": gateway
+        }])
+        if err is not None:
+            return err, None
+        return None, names[0]
+
+    # Attaches each of a list of dicts with container, pid, bridge, interface,
+    # ip_addr and gateway. The veth pairs are made together and every port
+    # is added in one OVSDB transaction. Returns the host side port names.
+    def attach_many(self, attachments):
+        if len(attachments) == 0:
+            return None, []
+
+        names = []
+        for attachment in attachments:
+            if not self.ovsdb.bridge_exists(attachment['bridge']):
+                return "Switch {} does not exist".format(attachment['bridge']), None
+            # Interface names are limited to 15 characters
+            names.append("{}_l".format(uuid.uuid4().hex[:13]))
+
+        err, _ = self.netlink.create_veths([(names[i], attachment['interface'], attachment['pid']) for i, attachment in enumerate(attachments)])
+        if err is not None:
+            return err, None
+
+        transaction = self.ovsdb.transaction()
+        for i, attachment in enumerate(attachments):
+            err, _ = self.netlink.configure(attachment['pid'], attachment['interface'], attachment['ip_addr'], attachment['gateway'])
+            if err is None and not transaction.add_port(attachment['bridge'], names[i], external_ids={
+                        "container_id": attachment['container'],
+                        "container_iface": attachment['interface']
+                    }):
+                err = "Switch {} does not exist".format(attachment['bridge'])
+            if err is not None:
+                self.netlink.delete_links(names)
+                return err, None
+
+        err, _ = transaction.commit()
+        if err is not None:
+            self.netlink.delete_links(names)
+            return err, None
+        return None, names
+
+    # Names of the ports on bridge for container, from the OVSDB cache
+    def ports(self, container, bridge):
+        bridge_row = self.ovsdb.find("Bridge", bridge)
+        if bridge_row is None:
+            return []
+        on_bridge = set(as_list(bridge_row['ports']))
+        ports = self.ovsdb.rows("Port")
+        interfaces = self.ovsdb.rows("Interface")
+        names = []
+        for port_id in on_bridge:
+            port = ports.get(port_id)
+            if port is None:
+                continue
+            for interface_id in as_list(port['interfaces']):
+                interface = interfaces.get(interface_id)
+                if interface is not None and isinstance(interface['external_ids'], dict) and interface['external_ids'].get("container_id") == container:
+                    names.append(port['name'])
+                    break
+        return sorted(names)
+
+    # Removes every port on bridge for container in one transaction, along
+    # with their veth pairs
+    def detach(self, container, bridge):
+        names = self.ports(container, bridge)
+        transaction = self.ovsdb.transaction()
+        for name in names:
+            transaction.del_port(bridge, name)
+        err, _ = transaction.commit()
+        if err is not None:
+            return err, None
+        err, _ = self.netlink.delete_links(names)
+        if err is not None:
+            return err, None
+        return None, len(names)
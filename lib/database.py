@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import sqlite3
+import threading
+
+# Stands in for a sqlite3 connection, giving each thread its own connection to
+# the database. Module calls run in parallel and a connection only has one
+# transaction, so with a shared connection one module's commit() would also
+# commit another module's half-done writes.
+class ThreadLocalConnection():
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        # How long to wait for another thread's write to finish
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # thread ident -> (thread, connection)
+        self._connections = {}
+
+    def _connection(self):
+        thread = threading.current_thread()
+        with self._lock:
+            entry = self._connections.get(thread.ident)
+            if entry is not None and entry[0] is thread:
+                return entry[1]
+
+            # Threads that have finished don't need theirs anymore
+            for ident in [ident for ident in self._connections if not self._connections[ident][0].is_alive()]:
+                self._connections.pop(ident)[1].close()
+
+            connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self._connections[thread.ident] = (thread, connection)
+            return connection
+
+    def cursor(self):
+        return self._connection().cursor()
+
+    def execute(self, *args):
+        return self._connection().execute(*args)
+
+    def commit(self):
+        self._connection().commit()
+
+    def rollback(self):
+        self._connection().rollback()
+
+    @property
+    def in_transaction(self):
+        return self._connection().in_transaction
+
+    def close(self):
+        with self._lock:
+            connections = self._connections
+            self._connections = {}
+        for _, connection in connections.values():
+            connection.close()
+
+# Generations let a module cache what it reads from its tables and tell, with
+# one query, whether any connection has written to them since. Every write
+# bumps the generation in the same transaction, so the value is the same
+# whichever connection reads it.
+def ensure_generation(db, name):
+    dbc = db.cursor()
+    dbc.execute("CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, generation INTEGER);")
+    dbc.execute("INSERT OR IGNORE INTO generations (name, generation) VALUES (?, 0);", (name,))
+    db.commit()
+
+def get_generation(db, name):
+    dbc = db.cursor()
+    dbc.execute("SELECT generation FROM generations WHERE name=?;", (name,))
+    return dbc.fetchone()[0]
+
+# Call after writing, before committing. Returns the new generation. Writes from
+# other connections can't come between the bump and the commit.
+def bump_generation(db, name):
+    dbc = db.cursor()
+    dbc.execute("UPDATE generations SET generation = generation + 1 WHERE name=?;", (name,))
+    return get_generation(db, name)
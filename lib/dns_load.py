@@ -0,0 +1,112 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+import random
+import asyncio
+
+import dns.message
+import dns.rcode
+import dns.exception
+
+# Sends queries with an outstanding query per worker, each worker with its
+# own socket, until count queries are sent or duration seconds pass.
+# queries is a list of (name, type) picked from at random. Returns a report of
+# the queries per second, latency percentiles in milliseconds and how many
+# got each RCODE.
+def run_load(address, queries, count=None, duration=None, concurrency=16, timeout=2.0):
+    if count is None and duration is None:
+        count = 1000
+    return asyncio.run(_run_load(tuple(address), queries, count, duration, concurrency, timeout))
+
+async def _run_load(address, queries, count, duration, concurrency, timeout):
+    loop = asyncio.get_event_loop()
+    latencies = []
+    rcodes = {}
+    state = {"sent": 0, "timeouts": 0}
+
+    start = time.perf_counter()
+    deadline = None if duration is None else start + duration
+
+    def more():
+        if count is not None and state["sent"] >= count:
+            return False
+        if deadline is not None and time.perf_counter() >= deadline:
+            return False
+        state["sent"] += 1
+        return True
+
+    async def worker():
+        receiver = _Receiver()
+        transport, _ = await loop.create_datagram_endpoint(lambda: receiver, remote_addr=address)
+        try:
+            while more():
+                name, rdtype = random.choice(queries)
+                query = dns.message.make_query(name, rdtype)
+                receiver.expect(query.id, loop.create_future())
+                sent = time.perf_counter()
+                transport.sendto(query.to_wire())
+                try:
+                    response = await asyncio.wait_for(receiver.future, timeout)
+                except asyncio.TimeoutError:
+                    state["timeouts"] += 1
+                    continue
+                latencies.append(time.perf_counter() - sent)
+                rcode = dns.rcode.to_text(response.rcode())
+                rcodes[rcode] = rcodes.get(rcode, 0) + 1
+        finally:
+            transport.close()
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "queries": state["sent"],
+        "answered": len(latencies),
+        "timeouts": state["timeouts"],
+        "rcodes": rcodes,
+        "seconds": elapsed,
+        "qps": len(latencies) / elapsed if elapsed > 0 else 0,
+        "latency_ms": {
+            "p50": _percentile(latencies, 50) * 1000,
+            "p90": _percentile(latencies, 90) * 1000,
+            "p99": _percentile(latencies, 99) * 1000,
+            "max": (latencies[-1] if len(latencies) > 0 else 0) * 1000
+        }
+    }
+
+def _percentile(values, percent):
+    if len(values) == 0:
+        return 0
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+class _Receiver(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.query_id = None
+        self.future = None
+
+    def expect(self, query_id, future):
+        self.query_id = query_id
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        try:
+            message = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return
+        # Late answers to queries that timed out are dropped
+        if message.id == self.query_id and not self.future.done():
+            self.future.set_result(message)
+
+def format_report(report):
+    lines = [
+        "Queries: {} sent, {} answered, {} timed out in {:.2f}s".format(report['queries'], report['answered'], report['timeouts'], report['seconds']),
+        "Rate: {:.0f} queries/s".format(report['qps']),
+        "Latency: p50 {p50:.2f}ms, p90 {p90:.2f}ms, p99 {p99:.2f}ms, max {max:.2f}ms".format(**report['latency_ms']),
+        "RCODEs: " + ", ".join(["{} {}".format(rcode, total) for rcode, total in sorted(report['rcodes'].items())])
+    ]
+    return "\n".join(lines)
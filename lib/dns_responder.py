@@ -0,0 +1,473 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import re
+import random
+import asyncio
+import threading
+
+import dns.name
+import dns.zone
+import dns.flags
+import dns.rcode
+import dns.opcode
+import dns.rrset
+import dns.message
+import dns.rdatatype
+import dns.rdataclass
+import dns.exception
+
+from lib.domain_index import DomainIndex
+
+OVERRIDE_ZONE = "fn.rpz"
+# Most CNAMEs followed for one answer
+MAX_CNAME_CHAIN = 8
+UDP_MAX_SIZE = 512
+# Most answers kept for repeated queries, per load of the zone data
+MAX_CACHED_ANSWERS = 10000
+
+FORWARDER_PATTERN = re.compile(r'([0-9]+\.[0-9]+\.[0-9]+\.[0-9]+)\s*;')
+
+# The zone data of one DNS server, read from the config directory the dns
+# module writes for it: zone files in zones/, forwarding zones from
+# conf/forward-*.conf, global forwarders from conf/forwarders.conf and
+# overrides from the zones/fn.rpz response policy zone.
+class ServerData():
+
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+        # zone name text -> dns.zone.Zone
+        self.zones = {}
+        # zone name text -> list of forwarder IPs
+        self.forwarding = {}
+        self.forwarders = []
+        self.overrides = None
+        self.index = DomainIndex()
+        self.errors = []
+        # (query wire without its ID, TCP) -> answer wire without its ID
+        self.answers = {}
+        self.load()
+
+    def load(self):
+        zones_dir = os.path.join(self.config_dir, "zones")
+        conf_dir = os.path.join(self.config_dir, "conf")
+
+        if os.path.isdir(zones_dir):
+            for filename in sorted(os.listdir(zones_dir)):
+                zone, _, direction = filename.rpartition(".")
+                path = os.path.join(zones_dir, filename)
+                try:
+                    if direction == "fwd" or direction == "rev":
+                        self.zones[zone] = dns.zone.from_file(path, origin=zone, relativize=False)
+                        self.index.add(zone, "zone", 0)
+                    elif filename == OVERRIDE_ZONE:
+                        self.overrides = dns.zone.from_file(path, origin=OVERRIDE_ZONE, relativize=False)
+                except (dns.exception.DNSException, OSError) as e:
+                    # BIND also skips zones it can't load
+                    self.errors.append("{}: {}".format(filename, e))
+
+        if os.path.isdir(conf_dir):
+            for filename in sorted(os.listdir(conf_dir)):
+                path = os.path.join(conf_dir, filename)
+                if filename.startswith("forward-") and filename.endswith(".conf"):
+                    zone = filename[len("forward-"):-len(".conf")]
+                    self.forwarding[zone] = _read_forwarders(path)
+                    self.index.add(zone, "forward", 0)
+                elif filename == "forwarders.conf":
+                    self.forwarders = _read_forwarders(path)
+
+def _read_forwarders(path):
+    config_file = open(path, "r")
+    contents = config_file.read()
+    config_file.close()
+    return FORWARDER_PATTERN.findall(contents)
+
+def _depth(name):
+    if name is None:
+        return -1
+    return len(name.strip(".").split(".")) if name.strip(".") != "" else 0
+
+# Answers DNS queries over UDP and TCP from the zone data of one server, the
+# way the BIND server the dns module configures would. Names in local zones
+# are answered authoritatively, delegations and forwarding zones are followed
+# by forwarding the query, and overrides rewrite answers to recursive
+# queries. upstreams maps server IPs, such as forwarders or delegated name
+# servers, to the (host, port) answering for them, so a whole lab can run on
+# local ports. Other IPs are only contacted if allow_network is set.
+class DNSResponder():
+
+    def __init__(self, config_dir, host="127.0.0.1", port=0, upstreams=None, allow_network=False, timeout=2.0):
+        self.config_dir = config_dir
+        self.host = host
+        self.port = port
+        self.upstreams = upstreams if upstreams is not None else {}
+        self.allow_network = allow_network
+        self.timeout = timeout
+
+        self.data = ServerData(config_dir)
+        self.queries = 0
+
+        self._loop = None
+        self._thread = None
+        self._udp = None
+        self._tcp = None
+
+    def reload(self):
+        # Swapped in whole, so queries being answered see old or new data
+        self.data = ServerData(self.config_dir)
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    # Serves queries from a thread with its own event loop
+    def start(self):
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(self._listen())
+            except OSError as e:
+                errors.append(e)
+                started.set()
+                self._loop.close()
+                return
+            started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        if len(errors) > 0:
+            self._thread.join()
+            self._thread = None
+            raise errors[0]
+
+    async def _listen(self):
+        loop = asyncio.get_event_loop()
+        # With port 0, TCP may find the port UDP was given taken
+        for _ in range(10):
+            self._udp, _ = await loop.create_datagram_endpoint(lambda: _UDPProtocol(self), local_addr=(self.host, self.port))
+            port = self._udp.get_extra_info("sockname")[1]
+            try:
+                self._tcp = await asyncio.start_server(self._handle_tcp, self.host, port)
+            except OSError:
+                self._udp.close()
+                if self.port != 0:
+                    raise
+                continue
+            self.port = port
+            return
+        raise OSError("Could not find a free port for UDP and TCP")
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        async def close():
+            self._udp.close()
+            self._tcp.close()
+            await self._tcp.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    async def _handle_tcp(self, reader, writer):
+        try:
+            while True:
+                length = await reader.readexactly(2)
+                wire = await reader.readexactly(int.from_bytes(length, "big"))
+                response = await self.handle_wire(wire, tcp=True)
+                if response is None:
+                    break
+                writer.write(len(response).to_bytes(2, "big") + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # Returns the wire format answer to a wire format query, or None to drop it
+    async def handle_wire(self, wire, tcp=False):
+        self.queries += 1
+        # Answers from local data only change when it is reloaded, so repeated
+        # queries skip parsing and resolving
+        data = self.data
+        key = (wire[2:], tcp)
+        cached = data.answers.get(key)
+        if cached is not None:
+            return wire[:2] + cached
+
+        try:
+            query = dns.message.from_wire(wire)
+        except dns.exception.DNSException:
+            return None
+        if query.flags & dns.flags.QR:
+            return None
+
+        response = await self.resolve(query)
+
+        max_size = 65535
+        if not tcp:
+            max_size = max(UDP_MAX_SIZE, query.payload) if query.edns >= 0 else UDP_MAX_SIZE
+        try:
+            answer = response.to_wire(max_size=max_size)
+        except dns.exception.TooBig:
+            # Have the client ask again over TCP
+            truncated = dns.message.make_response(query)
+            truncated.flags |= dns.flags.TC
+            answer = truncated.to_wire()
+
+        if not getattr(response, "forwarded", False):
+            if len(data.answers) >= MAX_CACHED_ANSWERS:
+                data.answers.clear()
+            data.answers[key] = answer[2:]
+        return answer
+
+    async def resolve(self, query):
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.RA
+        if query.opcode() != dns.opcode.QUERY or len(query.question) != 1:
+            response.set_rcode(dns.rcode.NOTIMP)
+            return response
+
+        question = query.question[0]
+        recursive = bool(query.flags & dns.flags.RD)
+        await self._answer(response, question.name, question.rdtype, recursive, 0)
+        return response
+
+    async def _answer(self, response, qname, rdtype, recursive, depth):
+        data = self.data
+        if depth > MAX_CNAME_CHAIN:
+            response.set_rcode(dns.rcode.SERVFAIL)
+            return
+
+        # BIND only applies response policy to recursive queries
+        if recursive and data.overrides is not None:
+            rrset = self._override(data, qname, rdtype)
+            if rrset is not None:
+                if len(rrset) > 0:
+                    response.answer.append(rrset)
+                return
+
+        name_text = qname.to_text()
+        _, zone = data.index.find(name_text, "zone")
+        _, forward_zone = data.index.find(name_text, "forward")
+
+        if forward_zone is not None and _depth(forward_zone) > _depth(zone):
+            if recursive:
+                await self._forward(response, qname, rdtype, data.forwarding[forward_zone])
+            else:
+                response.set_rcode(dns.rcode.REFUSED)
+            return
+
+        if zone is None:
+            if recursive and len(data.forwarders) > 0:
+                await self._forward(response, qname, rdtype, data.forwarders)
+            elif recursive:
+                response.set_rcode(dns.rcode.SERVFAIL)
+            else:
+                response.set_rcode(dns.rcode.REFUSED)
+            return
+
+        await self._answer_zone(response, data.zones[zone], qname, rdtype, recursive, depth)
+
+    # Returns the override rrset for qname, an empty rrset if only other types
+    # are overridden, or None if qname isn't overridden
+    def _override(self, data, qname, rdtype):
+        origin = data.overrides.origin
+        candidates = [qname]
+        # *.example.com overrides everything under example.com
+        for i in range(1, len(qname.labels) - 1):
+            candidates.append(dns.name.Name(("*",) + qname.labels[i:]))
+
+        for candidate in candidates:
+            try:
+                trigger = candidate.relativize(dns.name.root).concatenate(origin)
+            except dns.name.NameTooLong:
+                continue
+            node = data.overrides.get_node(trigger)
+            if node is None or len(node.rdatasets) == 0:
+                continue
+            rrset = dns.rrset.RRset(qname, dns.rdataclass.IN, rdtype)
+            rdataset = node.get_rdataset(dns.rdataclass.IN, rdtype)
+            if rdataset is not None:
+                rrset.update(rdataset)
+            return rrset
+        return None
+
+    async def _answer_zone(self, response, zone, qname, rdtype, recursive, depth):
+        # Names below a delegation belong to the delegated server
+        for i in range(len(zone.origin.labels) + 1, len(qname.labels) + 1):
+            cut = dns.name.Name(qname.labels[-i:])
+            ns_rrset = zone.get_rrset(cut, dns.rdatatype.NS)
+            if ns_rrset is None or (cut == qname and rdtype == dns.rdatatype.NS and not recursive):
+                continue
+
+            glue = []
+            for ns in ns_rrset:
+                a_rrset = zone.get_rrset(ns.target, dns.rdatatype.A)
+                if a_rrset is not None:
+                    glue.append(a_rrset)
+
+            if recursive:
+                await self._forward(response, qname, rdtype, [item.to_text() for rrset in glue for item in rrset])
+            else:
+                response.authority.append(ns_rrset)
+                response.additional += glue
+            return
+
+        response.flags |= dns.flags.AA
+        node = zone.get_node(qname)
+        if node is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(zone.get_rrset(zone.origin, dns.rdatatype.SOA))
+            return
+
+        rrset = zone.get_rrset(qname, rdtype)
+        if rrset is not None:
+            response.answer.append(rrset)
+            return
+
+        cname = zone.get_rrset(qname, dns.rdatatype.CNAME)
+        if cname is not None:
+            response.answer.append(cname)
+            await self._answer(response, cname[0].target, rdtype, recursive, depth + 1)
+            return
+
+        response.authority.append(zone.get_rrset(zone.origin, dns.rdatatype.SOA))
+
+    # Forwards the question to the first server that answers, and copies its
+    # answer into response
+    async def _forward(self, response, qname, rdtype, servers):
+        # Other servers' answers can change without a reload here
+        response.forwarded = True
+        query = dns.message.make_query(qname, rdtype)
+        for server in servers:
+            address = self.upstreams.get(server)
+            if address is None:
+                if not self.allow_network:
+                    continue
+                address = (server, 53)
+
+            answer = await udp_query(query, address, self.timeout)
+            if answer is None:
+                continue
+            response.set_rcode(answer.rcode())
+            response.answer += answer.answer
+            if len(answer.answer) == 0:
+                response.authority += answer.authority
+            return
+
+        response.set_rcode(dns.rcode.SERVFAIL)
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, responder):
+        self.responder = responder
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self._respond(data, addr))
+
+    async def _respond(self, data, addr):
+        response = await self.responder.handle_wire(data)
+        if response is not None and not self.transport.is_closing():
+            self.transport.sendto(response, addr)
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, query_id, future):
+        self.query_id = query_id
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        try:
+            message = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return
+        if message.id == self.query_id and not self.future.done():
+            self.future.set_result(message)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_result(None)
+
+# Sends a query over UDP from the running event loop. Returns the answer, or
+# None if there was none within timeout seconds.
+async def udp_query(query, address, timeout):
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    query.id = random.randint(0, 65535)
+    transport, _ = await loop.create_datagram_endpoint(lambda: _ClientProtocol(query.id, future), remote_addr=address)
+    try:
+        transport.sendto(query.to_wire())
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        transport.close()
+
+# Runs a responder for each server of a lab, each on its own local port, with
+# the server IPs mapped to them so forwarding and delegation between servers
+# works without containers or a network. servers maps server IDs to their IP
+# addresses. Each server's config is read from base_dir/<server ID>.
+class DNSLab():
+
+    def __init__(self, base_dir, servers, host="127.0.0.1", allow_network=False):
+        self.base_dir = base_dir
+        self.host = host
+        self.allow_network = allow_network
+        # Shared by every responder, so servers added later are reachable
+        self.upstreams = {}
+        # server ID -> (server IP, DNSResponder)
+        self.responders = {}
+        self._servers = dict(servers)
+
+    def start(self):
+        for server_id, server_ip in self._servers.items():
+            self.add_server(server_id, server_ip)
+
+    def add_server(self, server_id, server_ip):
+        server_id = str(server_id)
+        self.remove_server(server_id)
+        responder = DNSResponder(os.path.join(self.base_dir, server_id), host=self.host, upstreams=self.upstreams, allow_network=self.allow_network)
+        responder.start()
+        self.responders[server_id] = (server_ip, responder)
+        self.upstreams[server_ip] = responder.address
+
+    def remove_server(self, server_id):
+        server_id = str(server_id)
+        if server_id not in self.responders:
+            return
+        server_ip, responder = self.responders.pop(server_id)
+        responder.stop()
+        if self.upstreams.get(server_ip) == responder.address:
+            del self.upstreams[server_ip]
+
+    def reload(self, server_id):
+        entry = self.responders.get(str(server_id))
+        if entry is not None:
+            entry[1].reload()
+
+    # Returns {server ID: (host, port)}
+    def addresses(self):
+        addresses = {}
+        for server_id, entry in self.responders.items():
+            addresses[server_id] = entry[1].address
+        return addresses
+
+    def stop(self):
+        for server_id in list(self.responders.keys()):
+            self.remove_server(server_id)
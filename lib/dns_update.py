@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import re
+import base64
+import secrets
+
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.tsig
+import dns.tsigkeyring
+import dns.update
+import dns.exception
+
+UPDATE_KEY_NAME = "fn-update"
+UPDATE_KEY_ALGORITHM = "hmac-sha256"
+
+# Large imports are split so each message stays well under the 64KB limit
+MAX_CHANGES_PER_MESSAGE = 1000
+
+DEFAULT_TTL = 604800
+
+KEY_TEMPLATE = """key "{name}" {{
+    algorithm {algorithm};
+    secret "{secret}";
+}};
+"""
+
+def make_update_key():
+    return base64.b64encode(secrets.token_bytes(32)).decode("ascii")
+
+def update_key_config(secret):
+    return KEY_TEMPLATE.format(name=UPDATE_KEY_NAME, algorithm=UPDATE_KEY_ALGORITHM, secret=secret)
+
+# Returns the secret from a key file written with update_key_config
+def parse_update_key(text):
+    match = re.search(r'secret\s+"([^"]+)"', text)
+    if match is None:
+        return None
+    return match.group(1)
+
+# Returns a record value as zone file text, e.g. an MX (preference, exchange)
+# tuple or unquoted TXT
+def rdata_text(record_type, value):
+    if isinstance(value, (tuple, list)):
+        return " ".join([str(item) for item in value])
+    if record_type == "TXT" and not value.startswith('"'):
+        return '"{}"'.format(value.replace('"', '\\"'))
+    return value
+
+# Sends record changes for one zone as TSIG-signed DNS UPDATE messages.
+# changes is a list of (action, name, type, value), where action is "add" or
+# "delete" and names without a trailing dot are relative to the zone. Returns
+# the number of messages sent.
+def send_update(server_ip, zone, changes, secret, port=53, timeout=5):
+    origin = dns.name.from_text(zone)
+    keyring = dns.tsigkeyring.from_text({UPDATE_KEY_NAME: secret})
+
+    try:
+        messages = []
+        for start in range(0, len(changes), MAX_CHANGES_PER_MESSAGE):
+            update = dns.update.UpdateMessage(origin, keyring=keyring, keyname=UPDATE_KEY_NAME, keyalgorithm=dns.tsig.HMAC_SHA256)
+            for action, name, record_type, value in changes[start:start + MAX_CHANGES_PER_MESSAGE]:
+                name = dns.name.from_text(name, origin)
+                rdata = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.from_text(record_type), rdata_text(record_type, value), origin=origin)
+                if action == "add":
+                    update.add(name, DEFAULT_TTL, rdata)
+                else:
+                    update.delete(name, rdata)
+            messages.append(update)
+    except (dns.exception.DNSException, ValueError) as e:
+        return "Invalid record: {}".format(e), None
+
+    for update in messages:
+        try:
+            response = dns.query.tcp(update, server_ip, port=port, timeout=timeout)
+        except (dns.exception.DNSException, OSError) as e:
+            return "Update for {} failed: {}".format(zone, e), None
+        if response.rcode() != dns.rcode.NOERROR:
+            return "Update for {} refused: {}".format(zone, dns.rcode.to_text(response.rcode())), None
+
+    return None, len(messages)
@@ -0,0 +1,127 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+def domain_labels(domain):
+    domain = domain.strip().lower().rstrip(".")
+    if domain == "":
+        return []
+    labels = domain.split(".")
+    labels.reverse()
+    return labels
+
+class DomainNode():
+
+    def __init__(self):
+        self.children = {}
+        # kind -> {owner: name}
+        self.entries = {}
+
+# A trie of domain names keyed by their labels in reverse, so "www.test" is
+# stored under "test" then "www". Entries are added under a kind (such as
+# "server" or "fwd") for an owner (such as a server ID), and finding the
+# entry nearest to a name costs one step per label, however many domains
+# are indexed. Names are matched without case or a trailing dot.
+class DomainIndex():
+
+    def __init__(self):
+        self._root = DomainNode()
+        # owner -> set of (labels, kind), to remove everything for an owner
+        self._owned = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    # name is returned by lookups and defaults to domain as given
+    def add(self, domain, kind, owner, name=None):
+        if name is None:
+            name = domain
+        owner = str(owner)
+        labels = domain_labels(domain)
+
+        node = self._root
+        for label in labels:
+            if label not in node.children:
+                node.children[label] = DomainNode()
+            node = node.children[label]
+
+        owners = node.entries.setdefault(kind, {})
+        if owner not in owners:
+            self._count += 1
+        owners[owner] = name
+        self._owned.setdefault(owner, set()).add((tuple(labels), kind))
+
+    def remove(self, domain, kind, owner):
+        self._remove(domain_labels(domain), kind, str(owner))
+
+    def _remove(self, labels, kind, owner):
+        path = [self._root]
+        for label in labels:
+            node = path[-1].children.get(label)
+            if node is None:
+                return
+            path.append(node)
+
+        owners = path[-1].entries.get(kind)
+        if owners is None or owner not in owners:
+            return
+        del owners[owner]
+        self._count -= 1
+        if len(owners) == 0:
+            del path[-1].entries[kind]
+        if owner in self._owned:
+            self._owned[owner].discard((tuple(labels), kind))
+            if len(self._owned[owner]) == 0:
+                del self._owned[owner]
+
+        # Prune nodes left with nothing in or under them
+        for i in range(len(labels), 0, -1):
+            node = path[i]
+            if len(node.children) > 0 or len(node.entries) > 0:
+                break
+            del path[i - 1].children[labels[i - 1]]
+
+    # Removes every entry added for owner
+    def remove_owner(self, owner):
+        owner = str(owner)
+        for labels, kind in list(self._owned.get(owner, [])):
+            self._remove(list(labels), kind, owner)
+
+    # Returns {owner: name} for entries of kind at exactly domain
+    def get(self, domain, kind):
+        node = self._root
+        for label in domain_labels(domain):
+            node = node.children.get(label)
+            if node is None:
+                return {}
+        return dict(node.entries.get(kind, {}))
+
+    # Finds the entry of kind at fqdn or its nearest ancestor, or only at
+    # ancestors if strict. Returns (owner, name), or (None, None) if there
+    # is no such entry. If several owners have the domain, the lowest wins.
+    def find(self, fqdn, kind, strict=False):
+        labels = domain_labels(fqdn)
+        if strict:
+            if len(labels) == 0:
+                return None, None
+            labels = labels[:-1]
+
+        found = self._root.entries.get(kind)
+        node = self._root
+        for label in labels:
+            node = node.children.get(label)
+            if node is None:
+                break
+            if kind in node.entries:
+                found = node.entries[kind]
+
+        if found is None:
+            return None, None
+        owner = min(found, key=_owner_order)
+        return owner, found[owner]
+
+def _owner_order(owner):
+    if owner.isdigit():
+        return (0, int(owner), owner)
+    return (1, 0, owner)
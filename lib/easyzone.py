@@ -131,6 +131,9 @@ class Records(object):
         self._rdataset = rdataset
     
     def add(self, item):
+        if isinstance(item, dns.rdata.Rdata):
+            self._rdataset.add(item)
+            return
         if self.type == 'MX':
             assert isinstance(item, (tuple, list))
             assert len(item) == 2
@@ -148,7 +151,10 @@ class Records(object):
         self._rdataset.add(rd)
     
     def delete(self, item):
-        rd = _new_rdata(self.type, item)
+        if isinstance(item, dns.rdata.Rdata):
+            rd = item
+        else:
+            rd = _new_rdata(self.type, item)
         try:
             self._rdataset.remove(rd)
         except ValueError:
@@ -270,11 +276,69 @@ class Zone(object):
         return names
     names = property(get_names)
     
+    def _absolute_name(self, name):
+        '''Names without a trailing dot are relative to the zone, the
+        same as they would be after saving and reloading the zone file.
+        '''
+        if isinstance(name, str):
+            name = dns.name.from_text(name, self._zone.origin)
+        return name
+    
+    def get_name(self, name):
+        '''Return the Name object for a single name, or None if it is
+        not in the zone. Unlike `names`, this doesn't build every name.
+        '''
+        if not self._zone:
+            return None
+        
+        name = self._absolute_name(name)
+        node = self._zone.get_node(name)
+        if node is None:
+            return None
+        
+        default_ttl = self._zone.get_rdataset(self.domain, dns.rdatatype.SOA)[0].minimum
+        return Name(str(name), node, default_ttl)
+    
+    def has_name(self, name):
+        return self._zone.get_node(self._absolute_name(name)) is not None
+    
+    def get_size(self):
+        '''Return the number of names in the zone.'''
+        if not self._zone:
+            return 0
+        return len(self._zone.nodes)
+    size = property(get_size)
+    
+    def iter_records(self):
+        '''Yield (name, type, ttl, value) for every record in the zone
+        except the SOA, with absolute names and values as zone file text.
+        '''
+        if not self._zone:
+            return
+        for name, node in self._zone.nodes.items():
+            name = name.derelativize(self._zone.origin).to_text()
+            for rdataset in node.rdatasets:
+                if rdataset.rdtype == dns.rdatatype.SOA:
+                    continue
+                for rdata in rdataset:
+                    yield name, dns.rdatatype.to_text(rdataset.rdtype), rdataset.ttl, rdata.to_text(origin=None, relativize=False)
+    
+    def clear_records(self):
+        '''Remove every record from the zone except the SOA.
+        '''
+        origin = self._zone.origin
+        for name in list(self._zone.nodes.keys()):
+            if name.derelativize(origin) == origin:
+                node = self._zone.nodes[name]
+                node.rdatasets = [r for r in node.rdatasets if r.rdtype == dns.rdatatype.SOA]
+            else:
+                del self._zone.nodes[name]
+    
     def add_name(self, name):
         '''Add a new name (hostname) to the zone.
         If a node with the same name already exists it is returned instead.
         '''
-        node = self._zone.get_node(name, create=True)
+        node = self._zone.get_node(self._absolute_name(name), create=True)
         if node is None:
             raise ZoneError("Could not create node named: %s" %name)
     
@@ -282,17 +346,12 @@ class Zone(object):
         '''Remove all nodes associated with a name (hostname) from the zone.
         If no such nodes exist, nothing happens.
         '''
-        self._zone.delete_node(name)
+        self._zone.delete_node(self._absolute_name(name))
     
-    def save(self, filename=None, autoserial=False):
-        '''Write the zone back to a file.
-        
-        If `filename` is not specified the zone will be written
-        over the top of the file it was read from.
+    def to_text(self, autoserial=False):
+        '''Return the zone as zone file text.
         
-        if `autoserial`is True then the serial will be updated to the
-        current date in common YYYYMMDDxx format.  The serial is
-        guaranteed to be larger than the previous number.
+        if `autoserial`is True then the serial is incremented first.
         '''
         if autoserial:
             
@@ -306,11 +365,21 @@ class Zone(object):
             # self._zone.delete_rdataset("@", 'SOA')
             self._zone.replace_rdataset(self.domain, new_set)
 
-
+        return self._zone.to_text(relativize=False)
+    
+    def save(self, filename=None, autoserial=False):
+        '''Write the zone back to a file.
+        
+        If `filename` is not specified the zone will be written
+        over the top of the file it was read from.
         
+        if `autoserial`is True then the serial will be updated to the
+        current date in common YYYYMMDDxx format.  The serial is
+        guaranteed to be larger than the previous number.
+        '''
         if not filename:
             filename = self.filename
-        outtext = self._zone.to_text(relativize=False)
+        outtext = self.to_text(autoserial=autoserial)
 
         os.remove(filename)
         outfile = open(filename, "w+")
@@ -0,0 +1,111 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import ipaddress
+
+# The lowest clear bit of each byte value, or 8 for a full byte
+FIRST_FREE = [((~byte & (byte + 1)).bit_length() - 1) if byte != 0xFF else 8 for byte in range(256)]
+
+# One bit per address of a network, set when the address is taken. Above the
+# address bits are summary levels with a bit set for each full byte in the
+# level below, up to a single byte. Finding a free address reads one byte
+# per level, so it costs the same whether the network is empty or packed.
+class AddressBitmap():
+
+    def __init__(self, network, data=None):
+        self.network = ipaddress.ip_network(network)
+        self.size = self.network.num_addresses
+        self._base = int(self.network.network_address)
+
+        byte_count = (self.size + 7) // 8
+        if data is not None and len(data) == byte_count:
+            bits = bytearray(data)
+        else:
+            bits = bytearray(byte_count)
+        # Bits past the end of the network are never free
+        for index in range(self.size, byte_count * 8):
+            bits[index >> 3] |= 1 << (index & 7)
+
+        self.used = sum([bin(byte).count("1") for byte in bits]) - (byte_count * 8 - self.size)
+        self._levels = [bits]
+        level = bits
+        while len(level) > 1:
+            upper = bytearray((len(level) + 7) // 8)
+            for index, byte in enumerate(level):
+                if byte == 0xFF:
+                    upper[index >> 3] |= 1 << (index & 7)
+            for index in range(len(level), len(upper) * 8):
+                upper[index >> 3] |= 1 << (index & 7)
+            self._levels.append(upper)
+            level = upper
+
+    def free(self):
+        return self.size - self.used
+
+    def data(self):
+        return bytes(self._levels[0])
+
+    def _index(self, ip):
+        index = int(ipaddress.ip_address(ip)) - self._base
+        if index < 0 or index >= self.size:
+            return None
+        return index
+
+    def is_reserved(self, ip):
+        index = self._index(ip)
+        if index is None:
+            return False
+        return (self._levels[0][index >> 3] >> (index & 7)) & 1 == 1
+
+    def _set(self, index):
+        for level in self._levels:
+            byte = index >> 3
+            level[byte] |= 1 << (index & 7)
+            if level[byte] != 0xFF:
+                break
+            index = byte
+
+    def _clear(self, index):
+        for level in self._levels:
+            byte = index >> 3
+            was_full = level[byte] == 0xFF
+            level[byte] &= ~(1 << (index & 7))
+            if not was_full:
+                break
+            index = byte
+
+    # Returns False if the address is outside the network or already taken
+    def reserve(self, ip):
+        index = self._index(ip)
+        if index is None or (self._levels[0][index >> 3] >> (index & 7)) & 1 == 1:
+            return False
+        self._set(index)
+        self.used += 1
+        return True
+
+    def release(self, ip):
+        index = self._index(ip)
+        if index is None or (self._levels[0][index >> 3] >> (index & 7)) & 1 == 0:
+            return False
+        self._clear(index)
+        self.used -= 1
+        return True
+
+    # Takes the lowest free address, or returns None if the network is full
+    def allocate(self):
+        top = self._levels[-1][0]
+        if top == 0xFF:
+            return None
+        index = FIRST_FREE[top]
+        for level in reversed(self._levels[:-1]):
+            index = (index << 3) + FIRST_FREE[level[index]]
+        self._set(index)
+        self.used += 1
+        return ipaddress.ip_address(self._base + index)
+
+    # Takes count free addresses, or none of them if there are not enough
+    def allocate_block(self, count):
+        if count > self.free():
+            return None
+        return [self.allocate() for _ in range(count)]
@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_ERROR = "error"
+
+_current = threading.local()
+
+# Adds a progress message to the job running on this thread, if there is one.
+# BaseModule.print calls this, so module output shows up in the job.
+def report_progress(message):
+    job = getattr(_current, "job", None)
+    if job is not None:
+        job.add_progress(message)
+
+class Job():
+
+    def __init__(self, module_name, func, args):
+        self.id = uuid.uuid4().hex
+        self.module_name = module_name
+        self.func = func
+        self.args = args
+        self.status = JOB_QUEUED
+        self.error = None
+        self.result = None
+        self.progress = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._changed = threading.Condition()
+
+    def is_finished(self):
+        return self.status in (JOB_DONE, JOB_ERROR)
+
+    def add_progress(self, message):
+        with self._changed:
+            self.progress.append(message)
+            self._changed.notify_all()
+
+    def set_status(self, status, error=None, result=None):
+        with self._changed:
+            self.status = status
+            if status == JOB_RUNNING:
+                self.started = time.time()
+            elif status in (JOB_DONE, JOB_ERROR):
+                self.error = error
+                self.result = result
+                self.finished = time.time()
+            self._changed.notify_all()
+
+    # Blocks until there is progress past 'seen' messages or the job finishes.
+    # Returns the new messages and if the job is finished.
+    def wait_progress(self, seen, timeout=None):
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.progress) > seen or self.is_finished(), timeout=timeout)
+            return self.progress[seen:], self.is_finished()
+
+    def to_dict(self):
+        with self._changed:
+            return {
+                "id": self.id,
+                "module": self.module_name,
+                "func": self.func,
+                "status": self.status,
+                "progress": list(self.progress),
+                "error": self.error,
+                "output": self.result,
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished
+            }
+
+# Runs module functions in a bounded pool of worker threads and keeps their
+# status and results for polling. Only the last max_finished finished jobs
+# are kept.
+class JobManager():
+
+    def __init__(self, mm, workers=4, max_finished=1000):
+        self.mm = mm
+        self.max_finished = max_finished
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fakernet-job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+
+    def submit(self, module_name, func, args):
+        if module_name not in self.mm.modules:
+            return "Invalid module '{}'".format(module_name), None
+
+        job = Job(module_name, func, args)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._pool.submit(self._run_job, job)
+        self.mm.logger.info("Queued job %s: %s.%s", job.id, module_name, func)
+        return None, job.id
+
+    def get(self, job_id):
+        with self._lock:
+            if job_id not in self._jobs:
+                return "Job '{}' not found".format(job_id), None
+            return None, self._jobs[job_id]
+
+    def list(self):
+        with self._lock:
+            return None, [job.to_dict() for job in self._jobs.values()]
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def _prune(self):
+        finished = [job_id for job_id in self._jobs if self._jobs[job_id].is_finished()]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _run_job(self, job):
+        job.set_status(JOB_RUNNING)
+        _current.job = job
+        try:
+            error, result = self.mm.modules[job.module_name].run(job.func, **job.args)
+        except Exception as e:
+            error, result = "Job raised an exception: {}".format(e), None
+        finally:
+            _current.job = None
+
+        if error is not None:
+            job.set_status(JOB_ERROR, error=error)
+        else:
+            job.set_status(JOB_DONE, result=result)
+        self.mm.logger.info("Finished job %s: %s", job.id, job.status)
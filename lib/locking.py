@@ -0,0 +1,128 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import threading
+from contextlib import contextmanager
+
+# Lock ordering for modules that other modules call into. While holding a
+# module's lock, a thread may only take the lock of a module with a strictly
+# lower level (or the same module again). Service modules call ipreserve, dns,
+# netreserve and minica, ipreserve calls netreserve, and so on, so following
+# this order means there can't be a cycle between two threads.
+LOCK_LEVELS = {
+    "netreserve": 0,
+    "ipreserve": 1,
+    "dns": 2,
+    "minica": 3
+}
+DEFAULT_LOCK_LEVEL = 10
+
+# Function arguments that name a resource, and the namespace for its key.
+# IPs and names are shared between modules, so two modules can't work on the
+# same IP or hostname at the same time. Server IDs are per module.
+RESOURCE_ARGS = {
+    "ip_addr": "ip",
+    "front_ip": "ip",
+    "net_addr": "net",
+    "fqdn": "name",
+    "zone": "name",
+    "domain": "name",
+    "mail_domain": "name",
+    "id": None
+}
+
+def lock_level(shortname):
+    return LOCK_LEVELS.get(shortname, DEFAULT_LOCK_LEVEL)
+
+def resource_keys(shortname, kwargs):
+    keys = set()
+    for arg in RESOURCE_ARGS:
+        if arg not in kwargs:
+            continue
+        value = str(kwargs[arg]).strip().lower().rstrip(".")
+        if value == "":
+            continue
+        namespace = RESOURCE_ARGS[arg]
+        if namespace is None:
+            namespace = shortname
+        keys.add("{}:{}".format(namespace, value))
+    return sorted(keys)
+
+# Hands out the per-module and per-resource locks and tracks, for each thread,
+# which module locks it currently holds.
+class LockManager():
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._module_locks = {}
+        # key -> [lock, number of threads using or waiting on it]
+        self._resource_locks = {}
+        self._local = threading.local()
+
+    def _held(self):
+        if not hasattr(self._local, "held"):
+            self._local.held = []
+        return self._local.held
+
+    # Number of module calls this thread is currently inside of
+    def depth(self):
+        return len(self._held())
+
+    def module_lock(self, shortname):
+        with self._lock:
+            if shortname not in self._module_locks:
+                self._module_locks[shortname] = threading.RLock()
+            return self._module_locks[shortname]
+
+    def check_order(self, shortname):
+        held = self._held()
+        if len(held) == 0 or shortname in held:
+            return None
+
+        level = lock_level(shortname)
+        for held_name in held:
+            if lock_level(held_name) <= level:
+                return "Lock order violation: cannot call '{}' while holding '{}'".format(shortname, held_name)
+        return None
+
+    def _acquire_resource(self, key):
+        with self._lock:
+            if key not in self._resource_locks:
+                self._resource_locks[key] = [threading.Lock(), 0]
+            entry = self._resource_locks[key]
+            entry[1] += 1
+        entry[0].acquire()
+
+    def _release_resource(self, key):
+        with self._lock:
+            entry = self._resource_locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._resource_locks[key]
+
+    # Resource keys are only taken by the outermost call, in sorted order and
+    # before any module lock, so they can't take part in a deadlock. Nested
+    # calls already run on behalf of the resources the outer call holds.
+    @contextmanager
+    def hold(self, shortname, keys=None):
+        held = self._held()
+        if len(held) > 0 or keys is None:
+            keys = []
+
+        taken = []
+        module_lock = self.module_lock(shortname)
+        try:
+            for key in keys:
+                self._acquire_resource(key)
+                taken.append(key)
+            with module_lock:
+                held.append(shortname)
+                try:
+                    yield
+                finally:
+                    held.pop()
+        finally:
+            for key in reversed(taken):
+                self._release_resource(key)
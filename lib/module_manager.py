@@ -8,26 +8,43 @@ import json
 import re
 import logging
 import hashlib
-from threading import RLock
+import time
+from threading import RLock, Lock
+from contextlib import ExitStack
 
 from lib.version import FAKERNET_VERSION
+from lib.status_snapshot import StatusSnapshot
+from lib.container_cache import ContainerStateCache
+from lib.locking import LockManager, resource_keys
+from lib.jobs import JobManager, JOB_DONE, JOB_ERROR
+from lib.util import atomic_write
+from lib.restore_scheduler import RestoreScheduler
+from lib.database import ThreadLocalConnection
+from lib.ovsdb import OVSDBClient
+from lib.container_net import ContainerPlumbing, Netlink
+from lib.priv_helper import PrivilegedClient
 
 PORT = 5050
 PORT_HTTPS = 5051
 SAVES_DIR = "./saves"
+BATCH_SKIPPED = "Skipped due to an earlier error in the batch"
+# Functions starting with these don't change anything a save would record
+READ_ONLY_PREFIXES = ("list", "get", "is_", "show", "verify")
 
 class HistoryWriter():
 
     def __init__(self, path="./history.json"):
         self._outfile = open(path, "a+")
+        self._lock = Lock()
 
     def add_entry(self, module, func, args):
-        self._outfile.write(json.dumps({
-            "module": module,
-            "func": func,
-            "args": args
-        }) + "\n")
-        self._outfile.flush()
+        with self._lock:
+            self._outfile.write(json.dumps({
+                "module": module,
+                "func": func,
+                "args": args
+            }) + "\n")
+            self._outfile.flush()
 
 class LockModule():
 
@@ -37,21 +54,34 @@ class LockModule():
         
     def __getattr__(self, name):
         if name == "check":
-            with self.mm.lock:
+            with self.mm.locks.module_lock(self._module.__SHORTNAME__):
                 return getattr(self._module, name)
         else:
             return getattr(self._module, name)
 
     def run(self, func, **kwargs):
-        with self.mm.lock:
-            self.mm.depth += 1
+        shortname = self._module.__SHORTNAME__
+
+        error = self.mm.locks.check_order(shortname)
+        if error is not None:
+            self.mm.logger.error("%s (%s.%s)", error, shortname, func)
+            return error, None
+
+        outermost = self.mm.locks.depth() == 0
+        with self.mm.locks.hold(shortname, resource_keys(shortname, kwargs)):
             error, result = self._module.run(func, **kwargs)
-            self.mm.depth -= 1
-            if len(kwargs.keys()) > 0 and self.mm.depth == 0:
-                self.mm.history_writer.add_entry(self._module.__SHORTNAME__, func, kwargs)
-            self.mm.logger.info("Called: %s.%s, args=%s", self._module.__SHORTNAME__, func, str(kwargs))
+            if not func.startswith(READ_ONLY_PREFIXES):
+                self.mm.mark_dirty(shortname)
+
+        if len(kwargs.keys()) > 0 and outermost:
+            self.mm.history_writer.add_entry(shortname, func, kwargs)
+        self.mm.logger.info("Called: %s.%s, args=%s", shortname, func, str(kwargs))
 
-            return error, result
+        return error, result
+
+    # Run in the background, returns the job ID
+    def submit(self, func, **kwargs):
+        return self.mm.jobs.submit(self._module.__SHORTNAME__, func, kwargs)
 
 class RemoteModule():
     
@@ -72,42 +102,85 @@ class RemoteModule():
         else:
             return None, resp_data['result']['output']
 
+    # Run in the background on the server, returns the job ID
+    def submit(self, func, **kwargs):
+        resp = self.mm.http_post(self._url + "/" + self.__SHORTNAME__ + "/submit/" + func, kwargs)
+        self.mm.logger.info("Remote submitted: %s.%s, args=%s", self.__SHORTNAME__, func, str(kwargs))
+        resp_data = resp.json()
+        if not resp_data['ok']:
+            return resp_data['error'], None 
+        else:
+            return None, resp_data['result']['job_id']
+
 class ModuleManager():
 
-    def __init__(self, ip=None, db=None, https=False, https_ignore=False, user=None, password=None):
+    def __init__(self, ip=None, db=None, https=False, https_ignore=False, user=None, password=None, docker_client=None, lxd_client=None, job_workers=4, restore_workers=8, pool_size=10, retries=3, retry_backoff=0.5):
 
         self._user = ""
         
         if ip is None:
 
-            import docker
-            from pylxd import Client
-            import sqlite3
-
             self._user = "LOCAL"
+            # Guards the users table. Module calls are covered by self.locks
             self.lock = RLock()
+            self.locks = LockManager()
             self.modules = {}
             if db != None:
                 self.db = db
             else:
-                self.db = sqlite3.connect('fakernet.db') 
+                # Modules run in parallel, so each thread has its own connection
+                self.db = ThreadLocalConnection('fakernet.db')
+
+            if docker_client is not None:
+                self.docker = docker_client
+            else:
+                import docker
+                self.docker = docker.from_env()
 
-            self.docker = docker.from_env()
-            self.lxd = Client()
+            if lxd_client is not None:
+                self.lxd = lxd_client
+            else:
+                from pylxd import Client
+                self.lxd = Client()
+
+            # Started in load()
+            self.container_cache = ContainerStateCache(self.docker)
+            # Connects on first use, modules fall back to ovs-vsctl without it
+            self.ovsdb = OVSDBClient()
+            # Used instead of ovs-docker when it has the privileges it needs
+            self.plumbing = ContainerPlumbing(self.ovsdb, Netlink())
+            # Runs tools as root through the helper, or with sudo without it
+            self.privileged = PrivilegedClient()
             self.ip = None
             self._https = False
             self._port = 0
             self._https_ignore = https_ignore
             self.history_writer = HistoryWriter()
-            
-            self.depth = 0
+            self.jobs = JobManager(self, workers=job_workers)
+
+            # Cached save data for save_state, see _save_fragments
+            self._save_lock = Lock()
+            self._saved = {}
+            self._dirty = set()
+            self._saved_generation = None
+
+            self._restore_workers = restore_workers
+            # Per-server timing from the last restore_state
+            self.last_restore_timings = []
         else:
             import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
             self.lock = None
+            self.locks = None
             self.modules = {}
             self.db = None
             self.docker = None
             self.lxd = None
+            self.container_cache = None
+            self.ovsdb = None
+            self.plumbing = None
+            self.privileged = None
             self.ip = ip
             self._https = https
             if https:
@@ -118,7 +191,19 @@ class ModuleManager():
             self._r = requests
             self._user = user 
             self._password = password
+
+            # One keep-alive session for every request, so repeated calls reuse the
+            # connection and TLS session. Only GETs are safe to retry.
+            self._session = requests.Session()
+            self._session.verify = not https_ignore
+            if user is not None:
+                self._session.auth = (user, password)
+            retry = Retry(total=retries, backoff_factor=retry_backoff, status_forcelist=[502, 503, 504], allowed_methods=frozenset(["GET"]), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
             self.history_writer = None
+            self.jobs = None
 
         
         self._logger = logging.getLogger("fakernet")
@@ -132,6 +217,8 @@ class ModuleManager():
         self.logger = logging.LoggerAdapter(self._logger, {
             "user": self._user
         })
+        if self.container_cache is not None:
+            self.container_cache.logger = self.logger
 
 
     def _get_url(self):
@@ -142,28 +229,19 @@ class ModuleManager():
             return "https://" + start
 
     def http_get(self, url):
-        if self._user is None:
-            return self._r.get(url, verify=not self._https_ignore)
-        else:
-            return self._r.get(url, verify=not self._https_ignore, auth=(self._user, self._password))
+        return self._session.get(url)
 
     def http_post(self, url, data):
-        if self._user is None:
-            return self._r.post(url, verify=not self._https_ignore, data=data)
-        else:
-            return self._r.post(url, verify=not self._https_ignore, auth=(self._user, self._password), data=data)
+        return self._session.post(url, data=data)
+
+    def http_post_json(self, url, data):
+        return self._session.post(url, json=data)
 
     def http_put(self, url, data):
-        if self._user is None:
-            return self._r.put(url, verify=not self._https_ignore, data=data)
-        else:
-            return self._r.put(url, verify=not self._https_ignore, auth=(self._user, self._password), data=data)
+        return self._session.put(url, data=data)
 
     def http_delete(self, url, data):
-        if self._user is None:
-            return self._r.delete(url, verify=not self._https_ignore, data=data)
-        else:
-            return self._r.delete(url, verify=not self._https_ignore, auth=(self._user, self._password), data=data)
+        return self._session.delete(url, data=data)
 
     def _hash_password(self, password, salt=None):
         salt_hex = salt
@@ -173,13 +251,113 @@ class ModuleManager():
         return passhash.hex(), salt_hex
 
     def run_json_command(self, json_command):
+        if self.ip:
+            error, results = self.run_batch([json_command])
+            if error is not None:
+                return error, None
+            return results[0]
+
+        if not isinstance(json_command, dict):
+            return "Command is not a JSON object", None
         if 'module' not in json_command:
             return "Command does not have key 'module'", None
         elif 'func' not in json_command:
             return "Command does not have key 'func'", None
         if json_command['module'] not in self.modules:
-            return "Invalid module '{}'".format(json_command['module'])
-        return self.modules[json_command['module']].run(json_command['func'], **json_command['args'])
+            return "Invalid module '{}'".format(json_command['module']), None
+        module = self.modules[json_command['module']]
+        if json_command['func'] not in module.__FUNCS__:
+            return "Invalid function '{}.{}'".format(json_command['module'], json_command['func']), None
+        args = json_command.get('args', {})
+        if not isinstance(args, dict):
+            return "Command key 'args' is not a JSON object", None
+        return module.run(json_command['func'], **args)
+
+    # Runs a list of JSON commands in order. Remotely, they are all sent in one
+    # request. Returns (error, result) for each command. With stop_on_error,
+    # commands after the first failure are not run and get BATCH_SKIPPED.
+    def run_batch(self, json_commands, stop_on_error=False):
+        if not self.ip:
+            results = []
+            failed = False
+            with ExitStack() as holds:
+                # Modules that batch up reloads do them once, at the end
+                for module_name in self.modules:
+                    reloads = getattr(self.modules[module_name], "reloads", None)
+                    if reloads is not None:
+                        holds.enter_context(reloads.hold())
+
+                for json_command in json_commands:
+                    if failed:
+                        results.append((BATCH_SKIPPED, None))
+                        continue
+                    error, result = self.run_json_command(json_command)
+                    results.append((error, result))
+                    if error is not None and stop_on_error:
+                        failed = True
+            return None, results
+        else:
+            try:
+                resp = self.http_post_json(self._get_url() + "/_batch", {
+                    "commands": json_commands,
+                    "stop_on_error": stop_on_error
+                })
+                if resp.status_code != 200:
+                    return "Got error code {} from server".format(resp.status_code), None
+                resp_data = resp.json()
+                if not resp_data['ok']:
+                    return resp_data['error'], None
+
+                results = []
+                for result in resp_data['result']['results']:
+                    if result['ok']:
+                        results.append((None, result['output']))
+                    else:
+                        results.append((result['error'], None))
+                self.logger.info("Remote batch of %d commands", len(json_commands))
+                return None, results
+            except self._r.exceptions.SSLError:
+                return "Could not connect to {}:{} via HTTPS".format(self.ip, self._port), None
+            except self._r.exceptions.ConnectionError:
+                return "Failed to connect to server at {}:{}".format(self.ip, self._port), None
+
+    def get_job(self, job_id):
+        if not self.ip:
+            error, job = self.jobs.get(job_id)
+            if error is not None:
+                return error, None
+            return None, job.to_dict()
+        else:
+            resp = self.http_get(self._get_url() + "/_jobs/{}".format(job_id))
+            resp_data = resp.json()
+            if not resp_data['ok']:
+                return resp_data['error'], None 
+            else:
+                return None, resp_data['result']
+
+    # Wait for the jobs to finish, returning (error, result) for each, in order
+    def gather_jobs(self, job_ids, interval=0.5, timeout=None):
+        results = {}
+        start = time.monotonic()
+        while len(results) < len(job_ids):
+            for job_id in job_ids:
+                if job_id in results:
+                    continue
+                error, job = self.get_job(job_id)
+                if error is not None:
+                    results[job_id] = (error, None)
+                elif job['status'] in (JOB_DONE, JOB_ERROR):
+                    results[job_id] = (job['error'], job['output'])
+
+            if len(results) < len(job_ids):
+                if timeout is not None and time.monotonic() - start > timeout:
+                    for job_id in job_ids:
+                        if job_id not in results:
+                            results[job_id] = ("Timed out waiting for job {}".format(job_id), None)
+                    break
+                time.sleep(interval)
+
+        return [results[job_id] for job_id in job_ids]
 
     def check_user(self, username, password):
         if not self.ip:
@@ -292,6 +470,8 @@ class ModuleManager():
                 dbc.execute("CREATE TABLE fakernet_users (user_id INTEGER PRIMARY KEY, username TEXT, password TEXT, salt TEXT);")
                 self.db.commit()
 
+            self.container_cache.start()
+
             module_list = os.listdir("./modules")
             for module in module_list:
                 if module.endswith(".py"):
@@ -333,10 +513,13 @@ class ModuleManager():
 
     def list_all_servers(self):
         if self.ip is None:
+            # Get the state of every container up front instead of once per server
+            snapshot = StatusSnapshot(self.docker, self.lxd, self.container_cache).load()
+
             full_list = []
             for module_name in self.modules:
                 module = self.modules[module_name]
-                full_list += module.get_list()
+                full_list += module.get_list(snapshot=snapshot)
             return None, full_list
         else:
             resp = self.http_get(self._get_url() + "/_servers/list_all").json()
@@ -348,33 +531,78 @@ class ModuleManager():
     def __getitem__(self, key): 
         return self.modules[key]
 
+    # Called for every module call that may change state
+    def mark_dirty(self, shortname):
+        self._dirty.add(shortname)
+
+    # Drops the cached save data, so the next save asks every module again
+    def forget_saved(self):
+        with self._save_lock:
+            self._saved = {}
+
+    def _container_changes_seen(self):
+        cache = self.container_cache
+        if cache is None or not cache.is_fresh():
+            return True, None
+        generation = cache.generation
+        return generation != self._saved_generation, generation
+
+    # Returns each module's save data as indented JSON. Only modules that have been
+    # called since the last save, or whose containers have changed, are asked
+    # to save() again.
+    def _save_fragments(self):
+        containers_changed, generation = self._container_changes_seen()
+
+        fragments = {}
+        for module_name in self.modules:
+            module = self.modules[module_name]
+            shortname = module.__SHORTNAME__
+
+            # LXD has no event stream to tell us about changes
+            stale = shortname not in self._saved or shortname in self._dirty or hasattr(module, "lxd_get_status")
+            if not stale and containers_changed and hasattr(module, "docker_status"):
+                stale = True
+
+            if stale:
+                with self.locks.module_lock(shortname):
+                    self._dirty.discard(shortname)
+                    save_data = module.save()
+                if save_data is None:
+                    self._saved[shortname] = None
+                else:
+                    self._saved[shortname] = json.dumps(save_data, sort_keys=True, indent=4, separators=(',', ': ')).replace("\n", "\n    ")
+
+            if self._saved[shortname] is not None:
+                fragments[shortname] = self._saved[shortname]
+
+        self._saved_generation = generation
+        return fragments
+
     def save_state(self, save_name="default"):
 
         if re.search(r"[^-a-zA-Z0-9_]", save_name) is not None:
             return "Invalid character in save name", None
 
         if not self.ip:
-            all_save_data = {}
+            with self._save_lock:
+                fragments = self._save_fragments()
 
-            for module_name in self.modules:
-                module = self.modules[module_name]
-                save_data = module.save()
-                if save_data is not None:
-                    all_save_data[module.__SHORTNAME__] = save_data
-            
             if not os.path.exists(SAVES_DIR):
                 os.mkdir(SAVES_DIR, 0o750)
 
             out_path = "{}/{}.json".format(SAVES_DIR, save_name)
 
-            if os.path.exists(out_path):
-                os.rename(out_path, out_path + ".last")
-            
-            outdata = json.dumps(all_save_data, sort_keys=True, indent=4, separators=(',', ': '))
+            # Same output as json.dumps(..., sort_keys=True, indent=4), built from
+            # the modules' cached pieces
+            if len(fragments) == 0:
+                outdata = "{}"
+            else:
+                items = []
+                for shortname in sorted(fragments):
+                    items.append("    {}: {}".format(json.dumps(shortname), fragments[shortname]))
+                outdata = "{\n" + ",\n".join(items) + "\n}"
 
-            out_file = open(out_path, "w+")
-            out_file.write(outdata)
-            out_file.close()
+            atomic_write(out_path, outdata, keep_last=True)
 
             self.logger.info("Local save completed successfully")
             return None, True
@@ -408,10 +636,12 @@ class ModuleManager():
 
             all_save_data = json.loads(restore_raw)
 
-            for module_name in self.modules:
-                module = self.modules[module_name]
-                if module.__SHORTNAME__ in all_save_data:
-                    module.restore(all_save_data[module.__SHORTNAME__])
+            start = time.monotonic()
+            self.last_restore_timings = RestoreScheduler(self, workers=self._restore_workers).run(all_save_data)
+            self.logger.info("Restored %d servers in %.2fs", len(self.last_restore_timings), time.monotonic() - start)
+
+            # Everything may have changed
+            self.forget_saved()
 
             self.logger.info("Local restore completed successfully")
             return None, True
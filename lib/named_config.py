@@ -0,0 +1,152 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import re
+import zlib
+
+from lib.util import atomic_write
+
+INCLUDE_LINE = "include \"{}/{}\";"
+INCLUDE_PATTERN = re.compile(r'^include\s+"([^"]+)"\s*;\s*$')
+SHARD_TEMPLATE = "includes-{}.conf"
+SHARD_PATTERN = re.compile(r'^includes-[0-9]+\.conf$')
+
+# The includes of one server's named.conf, kept as sets instead of text. Zone
+# configs are included from shard files, each holding the includes of the
+# zones hashed to it, so a change rewrites one small shard rather than a
+# named.conf with thousands of lines. Names in top are included from
+# named.conf itself. Include names are files in conf_dir, which BIND sees as
+# bind_conf_dir. Nothing is written until flush(), which writes each changed
+# file atomically.
+class NamedConfig():
+
+    def __init__(self, path, conf_dir, bind_conf_dir="/etc/bind/conf", shards=16, top=()):
+        self.path = path
+        self.conf_dir = conf_dir
+        self.bind_conf_dir = bind_conf_dir
+        self.shards = shards
+        self.top = set(top)
+
+        # named.conf without the includes managed here
+        self._base = ""
+        self._top_includes = set()
+        self._shard_includes = [set() for _ in range(shards)]
+        self._dirty_shards = set()
+        self._rendered = None
+        self._stat = None
+        self._load()
+
+    def _shard(self, name):
+        return zlib.crc32(name.encode("utf-8")) % self.shards
+
+    # Reads the includes from any shard files and named.conf, so includes
+    # appended to named.conf by older versions move to the shards
+    def _load(self):
+        for shard in range(self.shards):
+            shard_path = os.path.join(self.conf_dir, SHARD_TEMPLATE.format(shard))
+            if not os.path.exists(shard_path):
+                self._dirty_shards.add(shard)
+                continue
+            shard_file = open(shard_path, "r")
+            for line in shard_file:
+                match = INCLUDE_PATTERN.match(line.strip())
+                if match is not None:
+                    self._shard_includes[shard].add(os.path.basename(match.group(1)))
+            shard_file.close()
+
+        base_lines = []
+        depth = 0
+        if os.path.exists(self.path):
+            config_file = open(self.path, "r")
+            self._rendered = config_file.read()
+            config_file.close()
+            self._stat = _file_stat(self.path)
+
+            for line in self._rendered.split("\n"):
+                match = INCLUDE_PATTERN.match(line.strip())
+                if depth == 0 and match is not None and os.path.dirname(match.group(1)) == self.bind_conf_dir:
+                    name = os.path.basename(match.group(1))
+                    if SHARD_PATTERN.match(name) is None:
+                        self.add_include(name)
+                    continue
+                base_lines.append(line)
+                code = line.split("//")[0].split("#")[0]
+                depth += code.count("{") - code.count("}")
+
+        self._base = "\n".join(base_lines).rstrip("\n") + "\n"
+
+    def is_dirty(self):
+        return len(self._dirty_shards) > 0 or self.render() != self._rendered
+
+    # True if named.conf was changed by something else since it was read
+    def is_stale(self):
+        if not os.path.exists(self.path):
+            return self._stat is not None
+        return _file_stat(self.path) != self._stat
+
+    def add_include(self, name):
+        if name in self.top:
+            self._top_includes.add(name)
+            return
+        shard = self._shard(name)
+        if name not in self._shard_includes[shard]:
+            self._shard_includes[shard].add(name)
+            self._dirty_shards.add(shard)
+
+    def remove_include(self, name):
+        if name in self.top:
+            self._top_includes.discard(name)
+            return
+        shard = self._shard(name)
+        if name in self._shard_includes[shard]:
+            self._shard_includes[shard].discard(name)
+            self._dirty_shards.add(shard)
+
+    def has_include(self, name):
+        if name in self.top:
+            return name in self._top_includes
+        return name in self._shard_includes[self._shard(name)]
+
+    def includes(self):
+        includes = set(self._top_includes)
+        for shard_includes in self._shard_includes:
+            includes.update(shard_includes)
+        return includes
+
+    def render(self):
+        lines = [self._base]
+        for name in sorted(self._top_includes):
+            lines.append(INCLUDE_LINE.format(self.bind_conf_dir, name))
+        for shard in range(self.shards):
+            lines.append(INCLUDE_LINE.format(self.bind_conf_dir, SHARD_TEMPLATE.format(shard)))
+        return "\n".join(lines) + "\n"
+
+    def render_shard(self, shard):
+        lines = []
+        for name in sorted(self._shard_includes[shard]):
+            lines.append(INCLUDE_LINE.format(self.bind_conf_dir, name))
+        return "\n".join(lines) + "\n"
+
+    # Writes changed shards, then named.conf if it changed. Returns the
+    # number of files written.
+    def flush(self):
+        written = 0
+        # Shards first, so named.conf never includes a missing file
+        for shard in sorted(self._dirty_shards):
+            atomic_write(os.path.join(self.conf_dir, SHARD_TEMPLATE.format(shard)), self.render_shard(shard))
+            written += 1
+        self._dirty_shards = set()
+
+        contents = self.render()
+        if contents != self._rendered:
+            atomic_write(self.path, contents)
+            self._rendered = contents
+            self._stat = _file_stat(self.path)
+            written += 1
+        return written
+
+def _file_stat(filename):
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_size)
@@ -0,0 +1,351 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import codecs
+import json
+import socket
+import threading
+import time
+
+OVSDB_SOCKET = "/var/run/openvswitch/db.sock"
+OVSDB_DATABASE = "Open_vSwitch"
+# How long to wait before trying a socket that could not be opened again
+RETRY_SECONDS = 30
+
+# The tables and columns kept in the client's cache
+MONITORED = {
+    "Open_vSwitch": ["bridges"],
+    "Bridge": ["name", "ports", "external_ids"],
+    "Port": ["name", "interfaces", "external_ids"],
+    "Interface": ["name", "type", "error", "external_ids", "ofport"]
+}
+
+# Turns an OVSDB value into Python: UUIDs become strings, sets lists and
+# maps dicts. An empty set is an empty list, and a set of one is the value.
+def from_ovsdb(value):
+    if isinstance(value, list):
+        if value[0] == "uuid" or value[0] == "named-uuid":
+            return value[1]
+        elif value[0] == "set":
+            items = [from_ovsdb(item) for item in value[1]]
+            if len(items) == 1:
+                return items[0]
+            return items
+        elif value[0] == "map":
+            return dict([(from_ovsdb(key), from_ovsdb(item)) for key, item in value[1]])
+    return value
+
+def as_list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+def uuid_set(uuids, named=False):
+    kind = "named-uuid" if named else "uuid"
+    return ["set", [[kind, uuid] for uuid in uuids]]
+
+def ovsdb_map(values):
+    return ["map", [[key, value] for key, value in values.items()]]
+
+# Operations to commit together, built with names looked up in the client's
+# cache. Each change also notes what the cache should show once the
+# server's update for it arrives, so commit() returns after the change can
+# be read back.
+class Transaction():
+
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+        self.expect = []
+        self._names = 0
+
+    def _named(self, prefix):
+        self._names += 1
+        return "{}{}".format(prefix, self._names)
+
+    def add_bridge(self, name):
+        interface = self._named("interface")
+        port = self._named("port")
+        bridge = self._named("bridge")
+        self.operations += [
+            {"op": "insert", "table": "Interface", "row": {"name": name, "type": "internal"}, "uuid-name": interface},
+            {"op": "insert", "table": "Port", "row": {"name": name, "interfaces": ["named-uuid", interface]}, "uuid-name": port},
+            {"op": "insert", "table": "Bridge", "row": {"name": name, "ports": ["named-uuid", port]}, "uuid-name": bridge},
+            {"op": "mutate", "table": "Open_vSwitch", "where": [], "mutations": [["bridges", "insert", uuid_set([bridge], named=True)]]}
+        ]
+        self.expect.append(lambda: self.client.find("Bridge", name) is not None)
+
+    def del_bridge(self, name):
+        bridge = self.client.find("Bridge", name)
+        if bridge is None:
+            return False
+        self.operations.append({"op": "mutate", "table": "Open_vSwitch", "where": [], "mutations": [["bridges", "delete", uuid_set([bridge['_uuid']])]]})
+        self.expect.append(lambda: self.client.find("Bridge", name) is None)
+        return True
+
+    # Adds a port with an interface of the same name
+    def add_port(self, bridge_name, name, external_ids=None, interface_type=""):
+        bridge = self.client.find("Bridge", bridge_name)
+        if bridge is None:
+            return False
+        interface = self._named("interface")
+        port = self._named("port")
+        interface_row = {"name": name, "type": interface_type}
+        if external_ids is not None:
+            interface_row["external_ids"] = ovsdb_map(external_ids)
+        self.operations += [
+            {"op": "insert", "table": "Interface", "row": interface_row, "uuid-name": interface},
+            {"op": "insert", "table": "Port", "row": {"name": name, "interfaces": ["named-uuid", interface]}, "uuid-name": port},
+            {"op": "mutate", "table": "Bridge", "where": [["_uuid", "==", ["uuid", bridge['_uuid']]]], "mutations": [["ports", "insert", uuid_set([port], named=True)]]}
+        ]
+        self.expect.append(lambda: self.client.find("Port", name) is not None)
+        return True
+
+    def del_port(self, bridge_name, name):
+        bridge = self.client.find("Bridge", bridge_name)
+        port = self.client.find("Port", name)
+        if bridge is None or port is None or port['_uuid'] not in as_list(bridge['ports']):
+            return False
+        self.operations.append({"op": "mutate", "table": "Bridge", "where": [["_uuid", "==", ["uuid", bridge['_uuid']]]], "mutations": [["ports", "delete", uuid_set([port['_uuid']])]]})
+        uuid = port['_uuid']
+        self.expect.append(lambda: uuid not in self.client.rows("Port"))
+        return True
+
+    def commit(self):
+        if len(self.operations) == 0:
+            return None, []
+        return self.client.transact(self.operations, self.expect)
+
+# A persistent connection to ovsdb-server speaking JSON-RPC (RFC 7047) over
+# its unix socket. The bridge, port and interface tables are monitored, so
+# reads come from a cache the server keeps up to date, and any number of
+# changes are sent as one transaction.
+class OVSDBClient():
+
+    def __init__(self, path=OVSDB_SOCKET, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.transactions = 0
+        self._socket = None
+        self._send_lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        # Guards the cache and pending requests
+        self._changed = threading.Condition()
+        self._tables = {}
+        self._pending = {}
+        self._next_id = 0
+        self._monitor_id = None
+        self._failed_at = None
+
+    def is_connected(self):
+        return self._socket is not None
+
+    # Returns an error if the server can't be reached, trying again at most
+    # every RETRY_SECONDS
+    def ensure_connected(self):
+        if self._socket is not None:
+            return None
+        with self._connect_lock:
+            if self._socket is not None:
+                return None
+            if self._failed_at is not None and time.monotonic() - self._failed_at < RETRY_SECONDS:
+                return "OVSDB is not available at {}".format(self.path)
+            error, _ = self.connect()
+            return error
+
+    def connect(self):
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+        except OSError as e:
+            self._failed_at = time.monotonic()
+            return "Could not connect to OVSDB at {}: {}".format(self.path, e), None
+
+        self._socket = sock
+        self._failed_at = None
+        reader = threading.Thread(target=self._read_loop, args=(sock,), daemon=True)
+        reader.start()
+
+        monitor = {}
+        for table, columns in MONITORED.items():
+            monitor[table] = {"columns": columns}
+        with self._changed:
+            self._tables = dict([(table, {}) for table in MONITORED])
+            self._monitor_id = self._next_id + 1
+        error, _ = self._request("monitor", [OVSDB_DATABASE, "fakernet", monitor])
+        if error is not None:
+            self.close()
+            self._failed_at = time.monotonic()
+            return error, None
+        return None, True
+
+    def close(self):
+        sock = self._socket
+        self._socket = None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def _request(self, method, params):
+        sock = self._socket
+        if sock is None:
+            return "Not connected to OVSDB", None
+
+        with self._changed:
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = None
+        message = json.dumps({"method": method, "params": params, "id": request_id}).encode()
+        try:
+            with self._send_lock:
+                sock.sendall(message)
+        except OSError as e:
+            self.close()
+            return "Lost connection to OVSDB: {}".format(e), None
+
+        deadline = time.monotonic() + self.timeout
+        with self._changed:
+            while self._pending.get(request_id) is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._socket is None:
+                    self._pending.pop(request_id, None)
+                    return "No reply from OVSDB for {}".format(method), None
+                self._changed.wait(remaining)
+            response = self._pending.pop(request_id)
+
+        if response.get("error") is not None:
+            return "OVSDB error: {}".format(response["error"]), None
+        return None, response.get("result")
+
+    def _read_loop(self, sock):
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder("utf-8")()
+        buffer = ""
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                data = b""
+            if data == b"":
+                break
+            buffer += text.decode(data)
+            while True:
+                buffer = buffer.lstrip()
+                if buffer == "":
+                    break
+                try:
+                    message, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    # The rest of the message hasn't arrived yet
+                    break
+                buffer = buffer[end:]
+                self._handle(sock, message)
+
+        with self._changed:
+            if self._socket is sock:
+                self._socket = None
+            self._changed.notify_all()
+
+    def _handle(self, sock, message):
+        method = message.get("method")
+        if method == "echo":
+            reply = json.dumps({"id": message.get("id"), "result": message.get("params"), "error": None}).encode()
+            try:
+                with self._send_lock:
+                    sock.sendall(reply)
+            except OSError:
+                pass
+        elif method == "update":
+            with self._changed:
+                self._apply(message["params"][1])
+                self._changed.notify_all()
+        elif message.get("id") in self._pending:
+            with self._changed:
+                # The monitor's first rows are applied here, before any
+                # updates after them are read
+                if message["id"] == self._monitor_id and message.get("result") is not None:
+                    self._apply(message["result"])
+                self._pending[message["id"]] = message
+                self._changed.notify_all()
+
+    # Called with self._changed held
+    def _apply(self, updates):
+        for table, rows in updates.items():
+            cached = self._tables.setdefault(table, {})
+            for uuid, change in rows.items():
+                if change.get("new") is None:
+                    cached.pop(uuid, None)
+                else:
+                    row = dict([(column, from_ovsdb(value)) for column, value in change["new"].items()])
+                    row["_uuid"] = uuid
+                    cached[uuid] = row
+
+    # Runs operations as one transaction. If expect is given, waits until
+    # each of those checks of the cache passes.
+    def transact(self, operations, expect=None):
+        error = self.ensure_connected()
+        if error is not None:
+            return error, None
+
+        error, results = self._request("transact", [OVSDB_DATABASE] + list(operations))
+        if error is not None:
+            return error, None
+        self.transactions += 1
+        for result in results:
+            if result is not None and result.get("error") is not None:
+                return "OVSDB transaction failed: {} {}".format(result["error"], result.get("details", "")).strip(), None
+
+        if expect is not None:
+            deadline = time.monotonic() + self.timeout
+            with self._changed:
+                while not all([check() for check in expect]):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return "Timed out waiting for OVSDB to report the change", None
+                    self._changed.wait(remaining)
+        return None, results
+
+    def transaction(self):
+        return Transaction(self)
+
+    # uuid -> row for a table in the cache
+    def rows(self, table):
+        with self._changed:
+            return dict(self._tables.get(table, {}))
+
+    def find(self, table, name):
+        with self._changed:
+            for row in self._tables.get(table, {}).values():
+                if row.get("name") == name:
+                    return row
+        return None
+
+    def bridge_exists(self, name):
+        return self.find("Bridge", name) is not None
+
+    def bridges(self):
+        return sorted([row['name'] for row in self.rows("Bridge").values()])
+
+    # Returns (bridge name, port name) for every port whose interface the
+    # kernel could not open, such as those left by a stopped container
+    def stale_ports(self):
+        with self._changed:
+            bridges = list(self._tables.get("Bridge", {}).values())
+            ports = self._tables.get("Port", {})
+            interfaces = self._tables.get("Interface", {})
+            stale = []
+            for bridge in bridges:
+                for port_id in as_list(bridge['ports']):
+                    port = ports.get(port_id)
+                    if port is None:
+                        continue
+                    for interface_id in as_list(port['interfaces']):
+                        interface = interfaces.get(interface_id)
+                        if interface is not None and "could not open" in str(interface.get("error", "")):
+                            stale.append((bridge['name'], port['name']))
+                            break
+            return stale
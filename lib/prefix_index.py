@@ -0,0 +1,318 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import ipaddress
+
+_EMPTY = object()
+
+class PrefixNode():
+
+    __slots__ = ("key", "prefixlen", "network", "value", "children", "free")
+
+    def __init__(self, key, prefixlen, network=None, value=_EMPTY):
+        self.key = key
+        self.prefixlen = prefixlen
+        self.network = network
+        self.value = value
+        self.children = [None, None]
+        # Prefix length of the largest block under this node with no
+        # networks in it, or None if there is none
+        self.free = None if value is not _EMPTY else prefixlen
+
+# A path-compressed radix (Patricia) trie of IP networks. Each node holds a
+# prefix, and only prefixes that branch or hold a network get a node, so a
+# lookup visits at most one node per prefix bit and usually far fewer.
+# Lookups return the most specific network containing an address. Every node
+# also keeps the size of the largest free block under it, so finding a free
+# block of a given size follows a single path down.
+class PrefixIndex():
+
+    def __init__(self):
+        self._roots = {
+            4: PrefixNode(0, 0),
+            6: PrefixNode(0, 0)
+        }
+        self._bits = {4: 32, 6: 128}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _bit(self, version, key, position):
+        return (key >> (self._bits[version] - 1 - position)) & 1
+
+    def _matches(self, version, key, node, prefixlen):
+        if prefixlen == 0:
+            return True
+        shift = self._bits[version] - prefixlen
+        return (key >> shift) == (node.key >> shift)
+
+    def _common(self, version, key, other, limit):
+        common = self._bits[version] - (key ^ other).bit_length()
+        return min(common, limit)
+
+    def add(self, network, value):
+        network = ipaddress.ip_network(network)
+        version = network.version
+        key = int(network.network_address)
+        prefixlen = network.prefixlen
+
+        path = []
+        node = self._roots[version]
+        while True:
+            path.append(node)
+            if node.prefixlen == prefixlen:
+                if node.value is _EMPTY:
+                    self._count += 1
+                node.network = network
+                node.value = value
+                break
+
+            bit = self._bit(version, key, node.prefixlen)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = PrefixNode(key, prefixlen, network, value)
+                self._count += 1
+                break
+
+            common = self._common(version, key, child.key, min(prefixlen, child.prefixlen))
+            if common == child.prefixlen:
+                node = child
+                continue
+
+            # The new prefix and the child part ways above the child, so a
+            # node is put in between for where they split
+            if common == prefixlen:
+                between = PrefixNode(key, prefixlen, network, value)
+            else:
+                between = PrefixNode(key >> (self._bits[version] - common) << (self._bits[version] - common), common)
+                between.children[self._bit(version, key, common)] = PrefixNode(key, prefixlen, network, value)
+            between.children[self._bit(version, child.key, common)] = child
+            node.children[bit] = between
+            self._update_free(version, between)
+            self._count += 1
+            break
+
+        for node in reversed(path):
+            self._update_free(version, node)
+
+    def remove(self, network):
+        network = ipaddress.ip_network(network)
+        version = network.version
+        key = int(network.network_address)
+        prefixlen = network.prefixlen
+
+        path = [self._roots[version]]
+        node = path[0]
+        while node.prefixlen < prefixlen:
+            node = node.children[self._bit(version, key, node.prefixlen)]
+            if node is None or node.prefixlen > prefixlen or not self._matches(version, key, node, node.prefixlen):
+                return False
+            path.append(node)
+
+        if node.prefixlen != prefixlen or node.value is _EMPTY:
+            return False
+        node.network = None
+        node.value = _EMPTY
+        self._count -= 1
+
+        # Nodes left holding nothing with one or no children are spliced out
+        for i in range(len(path) - 1, 0, -1):
+            node = path[i]
+            if node.value is not _EMPTY:
+                break
+            remaining = [child for child in node.children if child is not None]
+            if len(remaining) > 1:
+                break
+            parent = path[i - 1]
+            parent.children[parent.children.index(node)] = remaining[0] if len(remaining) == 1 else None
+
+        for node in reversed(path):
+            self._update_free(version, node)
+        return True
+
+    def _update_free(self, version, node):
+        if node.value is not _EMPTY:
+            node.free = None
+            return
+        if node.children[0] is None and node.children[1] is None:
+            node.free = node.prefixlen
+            return
+
+        half = node.prefixlen + 1
+        best = None
+        for child in node.children:
+            if child is None:
+                free = half
+            elif child.prefixlen == half:
+                free = child.free
+            else:
+                # The other side of the first bit past the half is empty
+                free = half + 1
+            if free is not None and (best is None or free < best):
+                best = free
+        node.free = best
+
+    def clear(self):
+        self.__init__()
+
+    # Returns (network, value) for the most specific network holding ip, or None
+    def lookup(self, ip):
+        if not isinstance(ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            ip = ipaddress.ip_address(ip)
+        version = ip.version
+        key = int(ip)
+        bits = self._bits[version]
+
+        best = None
+        node = self._roots[version]
+        while node is not None:
+            if node.prefixlen > 0 and (key >> (bits - node.prefixlen)) != (node.key >> (bits - node.prefixlen)):
+                break
+            if node.value is not _EMPTY:
+                best = node
+            if node.prefixlen == bits:
+                break
+            node = node.children[(key >> (bits - 1 - node.prefixlen)) & 1]
+
+        if best is None:
+            return None
+        return best.network, best.value
+
+    # Returns (network, value) for a network that overlaps network, or None
+    def overlapping(self, network):
+        network = ipaddress.ip_network(network)
+        version = network.version
+        key = int(network.network_address)
+        prefixlen = network.prefixlen
+
+        # Networks holding this one are on the way down
+        node = self._roots[version]
+        while node is not None and node.prefixlen < prefixlen:
+            if not self._matches(version, key, node, node.prefixlen):
+                return None
+            if node.value is not _EMPTY:
+                return node.network, node.value
+            node = node.children[self._bit(version, key, node.prefixlen)]
+
+        # And networks inside this one are under where the walk stopped
+        if node is None or not self._matches(version, key, node, prefixlen):
+            return None
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.value is not _EMPTY:
+                return node.network, node.value
+            stack.extend([child for child in node.children if child is not None])
+        return None
+
+    # Returns (network, value) for the most specific network holding all of
+    # network, or None
+    def containing(self, network):
+        network = ipaddress.ip_network(network)
+        version = network.version
+        key = int(network.network_address)
+
+        best = None
+        node = self._roots[version]
+        while node is not None and node.prefixlen <= network.prefixlen:
+            if not self._matches(version, key, node, node.prefixlen):
+                break
+            if node.value is not _EMPTY:
+                best = node
+            if node.prefixlen == network.prefixlen:
+                break
+            node = node.children[self._bit(version, key, node.prefixlen)]
+
+        if best is None:
+            return None
+        return best.network, best.value
+
+    # Returns the lowest /prefixlen network inside supernet that overlaps no
+    # network in the index, or None if there is no room
+    def free_block(self, supernet, prefixlen):
+        supernet = ipaddress.ip_network(supernet)
+        version = supernet.version
+        key = int(supernet.network_address)
+        bits = self._bits[version]
+        if prefixlen < supernet.prefixlen or prefixlen > bits:
+            return None
+
+        start = None
+        node = self._roots[version]
+        while True:
+            if node.prefixlen == supernet.prefixlen:
+                start = self._free_in_node(version, node, prefixlen)
+                break
+            if node.value is not _EMPTY:
+                break
+            child = node.children[self._bit(version, key, node.prefixlen)]
+            if child is None:
+                start = key
+                break
+            if child.prefixlen <= supernet.prefixlen:
+                if not self._matches(version, key, child, child.prefixlen):
+                    start = key
+                    break
+                node = child
+            else:
+                if self._matches(version, key, child, supernet.prefixlen):
+                    start = self._free_in_edge(version, supernet.prefixlen, child, prefixlen)
+                else:
+                    start = key
+                break
+
+        if start is None:
+            return None
+        return ipaddress.ip_network((start, prefixlen))
+
+    def _free_in_node(self, version, node, prefixlen):
+        if node.value is not _EMPTY:
+            return None
+        if node.children[0] is None and node.children[1] is None:
+            return node.key
+        if node.prefixlen == prefixlen:
+            return None
+
+        bits = self._bits[version]
+        half = node.prefixlen + 1
+        for bit in (0, 1):
+            child = node.children[bit]
+            if child is None:
+                return node.key | (bit << (bits - half))
+            start = self._free_in_edge(version, half, child, prefixlen)
+            if start is not None:
+                return start
+        return None
+
+    # Finds a free block in the range of child's prefix cut to level. Along
+    # the bits from level to child, every block off to the side is empty.
+    def _free_in_edge(self, version, level, child, prefixlen):
+        bits = self._bits[version]
+        last = min(child.prefixlen, prefixlen)
+
+        # Empty blocks before the child, the widest first
+        for depth in range(level + 1, last + 1):
+            if (child.key >> (bits - depth)) & 1 == 1:
+                return (child.key >> (bits - depth + 1)) << (bits - depth + 1)
+
+        if child.prefixlen <= prefixlen and child.free is not None and child.free <= prefixlen:
+            return self._free_in_node(version, child, prefixlen)
+
+        # Then empty blocks after it, the nearest first
+        for depth in range(last, level, -1):
+            if (child.key >> (bits - depth)) & 1 == 0:
+                return ((child.key >> (bits - depth + 1)) << (bits - depth + 1)) | (1 << (bits - depth))
+        return None
+
+    def items(self):
+        result = []
+        for version in (4, 6):
+            stack = [self._roots[version]]
+            while len(stack) > 0:
+                node = stack.pop()
+                if node.value is not _EMPTY:
+                    result.append((node.network, node.value))
+                stack.extend([child for child in node.children if child is not None])
+        return result
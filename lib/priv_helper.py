@@ -0,0 +1,320 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import time
+import shlex
+import socket
+import struct
+import threading
+import subprocess
+import socketserver
+
+HELPER_SOCKET = "/run/fakernet/helper.sock"
+SUDO = "/usr/bin/sudo"
+# The only tools the helper runs, by the names requests use
+TOOLS = {
+    "iptables": "/sbin/iptables",
+    "ip": "/sbin/ip",
+    "ovs-vsctl": "/usr/bin/ovs-vsctl",
+    "ovs-docker": "/usr/bin/ovs-docker"
+}
+# How long to wait before trying a socket that could not be opened again
+RETRY_SECONDS = 30
+MAX_REQUEST = 1024 * 1024
+
+# Returns (exit code, output, error output) for a command
+def run_command(argv, timeout=60):
+    try:
+        process = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    except OSError as e:
+        return 127, "", str(e)
+    except subprocess.TimeoutExpired:
+        return -1, "", "Timed out after {} seconds".format(timeout)
+    return process.returncode, process.stdout.decode(errors="replace"), process.stderr.decode(errors="replace")
+
+class PrivilegedHandler(socketserver.StreamRequestHandler):
+
+    def _send(self, response):
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        helper = self.server.helper
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        _, uid, _ = struct.unpack("3i", creds)
+        if uid not in helper.allowed_uids:
+            helper.log("Refused connection from uid {}".format(uid))
+            self._send({"id": None, "error": "User {} is not allowed to use the helper".format(uid), "results": []})
+            return
+
+        while True:
+            line = self.rfile.readline(MAX_REQUEST + 1)
+            if line == b"":
+                return
+            if len(line) > MAX_REQUEST:
+                self._send({"id": None, "error": "Request too large", "results": []})
+                return
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self._send({"id": None, "error": "Request is not valid JSON", "results": []})
+                return
+            self._send(helper.handle(request))
+
+class PrivilegedServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# Runs as root and does the privileged work FakerNet would otherwise use
+# sudo for, so each call costs a round trip on a unix socket instead of
+# starting sudo and PAM. Only users in allowed_uids may connect, checked
+# with the socket's peer credentials, and only the whitelisted tools are
+# run, directly and without a shell. A request is a list of operations run
+# in order, stopping at the first that fails unless told otherwise.
+class PrivilegedHelper():
+
+    def __init__(self, path=HELPER_SOCKET, allowed_uids=None, tools=TOOLS, runner=run_command, logger=None):
+        self.path = path
+        self.allowed_uids = set([0] if allowed_uids is None else allowed_uids)
+        self.tools = tools
+        self.runner = runner
+        self.logger = logger
+        self.requests = 0
+        self._server = None
+        self._thread = None
+
+    def log(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
+
+    # Opens the socket, readable and writable only by its owner, which is
+    # owner_uid if given
+    def listen(self, owner_uid=None):
+        directory = os.path.dirname(self.path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory, mode=0o755)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        old_umask = os.umask(0o177)
+        try:
+            self._server = PrivilegedServer(self.path, PrivilegedHandler)
+        finally:
+            os.umask(old_umask)
+        if owner_uid is not None:
+            os.chown(self.path, owner_uid, -1)
+        self._server.helper = self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    # Serves from a background thread
+    def start(self, owner_uid=None):
+        self.listen(owner_uid)
+        self._thread = threading.Thread(target=self.serve_forever, name="fakernet-helper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _check(self, op):
+        if not isinstance(op, dict) or op.get("tool") not in self.tools:
+            return "Tool {} is not allowed".format(op.get("tool") if isinstance(op, dict) else op)
+        args = op.get("args", [])
+        if not isinstance(args, list) or not all([isinstance(arg, str) and "\0" not in arg for arg in args]):
+            return "Arguments for {} must be a list of strings".format(op['tool'])
+        return None
+
+    def handle(self, request):
+        self.requests += 1
+        ops = request.get("ops") if isinstance(request, dict) else None
+        if not isinstance(ops, list):
+            return {"id": None, "error": "Request has no list of ops", "results": []}
+        stop_on_error = request.get("stop_on_error", True)
+
+        results = []
+        for op in ops:
+            error = self._check(op)
+            if error is not None:
+                result = {"code": None, "output": "", "error": error}
+            else:
+                argv = [self.tools[op['tool']]] + op.get("args", [])
+                code, output, error_output = self.runner(argv)
+                result = {"code": code, "output": output, "error": error_output}
+                self.log("Ran {} ({})".format(" ".join([shlex.quote(arg) for arg in argv]), code))
+            results.append(result)
+            if result['code'] != 0 and stop_on_error:
+                break
+        return {"id": request.get("id"), "error": None, "results": results}
+
+# Runs whitelisted tools as root. Through the helper if its socket can be
+# opened, keeping connections open for reuse, and otherwise with sudo.
+class PrivilegedClient():
+
+    def __init__(self, path=HELPER_SOCKET, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        self.requests = 0
+        self._lock = threading.Lock()
+        # Connections not in use, as (socket, file to read from)
+        self._idle = []
+        self._next_id = 0
+        self._failed_at = None
+
+    # Returns an error if the helper can't be reached, trying again at most
+    # every RETRY_SECONDS
+    def ensure_connected(self):
+        connection, _ = self._acquire()
+        if connection is None:
+            return "Privileged helper is not available at {}".format(self.path)
+        self._release(connection)
+        return None
+
+    # Returns (connection, whether it is new), with None for the connection if
+    # the socket could not be opened
+    def _acquire(self):
+        with self._lock:
+            if len(self._idle) > 0:
+                return self._idle.pop(), False
+            if self._failed_at is not None and time.monotonic() - self._failed_at < RETRY_SECONDS:
+                return None, False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            with self._lock:
+                self._failed_at = time.monotonic()
+            return None, False
+        with self._lock:
+            self._failed_at = None
+        return (sock, sock.makefile("rb")), True
+
+    def _release(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+    def _discard(self, connection):
+        sock, reader = connection
+        reader.close()
+        sock.close()
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for connection in idle:
+            self._discard(connection)
+
+    # Returns None if the helper could not be reached
+    def _helper_batch(self, ops, stop_on_error):
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+        request = json.dumps({
+            "id": request_id,
+            "ops": [{"tool": tool, "args": list(args)} for tool, args in ops],
+            "stop_on_error": stop_on_error
+        }).encode() + b"\n"
+
+        for attempt in range(2):
+            connection, fresh = self._acquire()
+            if connection is None:
+                return None
+            sock, reader = connection
+            send_error = None
+            try:
+                sock.sendall(request)
+            except OSError as e:
+                send_error = e
+
+            # Read even if sending failed, in case the helper answered first
+            try:
+                line = reader.readline()
+                response = json.loads(line) if line != b"" else None
+            except (OSError, ValueError) as e:
+                if send_error is None or isinstance(e, ValueError):
+                    # The operations may have run, so they are not tried again
+                    self._discard(connection)
+                    return "Lost connection to the privileged helper: {}".format(e), None
+                response = None
+
+            if send_error is not None and (response is None or response.get("error") is None):
+                self._discard(connection)
+                if not fresh:
+                    # An idle connection the helper has since closed, such as
+                    # when it restarted. Nothing reached it, so a new one is
+                    # safe to try.
+                    self.close()
+                    continue
+                return "Lost connection to the privileged helper: {}".format(send_error), None
+            if response is None:
+                self._discard(connection)
+                return "Lost connection to the privileged helper: Connection closed by the helper", None
+
+            # The helper answers and closes the connection when it refuses us,
+            # which may be before or after our request was sent
+            if response.get("id") is None:
+                self._discard(connection)
+            else:
+                self._release(connection)
+            if response.get("error") is not None:
+                return response['error'], None
+            return None, response['results']
+        return None
+
+    def _sudo_batch(self, ops, stop_on_error):
+        results = []
+        for tool, args in ops:
+            if tool not in TOOLS:
+                result = {"code": None, "output": "", "error": "Tool {} is not allowed".format(tool)}
+            else:
+                code, output, error_output = run_command([SUDO, "-n", TOOLS[tool]] + list(args))
+                result = {"code": code, "output": output, "error": error_output}
+            results.append(result)
+            if result['code'] != 0 and stop_on_error:
+                break
+        return None, results
+
+    # Runs a list of (tool, args) in order. Returns the results, each a dict
+    # of code, output and error, with an error for the first that failed.
+    def run_batch(self, ops, stop_on_error=True):
+        ops = list(ops)
+        self.requests += 1
+        response = self._helper_batch(ops, stop_on_error)
+        if response is None:
+            response = self._sudo_batch(ops, stop_on_error)
+        err, results = response
+        if err is not None:
+            return err, None
+
+        for (tool, args), result in zip(ops, results):
+            if result['code'] != 0:
+                message = result['error'].strip()
+                if message == "":
+                    message = "exit code {}".format(result['code'])
+                return "'{} {}' failed: {}".format(tool, " ".join(args), message), results
+        return None, results
+
+    # Runs one tool, returning its output
+    def run(self, tool, args):
+        err, results = self.run_batch([(tool, args)])
+        if err is not None:
+            return err, None
+        return None, results[0]['output']
+
+_default_client = None
+
+# A shared client for code without a ModuleManager
+def default_client():
+    global _default_client
+    if _default_client is None:
+        _default_client = PrivilegedClient()
+    return _default_client
@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.exception
+
+from lib.dns_update import rdata_text, DEFAULT_TTL
+
+def reversed_name(name):
+    labels = name.lower().rstrip(".").split(".")
+    labels.reverse()
+    return ".".join(labels) + "."
+
+# Returns (name, rdata) for a record, with the name made absolute and lower
+# case. Names without a trailing dot, in the name or value, are relative to
+# the zone. Raises ValueError if the record isn't valid.
+def parse_record(zone, name, record_type, value):
+    try:
+        origin = dns.name.from_text(zone)
+        name = dns.name.from_text(name, origin).to_text().lower()
+        rdata = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.from_text(record_type), rdata_text(record_type, value), origin=origin, relativize=False)
+    except (dns.exception.DNSException, ValueError) as e:
+        raise ValueError(str(e))
+    return name, rdata
+
+# Keeps every DNS record in the dns_record table, so records can be found with
+# indexed queries instead of by parsing zone files. rname is the name with its
+# labels reversed, so names under a domain sort together.
+class RecordStore():
+
+    def __init__(self, db):
+        self.db = db
+
+    # Creates the table if needed. Returns True if it was created.
+    def ensure_schema(self):
+        dbc = self.db.cursor()
+        dbc.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='dns_record';")
+        if dbc.fetchone() is not None:
+            return False
+        dbc.execute("CREATE TABLE dns_record (record_id INTEGER PRIMARY KEY, server_id INTEGER, zone TEXT, direction TEXT, name TEXT, rname TEXT, type TEXT, value TEXT, ttl INTEGER);")
+        dbc.execute("CREATE UNIQUE INDEX dns_record_entry ON dns_record (zone, name, type, value, server_id);")
+        dbc.execute("CREATE INDEX dns_record_value ON dns_record (value);")
+        dbc.execute("CREATE INDEX dns_record_rname ON dns_record (rname, type);")
+        self.db.commit()
+        return True
+
+    # records is a list of (name, type, value, ttl) as from parse_record
+    def add(self, server_id, zone, direction, records):
+        rows = []
+        for name, record_type, value, ttl in records:
+            rows.append((int(server_id), zone, direction, name, reversed_name(name), record_type, value, ttl))
+        self.db.cursor().executemany("INSERT OR IGNORE INTO dns_record (server_id, zone, direction, name, rname, type, value, ttl) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+
+    # records is a list of (name, type, value)
+    def remove(self, server_id, zone, records):
+        rows = []
+        for name, record_type, value in records:
+            rows.append((zone, name, record_type, value, int(server_id)))
+        self.db.cursor().executemany("DELETE FROM dns_record WHERE zone=? AND name=? AND type=? AND value=? AND server_id=?", rows)
+        self.db.commit()
+
+    def has_name(self, server_id, zone, name):
+        dbc = self.db.cursor()
+        dbc.execute("SELECT 1 FROM dns_record WHERE zone=? AND name=? AND server_id=? LIMIT 1", (zone, name, int(server_id)))
+        return dbc.fetchone() is not None
+
+    def has_record(self, server_id, zone, name, record_type, value):
+        dbc = self.db.cursor()
+        dbc.execute("SELECT 1 FROM dns_record WHERE zone=? AND name=? AND type=? AND value=? AND server_id=?", (zone, name, record_type, value, int(server_id)))
+        return dbc.fetchone() is not None
+
+    # Returns (name, type, value, ttl) for each record in a zone
+    def zone_records(self, server_id, zone, direction):
+        dbc = self.db.cursor()
+        dbc.execute("SELECT name, type, value, ttl FROM dns_record WHERE zone=? AND server_id=? AND direction=? ORDER BY rname, type, value", (zone, int(server_id), direction))
+        return dbc.fetchall()
+
+    # Returns (zone, direction) for each zone of a server with records
+    def zones(self, server_id):
+        dbc = self.db.cursor()
+        dbc.execute("SELECT DISTINCT zone, direction FROM dns_record WHERE server_id=? ORDER BY zone", (int(server_id),))
+        return dbc.fetchall()
+
+    def clear_zone(self, server_id, zone, direction):
+        self.db.cursor().execute("DELETE FROM dns_record WHERE zone=? AND server_id=? AND direction=?", (zone, int(server_id), direction))
+        self.db.commit()
+
+    def remove_server(self, server_id):
+        self.db.cursor().execute("DELETE FROM dns_record WHERE server_id=?", (int(server_id),))
+        self.db.commit()
+
+    # Finds records at or under the domain under, of a type and with a value,
+    # any of which may be None to match everything. Returns (server ID, zone,
+    # name, type, value) for each.
+    def find(self, under=None, record_type=None, value=None):
+        conditions = []
+        params = []
+        if under is not None and under.strip(".") != "":
+            prefix = reversed_name(under)
+            # Names under the domain sort from its reversed name up to the
+            # same with the last "." replaced by the next character, "/"
+            conditions.append("rname >= ? AND rname < ?")
+            params += [prefix, prefix[:-1] + "/"]
+        if record_type is not None:
+            conditions.append("type=?")
+            params.append(record_type)
+        if value is not None:
+            conditions.append("value=?")
+            params.append(value)
+
+        query = "SELECT server_id, zone, name, type, value FROM dns_record"
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY rname, type, value"
+
+        dbc = self.db.cursor()
+        dbc.execute(query, params)
+        return dbc.fetchall()
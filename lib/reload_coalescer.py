@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import threading
+from contextlib import contextmanager
+
+# Collects which zones on which servers need reloading and reloads them
+# together, at most once per debounce window, instead of once per change.
+# reload_func(server_id, zones) is called for each server with changes, where
+# zones is a sorted list of zone names, or None if the whole server (its
+# config included) needs reloading. While held, nothing is reloaded until the
+# last hold is released.
+class ReloadCoalescer():
+
+    def __init__(self, reload_func, debounce=1.0, lock=None, logger=None):
+        self._reload_func = reload_func
+        self.debounce = debounce
+        # Called to get a lock that keeps files from changing during a reload
+        self._get_lock = lock
+        self._logger = logger
+
+        self._lock = threading.Lock()
+        # server ID -> set of zone names, or None for a full reload
+        self._pending = {}
+        self._holds = 0
+        self._timer = None
+
+    def mark(self, server_id, zone=None):
+        # IDs come in as both numbers and strings from the API
+        server_id = str(server_id)
+        with self._lock:
+            if zone is None:
+                self._pending[server_id] = None
+            elif server_id not in self._pending:
+                self._pending[server_id] = set([zone])
+            elif self._pending[server_id] is not None:
+                self._pending[server_id].add(zone)
+
+            if self._holds == 0 and self._timer is None:
+                self._start_timer()
+
+    # Drop any pending reloads for a server, such as one that was removed
+    def discard(self, server_id):
+        with self._lock:
+            self._pending.pop(str(server_id), None)
+
+    def pending(self):
+        with self._lock:
+            pending = {}
+            for server_id in self._pending:
+                zones = self._pending[server_id]
+                pending[server_id] = None if zones is None else sorted(zones)
+            return pending
+
+    def is_held(self):
+        with self._lock:
+            return self._holds > 0
+
+    def begin_hold(self):
+        with self._lock:
+            self._holds += 1
+            self._cancel_timer()
+
+    # Releasing the last hold reloads everything that changed while held
+    def end_hold(self):
+        with self._lock:
+            if self._holds == 0:
+                return "Reloads are not being held", None
+            self._holds -= 1
+            if self._holds > 0:
+                return None, True
+        return self.flush()
+
+    @contextmanager
+    def hold(self):
+        self.begin_hold()
+        try:
+            yield
+        finally:
+            error, _ = self.end_hold()
+            if error is not None and self._logger is not None:
+                self._logger.error("Reload after hold failed: %s", error)
+
+    # Reload everything pending now. Returns the number of servers reloaded.
+    def flush(self):
+        return self._locked_flush(False)
+
+    def _locked_flush(self, from_timer):
+        if self._get_lock is not None:
+            with self._get_lock():
+                return self._flush(from_timer)
+        return self._flush(from_timer)
+
+    def _flush(self, from_timer):
+        with self._lock:
+            # A hold may have started while the timer waited for the lock
+            if from_timer and self._holds > 0:
+                return None, 0
+            self._cancel_timer()
+            pending = self._pending
+            self._pending = {}
+
+        errors = []
+        for server_id in sorted(pending):
+            zones = pending[server_id]
+            if zones is not None:
+                zones = sorted(zones)
+            try:
+                error, _ = self._reload_func(server_id, zones)
+            except Exception as e:
+                error = str(e)
+            if error is not None:
+                errors.append("Server {}: {}".format(server_id, error))
+
+        if len(errors) > 0:
+            return ", ".join(errors), None
+        return None, len(pending)
+
+    def _start_timer(self):
+        self._timer = threading.Timer(self.debounce, self._timer_flush)
+        self._timer.name = "dns-reload"
+        self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    # Not a daemon thread, so pending reloads still happen if the process exits
+    def _timer_flush(self):
+        error, _ = self._locked_flush(True)
+        if error is not None and self._logger is not None:
+            self._logger.error("Reload failed: %s", error)
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from lib.locking import lock_level
+
+# Restores saved servers in stages: anything networking related first, then
+# DNS, then the CA, then every other service. Modules within a stage don't
+# depend on each other, so they are restored at the same time in a bounded
+# pool. A module's own servers share its state, so they are restored one after
+# another while holding the module's lock, like any other call into it.
+class RestoreScheduler():
+
+    def __init__(self, mm, workers=8, clock=time.monotonic):
+        self.mm = mm
+        self.workers = workers
+        self._clock = clock
+
+    # Returns a list of stages, each a list of (module shortname, server ID, save
+    # data) to restore. Modules save a list with one [server ID, status] entry
+    # per server, so each entry is restored on its own. Anything else is
+    # restored as one piece.
+    def plan(self, all_save_data):
+        levels = {}
+        for module_name in self.mm.modules:
+            module = self.mm.modules[module_name]
+            shortname = module.__SHORTNAME__
+            if shortname not in all_save_data:
+                continue
+
+            save_data = all_save_data[shortname]
+            if isinstance(save_data, list):
+                tasks = []
+                for server_data in save_data:
+                    server_id = None
+                    if isinstance(server_data, list) and len(server_data) > 0:
+                        server_id = server_data[0]
+                    tasks.append((shortname, server_id, [server_data]))
+            else:
+                tasks = [(shortname, None, save_data)]
+
+            level = lock_level(shortname)
+            if level not in levels:
+                levels[level] = []
+            levels[level] += tasks
+
+        return [levels[level] for level in sorted(levels) if len(levels[level]) > 0]
+
+    def _restore_one(self, shortname, server_id, save_data):
+        start = self._clock()
+        error = None
+        try:
+            self.mm.modules[shortname].restore(save_data)
+        except Exception as e:
+            error = str(e)
+        return {
+            "module": shortname,
+            "server": server_id,
+            "seconds": self._clock() - start,
+            "error": error
+        }
+
+    def _restore_module(self, shortname, tasks):
+        timings = []
+        with self.mm.locks.hold(shortname):
+            for _, server_id, save_data in tasks:
+                timings.append(self._restore_one(shortname, server_id, save_data))
+        return timings
+
+    # Returns the timing for each server restored, in the order they were planned
+    def run(self, all_save_data):
+        timings = []
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fakernet-restore") as pool:
+            for stage in self.plan(all_save_data):
+                module_tasks = {}
+                for task in stage:
+                    if task[0] not in module_tasks:
+                        module_tasks[task[0]] = []
+                    module_tasks[task[0]].append(task)
+                futures = [pool.submit(self._restore_module, shortname, module_tasks[shortname]) for shortname in module_tasks]
+                wait(futures)
+                for timing in [timing for future in futures for timing in future.result()]:
+                    timings.append(timing)
+                    if timing['error'] is not None:
+                        self.mm.logger.error("Restore of %s server %s failed: %s", timing['module'], timing['server'], timing['error'])
+                    else:
+                        self.mm.logger.info("Restored %s server %s in %.2fs", timing['module'], timing['server'], timing['seconds'])
+        return timings
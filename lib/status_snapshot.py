@@ -0,0 +1,66 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import docker
+import pylxd
+
+# A point-in-time view of every Docker and LXD container's state, pulled
+# with one listing call per backend and indexed by container name. Passed to
+# each module's get_list so a full listing doesn't do a lookup per server.
+class StatusSnapshot():
+
+    def __init__(self, docker_client, lxd_client, container_cache=None):
+        self._docker = docker_client
+        self._lxd = lxd_client
+        self._cache = container_cache
+        self._docker_status = None
+        self._lxd_status = None
+
+    def load(self):
+        self._docker_status = None
+        self._lxd_status = None
+
+        # An up to date ContainerStateCache already has the Docker side
+        cache_fresh = self._cache is not None and self._cache.is_fresh()
+
+        if self._docker is not None and not cache_fresh:
+            try:
+                # sparse avoids an inspect call per container
+                containers = self._docker.containers.list(all=True, sparse=True)
+                self._docker_status = {}
+                for container in containers:
+                    for name in container.attrs.get('Names', []):
+                        self._docker_status[name.lstrip("/")] = container.status
+            except docker.errors.APIError:
+                self._docker_status = None
+
+        if self._lxd is not None:
+            try:
+                # recursion=1 returns full container data rather than just URLs
+                resp = self._lxd.api.containers.get(params={"recursion": 1})
+                self._lxd_status = {}
+                for container in resp.json()['metadata']:
+                    self._lxd_status[container['name']] = container['status'].lower()
+            except pylxd.exceptions.LXDAPIException:
+                self._lxd_status = None
+
+        return self
+
+    # Same return format as DockerBaseModule.docker_status
+    def docker_status(self, container_name):
+        if self._docker_status is None and self._cache is not None:
+            return self._cache.docker_status(container_name)
+        if self._docker_status is None:
+            return "Docker status not available", ("no", "n/a")
+        if container_name in self._docker_status:
+            return None, ("yes", self._docker_status[container_name])
+        return None, ("no", "n/a")
+
+    # Same return format as LXDBaseModule.lxd_get_status
+    def lxd_status(self, container_name):
+        if self._lxd_status is None:
+            return "LXD status not available", ("no", "unknown")
+        if container_name in self._lxd_status:
+            return None, ("yes", self._lxd_status[container_name])
+        return "Container {} not found".format(container_name), ("no", "unknown")
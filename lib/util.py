@@ -4,10 +4,15 @@
 
 import subprocess
 import json
+import os
+import tempfile
 
 import docker
 import pylxd
 
+from lib.ovsdb import OVSDBClient
+from lib.priv_helper import default_client
+
 def _convert_ovs_type(item):
     if isinstance(item, list):
         if item[0] == 'uuid':
@@ -43,6 +48,35 @@ def convert_ovs_table(ovs_data):
     
     return out_list
 
+# Write a file so readers only ever see the old or new contents. If keep_last
+# is set, the old file is kept as <path>.last
+def atomic_write(path, data, keep_last=False, mode=None):
+    out_dir = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=out_dir, prefix="." + os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        elif os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        else:
+            os.chmod(temp_path, 0o644)
+
+        if keep_last and os.path.exists(path):
+            last_path = path + ".last"
+            if os.path.exists(last_path):
+                os.remove(last_path)
+            os.link(path, last_path)
+
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
 def remove_db():
     subprocess.run(["/bin/rm", "../fakernet.db"])
     subprocess.run(["/bin/rm", "fakernet.db"])
@@ -80,26 +114,54 @@ def remove_all_lxd_images():
         image.delete()
 
 def remove_all_ovs():
-    output = subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "-f", "json", "list", "bridge"]).decode()
-    bridge_list = json.loads(output)
-    bridge_data = convert_ovs_table(bridge_list)
-
-    for bridge in bridge_data:
-        subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "del-br", bridge['name']]).decode()
-
-
-def clean_ovs():
-    output = subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "-f", "json", "list", "bridge"]).decode()
-    bridge_list = json.loads(output)
-    bridge_data = convert_ovs_table(bridge_list)
-
-    output = subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "-f", "json", "list", "port"]).decode()
-    port_list = json.loads(output)
-    port_data = convert_ovs_table(port_list)
-
-    output = subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "-f", "json", "list", "interface"]).decode()
-    interface_list = json.loads(output)
-    interface_data = convert_ovs_table(interface_list)
+    privileged = default_client()
+    err, output = privileged.run("ovs-vsctl", ["-f", "json", "list", "bridge"])
+    if err is not None:
+        raise Exception(err)
+    bridge_data = convert_ovs_table(json.loads(output))
+
+    if len(bridge_data) > 0:
+        err, _ = privileged.run_batch([("ovs-vsctl", ["del-br", bridge['name']]) for bridge in bridge_data])
+        if err is not None:
+            raise Exception(err)
+
+
+# Removes the ports whose interfaces are gone, such as those of stopped
+# containers. Through OVSDB this reads the cached tables and removes every
+# stale port in one transaction, otherwise it uses ovs-vsctl through the
+# privileged client.
+def clean_ovs(ovsdb=None, privileged=None):
+    client = ovsdb
+    if client is None:
+        client = OVSDBClient()
+    try:
+        if client.ensure_connected() is None:
+            transaction = client.transaction()
+            for bridge, port in client.stale_ports():
+                transaction.del_port(bridge, port)
+            err, _ = transaction.commit()
+            if err is not None:
+                raise Exception(err)
+            return
+    finally:
+        if ovsdb is None:
+            client.close()
+
+    if privileged is None:
+        privileged = default_client()
+
+    # The three tables are listed in one request
+    err, results = privileged.run_batch([
+        ("ovs-vsctl", ["-f", "json", "list", "bridge"]),
+        ("ovs-vsctl", ["-f", "json", "list", "port"]),
+        ("ovs-vsctl", ["-f", "json", "list", "interface"])
+    ])
+    if err is not None:
+        raise Exception(err)
+
+    bridge_data = convert_ovs_table(json.loads(results[0]['output']))
+    port_data = convert_ovs_table(json.loads(results[1]['output']))
+    interface_data = convert_ovs_table(json.loads(results[2]['output']))
 
     interface_map = {}
     for interface in interface_data:
@@ -112,14 +174,18 @@ def clean_ovs():
         if isinstance(port['interfaces'], str):
             port_map[port['_uuid']]['interfaces'] = interface_map[port['interfaces']]
 
+    # Every del-port goes in one ovs-vsctl call, which is one transaction
+    args = []
     for row in bridge_data:
         for iface_id in row['ports']:
             if iface_id in port_map:
                 port = port_map[iface_id]
                 if 'error' in port['interfaces'] and 'could not open' in port['interfaces']['error']:
-                    subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "del-port", row['name'], port['name']]).decode()
-
-            
-
-    
-    # print(bridge_list['data'])
+                    if len(args) > 0:
+                        args.append("--")
+                    args += ["del-port", row['name'], port['name']]
+
+    if len(args) > 0:
+        err, _ = privileged.run("ovs-vsctl", args)
+        if err is not None:
+            raise Exception(err)
@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import functools
 import ipaddress
 import re
 
@@ -21,9 +22,35 @@ def is_ip(value):
 
 def is_ip_in_network(ip, network):
     if is_ipnetwork(network) and is_ip(ip):
-        net = ipaddress.ip_network(network)
-        return ipaddress.ip_address(ip) in net
+        return ipaddress.ip_address(ip) in get_network(network)
     return False
 
+# Networks are looked up by the same few strings on every container start, so
+# the parsed networks and the addresses worked out from them are kept. None of
+# these walk the network's hosts, so a /8 costs the same as a /30.
+@functools.lru_cache(maxsize=4096)
+def get_network(network):
+    return ipaddress.ip_network(network)
+
+# The first host, which is the switch's address and every container's gateway
+@functools.lru_cache(maxsize=4096)
+def get_gateway(network):
+    network = get_network(network)
+    if network.num_addresses <= 2:
+        return network.network_address
+    return network.network_address + 1
+
+@functools.lru_cache(maxsize=4096)
+def get_broadcast(network):
+    return get_network(network).broadcast_address
+
+# The number of usable host addresses
+@functools.lru_cache(maxsize=4096)
+def get_host_count(network):
+    network = get_network(network)
+    if network.num_addresses <= 2:
+        return network.num_addresses
+    return network.num_addresses - 2
+
 def is_valid_dns(name):
     return re.match(r"[0-9A-Za-z-]+$", name)
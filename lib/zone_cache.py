@@ -0,0 +1,162 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import threading
+from collections import OrderedDict
+
+import lib.easyzone as easyzone
+from lib.util import atomic_write
+
+class CachedZone():
+
+    def __init__(self, zone, filename):
+        self.zone = zone
+        self.filename = filename
+        self.dirty = False
+        self.size = zone.size
+        self.stat = _file_stat(filename)
+
+def _file_stat(filename):
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_size)
+
+# Keeps parsed zones in memory so a change to one record doesn't mean parsing
+# and writing out the whole zone. Zones are keyed by a tuple, e.g. (server ID,
+# zone, direction). A clean zone is parsed again if its file changed on disk.
+# Changed zones are written out write_delay seconds after the first change, or
+# on flush(). Once the cached zones hold more than max_names names, the least
+# recently used zones are written out if needed and dropped.
+class ZoneCache():
+
+    def __init__(self, max_names=500000, write_delay=1.0, lock=None, logger=None):
+        self.max_names = max_names
+        self.write_delay = write_delay
+        # Called to get a lock that keeps zones from changing during a write
+        self._get_lock = lock
+        self._logger = logger
+
+        self._lock = threading.RLock()
+        self._zones = OrderedDict()
+        self._names = 0
+        self._timer = None
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the easyzone.Zone for key, loading it from filename if needed
+    def get(self, key, domain, filename):
+        with self._lock:
+            entry = self._zones.get(key)
+            if entry is not None and entry.filename == filename:
+                if entry.dirty:
+                    # Unsaved changes win over any outside edit
+                    self._zones.move_to_end(key)
+                    self.hits += 1
+                    return entry.zone
+                if _file_stat(filename) == entry.stat:
+                    self._zones.move_to_end(key)
+                    self.hits += 1
+                    return entry.zone
+
+            self.misses += 1
+            self._drop(key)
+            entry = CachedZone(easyzone.zone_from_file(domain, filename), filename)
+            self._zones[key] = entry
+            self._names += entry.size
+            self._evict(key)
+            return entry.zone
+
+    # Call after changing a zone returned by get()
+    def mark_dirty(self, key):
+        with self._lock:
+            entry = self._zones.get(key)
+            if entry is None:
+                return
+            entry.dirty = True
+            self._names += entry.zone.size - entry.size
+            entry.size = entry.zone.size
+            if self._timer is None:
+                self._timer = threading.Timer(self.write_delay, self._timer_flush)
+                self._timer.name = "zone-cache-write"
+                self._timer.start()
+
+    def is_dirty(self, key):
+        with self._lock:
+            return key in self._zones and self._zones[key].dirty
+
+    def _matching(self, prefix):
+        if prefix is None:
+            return list(self._zones.keys())
+        return [key for key in self._zones if key[:len(prefix)] == prefix]
+
+    # Drops zones whose key starts with prefix without writing them, for zones
+    # that are about to be replaced or removed
+    def discard(self, prefix):
+        with self._lock:
+            for key in self._matching(prefix):
+                self._drop(key)
+            self._stop_timer_if_clean()
+
+    def _drop(self, key):
+        entry = self._zones.pop(key, None)
+        if entry is not None:
+            self._names -= entry.size
+
+    def _write(self, entry):
+        atomic_write(entry.filename, entry.zone.to_text(autoserial=True))
+        entry.dirty = False
+        entry.stat = _file_stat(entry.filename)
+
+    def _evict(self, keep_key):
+        while self._names > self.max_names and len(self._zones) > 1:
+            key = next(iter(self._zones))
+            if key == keep_key:
+                self._zones.move_to_end(key)
+                key = next(iter(self._zones))
+            entry = self._zones[key]
+            if entry.dirty:
+                self._write(entry)
+            self._drop(key)
+        self._stop_timer_if_clean()
+
+    def _stop_timer_if_clean(self):
+        if self._timer is not None and not any(entry.dirty for entry in self._zones.values()):
+            self._timer.cancel()
+            self._timer = None
+
+    # Writes out changed zones, all of them or those whose key starts with
+    # prefix. Returns the number of zones written.
+    def flush(self, prefix=None):
+        if self._get_lock is not None:
+            with self._get_lock():
+                return self._flush(prefix)
+        return self._flush(prefix)
+
+    def _flush(self, prefix):
+        errors = []
+        written = 0
+        with self._lock:
+            for key in self._matching(prefix):
+                entry = self._zones[key]
+                if not entry.dirty:
+                    continue
+                try:
+                    self._write(entry)
+                    written += 1
+                except OSError as e:
+                    errors.append("{}: {}".format(entry.filename, e))
+
+            self._stop_timer_if_clean()
+
+        if len(errors) > 0:
+            return ", ".join(errors), None
+        return None, written
+
+    # Not a daemon thread, so changes are still written if the process exits
+    def _timer_flush(self):
+        with self._lock:
+            self._timer = None
+        error, _ = self.flush()
+        if error is not None and self._logger is not None:
+            self._logger.error("Writing zones failed: %s", error)
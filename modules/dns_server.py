@@ -1,6 +1,8 @@
 import os
+import io
+import csv
+import json
 import shutil 
-import time
 from string import Template
 
 import dns.reversename
@@ -8,8 +10,16 @@ import docker
 
 import lib.easyzone as easyzone
 import lib.validate as validate
+import lib.dns_update as dns_update
 
 from lib.base_module import DockerBaseModule
+from lib.domain_index import DomainIndex
+from lib.dns_responder import DNSLab
+from lib.named_config import NamedConfig
+from lib.record_store import RecordStore, parse_record
+from lib.reload_coalescer import ReloadCoalescer
+from lib.zone_cache import ZoneCache
+from lib.util import atomic_write
 
 DNS_BASE_DIR = "{}/work/dns".format(os.getcwd())
 
@@ -20,6 +30,14 @@ ZONE_CONFIG_TEMPLATE = """zone "$ZONE" IN {
 };
 """
 
+ZONE_DYNAMIC_CONFIG_TEMPLATE = """zone "$ZONE" IN {
+    type master;
+    file "$PATH";
+    forwarders { };
+    allow-update { key "$KEY"; };
+};
+"""
+
 ZONE_FORWARDING_CONFIG_TEMPLATE = """zone "$ZONE" {
     type forward;
     forward only;
@@ -30,10 +48,53 @@ ZONE_FORWARDING_CONFIG_TEMPLATE = """zone "$ZONE" {
 
 INSTANCE_TEMPLATE = "dns-server-{}"
 
+# Seconds to wait for more changes before reloading BIND
+RELOAD_DEBOUNCE = 1.0
+# Seconds to wait for more changes before writing out a changed zone
+ZONE_WRITE_DELAY = 1.0
+# Seconds to wait for more dynamic updates before having BIND write them to
+# the zone file
+ZONE_SYNC_DELAY = 5.0
+# Port BIND takes dynamic updates on
+DNS_UPDATE_PORT = 53
+# Number of files the zone config includes of named.conf are split across
+NAMED_INCLUDE_SHARDS = 16
+# Included from named.conf itself rather than a shard
+UPDATE_KEY_INCLUDE = "update.key"
+
+BULK_RECORD_TYPES = ['A', 'CNAME', 'MX', 'NS', 'TXT', 'PTR']
+BULK_RECORD_FIELDS = {
+    "fqdn": "TEXT",
+    "type": BULK_RECORD_TYPES,
+    "value": "ADVTEXT"
+}
+
+# Overrides are A records in a response policy zone on the main server
+OVERRIDE_ZONE = "fn.rpz"
+OVERRIDE_SERVER_ID = 1
+OVERRIDE_FIELDS = {
+    "fqdn": "TEXT",
+    "ip_addr": "IP_ADDR"
+}
+
 class DNSServer(DockerBaseModule):
 
     def __init__(self, mm):
         self.mm = mm
+        lock = None
+        if hasattr(mm, "locks"):
+            lock = lambda: mm.locks.module_lock(self.__SHORTNAME__)
+        self.reloads = ReloadCoalescer(self._rndc_reload, debounce=RELOAD_DEBOUNCE, lock=lock, logger=getattr(mm, "logger", None))
+        self.zones = ZoneCache(write_delay=ZONE_WRITE_DELAY, lock=lock, logger=getattr(mm, "logger", None))
+        self.syncs = ReloadCoalescer(self._rndc_sync, debounce=ZONE_SYNC_DELAY, lock=lock, logger=getattr(mm, "logger", None))
+        self._domain_index = None
+        self._store = None
+        # server ID -> NamedConfig
+        self._named_configs = {}
+        # In-process responders serving the servers' zones, if started
+        self._simulation = None
+        # server ID -> dynamic update key, or None for servers using zone files
+        self._update_keys = {}
 
     __FUNCS__ = {
         "list": {
@@ -152,6 +213,42 @@ class DNSServer(DockerBaseModule):
             "fqdn": "TEXT",
             "ip_addr": "IP_ADDR"
         },
+        "bulk_add_records": {
+            "_desc": "Add many records at once, from a list or a JSON or CSV file of fqdn, type and value",
+            "records": "DATA"
+        },
+        "bulk_remove_records": {
+            "_desc": "Remove many records at once, from a list or a JSON or CSV file of fqdn, type and value",
+            "records": "DATA"
+        },
+        "find_zone": {
+            "_desc": "Find the DNS server and zone that hold a name",
+            "fqdn": "TEXT"
+        },
+        "find_records": {
+            "_desc": "Find records at or under a name, of a type or with a value. Leave any blank to match everything",
+            "fqdn": "TEXT",
+            "type": "TEXT",
+            "value": "TEXT"
+        },
+        "render_zones": {
+            "_desc": "Rewrite a DNS server's zone files from the records in the database",
+            "id": "INTEGER"
+        },
+        "start_simulation": {
+            "_desc": "Serve every DNS server's zones from in-process responders on local ports, without containers"
+        },
+        "stop_simulation": {
+            "_desc": "Stop the in-process DNS responders"
+        },
+        "set_update_engine": {
+            "_desc": "Change records by editing zone files, or by sending dynamic updates to BIND",
+            "id": "INTEGER",
+            "engine": ["file", "dynamic"]
+        },
+        "flush": {
+            "_desc": "Reload changed zones on all DNS servers now"
+        },
         "add_override": {
             "_desc": "Add a single domain override",
             "fqdn": "TEXT",
@@ -162,6 +259,14 @@ class DNSServer(DockerBaseModule):
             "fqdn": "TEXT",
             "ip_addr": "IP_ADDR"
         },
+        "add_overrides": {
+            "_desc": "Add many domain overrides at once, from a list or a JSON or CSV file of fqdn and ip_addr",
+            "overrides": "DATA"
+        },
+        "remove_overrides": {
+            "_desc": "Remove many domain overrides at once, from a list or a JSON or CSV file of fqdn and ip_addr",
+            "overrides": "DATA"
+        },
     } 
 
     __SHORTNAME__  = "dns"
@@ -169,17 +274,115 @@ class DNSServer(DockerBaseModule):
     __AUTHOR__ = "Jacob Hartman"
     __SERVER_IMAGE_NAME__ = "fn-dns-server"
 
-    def _get_dns_server(self, fqdn):
+    # The index of servers, zones and forwarding zones, built from the
+    # database and config directories the first time it is needed
+    def _domains(self):
+        if self._domain_index is None:
+            self._domain_index = self._build_domain_index()
+        return self._domain_index
+
+    def _build_domain_index(self):
+        index = DomainIndex()
         dbc = self.mm.db.cursor()
-        # Get our server id by looking through the domains
-        fqdn_split = fqdn.split(".")
-        parent_domain = ".".join(fqdn_split[1:])
-        dbc.execute("SELECT * FROM dns_server WHERE server_domain=?",(parent_domain,))
-        result = dbc.fetchone()
-        if result is None:
-            return None
-        else:
-            return result[0]
+        dbc.execute("SELECT server_id, server_domain FROM dns_server;")
+        for dns_server_id, server_domain in dbc.fetchall():
+            index.add(server_domain, "server", dns_server_id)
+
+            for zone, direction in self._list_zones(dns_server_id):
+                index.add(zone, direction, dns_server_id)
+
+            conf_path = "{}/{}/conf".format(DNS_BASE_DIR, dns_server_id)
+            if os.path.isdir(conf_path):
+                for filename in os.listdir(conf_path):
+                    if filename.startswith("forward-") and filename.endswith(".conf"):
+                        index.add(filename[len("forward-"):-len(".conf")], "forward", dns_server_id)
+
+        return index
+
+    # The dns_record table, the source of truth for records. It is filled
+    # from the zone files of existing servers when first created.
+    def _record_store(self):
+        if self._store is None:
+            self._store = RecordStore(self.mm.db)
+            if self._store.ensure_schema():
+                self._import_zone_files()
+        return self._store
+
+    def _import_zone_files(self):
+        dbc = self.mm.db.cursor()
+        dbc.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='dns_server';")
+        if dbc.fetchone() is None:
+            return
+
+        dbc.execute("SELECT server_id FROM dns_server;")
+        for (dns_server_id,) in dbc.fetchall():
+            zones = self._list_zones(dns_server_id)
+            if os.path.exists(self._override_path(dns_server_id)):
+                zones.append((OVERRIDE_ZONE, "rpz"))
+            for zone, direction in zones:
+                try:
+                    if direction == "rpz":
+                        zone_file = easyzone.zone_from_file(zone, self._override_path(dns_server_id))
+                    else:
+                        zone_file = self._load_zone(dns_server_id, zone, direction)
+                    self._store_zone_file(dns_server_id, zone, direction, zone_file)
+                except Exception as e:
+                    self.print("Could not import zone {} of DNS server {}: {}".format(zone, dns_server_id, e))
+
+    # Replaces the records of a zone in the record store with those in the
+    # easyzone.Zone zone_file
+    def _store_zone_file(self, dns_server_id, zone, direction, zone_file):
+        store = self._record_store()
+        store.clear_zone(dns_server_id, zone, direction)
+        records = []
+        for name, record_type, ttl, value in zone_file.iter_records():
+            records.append((name.lower(), record_type, value, ttl))
+        store.add(dns_server_id, zone, direction, records)
+
+    # The includes of a server's named.conf. Changes are written out by
+    # _flush_named_config, which happens before each reload.
+    def _named_config(self, dns_server_id):
+        server_key = str(dns_server_id)
+        config = self._named_configs.get(server_key)
+        # Unsaved changes win over any outside edit
+        if config is None or (config.is_stale() and not config.is_dirty()):
+            dns_config_path = "{}/{}".format(DNS_BASE_DIR, dns_server_id)
+            config = NamedConfig(dns_config_path + "/named.conf", dns_config_path + "/conf", shards=NAMED_INCLUDE_SHARDS, top=(UPDATE_KEY_INCLUDE,))
+            self._named_configs[server_key] = config
+        return config
+
+    def _flush_named_config(self, dns_server_id):
+        config = self._named_configs.get(str(dns_server_id))
+        if config is None:
+            return None, 0
+        try:
+            return None, config.flush()
+        except OSError as e:
+            return "Could not write named.conf: {}".format(e), None
+
+    # Returns (zone, direction) for each zone file of a server
+    def _list_zones(self, dns_server_id):
+        zones = []
+        zones_path = "{}/{}/zones".format(DNS_BASE_DIR, dns_server_id)
+        if os.path.isdir(zones_path):
+            for filename in sorted(os.listdir(zones_path)):
+                zone, _, direction = filename.rpartition(".")
+                if zone != "" and (direction == "fwd" or direction == "rev"):
+                    zones.append((zone, direction))
+        return zones
+
+    # Returns (server ID, domain) for the server of the nearest domain above
+    # fqdn, or (None, None)
+    def _get_dns_server(self, fqdn):
+        return self._domains().find(fqdn, "server", strict=True)
+
+    # Returns (server ID, zone) for the nearest zone holding fqdn, or only
+    # above it if strict, or (None, None)
+    def _find_zone(self, fqdn, direction, strict=False):
+        return self._domains().find(fqdn, direction, strict=strict)
+
+    def _has_zone(self, dns_server_id, zone, direction):
+        return str(dns_server_id) in self._domains().get(zone, direction)
 
     def _split_fqdn(self, fqdn):
         fqdn_split = fqdn.split(".")
@@ -189,6 +392,20 @@ class DNSServer(DockerBaseModule):
         zone = ".".join(fqdn_split[1:])
         return hostname, zone
 
+    def _zone_key(self, dns_server_id, zone, direction):
+        return (str(dns_server_id), zone, direction)
+
+    # Returns the zone's easyzone.Zone from the zone cache
+    def _load_zone(self, dns_server_id, zone, direction):
+        zone_path = "{}/{}/zones/{}.{}".format(DNS_BASE_DIR, dns_server_id, zone, direction)
+        return self.zones.get(self._zone_key(dns_server_id, zone, direction), zone, zone_path)
+
+    # Call after changing a zone from _load_zone, so it gets written out and
+    # reloaded by BIND
+    def _zone_changed(self, dns_server_id, zone, direction):
+        self.zones.mark_dirty(self._zone_key(dns_server_id, zone, direction))
+        self.reloads.mark(dns_server_id, zone)
+
     def _add_forwarding_zone(self, dns_server_id, zone, forwarder):
 
         dns_config_path = "{}/{}".format(DNS_BASE_DIR, dns_server_id)
@@ -200,10 +417,8 @@ class DNSServer(DockerBaseModule):
         config_file.write(t.substitute({'ZONE' : zone, 'FORWARDER': forwarder})) 
         config_file.close()
 
-        main_config_contents = open(dns_config_path + "/named.conf", "r").read()
-        if not "include \"/etc/bind/conf/{}.conf\";\n".format(zone) in main_config_contents:
-            main_config_file = open(dns_config_path + "/named.conf", "a")
-            main_config_file.write("\ninclude \"/etc/bind/conf/forward-{}.conf\";\n".format(zone))
+        self._named_config(dns_server_id).add_include("forward-{}.conf".format(zone))
+        self._domains().add(zone, "forward", dns_server_id)
 
         return None, True
 
@@ -213,20 +428,9 @@ class DNSServer(DockerBaseModule):
 
         zone_config_path = "{}/conf/forward-{}.conf".format(dns_config_path, zone)
 
+        self._named_config(dns_server_id).remove_include("forward-{}.conf".format(zone))
         os.remove(zone_config_path)
-
-        main_config = open(dns_config_path + "/named.conf", "r+")
-        main_config_contents = main_config.read()
-        config_lines = main_config_contents.split("\n")
-        new_contents = ""
-        for line in config_lines:
-            if "include \"/etc/bind/conf/forward-{}.conf\";".format(zone) not in line:
-                new_contents += line + "\n"
-        
-        main_config.seek(0)
-        main_config.truncate()
-        main_config.write(new_contents)
-        main_config.close()
+        self._domains().remove(zone, "forward", dns_server_id)
 
         return None, True
 
@@ -245,23 +449,24 @@ class DNSServer(DockerBaseModule):
             return "Zone already exists", None
         
 
+        self.zones.discard(self._zone_key(dns_server_id, zone, direction))
+
         zone_file = open("./docker-images/dns/zone-template", "r").read()
         zone_file = zone_file.replace("TEMPLATE.ZONE", zone)
         out_zone = open(zone_path, "w+")
         out_zone.write(zone_file)
         out_zone.close()
 
-        t = Template(ZONE_CONFIG_TEMPLATE) 
-        config_file = open(zone_config_path, "w+")
-        config_file.write(t.substitute({'ZONE' : zone, 'PATH': "/etc/bind/zones/{}.{}".format(zone, direction)})) 
-        config_file.close()
+        self._write_zone_config(dns_server_id, zone, direction)
+
+        self._domains().add(zone, direction, dns_server_id)
 
         full_zone_name = zone
 
         if full_zone_name[len(full_zone_name)-1] != ".":
             full_zone_name = full_zone_name + "."
 
-        zone_file = easyzone.zone_from_file(zone, zone_path)
+        zone_file = self._load_zone(dns_server_id, zone, direction)
         zone_ns = "ns1." + full_zone_name
 
         # Set up the NS to point to the server correctly
@@ -275,56 +480,269 @@ class DNSServer(DockerBaseModule):
         zone_file.delete_name(zone_ns)
         zone_file.add_name(zone_ns)
 
-        ns_a = zone_file.names[zone_ns].records("A", create=True)
+        ns_a = zone_file.get_name(zone_ns).records("A", create=True)
         ns_a.add(result[0])
 
+        self.zones.mark_dirty(self._zone_key(dns_server_id, zone, direction))
+
+        self._store_zone_file(dns_server_id, zone, direction, zone_file)
+
+        self._named_config(dns_server_id).add_include("{}.conf".format(zone))
+
+        # BIND only learns about new zones from a full reload
+        if self._update_key(dns_server_id) is not None:
+            # Load it now, so dynamic updates to it can follow right away
+            self.reloads.discard(dns_server_id)
+            err, _ = self._rndc_reload(dns_server_id)
+            if err is not None:
+                return err, None
+            return self._prepare_dynamic_updates(dns_server_id)
+        self.reloads.mark(dns_server_id)
+
+        return None, True
+
+    def _write_zone_config(self, dns_server_id, zone, direction):
+        zone_config_path = "{}/{}/conf/{}.conf".format(DNS_BASE_DIR, dns_server_id, zone)
+        values = {'ZONE' : zone, 'PATH': "/etc/bind/zones/{}.{}".format(zone, direction)}
+
+        if self._update_key(dns_server_id) is None:
+            t = Template(ZONE_CONFIG_TEMPLATE)
+        else:
+            t = Template(ZONE_DYNAMIC_CONFIG_TEMPLATE)
+            values['KEY'] = dns_update.UPDATE_KEY_NAME
+
+        config_file = open(zone_config_path, "w+")
+        config_file.write(t.substitute(values)) 
+        config_file.close()
+
+    def _update_key_path(self, dns_server_id):
+        return "{}/{}/conf/update.key".format(DNS_BASE_DIR, dns_server_id)
+
+    # Returns the server's dynamic update key, or None if records are
+    # changed by editing zone files
+    def _update_key(self, dns_server_id):
+        server_key = str(dns_server_id)
+        if server_key not in self._update_keys:
+            secret = None
+            key_path = self._update_key_path(dns_server_id)
+            if os.path.exists(key_path):
+                key_file = open(key_path, "r")
+                secret = dns_update.parse_update_key(key_file.read())
+                key_file.close()
+            self._update_keys[server_key] = secret
+        return self._update_keys[server_key]
+
+    # Applies (action, name, type, value) changes, where action is "add" or
+    # "delete", to one zone. Changes are checked against and saved to the
+    # record store, then running servers using dynamic updates get them as
+    # DNS UPDATE messages, otherwise the zone file is changed. Returns an error
+    # or None for each change.
+    def _change_records(self, dns_server_id, zone, direction, changes):
+        store = self._record_store()
+        errors = []
+        # (action, name, type, rdata) for each valid change
+        valid = []
+        for action, name, record_type, value in changes:
+            try:
+                name, rdata = parse_record(zone, name, record_type, value)
+            except ValueError as e:
+                errors.append("Invalid record: {}".format(e))
+                continue
+
+            error = None
+            if action == "delete" and not store.has_record(dns_server_id, zone, name, record_type, rdata.to_text()):
+                if not store.has_name(dns_server_id, zone, name):
+                    error = "{} not in zone {}".format(name, zone)
+                else:
+                    error = "Value '{}' not in records".format(value)
+            else:
+                valid.append((action, name, record_type, rdata))
+            errors.append(error)
+
+        if len(valid) == 0:
+            return None, errors
+
+        err = self._apply_changes(dns_server_id, zone, direction, valid)
+        if err is not None:
+            return err, None
+
+        added = []
+        removed = []
+        for action, name, record_type, rdata in valid:
+            if action == "add":
+                added.append((name, record_type, rdata.to_text(), dns_update.DEFAULT_TTL))
+            else:
+                removed.append((name, record_type, rdata.to_text()))
+        store.add(dns_server_id, zone, direction, added)
+        store.remove(dns_server_id, zone, removed)
+
+        return None, errors
+
+    def _apply_changes(self, dns_server_id, zone, direction, changes):
+        secret = self._update_key(dns_server_id)
+        if secret is not None:
+            _, status = self.docker_status(INSTANCE_TEMPLATE.format(dns_server_id))
+            if status[1] == "running":
+                updates = []
+                for action, name, record_type, rdata in changes:
+                    updates.append((action, name, record_type, rdata.to_text()))
+                err, _ = self._send_updates(dns_server_id, zone, updates, secret)
+                return err
+
+        zone_file = self._load_zone(dns_server_id, zone, direction)
+        for action, name, record_type, rdata in changes:
+            try:
+                if action == "add":
+                    zone_file.add_name(name)
+                    zone_file.get_name(name).records(record_type, create=True).add(rdata)
+                elif zone_file.has_name(name):
+                    name_records = zone_file.get_name(name).records(record_type)
+                    if name_records is not None:
+                        name_records.delete(rdata)
+            except easyzone.RecordsError:
+                # The zone file already matches
+                pass
+
+        self._zone_changed(dns_server_id, zone, direction)
+        return None
 
-        zone_file.save(autoserial=True)
+    def _send_updates(self, dns_server_id, zone, changes, secret):
+        dbc = self.mm.db.cursor()
+        dbc.execute("SELECT server_ip FROM dns_server WHERE server_id=?", (dns_server_id,))
+        result = dbc.fetchone()
+        if not result:
+            return "DNS server does not exist", None
+
+        error, _ = dns_update.send_update(result[0], zone, changes, secret, port=DNS_UPDATE_PORT)
+        if error is not None:
+            return error, None
 
-        main_config_contents = open(dns_config_path + "/named.conf", "r").read()
-        if not "include \"/etc/bind/conf/{}.conf\";\n".format(zone) in main_config_contents:
-            main_config_file = open(dns_config_path + "/named.conf", "a")
-            main_config_file.write("\ninclude \"/etc/bind/conf/{}.conf\";\n".format(zone))
+        # BIND keeps updates in a journal until told to write the zone file
+        self.syncs.mark(dns_server_id, zone)
+        return None, [None] * len(changes)
 
+    # Lets BIND, which runs as the named user, write journals and zone files
+    def _prepare_dynamic_updates(self, dns_server_id):
+        container_name = INSTANCE_TEMPLATE.format(dns_server_id)
+        try:
+            container = self.mm.docker.containers.get(container_name)
+            if container.status != "running":
+                return None, True
+            code, _ = container.exec_run("chown -R named:named /etc/bind/zones /etc/bind/conf/update.key")
+            if code != 0:
+                return "Could not give BIND access to the zone files", None
+        except docker.errors.NotFound:
+            return "DNS server not found", None
         return None, True
 
+    def _set_update_engine(self, dns_server_id, dynamic):
+        if dynamic == (self._update_key(dns_server_id) is not None):
+            return None, True
+
+        key_path = self._update_key_path(dns_server_id)
+
+        if dynamic:
+            # BIND takes over changing the zone files, so they must be current
+            err, _ = self.zones.flush((str(dns_server_id),))
+            if err is not None:
+                return err, None
+            atomic_write(key_path, dns_update.update_key_config(dns_update.make_update_key()), mode=0o600)
+            self._named_config(dns_server_id).add_include(UPDATE_KEY_INCLUDE)
+        else:
+            # Have BIND write out its journals, so the zone files have every update
+            self.syncs.discard(dns_server_id)
+            err, _ = self._rndc_sync(dns_server_id)
+            if err is not None:
+                return err, None
+            os.remove(key_path)
+            self._named_config(dns_server_id).remove_include(UPDATE_KEY_INCLUDE)
+
+        self._update_keys.pop(str(dns_server_id), None)
+        for zone, direction in self._list_zones(dns_server_id):
+            self._write_zone_config(dns_server_id, zone, direction)
+
+        if dynamic:
+            err, _ = self._prepare_dynamic_updates(dns_server_id)
+            if err is not None:
+                return err, None
+
+        # BIND picks up the zone configs on a full reload
+        self.reloads.discard(dns_server_id)
+        return self._rndc_reload(dns_server_id)
+
+    # Rewrites every zone file of a server from the record store
+    def _render_zones(self, dns_server_id):
+        if self._update_key(dns_server_id) is not None:
+            return "Zone files of servers using dynamic updates are changed by BIND, switch to the file engine first", None
+
+        store = self._record_store()
+        dns_config_path = "{}/{}".format(DNS_BASE_DIR, dns_server_id)
+        zone_template = open("./docker-images/dns/zone-template", "r").read()
+
+        named_config = self._named_config(dns_server_id)
+        for zone, direction in store.zones(dns_server_id):
+            if direction == "rpz":
+                # Configured in named.conf itself
+                err = self._write_override_zone(dns_server_id)
+                if err is not None:
+                    return err, None
+                continue
+
+            zone_path = "{}/zones/{}.{}".format(dns_config_path, zone, direction)
+            if not os.path.exists(zone_path):
+                out_zone = open(zone_path, "w+")
+                out_zone.write(zone_template.replace("TEMPLATE.ZONE", zone))
+                out_zone.close()
+                self.zones.discard(self._zone_key(dns_server_id, zone, direction))
+            self._write_zone_config(dns_server_id, zone, direction)
+            self._domains().add(zone, direction, dns_server_id)
+
+            named_config.add_include("{}.conf".format(zone))
+
+            zone_file = self._load_zone(dns_server_id, zone, direction)
+            zone_file.clear_records()
+            for name, record_type, value, _ in store.zone_records(dns_server_id, zone, direction):
+                _, rdata = parse_record(zone, name, record_type, value)
+                zone_file.add_name(name)
+                zone_file.get_name(name).records(record_type, create=True).add(rdata)
+            self.zones.mark_dirty(self._zone_key(dns_server_id, zone, direction))
+
+        # New zones are only picked up on a full reload
+        self.reloads.discard(dns_server_id)
+        err, _ = self._rndc_reload(dns_server_id)
+        if err is not None:
+            return err, None
+        return None, len(store.zones(dns_server_id))
+
     def _add_host(self, fqdn, ip_addr):
 
         if not validate.is_ip(ip_addr):
             return "Invalid IP address", None
 
-        # Get our server id by looking through the domains
-        dns_server_id = self._get_dns_server(fqdn)
+        fqdn = fqdn.rstrip(".")
+
+        # Find the zone the host goes in
+        dns_server_id, zone = self._find_zone(fqdn, "fwd")
         if dns_server_id is None:
             return "Could not find parent domain for {}".format(fqdn), None 
 
-        dns_config_path = "{}/{}".format(DNS_BASE_DIR, dns_server_id)
-        if not os.path.exists(dns_config_path):
-            return "DNS server {} does not exist".format(dns_server_id), None
-
-        hostname, zone = self._split_fqdn(fqdn)
-
-        zone_path =  "{}/zones/{}.{}".format(dns_config_path, zone, "fwd")
-        if not os.path.exists(zone_path):
-            return "Zone does not exist", None
-
-        error, _ = self.run("add_record", id=dns_server_id, zone=zone, direction="fwd", type="A", name=hostname+"."+zone, value=ip_addr)
+        error, _ = self.run("add_record", id=dns_server_id, zone=zone, direction="fwd", type="A", name=fqdn + ".", value=ip_addr)
         if error is not None:
             return error, None
 
         # Check for reverse
-        rev_name = str(dns.reversename.from_address(str(ip_addr)))[:-1]
-        
-        last_num, rev_name = self._split_fqdn(rev_name)
+        rev_name_full = str(dns.reversename.from_address(str(ip_addr)))[:-1]
 
-        dns_config_path = "{}/{}".format(DNS_BASE_DIR, 1)
-        zone_path =  "{}/zones/{}.{}".format(dns_config_path, rev_name, "rev")
-        if not os.path.exists(zone_path):
-            error, _ = self.run("add_zone", id=1, direction="rev", zone=rev_name)
+        rev_server_id, rev_name = self._find_zone(rev_name_full, "rev")
+        if rev_server_id is None:
+            # Reverse zones are created on the main server
+            rev_server_id = 1
+            _, rev_name = self._split_fqdn(rev_name_full)
+            error, _ = self.run("add_zone", id=rev_server_id, direction="rev", zone=rev_name)
             if error is not None:
                 return error, None
 
-        error, _ = self.run("add_record", id=1, zone=rev_name, direction="rev", type="PTR", name=str(last_num), value=hostname+"."+zone+".")
+        error, _ = self.run("add_record", id=rev_server_id, zone=rev_name, direction="rev", type="PTR", name=rev_name_full + ".", value=fqdn + ".")
         if error is not None:
             return error, None
 
@@ -335,41 +753,266 @@ class DNSServer(DockerBaseModule):
         if not validate.is_ip(ip_addr):
             return "Invalid IP address", None
 
-        # Get our server id by looking through the domains
-        dns_server_id = self._get_dns_server(fqdn)
+        fqdn = fqdn.rstrip(".")
+
+        # Find the zone the host is in
+        dns_server_id, zone = self._find_zone(fqdn, "fwd")
         if dns_server_id is None:
             return "Could not find parent domain for {}".format(fqdn), None 
 
-        dns_config_path = "{}/{}".format(DNS_BASE_DIR, dns_server_id)
-        if not os.path.exists(dns_config_path):
-            return "DNS server {} does not exist".format(dns_server_id), None
-
-        hostname, zone = self._split_fqdn(fqdn)
-
-        zone_path =  "{}/zones/{}.{}".format(dns_config_path, zone, "fwd")
-        if not os.path.exists(zone_path):
-            return "Zone does not exist", None
-
-        error, _ = self.run("remove_record", id=dns_server_id, zone=zone, direction="fwd", type="A", name=hostname+"."+zone, value=ip_addr)
+        error, _ = self.run("remove_record", id=dns_server_id, zone=zone, direction="fwd", type="A", name=fqdn + ".", value=ip_addr)
         if error is not None:
             return error, None
 
         # Check for reverse
         rev_name_full = str(dns.reversename.from_address(str(ip_addr)))[:-1]
-        
-        last_num, rev_name = self._split_fqdn(rev_name_full)
 
-        dns_config_path = "{}/{}".format(DNS_BASE_DIR, 1)
-        zone_path =  "{}/zones/{}.{}".format(dns_config_path, rev_name, "rev")
-        if not os.path.exists(zone_path):
+        rev_server_id, rev_name = self._find_zone(rev_name_full, "rev")
+        if rev_server_id is None:
             return "Reverse zone does not exist", None
 
-        error, _ = self.run("remove_record", id=1, zone=rev_name, direction="rev", type="PTR", name=rev_name_full + ".", value=hostname+"."+zone+".")
+        error, _ = self.run("remove_record", id=rev_server_id, zone=rev_name, direction="rev", type="PTR", name=rev_name_full + ".", value=fqdn + ".")
         if error is not None:
             return error, None
 
         return None, True
 
+    # Turns a list, or JSON or CSV text, into a list of dicts of columns. CSV
+    # rows have the columns in order with an optional header row, and JSON
+    # objects have the list under key.
+    def _parse_records(self, data, columns=("fqdn", "type", "value"), key="records"):
+        if isinstance(data, str):
+            text = data.strip()
+            if text.startswith("[") or text.startswith("{"):
+                try:
+                    data = json.loads(text)
+                except ValueError as e:
+                    return "Invalid JSON: {}".format(e), None
+                if isinstance(data, dict):
+                    data = data.get(key)
+            else:
+                data = []
+                for row in csv.reader(io.StringIO(text)):
+                    if len(row) == 0 or row[0].strip().startswith("#"):
+                        continue
+                    data.append(row)
+                if len(data) > 0 and [column.strip().lower() for column in data[0][:len(columns)]] == list(columns):
+                    data = data[1:]
+
+        if not isinstance(data, list):
+            return "{} must be a list, or JSON or CSV text".format(key.capitalize()), None
+
+        records = []
+        for item in data:
+            if isinstance(item, (list, tuple)):
+                item = dict(zip(columns, [str(column).strip() for column in item]))
+            records.append(item)
+        return None, records
+
+    # Works out where a bulk record goes. Returns (server ID, zone, direction,
+    # name, type, value)
+    def _plan_record(self, record):
+        if not isinstance(record, dict):
+            return "Record must have fqdn, type and value", None
+        if 'type' in record:
+            record = dict(record, type=str(record['type']).upper())
+        perror, _ = self.validate_params(BULK_RECORD_FIELDS, record)
+        if perror is not None:
+            return perror, None
+
+        fqdn = str(record['fqdn']).strip().rstrip(".")
+        record_type = record['type']
+        value = str(record['value']).strip()
+
+        if record_type == "PTR":
+            if validate.is_ip(fqdn):
+                fqdn = str(dns.reversename.from_address(fqdn))[:-1]
+            if not fqdn.endswith(".in-addr.arpa"):
+                return "PTR records need an IP address or in-addr.arpa name", None
+            direction = "rev"
+            server_id, zone = self._find_zone(fqdn, direction)
+            if server_id is None:
+                # New reverse zones are created on the main server
+                server_id = 1
+                _, zone = self._split_fqdn(fqdn)
+        else:
+            direction = "fwd"
+            server_id, zone = self._find_zone(fqdn, direction)
+            if server_id is None:
+                server_id, _ = self._get_dns_server(fqdn)
+                if server_id is None:
+                    return "Could not find a parent domain for {}".format(fqdn), None
+                _, zone = self._split_fqdn(fqdn)
+
+        if record_type == "A":
+            if not validate.is_ip(value):
+                return "Invalid IP address '{}'".format(value), None
+        elif record_type == "MX":
+            parts = value.split()
+            if len(parts) != 2 or not parts[0].isdigit():
+                return "MX values should be 'preference exchange'", None
+            exchange = parts[1] if parts[1].endswith(".") else parts[1] + "."
+            value = (int(parts[0]), exchange)
+        elif record_type != "TXT" and not value.endswith("."):
+            value += "."
+
+        return None, (server_id, zone, direction, fqdn + ".", record_type, value)
+
+    # Applies records grouped by zone, so each zone is loaded and changed once
+    # and BIND reloads once at the end
+    def _bulk_records(self, data, remove):
+        error, records = self._parse_records(data)
+        if error is not None:
+            return error, None
+
+        errors = [None] * len(records)
+        groups = {}
+        for i in range(len(records)):
+            error, plan = self._plan_record(records[i])
+            if error is not None:
+                errors[i] = error
+                continue
+            group_key = (str(plan[0]), plan[1], plan[2])
+            if group_key not in groups:
+                groups[group_key] = []
+            groups[group_key].append((i, plan[3], plan[4], plan[5]))
+
+        with self.reloads.hold():
+            for group_key in sorted(groups):
+                dns_server_id, zone, direction = group_key
+                entries = groups[group_key]
+
+                error = None
+                if not self._has_zone(dns_server_id, zone, direction):
+                    if remove or direction != "rev":
+                        error = "Zone {} in server {} not found".format(zone, dns_server_id)
+                    else:
+                        error, _ = self._add_zone(dns_server_id, zone, direction)
+                if error is not None:
+                    for i, _, _, _ in entries:
+                        errors[i] = error
+                    continue
+
+                changes = []
+                for i, name, record_type, value in entries:
+                    changes.append(("delete" if remove else "add", name, record_type, value))
+                error, change_errors = self._change_records(dns_server_id, zone, direction, changes)
+                if error is not None:
+                    change_errors = [error] * len(entries)
+                for entry, change_error in zip(entries, change_errors):
+                    errors[entry[0]] = change_error
+
+        return None, self._bulk_results(errors)
+
+    def _bulk_results(self, errors):
+        results = []
+        failed = 0
+        for error in errors:
+            if error is None:
+                results.append({"ok": True})
+            else:
+                failed += 1
+                results.append({"ok": False, "error": error})
+
+        return {
+            "succeeded": len(errors) - failed,
+            "failed": failed,
+            "results": results
+        }
+
+    def _override_path(self, dns_server_id):
+        return "{}/{}/zones/{}".format(DNS_BASE_DIR, dns_server_id, OVERRIDE_ZONE)
+
+    # Adds or removes overrides, dicts of fqdn and ip_addr, in one pass. A name
+    # has one override, so adding replaces any other address. The override zone
+    # is written out and reloaded once for the whole batch.
+    def _change_overrides(self, overrides, remove):
+        store = self._record_store()
+        rows = store.zone_records(OVERRIDE_SERVER_ID, OVERRIDE_ZONE, "rpz")
+        if len(rows) == 0 and os.path.exists(self._override_path(OVERRIDE_SERVER_ID)):
+            # Stored before overrides were kept in the database
+            self._store_zone_file(OVERRIDE_SERVER_ID, OVERRIDE_ZONE, "rpz", easyzone.zone_from_file(OVERRIDE_ZONE, self._override_path(OVERRIDE_SERVER_ID)))
+            rows = store.zone_records(OVERRIDE_SERVER_ID, OVERRIDE_ZONE, "rpz")
+
+        # name -> addresses of the current overrides
+        current = {}
+        for name, record_type, value, _ in rows:
+            if record_type == "A":
+                current.setdefault(name, set()).add(value)
+
+        errors = []
+        added = {}
+        removed = set()
+        for override in overrides:
+            if not isinstance(override, dict):
+                errors.append("Override must have fqdn and ip_addr")
+                continue
+            perror, _ = self.validate_params(OVERRIDE_FIELDS, override)
+            if perror is not None:
+                errors.append(perror)
+                continue
+
+            fqdn = str(override['fqdn']).strip().rstrip(".")
+            ip_addr = str(override['ip_addr']).strip()
+            # Checked by hand, as parsing with dnspython is most of the time
+            # taken by large batches
+            labels = fqdn.split(".")
+            if labels[0] == "*":
+                labels = labels[1:]
+            if len(labels) == 0 or not all([validate.is_valid_dns(label) for label in labels]):
+                errors.append("Invalid domain '{}'".format(fqdn))
+                continue
+            if not validate.is_ip(ip_addr):
+                errors.append("Invalid IP address '{}'".format(ip_addr))
+                continue
+            # Names are relative to the zone, as response policy triggers
+            name = "{}.{}.".format(fqdn.lower(), OVERRIDE_ZONE)
+
+            addresses = current.setdefault(name, set())
+            if remove:
+                if ip_addr not in addresses:
+                    errors.append("No override of {} to {}".format(fqdn, ip_addr))
+                    continue
+                addresses.discard(ip_addr)
+                removed.add((name, "A", ip_addr))
+            else:
+                for old_addr in addresses:
+                    removed.add((name, "A", old_addr))
+                addresses.clear()
+                addresses.add(ip_addr)
+                added[name] = ip_addr
+            errors.append(None)
+
+        if len(added) + len(removed) > 0:
+            new_records = [(name, "A", ip_addr, dns_update.DEFAULT_TTL) for name, ip_addr in added.items()]
+            store.remove(OVERRIDE_SERVER_ID, OVERRIDE_ZONE, [record for record in removed if (record[0], record[2]) not in added.items()])
+            store.add(OVERRIDE_SERVER_ID, OVERRIDE_ZONE, "rpz", new_records)
+
+            err = self._write_override_zone(OVERRIDE_SERVER_ID)
+            if err is not None:
+                return err, None
+            self.reloads.mark(OVERRIDE_SERVER_ID, OVERRIDE_ZONE)
+
+        return None, errors
+
+    # Writes the override zone from the record store. It is written as text,
+    # since a zone of tens of thousands of overrides is slow to build with
+    # easyzone.
+    def _write_override_zone(self, dns_server_id):
+        zone_template = open("./docker-images/dns/zone-template", "r").read()
+        soa_line = zone_template.split("\n")[0].replace("TEMPLATE.ZONE", OVERRIDE_ZONE)
+
+        lines = [soa_line]
+        for name, record_type, value, ttl in self._record_store().zone_records(dns_server_id, OVERRIDE_ZONE, "rpz"):
+            lines.append("{} {} IN {} {}".format(name, ttl, record_type, value))
+        lines.append("")
+
+        try:
+            atomic_write(self._override_path(dns_server_id), "\n".join(lines))
+        except OSError as e:
+            return "Could not write the override zone: {}".format(e)
+        return None
+
     def _parse_forwarders_file(self, path):
         forwarder_file = open(path, "r").read()
             
@@ -392,13 +1035,64 @@ class DNSServer(DockerBaseModule):
         forwarder_file.write(output)
         forwarder_file.close()
 
-    def _rndc_reload(self, dns_server_id):
+    # Reloads the given zones, or everything if zones is None. Called by the
+    # ReloadCoalescer, use self.reloads.mark() to request a reload.
+    def _rndc_reload(self, dns_server_id, zones=None):
+        err, _ = self.zones.flush((str(dns_server_id),))
+        if err is not None:
+            return err, None
+        err, _ = self._flush_named_config(dns_server_id)
+        if err is not None:
+            return err, None
+
+        if self._simulation is not None:
+            self._simulation.reload(dns_server_id)
+
+        container_name = INSTANCE_TEMPLATE.format(dns_server_id)
         try:
-            time.sleep(2)
-            container = self.mm.docker.containers.get(INSTANCE_TEMPLATE.format(dns_server_id))
-            code, output = container.exec_run("rndc reload")
-            if code != 0:
-                return "'rndc reload' failed", None
+            container = self.mm.docker.containers.get(container_name)
+            # A stopped server reads everything when it starts
+            if container.status != "running":
+                return None, True
+            # named may still be starting up
+            err, _ = self.docker_wait_exec(container_name, "rndc status", timeout=30)
+            if err is not None:
+                return err, None
+
+            if zones is None:
+                code, output = container.exec_run("rndc reload")
+                if code != 0:
+                    return "'rndc reload' failed", None
+            else:
+                for zone in zones:
+                    code, output = container.exec_run("rndc reload {}".format(zone))
+                    if code != 0:
+                        return "'rndc reload {}' failed".format(zone), None
+        except docker.errors.NotFound:
+            return "DNS server not found", None
+
+        return None, True
+
+    # Has BIND write dynamic updates for the given zones, or all zones if
+    # zones is None, to the zone files and drop the journals. Called by a
+    # ReloadCoalescer, use self.syncs.mark() to request a sync.
+    def _rndc_sync(self, dns_server_id, zones=None):
+        container_name = INSTANCE_TEMPLATE.format(dns_server_id)
+        try:
+            container = self.mm.docker.containers.get(container_name)
+            # A stopped server has nothing left to sync
+            if container.status != "running":
+                return None, True
+
+            if zones is None:
+                code, output = container.exec_run("rndc sync -clean")
+                if code != 0:
+                    return "'rndc sync' failed", None
+            else:
+                for zone in zones:
+                    code, output = container.exec_run("rndc sync -clean {}".format(zone))
+                    if code != 0:
+                        return "'rndc sync {}' failed".format(zone), None
         except docker.errors.NotFound:
             return "DNS server not found", None
 
@@ -465,6 +1159,15 @@ class DNSServer(DockerBaseModule):
             # Remove the container from the database
             dbc.execute("DELETE FROM dns_server WHERE server_id=?", (dns_server_id,))
             self.mm.db.commit()
+            self._domains().remove_owner(dns_server_id)
+            self._update_keys.pop(str(dns_server_id), None)
+            self._named_configs.pop(str(dns_server_id), None)
+            if self._simulation is not None:
+                self._simulation.remove_server(dns_server_id)
+            self.reloads.discard(dns_server_id)
+            self.syncs.discard(dns_server_id)
+            self.zones.discard((str(dns_server_id),))
+            self._record_store().remove_server(dns_server_id)
 
             return self.docker_delete(container_name)
         elif func == "add_server":
@@ -496,6 +1199,10 @@ class DNSServer(DockerBaseModule):
 
             dns_server_id = dbc.lastrowid
             container_name = INSTANCE_TEMPLATE.format(dns_server_id)
+            # Zones left over from an old server with this ID are removed below
+            self._domains().remove_owner(dns_server_id)
+            self._domains().add(domain, "server", dns_server_id)
+            self._update_keys.pop(str(dns_server_id), None)
 
             # Setup config directories
             dns_config_path = "{}/{}".format(DNS_BASE_DIR, dns_server_id)
@@ -508,18 +1215,22 @@ class DNSServer(DockerBaseModule):
             os.mkdir(dns_config_path + "/conf")
             os.mkdir(dns_config_path + "/zones")
             shutil.copy("./docker-images/dns/config-template", dns_config_path + "/named.conf")
+            self._named_configs.pop(str(dns_server_id), None)
 
             # Create forwarders file
             open(dns_config_path + "/conf/forwarders.conf", "a").close()
 
             # Prepare the override zone
-            override_zone_path = dns_config_path + "/zones/fn.rpz"
+            override_zone_path = self._override_path(dns_server_id)
             zone_file = open("./docker-images/dns/zone-template", "r").read()
-            zone_file = zone_file.replace("TEMPLATE.ZONE", "fn.rpz")
+            zone_file = zone_file.replace("TEMPLATE.ZONE", OVERRIDE_ZONE)
             zone_file = zone_file.replace("1.1.1.1", "127.0.0.1")
             out_zone = open(override_zone_path, "w+")
             out_zone.write(zone_file)
             out_zone.close()
+            self._store_zone_file(dns_server_id, OVERRIDE_ZONE, "rpz", easyzone.zone_from_file(OVERRIDE_ZONE, override_zone_path))
+            if self._simulation is not None:
+                self._simulation.add_server(dns_server_id, server_ip)
 
             vols = {
                 dns_config_path: {"bind": "/etc/bind", 'mode': 'rw'}
@@ -555,34 +1266,27 @@ class DNSServer(DockerBaseModule):
             value = kwargs['value']
             autocreate = kwargs['autocreate']
 
-            found = False
-            counter = 0
-
-            fqdn_split = fqdn.split(".")
-
-            while found == False and counter < len(fqdn_split):
-                search_domain = '.'.join(fqdn_split[counter:])
-                dns_server_id = self._get_dns_server(search_domain)
-                if dns_server_id is not None:
-                    found = True
-                counter += 1
+            fqdn = fqdn.rstrip(".")
 
-            if found == False:
-                return "Could not find a parent domain for {}".format(fqdn), None 
-
-            first, zone = self._split_fqdn(fqdn)
-            dns_config_path = "{}/{}".format(DNS_BASE_DIR, dns_server_id)
-            zone_path = "{}/zones/{}.{}".format(dns_config_path, zone, direction)
+            dns_server_id, zone = self._find_zone(fqdn, direction)
+            if dns_server_id is None:
+                if direction == "rev":
+                    # Reverse zones are created on the main server
+                    dns_server_id = 1
+                else:
+                    dns_server_id, _ = self._get_dns_server(fqdn)
+                    if dns_server_id is None:
+                        return "Could not find a parent domain for {}".format(fqdn), None 
 
-            if not os.path.exists(zone_path):
+                first, zone = self._split_fqdn(fqdn)
                 if autocreate == True:
-                    self._add_zone(dns_server_id, zone, direction)
+                    error, _ = self._add_zone(dns_server_id, zone, direction)
+                    if error is not None:
+                        return error, None
                 else:
                     return "Zone for FQDN {} in server {} not found".format(fqdn, dns_server_id), None
 
-            name = '.'.join(fqdn_split[:-1])
-
-            return self.run('add_record', id=dns_server_id, zone=zone, direction=direction, type=record_type, name=name, value=value)
+            return self.run('add_record', id=dns_server_id, zone=zone, direction=direction, type=record_type, name=fqdn + ".", value=value)
         elif func == "smart_remove_record":
             perror, _ = self.validate_params(self.__FUNCS__['smart_remove_record'], kwargs)
             if perror is not None:
@@ -593,28 +1297,9 @@ class DNSServer(DockerBaseModule):
             record_type = kwargs['type']
             value = kwargs['value']
 
-            found = False
-            counter = 0
-
-            fqdn_split = fqdn.split(".")
-
-            while found == False and counter < len(fqdn_split):
-                search_domain = '.'.join(fqdn_split[counter:])
-                dns_server_id = self._get_dns_server(search_domain)
-                if dns_server_id is not None:
-                    found = True
-                counter += 1
-
-            if found == False:
-                return "Could not find a parent domain for {}".format(fqdn), None 
-
-            first, zone = self._split_fqdn(fqdn)
-
-            dns_config_path = "{}/{}".format(DNS_BASE_DIR, dns_server_id)
-            zone_path = "{}/zones/{}.{}".format(dns_config_path, zone, direction)
-
-            if not os.path.exists(zone_path):
-                return "Zone for FQDN {} in server {} not found".format(fqdn, dns_server_id), None
+            dns_server_id, zone = self._find_zone(fqdn, direction)
+            if dns_server_id is None:
+                return "Zone for FQDN {} not found".format(fqdn), None
 
             if not fqdn.endswith("."):
                 fqdn += "."
@@ -632,24 +1317,15 @@ class DNSServer(DockerBaseModule):
             name = kwargs['name']
             value = kwargs['value']
 
-            dns_config_path = "{}/{}".format(DNS_BASE_DIR, dns_server_id)
-            zone_path =  "{}/zones/{}.{}".format(dns_config_path, zone, direction)
-            
-
-            
-
             if not name.endswith(".") and record_type == "A" and name.endswith(zone):
                 name = name + "."
 
-            zone = easyzone.zone_from_file(zone, zone_path)
-
-            zone.add_name(name)
-            ns = zone.names[name].records(record_type, create=True)
-            ns.add(value)
-            zone.save(autoserial=True)
-            
-
-            return self._rndc_reload(dns_server_id)        
+            error, errors = self._change_records(dns_server_id, zone, direction, [("add", name, record_type, value)])
+            if error is not None:
+                return error, None
+            if errors[0] is not None:
+                return errors[0], None
+            return None, True
         elif func == "remove_record":
             perror, _ = self.validate_params(self.__FUNCS__['remove_record'], kwargs)
             if perror is not None:
@@ -662,31 +1338,14 @@ class DNSServer(DockerBaseModule):
             name = kwargs['name']
             value = kwargs['value']
 
-            dns_config_path = "{}/{}".format(DNS_BASE_DIR, dns_server_id)
-            zone_path =  "{}/zones/{}.{}".format(dns_config_path, zone_name, direction)
-            zone = easyzone.zone_from_file(zone_name, zone_path)
-
             if name[len(name)-1] != "." and record_type == "A":
                 name = name + "."
 
-
-            if name not in zone.get_names():
-                return "{} not in zone {}".format(name, zone_name), None
-            records = zone.names[name].records(record_type, create=True)
-            try:
-                records.delete(value)
-            except easyzone.RecordsError: 
-                return "Value '{}' not in records".format(value), None
-            zone.save(autoserial=True)
-
-            try:
-                container = self.mm.docker.containers.get(INSTANCE_TEMPLATE.format(dns_server_id))
-                code, output = container.exec_run("rndc reload")
-                if code != 0:
-                    return "'rndc reload' failed", None
-            except docker.errors.NotFound:
-                return "DNS server not found", None
-
+            error, errors = self._change_records(dns_server_id, zone_name, direction, [("delete", name, record_type, value)])
+            if error is not None:
+                return error, None
+            if errors[0] is not None:
+                return errors[0], None
             return None, True
         elif func == "add_host":
             perror, _ = self.validate_params(self.__FUNCS__['add_host'], kwargs)
@@ -716,8 +1375,23 @@ class DNSServer(DockerBaseModule):
             container_name = INSTANCE_TEMPLATE.format(dns_server_id)
             server_ip = result[0]
 
+            # BIND reads the zone files when it starts
+            err, _ = self.zones.flush((str(dns_server_id),))
+            if err is not None:
+                return err, None
+            err, _ = self._flush_named_config(dns_server_id)
+            if err is not None:
+                return err, None
+
             # Start the Docker container
-            return self.docker_start(container_name, server_ip)
+            err, _ = self.docker_start(container_name, server_ip)
+            if err is not None:
+                return err, None
+
+            if self._update_key(dns_server_id) is not None:
+                # Zone files may have been replaced while the server was stopped
+                return self._prepare_dynamic_updates(dns_server_id)
+            return None, True
         elif func == "stop_server":
             perror, _ = self.validate_params(self.__FUNCS__['stop_server'], kwargs)
             if perror is not None:
@@ -737,6 +1411,14 @@ class DNSServer(DockerBaseModule):
                 return "DNS server does not exist", None
 
             server_ip = result[0]
+
+            if self._update_key(dns_server_id) is not None:
+                # While stopped, records are changed in the zone files, so they
+                # need every dynamic update
+                self.syncs.discard(dns_server_id)
+                err, _ = self._rndc_sync(dns_server_id)
+                if err is not None:
+                    self.print("Could not sync zones before stopping: {}".format(err))
             
             # Stop the container
             return self.docker_stop(container_name, server_ip)
@@ -792,7 +1474,8 @@ class DNSServer(DockerBaseModule):
 
             self._write_forwarders_file(forwarder_conf, forwarders)
 
-            return self._rndc_reload(dns_server_id)
+            self.reloads.mark(dns_server_id)
+            return None, True
 
         elif func == "remove_forwarder":
             perror, _ = self.validate_params(self.__FUNCS__['add_forwarder'], kwargs)
@@ -820,7 +1503,8 @@ class DNSServer(DockerBaseModule):
 
             self._write_forwarders_file(forwarder_conf, forwarders)
 
-            return self._rndc_reload(dns_server_id)
+            self.reloads.mark(dns_server_id)
+            return None, True
         elif func == "smart_add_subdomain_server":
             perror, _ = self.validate_params(self.__FUNCS__['smart_add_subdomain_server'], kwargs)
             if perror is not None:
@@ -829,23 +1513,9 @@ class DNSServer(DockerBaseModule):
             fqdn = kwargs['fqdn']
             ip_addr = kwargs['ip_addr']
 
-            found = False
-            counter = 0
-            fqdn_split = fqdn.split(".")
-            found_domain = ""
-            parent_server_id = None
-
-            while found == False and counter < len(fqdn_split):
-                search_domain = '.'.join(fqdn_split[counter:])
-                parent_server_id = self._get_dns_server(search_domain)
-                if parent_server_id is not None:
-                    found = True
-                    search_split = search_domain.split(".")
-                    
-                    found_domain = '.'.join(search_split[1:])
-                counter += 1
-
-            if found == False:
+            # The delegation goes in the nearest zone above the subdomain
+            parent_server_id, found_domain = self._find_zone(fqdn, "fwd", strict=True)
+            if parent_server_id is None:
                 return "Could not find a parent domain for {}".format(fqdn), None 
 
             error, new_server_id = self.run('add_server', ip_addr=ip_addr, description="Automatically generated subdomain server for {}".format(fqdn), domain=fqdn)
@@ -868,12 +1538,8 @@ class DNSServer(DockerBaseModule):
             if rerror is not None:
                 return rerror, None
 
-            error, _ = self._rndc_reload(new_server_id)
-            if error is not None:
-                return error, None
-            error, _ = self._rndc_reload(parent_server_id)
-            if error is not None:
-                return error, None
+            self.reloads.mark(new_server_id)
+            self.reloads.mark(parent_server_id, found_domain)
 
             return None, new_server_id
         elif func == "smart_remove_subdomain_server":
@@ -895,21 +1561,10 @@ class DNSServer(DockerBaseModule):
             if derror is not None:
                 return derror, None
 
-            # Find the parent server, this will now go to the parent since the child server has been deleted
-            found = False
-            counter = 0
-            fqdn_split = server_domain.split(".")
-            found_domain = ""
-            parent_server_id = None
-
-            while found == False and counter < len(fqdn_split):
-                search_domain = '.'.join(fqdn_split[counter:])
-                parent_server_id = self._get_dns_server(search_domain)
-                if parent_server_id is not None:
-                    found = True
-                    search_split = search_domain.split(".")
-                    found_domain = '.'.join(search_split[1:])
-                counter += 1
+            # Find the parent zone, the child server's zones are gone now it has been deleted
+            parent_server_id, found_domain = self._find_zone(server_domain, "fwd", strict=True)
+            if parent_server_id is None:
+                return "Could not find a parent domain for {}".format(server_domain), None 
 
             if not server_domain.endswith("."):
                 server_domain = server_domain + "."
@@ -923,9 +1578,7 @@ class DNSServer(DockerBaseModule):
             if rerror is not None:
                 return rerror, None
 
-            error, _ = self._rndc_reload(parent_server_id)
-            if error is not None:
-                return error, None
+            self.reloads.mark(parent_server_id, found_domain)
             
             return None, True
         elif func == "smart_add_root_server":
@@ -953,13 +1606,8 @@ class DNSServer(DockerBaseModule):
             if ferror is not None:
                 return ferror, None
 
-            error, _ = self._rndc_reload(1)
-            if error is not None:
-                return error, None
-            
-            error, _ = self._rndc_reload(new_server_id)
-            if error is not None:
-                return error, None
+            self.reloads.mark(1)
+            self.reloads.mark(new_server_id)
             
 
             return None, new_server_id
@@ -984,9 +1632,7 @@ class DNSServer(DockerBaseModule):
 
             self._remove_forwarding_zone(1, server_domain)
             
-            error, _ = self._rndc_reload(1)
-            if error is not None:
-                return error, None
+            self.reloads.mark(1)
 
             return None, True
         elif func == "smart_add_external_subdomain":
@@ -997,23 +1643,9 @@ class DNSServer(DockerBaseModule):
             fqdn = kwargs['fqdn']
             ip_addr = kwargs['ip_addr']
 
-            found = False
-            counter = 0
-            fqdn_split = fqdn.split(".")
-            found_domain = ""
-            parent_server_id = None
-
-            while found == False and counter < len(fqdn_split):
-                search_domain = '.'.join(fqdn_split[counter:])
-                parent_server_id = self._get_dns_server(search_domain)
-                if parent_server_id is not None:
-                    found = True
-                    search_split = search_domain.split(".")
-                    
-                    found_domain = '.'.join(search_split[1:])
-                counter += 1
-
-            if found == False:
+            # The delegation goes in the nearest zone above the subdomain
+            parent_server_id, found_domain = self._find_zone(fqdn, "fwd", strict=True)
+            if parent_server_id is None:
                 return "Could not find a parent domain for {}".format(fqdn), None 
 
             if not fqdn.endswith("."):
@@ -1028,9 +1660,7 @@ class DNSServer(DockerBaseModule):
             if rerror is not None:
                 return rerror, None
 
-            error, _ = self._rndc_reload(parent_server_id)
-            if error is not None:
-                return error, None
+            self.reloads.mark(parent_server_id, found_domain)
             
             return None, True
         elif func == "smart_remove_external_subdomain":
@@ -1041,21 +1671,10 @@ class DNSServer(DockerBaseModule):
             fqdn = kwargs['fqdn']
             ip_addr = kwargs['ip_addr']
 
-            # Find the parent server, this will now go to the parent since the child server has been deleted
-            found = False
-            counter = 0
-            fqdn_split = fqdn.split(".")
-            found_domain = ""
-            parent_server_id = None
-
-            while found == False and counter < len(fqdn_split):
-                search_domain = '.'.join(fqdn_split[counter:])
-                parent_server_id = self._get_dns_server(search_domain)
-                if parent_server_id is not None:
-                    found = True
-                    search_split = search_domain.split(".")
-                    found_domain = '.'.join(search_split[1:])
-                counter += 1
+            # Find the parent zone holding the delegation
+            parent_server_id, found_domain = self._find_zone(fqdn, "fwd", strict=True)
+            if parent_server_id is None:
+                return "Could not find a parent domain for {}".format(fqdn), None 
 
             if not fqdn.endswith("."):
                 fqdn = fqdn + "."
@@ -1069,90 +1688,163 @@ class DNSServer(DockerBaseModule):
             if rerror is not None:
                 return rerror, None
 
-            error, _ = self._rndc_reload(parent_server_id)
-            if error is not None:
-                return error, None
+            self.reloads.mark(parent_server_id, found_domain)
             
             return None, True
-        elif func == "add_override":
-            perror, _ = self.validate_params(self.__FUNCS__['add_override'], kwargs)
+        elif func == "bulk_add_records":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
             if perror is not None:
                 return perror, None
-            
-            fqdn = kwargs['fqdn']
-            ip_addr = kwargs['ip_addr']
 
-            if fqdn.endswith("."):
-                fqdn = fqdn[:-1]
+            return self._bulk_records(kwargs['records'], False)
+        elif func == "bulk_remove_records":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
+            if perror is not None:
+                return perror, None
 
-            # Python DNS module does not support zones with names not in the subdomain.
-            # We just do rudimentary manual records
+            return self._bulk_records(kwargs['records'], True)
+        elif func == "find_zone":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
+            if perror is not None:
+                return perror, None
 
-            dns_config_path = "{}/{}".format(DNS_BASE_DIR, 1)
-            override_zone = "{}/zones/fn.rpz".format(dns_config_path)
+            fqdn = kwargs['fqdn']
+            direction = "fwd"
+            if fqdn.rstrip(".").lower().endswith(".in-addr.arpa"):
+                direction = "rev"
 
-            override_file = open(override_zone, "r")
-            lines = override_file.readlines()
-            override_file.close()
+            dns_server_id, zone = self._find_zone(fqdn, direction)
+            if dns_server_id is None:
+                return "Could not find a zone for {}".format(fqdn), None
 
-            found = False 
+            # The server, if any, that forwards queries for the name elsewhere
+            forwarding_server_id, _ = self._domains().find(fqdn, "forward")
+            if forwarding_server_id is not None:
+                forwarding_server_id = int(forwarding_server_id)
 
-            override_file = open(override_zone, "w")
-            for line in lines:
-                line_split = line.split(" ")
-                if line_split[0] == fqdn:
-                    line_split[4] = ip_addr
-                    found = True
-                override_file.write(" ".join(line_split))
-            
-            if not found:
-                override_file.write("\n")
-                override_file.write(" ".join([
-                    fqdn, "604800", "IN", "A", ip_addr
-                ]))
-                override_file.write("\n")
-            
-            override_file.close()
+            return None, {
+                "server_id": int(dns_server_id),
+                "zone": zone,
+                "direction": direction,
+                "forwarded_by": forwarding_server_id
+            }
+        elif func == "find_records":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
+            if perror is not None:
+                return perror, None
 
-            error, _ = self._rndc_reload(1)
-            if error is not None:
-                return error, None
+            under = kwargs['fqdn'].strip()
+            record_type = kwargs['type'].strip().upper()
+            value = kwargs['value'].strip()
+
+            if value != "" and record_type != "":
+                # Match values as stored, with names made absolute
+                try:
+                    _, rdata = parse_record(".", "@", record_type, value)
+                except ValueError as e:
+                    return "Invalid value: {}".format(e), None
+                value = rdata.to_text()
+
+            if under == "":
+                under = None
+            if record_type == "":
+                record_type = None
+            if value == "":
+                value = None
 
-            return None, True
-        elif func == "remove_override":
-            perror, _ = self.validate_params(self.__FUNCS__['remove_override'], kwargs)
+            return None, {
+                "rows": self._record_store().find(under=under, record_type=record_type, value=value),
+                "columns": ['server', 'zone', 'name', 'type', 'value']
+            }
+        elif func == "render_zones":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
             if perror is not None:
                 return perror, None
-            
-            fqdn = kwargs['fqdn']
-            ip_addr = kwargs['ip_addr']
 
-            if fqdn.endswith("."):
-                fqdn = fqdn[:-1]
-
-            # Python DNS module does not support zones with names not in the subdomain.
-            # We just do rudimentary manual records
+            dns_server_id = kwargs['id']
+            dbc.execute("SELECT server_ip FROM dns_server WHERE server_id=?", (dns_server_id,))
+            if not dbc.fetchone():
+                return "DNS server does not exist", None
 
-            dns_config_path = "{}/{}".format(DNS_BASE_DIR, 1)
-            override_zone = "{}/zones/fn.rpz".format(dns_config_path)
+            return self._render_zones(dns_server_id)
+        elif func == "start_simulation":
+            if self._simulation is None:
+                # Zone and config changes must be on disk to be served
+                err, _ = self.zones.flush()
+                if err is not None:
+                    return err, None
+                dbc.execute("SELECT server_id, server_ip FROM dns_server;")
+                servers = {}
+                for dns_server_id, server_ip in dbc.fetchall():
+                    err, _ = self._flush_named_config(dns_server_id)
+                    if err is not None:
+                        return err, None
+                    servers[dns_server_id] = server_ip
+
+                simulation = DNSLab(DNS_BASE_DIR, servers)
+                try:
+                    simulation.start()
+                except OSError as e:
+                    simulation.stop()
+                    return "Could not start DNS responders: {}".format(e), None
+                self._simulation = simulation
+
+            rows = []
+            for dns_server_id, (server_ip, responder) in sorted(self._simulation.responders.items(), key=lambda item: int(item[0])):
+                rows.append([int(dns_server_id), server_ip, "{}:{}".format(*responder.address)])
+            return None, {
+                "rows": rows,
+                "columns": ['ID', 'server_ip', 'address']
+            }
+        elif func == "stop_simulation":
+            if self._simulation is not None:
+                self._simulation.stop()
+                self._simulation = None
+            return None, True
+        elif func == "set_update_engine":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
+            if perror is not None:
+                return perror, None
 
-            override_file = open(override_zone, "r")
-            lines = override_file.readlines()
-            override_file.close()
-            override_file = open(override_zone, "w")
+            dns_server_id = kwargs['id']
+            dbc.execute("SELECT server_ip FROM dns_server WHERE server_id=?", (dns_server_id,))
+            if not dbc.fetchone():
+                return "DNS server does not exist", None
 
-            for line in lines:
-                line_split = line.split(" ")
-                if line_split[0] != fqdn and line_split[4] != ip_addr:
-                    override_file.write(" ".join(line_split))
+            return self._set_update_engine(dns_server_id, kwargs['engine'] == "dynamic")
+        elif func == "flush":
+            err, count = self.reloads.flush()
+            if err is not None:
+                return err, None
+            # Also write out dynamic updates waiting to be synced
+            err, _ = self.syncs.flush()
+            if err is not None:
+                return err, None
+            return None, count
+        elif func == "add_override" or func == "remove_override":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
+            if perror is not None:
+                return perror, None
 
-            override_file.close()
+            error, errors = self._change_overrides([{"fqdn": kwargs['fqdn'], "ip_addr": kwargs['ip_addr']}], func == "remove_override")
+            if error is not None:
+                return error, None
+            if errors[0] is not None:
+                return errors[0], None
+            return None, True
+        elif func == "add_overrides" or func == "remove_overrides":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
+            if perror is not None:
+                return perror, None
 
-            error, _ = self._rndc_reload(1)
+            error, overrides = self._parse_records(kwargs['overrides'], columns=("fqdn", "ip_addr"), key="overrides")
             if error is not None:
                 return error, None
 
-            return None, True
+            error, errors = self._change_overrides(overrides, func == "remove_overrides")
+            if error is not None:
+                return error, None
+            return None, self._bulk_results(errors)
         else:
             return "Invalid function '{}.{}'".format(self.__SHORTNAME__, func), None
 
@@ -1171,12 +1863,12 @@ class DNSServer(DockerBaseModule):
         _, logs = self.mm.docker.images.build(path="./docker-images/dns/", tag=self.__SERVER_IMAGE_NAME__, rm=True)
         # self.print(logs)
 
-    def get_list(self):
+    def get_list(self, snapshot=None):
         dbc = self.mm.db.cursor()
         dbc.execute("SELECT server_id, server_ip, server_desc FROM dns_server;")
         results = dbc.fetchall()
 
-        return self._list_add_data(results, INSTANCE_TEMPLATE)
+        return self._list_add_data(results, INSTANCE_TEMPLATE, snapshot)
 
     def save(self):
         dbc = self.mm.db.cursor()
@@ -26,15 +26,14 @@ class FakernetInit(BaseModule):
         if func == "verify_permissions":
             errors = []
 
-            try:
-                subprocess.check_output(["/usr/bin/sudo", "-n", "/sbin/iptables", "-vL"], stderr=subprocess.DEVNULL)     
-            except subprocess.CalledProcessError:
-                errors.append("'sudo' for iptables not set. Add permissions to run this command using 'visudo'")
+            # Through the privileged helper if it is running, otherwise with sudo
+            err, _ = self.run_privileged("iptables", ["-vL"])
+            if err is not None:
+                errors.append("'sudo' for iptables not set. Add permissions to run this command using 'visudo' or start the privileged helper")
 
-            try:
-                subprocess.check_output(["/usr/bin/sudo", "-n", "/usr/bin/ovs-docker"], stderr=subprocess.DEVNULL)     
-            except subprocess.CalledProcessError:
-                errors.append("'sudo' for ovs-docker not set. Add permissions to run this command using 'visudo'")
+            err, _ = self.run_privileged("ovs-docker", [])
+            if err is not None:
+                errors.append("'sudo' for ovs-docker not set. Add permissions to run this command using 'visudo' or start the privileged helper")
 
             try:
                 subprocess.check_output(["docker", "ps"], shell=True, stderr=subprocess.DEVNULL)     
@@ -64,15 +63,14 @@ class FakernetInit(BaseModule):
         if len(netallocs['rows']) == 0:
             self.init_needed = True
         else:
-            clean_ovs()
+            clean_ovs(self.mm.ovsdb, self.mm.privileged)
         try:
             self.mm.docker.networks.get(NETWORK_NAME)
         except docker.errors.NotFound:
             self.network_needed = True
 
-        try:
-            subprocess.check_output(["/usr/bin/sudo", "-n", "/sbin/iptables", "-P", "FORWARD", "ACCEPT"], stderr=subprocess.DEVNULL)     
-        except subprocess.CalledProcessError:
+        err, _ = self.run_privileged("iptables", ["-P", "FORWARD", "ACCEPT"])
+        if err is not None:
             return "Could not enable ACCEPT on FORWARD table", None
 
         
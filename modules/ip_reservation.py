@@ -1,10 +1,18 @@
+import ipaddress
+
 from lib.base_module import BaseModule
+from lib.ip_bitmap import AddressBitmap
+from lib.database import ensure_generation, get_generation, bump_generation
 import lib.validate as validate
 
 class IPReservation(BaseModule):
 
     def __init__(self, mm):
         self.mm = mm
+        # net_id -> AddressBitmap, loaded when a network is first allocated from
+        self._bitmaps = {}
+        # The ipreserve generation the cached bitmaps are current for
+        self._bitmap_generation = None
 
     __FUNCS__ = {
         "list_ips": {
@@ -22,6 +30,17 @@ class IPReservation(BaseModule):
         "remove_ip": {
             "_desc": "Remove an IP reservation",
             "ip_addr": "IP_ADDR",
+        },
+        "allocate_next": {
+            "_desc": "Reserve the lowest free IP in a network",
+            "net_addr": "IP_NETWORK",
+            "description": "TEXT"
+        },
+        "allocate_block": {
+            "_desc": "Reserve a number of free IPs in a network",
+            "net_addr": "IP_NETWORK",
+            "count": "INTEGER",
+            "description": "TEXT"
         }
     } 
 
@@ -29,6 +48,107 @@ class IPReservation(BaseModule):
     __DESC__ = "Manages IP reservations"
     __AUTHOR__ = "Jacob Hartman"
 
+    # Returns (net_id, network) for a network reserved in netreserve
+    def _get_network(self, net_addr):
+        try:
+            network = ipaddress.ip_network(net_addr)
+        except ValueError:
+            return "Invalid network address", None
+
+        err, info = self.mm['netreserve'].run("get_ip_network_info", ip_addr=str(network.network_address))
+        if err is not None or ipaddress.ip_network(info['net_address']) != network:
+            return "Network {} is not reserved".format(net_addr), None
+        return None, (info['net_id'], network)
+
+    # The allocation bitmap for a network, from the database or built from
+    # the reserved IPs. The network address, broadcast address and the
+    # gateway (the first host, given to the switch) are never handed out.
+    def _get_bitmap(self, net_id, network):
+        dbc = self.mm.db.cursor()
+        generation = get_generation(self.mm.db, "ipreserve")
+        if generation != self._bitmap_generation:
+            self._bitmaps = {}
+            self._bitmap_generation = generation
+
+        bitmap = self._bitmaps.get(net_id)
+        if bitmap is not None and bitmap.network == network:
+            return bitmap
+
+        dbc.execute("SELECT net_address, bitmap FROM ip_bitmap WHERE net_id=?", (net_id,))
+        result = dbc.fetchone()
+        if result is not None and ipaddress.ip_network(result[0]) == network:
+            bitmap = AddressBitmap(network, result[1])
+        else:
+            bitmap = AddressBitmap(network)
+            for ip in self._kept_addresses(network):
+                bitmap.reserve(ip)
+            dbc.execute("SELECT ip FROM ip_list WHERE net_id=?", (net_id,))
+            for row in dbc.fetchall():
+                bitmap.reserve(row[0])
+            self._save_bitmap(net_id, bitmap)
+        self._bitmaps[net_id] = bitmap
+        return bitmap
+
+    def _kept_addresses(self, network):
+        if network.num_addresses <= 2:
+            return []
+        return [network.network_address, validate.get_broadcast(network), validate.get_gateway(network)]
+
+    def _save_bitmap(self, net_id, bitmap):
+        dbc = self.mm.db.cursor()
+        dbc.execute("INSERT OR REPLACE INTO ip_bitmap (net_id, net_address, bitmap) VALUES (?, ?, ?)", (net_id, str(bitmap.network), bitmap.data()))
+
+    # Keeps a network's bitmap in step with add_ip and remove_ip, if it has one
+    def _update_bitmap(self, net_id, ip, reserved):
+        dbc = self.mm.db.cursor()
+        dbc.execute("SELECT net_address FROM ip_bitmap WHERE net_id=?", (net_id,))
+        result = dbc.fetchone()
+        if result is None:
+            self._bitmaps.pop(net_id, None)
+            return
+
+        bitmap = self._get_bitmap(net_id, ipaddress.ip_network(result[0]))
+        if reserved:
+            bitmap.reserve(ip)
+        elif ipaddress.ip_address(ip) not in self._kept_addresses(bitmap.network):
+            bitmap.release(ip)
+        self._save_bitmap(net_id, bitmap)
+
+    def _allocate(self, net_addr, count, description):
+        err, found = self._get_network(net_addr)
+        if err is not None:
+            return err, None
+        net_id, network = found
+
+        # Taking the write lock before reading the bitmap means no other
+        # connection can allocate from it before this is committed
+        dbc = self.mm.db.cursor()
+        if not self.mm.db.in_transaction:
+            dbc.execute("BEGIN IMMEDIATE;")
+
+        bitmap = self._get_bitmap(net_id, network)
+        ips = bitmap.allocate_block(count)
+        if ips is None:
+            self.mm.db.commit()
+            return "Network {} has {} free IPs".format(net_addr, bitmap.free()), None
+
+        dbc.executemany('INSERT INTO ip_list (ip, net_id, ip_desc) VALUES (?, ?, ?)', [(str(ip), net_id, description) for ip in ips])
+        self._save_bitmap(net_id, bitmap)
+        self._count_write()
+        self.mm.db.commit()
+        return None, [str(ip) for ip in ips]
+
+    # Counts a write to ip_list or ip_bitmap, before it is committed. The
+    # cached bitmaps are dropped if another connection has written to them
+    # since they were read.
+    def _count_write(self):
+        generation = bump_generation(self.mm.db, "ipreserve")
+        if self._bitmap_generation is not None and generation == self._bitmap_generation + 1:
+            self._bitmap_generation = generation
+        else:
+            self._bitmaps = {}
+            self._bitmap_generation = None
+
     def run(self, func, **kwargs) :
         dbc = self.mm.db.cursor()
         if func == "list_ips":
@@ -43,15 +163,11 @@ class IPReservation(BaseModule):
             if perror is not None:
                 return perror, None
 
-            err, results = self.mm['netreserve'].run('list')
-            if err is not None:
-                return err, None
-
             ip = kwargs['ip_addr']
             in_network = False
-            for result in results['rows']:
-                if validate.is_ip_in_network(ip, result[1]):
-                    in_network = result[0] 
+            err, network = self.mm['netreserve'].run('get_ip_network_info', ip_addr=ip)
+            if err is None:
+                in_network = network['net_id']
 
             if in_network is not False:
                 dbc.execute('SELECT * FROM ip_list WHERE ip=?', (ip,))
@@ -59,6 +175,8 @@ class IPReservation(BaseModule):
                 if result is not None:
                     return "IP already allocated", None
                 dbc.execute('INSERT INTO ip_list (ip, net_id, ip_desc) VALUES (?, ?, ?)', (ip, in_network, kwargs['description']))
+                self._update_bitmap(in_network, ip, True)
+                self._count_write()
                 self.mm.db.commit()
                 return None, (in_network, ip)
             else:
@@ -72,14 +190,35 @@ class IPReservation(BaseModule):
 
             ip_addr = kwargs['ip_addr']
 
-            dbc.execute("SELECT ip FROM ip_list WHERE ip=?", (ip_addr,))
+            dbc.execute("SELECT ip, net_id FROM ip_list WHERE ip=?", (ip_addr,))
             result = dbc.fetchone()
             if not result:
                 return "IP {} is not allocated".format(ip_addr), None
 
             dbc.execute("DELETE FROM ip_list WHERE ip=?", (ip_addr,))
+            self._update_bitmap(result[1], ip_addr, False)
+            self._count_write()
             self.mm.db.commit()
             return None, True
+        elif func == "allocate_next":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
+            if perror is not None:
+                return perror, None
+
+            err, ips = self._allocate(kwargs['net_addr'], 1, kwargs['description'])
+            if err is not None:
+                return err, None
+            return None, ips[0]
+        elif func == "allocate_block":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
+            if perror is not None:
+                return perror, None
+
+            count = int(kwargs['count'])
+            if count < 1:
+                return "Count must be at least 1", None
+
+            return self._allocate(kwargs['net_addr'], count, kwargs['description'])
         else:
             return "Invalid function '{}.{}'".format(self.__SHORTNAME__, func), None
 
@@ -91,6 +230,12 @@ class IPReservation(BaseModule):
             dbc.execute("CREATE TABLE ip_list (ip_id INTEGER PRIMARY KEY, ip TEXT, net_id INTEGER, ip_desc TEXT);")
             self.mm.db.commit()
 
+        dbc.execute("CREATE INDEX IF NOT EXISTS ip_list_ip ON ip_list (ip);")
+        dbc.execute("CREATE INDEX IF NOT EXISTS ip_list_net_id ON ip_list (net_id);")
+        dbc.execute("CREATE TABLE IF NOT EXISTS ip_bitmap (net_id INTEGER PRIMARY KEY, net_address TEXT, bitmap BLOB);")
+        self.mm.db.commit()
+        ensure_generation(self.mm.db, "ipreserve")
+
     def build(self):
         pass
 
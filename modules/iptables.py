@@ -1,5 +1,4 @@
 import os
-import subprocess
 import shutil
 from string import Template, ascii_letters
 import random
@@ -191,23 +190,22 @@ class Iptables(BaseModule):
         return self._add_rule(table, chain, command, rule_id)
 
 
-    def _add_rule(self, table, chain, command, rule_id):
+    def _add_args(self, table, chain, command, rule_id):
         iptables_cmd = []
         if table is not None and table != "":
             iptables_cmd += ["-t", table]
-        else:
-            table = ""
     
         iptables_cmd += ["-I", chain, "1"]
         iptables_cmd += shlex.split(command)
         iptables_cmd += ["-m", "comment", "--comment", "FakerNet Iptables rule {}".format(rule_id)]
+        return iptables_cmd
 
+    def _add_rule(self, table, chain, command, rule_id):
+        iptables_cmd = self._add_args(table, chain, command, rule_id)
 
-        str_cmd = " ".join(["/usr/bin/sudo", "-n", "/sbin/iptables"] + iptables_cmd)
-        try:
-            subprocess.check_output(["/usr/bin/sudo", "-n", "/sbin/iptables"] + iptables_cmd, stderr=subprocess.DEVNULL)     
-        except subprocess.CalledProcessError as ex:
-            return "Command failed: " + str_cmd, ""
+        err, _ = self.run_privileged("iptables", iptables_cmd)
+        if err is not None:
+            return "Command failed: " + " ".join(["iptables"] + iptables_cmd), ""
 
         return None, rule_id
 
@@ -228,19 +226,19 @@ class Iptables(BaseModule):
 
         return self._remove_rule(table, chain, command, rule_id)
 
-    def _remove_rule(self, table, chain, command, rule_id):
+    def _remove_args(self, table, chain, command, rule_id):
         iptables_cmd = []
         if table is not None and table != "":
             iptables_cmd += ["-t", table]
-        else:
-            table = ""
         
         iptables_cmd += ["-D", chain]
         iptables_cmd += ["-m", "comment", "--comment", "FakerNet Iptables rule {}".format(rule_id)]
         iptables_cmd += shlex.split(command)
-        try:
-            subprocess.check_output(["/usr/bin/sudo", "-n", "/sbin/iptables"] + iptables_cmd, stderr=subprocess.DEVNULL)     
-        except subprocess.CalledProcessError:
+        return iptables_cmd
+
+    def _remove_rule(self, table, chain, command, rule_id):
+        err, _ = self.run_privileged("iptables", self._remove_args(table, chain, command, rule_id))
+        if err is not None:
             return "Command failed, you may need to manually remove rule", None
 
         return None, True
@@ -270,14 +268,20 @@ class Iptables(BaseModule):
         dbc.execute("SELECT * FROM iptables;") 
         results = dbc.fetchall()
 
+        # Every rule is removed, in case it is already there, and added back in
+        # one request. Rules that weren't there fail to be removed, so this
+        # carries on past errors.
+        ops = []
         for result in results:
             rule_id = result[0]
             table = result[1]
             chain = result[2]
             command = result[3]
 
-            self._remove_rule(table, chain, command, rule_id)
-            self._add_rule(table, chain, command, rule_id)
+            ops.append(("iptables", self._remove_args(table, chain, command, rule_id)))
+            ops.append(("iptables", self._add_args(table, chain, command, rule_id)))
+        if len(ops) > 0:
+            self.run_privileged_batch(ops, stop_on_error=False)
 
     def build(self):
         pass
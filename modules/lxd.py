@@ -416,7 +416,7 @@ class LXDManager(LXDBaseModule):
         lxd_network = self.mm.lxd.networks.get(BUILD_SWITCH)
         lxd_network.delete()
 
-    def get_list(self):
+    def get_list(self, snapshot=None):
         dbc = self.mm.db.cursor()
 
         dbc.execute("SELECT lxd_id, ip_addr, fqdn FROM lxd_container;")
@@ -427,7 +427,10 @@ class LXDManager(LXDBaseModule):
             new_data = ["lxd"]
             new_data += [container[0], container[1], container[2]]
             container_name = container[2].replace(".", "-")
-            _, status = self.lxd_get_status(container_name)
+            if snapshot is not None:
+                _, status = snapshot.lxd_status(container_name)
+            else:
+                _, status = self.lxd_get_status(container_name)
             new_data += [status[1]]
             new_list.append(new_data)
         return new_list
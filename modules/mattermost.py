@@ -1,7 +1,6 @@
 import os
 import shutil 
 from string import Template
-import time
 
 import docker
 from OpenSSL import crypto
@@ -83,7 +82,11 @@ class MattermostServer(DockerBaseModule):
             container_name = INSTANCE_TEMPLATE.format(mattermost_id)
 
             self.docker_start(container_name, None)
-            time.sleep(20)
+            # Same check as the image's HEALTHCHECK. Carry on even if it never
+            # comes up, the container may be broken
+            err, _ = self.docker_wait_exec(container_name, "curl --fail --insecure https://localhost", timeout=60)
+            if err is not None:
+                self.print(err)
 
             self.docker_run(container_name, "chown -R root:root /mattermost")
 
@@ -241,13 +244,13 @@ class MattermostServer(DockerBaseModule):
         _, logs = self.mm.docker.images.build(path="./docker-images/mattermost/", tag=self.__SERVER_IMAGE_NAME__, rm=True)
         # self.print(logs)
 
-    def get_list(self):
+    def get_list(self, snapshot=None):
         dbc = self.mm.db.cursor()
 
         dbc.execute("SELECT server_id, server_ip, server_fqdn FROM mattermost;")
 
         results = dbc.fetchall()
-        return self._list_add_data(results, INSTANCE_TEMPLATE)
+        return self._list_add_data(results, INSTANCE_TEMPLATE, snapshot)
 
     def save(self):
         dbc = self.mm.db.cursor()
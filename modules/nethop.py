@@ -1,6 +1,4 @@
-import ipaddress
 import subprocess 
-import time
 
 import pylxd.exceptions
 
@@ -142,7 +140,12 @@ class NetReservation(LXDBaseModule):
             if error != None:
                 return error, None
 
-            time.sleep(10)
+            # Boot starts zebra and ripd, and they have to be up before they are
+            # reconfigured and restarted below
+            err, _ = self.lxd_wait_ready(container_name, check="rc-service zebra status && rc-service ripd status")
+            if err is not None:
+                return err, None
+
             self.lxd_execute(container_name, "echo '' >> /etc/quagga/zebra.conf")
             self.lxd_execute(container_name, "echo 'router rip' >> /etc/quagga/ripd.conf")
             self.lxd_execute(container_name, "echo ' version 2' >> /etc/quagga/ripd.conf")
@@ -200,7 +203,7 @@ class NetReservation(LXDBaseModule):
             # Delete the hop container itself
             err, _ = self.lxd_delete(container_name)
 
-            time.sleep(2)
+            self.lxd_wait_deleted(container_name)
 
             # Remove the container from the database
             dbc.execute("DELETE FROM nethop WHERE hop_id=?", (hop_id,))
@@ -238,9 +241,9 @@ class NetReservation(LXDBaseModule):
             if err is not None:
                 return err, None
 
-            network_obj = ipaddress.ip_network(network_data['net_address'])
+            network_obj = validate.get_network(network_data['net_address'])
 
-            err, _ = self.lxd_execute(container_name, "ip addr add {}/{} dev eth1".format(str(list(network_obj.hosts())[0]), str(network_obj.prefixlen)))
+            err, _ = self.lxd_execute(container_name, "ip addr add {}/{} dev eth1".format(str(validate.get_gateway(network_obj)), str(network_obj.prefixlen)))
             if err is not None:
                 return err, None
 
@@ -314,7 +317,7 @@ class NetReservation(LXDBaseModule):
         lxd_network = self.mm.lxd.networks.get(BUILD_SWITCH)
         lxd_network.delete()
 
-    def get_list(self):
+    def get_list(self, snapshot=None):
         dbc = self.mm.db.cursor()
 
         dbc.execute("SELECT hop_id, front_ip, fqdn FROM nethop;")
@@ -324,9 +327,12 @@ class NetReservation(LXDBaseModule):
         for container in results:
             new_data = ["lxd"]
             new_data += [container[0], container[1], container[2]]
-            container_name = container[2].split(".")[0]
-            _, status = self.lxd_get_status(container_name)
-            new_data += status[1]
+            container_name = INSTANCE_TEMPLATE.format(container[0])
+            if snapshot is not None:
+                _, status = snapshot.lxd_status(container_name)
+            else:
+                _, status = self.lxd_get_status(container_name)
+            new_data.append(status[1])
             new_list.append(new_data)
         return new_list
 
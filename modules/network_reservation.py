@@ -1,15 +1,19 @@
 import ipaddress
-import subprocess 
 
 import pylxd.exceptions
 
 from lib.base_module import BaseModule
+from lib.prefix_index import PrefixIndex
+from lib.database import ensure_generation, get_generation, bump_generation
 import lib.validate as validate
 
 class NetReservation(BaseModule):
 
     def __init__(self, mm):
         self.mm = mm
+        self._prefix_index = None
+        # The networks generation the index is current for
+        self._index_generation = None
 
     __FUNCS__ = {
         "list": {
@@ -31,6 +35,13 @@ class NetReservation(BaseModule):
             "description": "TEXT",
             "switch": "SIMPLE_STRING"
         },
+        "allocate_subnet": {
+            "_desc": "Add a network allocation for the lowest free subnet of a size inside a larger network",
+            "supernet": "IP_NETWORK",
+            "prefixlen": "INTEGER",
+            "description": "TEXT",
+            "switch": "SIMPLE_STRING"
+        },
         "remove_network": {
             "_desc": "Delete a network allocation",
             "id": "INTEGER"
@@ -51,6 +62,10 @@ class NetReservation(BaseModule):
             "_desc": "Get the mask for a network",
             "ip_addr": "IP"
         },
+        "get_ip_network_info": {
+            "_desc": "Get the network, switch and hop flag for the network holding an IP",
+            "ip_addr": "IP"
+        },
         "is_hop_network_by_switch": {
             "_desc": "Check if a network is a hop network (behind a hop router) by switch name",
             "switch": "SIMPLE_STRING"
@@ -63,18 +78,98 @@ class NetReservation(BaseModule):
 
     def _set_switch_ip(self, switch, ip_addr):
 
-        try:
-            status_data = subprocess.check_output(["/usr/bin/sudo", "/sbin/ip", "addr", "show", "dev", switch]).decode()
-            if "UP" in status_data and ip_addr in status_data:
-                return None, True
-        except subprocess.CalledProcessError:
+        err, status_data = self.run_privileged("ip", ["addr", "show", "dev", switch])
+        if err is not None:
             return "Failed to get switch status", None
-        
-        try:
-            subprocess.check_output(["/usr/bin/sudo", "/sbin/ip", 'link', 'set', switch, 'up'])
-            subprocess.check_output(["/usr/bin/sudo", "/sbin/ip", 'addr', 'add', ip_addr, 'dev', switch])
-        except subprocess.CalledProcessError:
+        if "UP" in status_data and ip_addr in status_data:
+            return None, True
+
+        err, _ = self.run_privileged_batch([
+            ("ip", ['link', 'set', switch, 'up']),
+            ("ip", ['addr', 'add', ip_addr, 'dev', switch])
+        ])
+        if err is not None:
             return "Failed to set switch ip", None
+        return None, True
+
+    # The networks as a prefix index, kept up to date as this module changes
+    # networks and rebuilt when the networks generation shows someone else has
+    def _network_index(self):
+        generation = get_generation(self.mm.db, "networks")
+        if self._prefix_index is not None and self._index_generation == generation:
+            return self._prefix_index
+
+        dbc = self.mm.db.cursor()
+        index = PrefixIndex()
+        dbc.execute("SELECT net_id, net_address, net_desc, switch_name, is_hop_network FROM networks;")
+        for net_id, net_address, net_desc, switch, is_hop in dbc.fetchall():
+            if validate.is_ipnetwork(net_address):
+                index.add(net_address, (net_id, net_address, net_desc, switch, is_hop == 1))
+        self._prefix_index = index
+        self._index_generation = generation
+        return index
+
+    def _invalidate_index(self):
+        self._prefix_index = None
+
+    # Counts a write to networks, before it is committed. Returns True if the
+    # index can be updated in place, which is when nothing else has written to
+    # networks since it was built.
+    def _index_written(self):
+        generation = bump_generation(self.mm.db, "networks")
+        if self._prefix_index is not None and generation == self._index_generation + 1:
+            self._index_generation = generation
+            return True
+        self._prefix_index = None
+        return False
+
+    def _index_add(self, net_id, net_address, net_desc, switch, is_hop):
+        if self._index_written():
+            self._prefix_index.add(net_address, (net_id, net_address, net_desc, switch, is_hop))
+
+    def _index_remove(self, net_address):
+        if self._index_written() and validate.is_ipnetwork(net_address):
+            self._prefix_index.remove(net_address)
+
+    def _add_network(self, new_network, description, switch):
+        dbc = self.mm.db.cursor()
+
+        if switch != "":
+            dbc.execute("SELECT * FROM networks WHERE switch_name=?", (switch,))
+            if dbc.fetchone():
+                return "Switch of that name already exists", None
+
+        if not validate.is_ipnetwork(new_network):
+            return "Invalid network address", None
+
+        # Check if the network already exists
+        new_network_obj = ipaddress.ip_network(new_network)
+
+        overlap = self._network_index().overlapping(new_network_obj)
+        if overlap is not None:
+            return "{} network is already part of network {}".format(new_network, str(overlap[0])), None
+
+        # Insert our new network
+        dbc.execute('INSERT INTO networks (net_address, net_desc, switch_name, is_hop_network) VALUES (?, ?, ?, ?)', (new_network, description, switch, 0))
+        network_id = dbc.lastrowid
+        self._index_add(network_id, new_network, description, switch, False)
+        self.mm.db.commit()
+
+        # A blank switch means we don't want one
+        if switch != "":
+            # Ensure the switch exists
+            err, created = self.ovs_add_bridge(switch)
+            if err is not None:
+                return err, None
+            if created:
+                self._set_switch_ip(switch, str(validate.get_gateway(new_network_obj)) + "/" + str(new_network_obj.prefixlen))
+
+        return None, network_id
+
+    def _find_ip(self, ip):
+        if not validate.is_ip(ip):
+            return None
+        return self._network_index().lookup(ip)
               
 
     def run(self, func, **kwargs) :
@@ -99,20 +194,14 @@ class NetReservation(BaseModule):
                 return "Network does not exist", None
             
             dbc.execute("DELETE FROM networks WHERE net_id=?", (net_id,))
+            self._index_remove(result[1])
             self.mm.db.commit()
             
             switch = result[3]
             if switch != "":
-                # Ensure the switch exists
-                try:
-                    subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "br-exists", switch])
-                except subprocess.CalledProcessError:
-                    return "Switch {} does not exit".format(switch), None
-
-                try:
-                    subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "del-br", switch])
-                except subprocess.CalledProcessError:
-                    return "Could not delete switch {}".format(switch), None
+                err, _ = self.ovs_del_bridge(switch)
+                if err is not None:
+                    return err, None
 
 
             return None, True
@@ -132,35 +221,27 @@ class NetReservation(BaseModule):
 
             if validate.is_ipnetwork(new_network):
                 # Check if the network already exists
-                dbc.execute("SELECT * FROM networks;") 
-                results = dbc.fetchall()
-
                 new_network_obj = ipaddress.ip_network(new_network)
 
-                for network in results:
-                    network_obj = ipaddress.ip_network(network[1])
-                    if new_network_obj.overlaps(network_obj):
-                        return "{} network is already part of network {}".format(new_network, str(new_network_obj)), None
+                overlap = self._network_index().overlapping(new_network_obj)
+                if overlap is not None:
+                    return "{} network is already part of network {}".format(new_network, str(overlap[0])), None
 
                 # Insert our new network
                 dbc.execute('INSERT INTO networks (net_address, net_desc, switch_name, is_hop_network) VALUES (?, ?, ?, ?)', (new_network, description, switch, 1))
+                self._index_add(dbc.lastrowid, new_network, description, switch, True)
                 self.mm.db.commit()
 
                 if switch == "":
                     return "Switch name is blank", None
                 
                 # Ensure the switch exists
-                try:
-                    subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "br-exists", switch])
-                except:
-                    try:
-                        subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "add-br", switch])
-                    except:
-                        return "Failed to create OVS bridge", None
+                err, _ = self.ovs_add_bridge(switch)
+                if err is not None:
+                    return err, None
                 
-                try:
-                    subprocess.check_output(["/usr/bin/sudo", "/sbin/ip", 'link', 'set', switch, 'up'])
-                except subprocess.CalledProcessError:
+                err, _ = self.run_privileged("ip", ['link', 'set', switch, 'up'])
+                if err is not None:
                     return "Failed to set hop switch to up", None
 
                 return None, True
@@ -172,49 +253,31 @@ class NetReservation(BaseModule):
             if perror is not None:
                 return perror, None
 
-            new_network = kwargs['net_addr']
-            switch = kwargs['switch']
-            description = kwargs['description']
-
-            if switch != "":
-                dbc.execute("SELECT * FROM networks WHERE switch_name=?", (switch,))
-                if dbc.fetchone():
-                    return "Switch of that name already exists", None
-
-            if validate.is_ipnetwork(new_network):
-                # Check if the network already exists
-                dbc.execute("SELECT * FROM networks;") 
-                results = dbc.fetchall()
-
-                new_network_obj = ipaddress.ip_network(new_network)
+            return self._add_network(kwargs['net_addr'], kwargs['description'], kwargs['switch'])
+        elif func == "allocate_subnet":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
+            if perror is not None:
+                return perror, None
 
-                for network in results:
-                    network_obj = ipaddress.ip_network(network[1])
-                    if new_network_obj.overlaps(network_obj):
-                        return "{} network is already part of network {}".format(new_network, str(new_network_obj)), None
+            supernet = kwargs['supernet']
+            prefixlen = int(kwargs['prefixlen'])
+            if not validate.is_ipnetwork(supernet):
+                return "Invalid network address", None
+            supernet_obj = ipaddress.ip_network(supernet)
+            if prefixlen < supernet_obj.prefixlen or prefixlen > supernet_obj.max_prefixlen:
+                return "Prefix length must be between {} and {}".format(supernet_obj.prefixlen, supernet_obj.max_prefixlen), None
 
-                # Insert our new network
-                
-                dbc.execute('INSERT INTO networks (net_address, net_desc, switch_name, is_hop_network) VALUES (?, ?, ?, ?)', (new_network, description, switch, 0))
-                self.mm.db.commit()
+            new_network = self._network_index().free_block(supernet_obj, prefixlen)
+            if new_network is None:
+                return "No free /{} left in {}".format(prefixlen, supernet), None
 
-                network_id = dbc.lastrowid
-
-                # A blank switch means we don't want one
-                if switch != "":
-                    # Ensure the switch exists
-                    try:
-                        subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "br-exists", switch])
-                    except subprocess.CalledProcessError:
-                        try:
-                            subprocess.check_output(["/usr/bin/sudo", "/usr/bin/ovs-vsctl", "add-br", switch])
-                        except subprocess.CalledProcessError:
-                            return "Failed to create OVS bridge", None
-                        self._set_switch_ip(switch, str(list(new_network_obj.hosts())[0]) + "/" + str(new_network_obj.prefixlen))
-
-                return None, network_id
-            else:
-                return "Invalid network address", None
+            err, network_id = self._add_network(str(new_network), kwargs['description'], kwargs['switch'])
+            if err is not None:
+                return err, None
+            return None, {
+                "net_id": network_id,
+                "net_address": str(new_network)
+            }
         elif func == "get_network_switch":
             pass
         elif func == "get_network_by_switch":
@@ -241,31 +304,38 @@ class NetReservation(BaseModule):
             if perror is not None:
                 return perror, None
 
-            ip = kwargs['ip_addr']
-            
+            found = self._find_ip(kwargs['ip_addr'])
+            if found is None:
+                return "Could not find network", None
 
-            dbc.execute("SELECT * FROM networks")
-            results = dbc.fetchall()
-            for network in results:
-                if validate.is_ip_in_network(ip, network[1]):
-                    return None, network[3]
-            
-            return "Could not find network", None
+            return None, found[1][3]
         elif func == "get_ip_network":
             perror, _ = self.validate_params(self.__FUNCS__['get_ip_network'], kwargs)
             if perror is not None:
                 return perror, None
 
-            ip = kwargs['ip_addr']
-            
+            found = self._find_ip(kwargs['ip_addr'])
+            if found is None:
+                return None, True
 
-            dbc.execute("SELECT * FROM networks")
-            results = dbc.fetchall()
-            for network in results:
-                if validate.is_ip_in_network(ip, network[1]):
-                    return None, ipaddress.ip_network(network[1])
-            
-            return None, True
+            return None, found[0]
+        elif func == "get_ip_network_info":
+            perror, _ = self.validate_params(self.__FUNCS__[func], kwargs)
+            if perror is not None:
+                return perror, None
+
+            found = self._find_ip(kwargs['ip_addr'])
+            if found is None:
+                return "Could not find network", None
+
+            net_id, net_address, net_desc, switch, is_hop = found[1]
+            return None, {
+                "net_id": net_id,
+                "net_address": net_address,
+                "net_desc": net_desc,
+                "switch": switch,
+                "is_hop": is_hop
+            }
         elif func == "is_hop_network_by_switch":
             perror, _ = self.validate_params(self.__FUNCS__['is_hop_network_by_switch'], kwargs)
             if perror is not None:
@@ -289,6 +359,7 @@ class NetReservation(BaseModule):
         if dbc.fetchone() is None:
             dbc.execute("CREATE TABLE networks (net_id INTEGER PRIMARY KEY, net_address TEXT, net_desc TEXT, switch_name TEXT, is_hop_network INTEGER);")
             self.mm.db.commit()
+        ensure_generation(self.mm.db, "networks")
         
         dbc.execute("SELECT net_address, switch_name, is_hop_network FROM networks")
         results = dbc.fetchall()
@@ -298,8 +369,8 @@ class NetReservation(BaseModule):
             is_hop = network[2]
 
             if is_hop != 1 and switch != "":
-                new_network_obj = ipaddress.ip_network(net_addr)
-                self._set_switch_ip(switch, str(list(new_network_obj.hosts())[0]) + "/" + str(new_network_obj.prefixlen))
+                new_network_obj = validate.get_network(net_addr)
+                self._set_switch_ip(switch, str(validate.get_gateway(new_network_obj)) + "/" + str(new_network_obj.prefixlen))
                
 
     def build(self):
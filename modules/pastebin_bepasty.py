@@ -225,13 +225,13 @@ class BePastyServer(DockerBaseModule):
         self.print("Building PasteBin Bepasty server image...")
         self.mm.docker.images.build(path="./docker-images/pastebin-bepasty/", tag=self.__SERVER_IMAGE_NAME__, rm=True)
 
-    def get_list(self):
+    def get_list(self, snapshot=None):
         dbc = self.mm.db.cursor()
 
         dbc.execute("SELECT server_id, server_ip, server_fqdn FROM bepasty;")
 
         results = dbc.fetchall()
-        return self._list_add_data(results, INSTANCE_TEMPLATE)
+        return self._list_add_data(results, INSTANCE_TEMPLATE, snapshot)
 
     def save(self):
         dbc = self.mm.db.cursor()
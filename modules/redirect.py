@@ -1,6 +1,5 @@
 import os
 import shutil 
-import subprocess
 from lib.base_module import BaseModule
 
 
@@ -38,9 +37,8 @@ class RedirectModule(BaseModule):
             if error is not None:
                 return "No base DNS server has been created", None
 
-            try:
-                subprocess.check_output(["/usr/bin/sudo", "-n", "/sbin/iptables", "-t", "nat", "-A", "PREROUTING", "-i", interface, "-p", "udp", "-m", "udp", "--dport", "53", "-j", "DNAT", "--to-destination", server_data['server_ip'] + ":53"], stderr=subprocess.DEVNULL)     
-            except subprocess.CalledProcessError:
+            err, _ = self.run_privileged("iptables", ["-t", "nat", "-A", "PREROUTING", "-i", interface, "-p", "udp", "-m", "udp", "--dport", "53", "-j", "DNAT", "--to-destination", server_data['server_ip'] + ":53"])
+            if err is not None:
                 return "Could not enable DNS redirect", None
 
             return None, True
@@ -56,9 +54,8 @@ class RedirectModule(BaseModule):
             if error is not None:
                 return "No base DNS server has been created", None
 
-            try:
-                subprocess.check_output(["/usr/bin/sudo", "-n", "/sbin/iptables", "-t", "nat", "-D", "PREROUTING", "-i", interface, "-p", "udp", "-m", "udp", "--dport", "53", "-j", "DNAT", "--to-destination", server_data['server_ip'] + ":53"])     
-            except subprocess.CalledProcessError:
+            err, _ = self.run_privileged("iptables", ["-t", "nat", "-D", "PREROUTING", "-i", interface, "-p", "udp", "-m", "udp", "--dport", "53", "-j", "DNAT", "--to-destination", server_data['server_ip'] + ":53"])
+            if err is not None:
                 return "Could not disable DNS redirect", None
 
             return None, True
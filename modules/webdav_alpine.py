@@ -230,13 +230,13 @@ class AlpineWebDAVServer(DockerBaseModule):
         self.print("Building Alpine WebDAV server image...")
         self.mm.docker.images.build(path="./docker-images/webdav_alpine/", tag=self.__SERVER_IMAGE_NAME__, rm=True)
 
-    def get_list(self):
+    def get_list(self, snapshot=None):
         dbc = self.mm.db.cursor()
 
         dbc.execute("SELECT server_id, server_ip, server_fqdn FROM alpinewebdav;")
 
         results = dbc.fetchall()
-        return self._list_add_data(results, INSTANCE_TEMPLATE)
+        return self._list_add_data(results, INSTANCE_TEMPLATE, snapshot)
 
     def save(self):
         dbc = self.mm.db.cursor()
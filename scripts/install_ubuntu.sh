@@ -199,6 +199,9 @@ if [[ "$CREATE_SERVICE" -eq "1" ]]; then
     sudo cp scripts/fakernet.service.template /etc/systemd/system/fakernet.service
     sudo sed -i "s_CURRENTUSER_${INSTALL_USER}_g" /etc/systemd/system/fakernet.service
     sudo sed -i "s_PWD_${INSTALL_DIR}_g" /etc/systemd/system/fakernet.service
+    sudo cp scripts/fakernet-helper.service.template /etc/systemd/system/fakernet-helper.service
+    sudo sed -i "s_CURRENTUSER_${INSTALL_USER}_g" /etc/systemd/system/fakernet-helper.service
+    sudo sed -i "s_PWD_${INSTALL_DIR}_g" /etc/systemd/system/fakernet-helper.service
     sudo systemctl daemon-reload 
 fi
 
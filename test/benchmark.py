@@ -0,0 +1,13 @@
+import os
+import unittest
+
+# Timing benchmarks are slow and their numbers depend on the machine, so they
+# only run when asked for:
+#   FAKERNET_BENCHMARK=1 python3 -m pytest test/test_ovsdb.py
+ENABLED = os.environ.get("FAKERNET_BENCHMARK", "") not in ("", "0")
+
+def benchmark(test):
+    return unittest.skipUnless(ENABLED, "set FAKERNET_BENCHMARK=1 to run benchmarks")(test)
+
+def report(name, message):
+    print("\n[benchmark] {}: {}".format(name, message))
@@ -0,0 +1,664 @@
+import os
+import queue
+import time
+import json
+import copy
+import uuid
+import struct
+import threading
+import socketserver
+
+import docker
+import pylxd.exceptions
+import dns.exception
+import dns.message
+import dns.opcode
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.tsigkeyring
+
+from lib.priv_helper import PrivilegedHelper, TOOLS
+
+# In-memory stand-ins for the Docker and LXD clients, for tests that
+# need to count or control calls to the backends.
+
+class FakeContainer():
+
+    def __init__(self, client, name, status):
+        self._client = client
+        self.name = name
+        self.status = status
+        self.pid = 0
+        self.exec_log = []
+
+    @property
+    def attrs(self):
+        return {
+            "Names": ["/" + self.name],
+            "State": {
+                "Status": self.status,
+                "Pid": self.pid
+            }
+        }
+
+    def start(self):
+        self._client.round_trips += 1
+        self.status = "running"
+        self._client.pids += 1
+        self.pid = self._client.pids
+        self._client.emit("start", self.name)
+
+    def stop(self):
+        self._client.round_trips += 1
+        self.status = "exited"
+        self._client.emit("die", self.name)
+        self._client.emit("stop", self.name)
+
+    def remove(self):
+        self._client.round_trips += 1
+        del self._client.containers._containers[self.name]
+        self._client.emit("destroy", self.name)
+
+    def exec_run(self, cmd):
+        self._client.round_trips += 1
+        self.exec_log.append(cmd)
+        return self._client.exec_result(self.name, cmd)
+
+class FakeContainerCollection():
+
+    def __init__(self, client):
+        self._client = client
+        self._containers = {}
+
+    def add(self, name, status):
+        self._containers[name] = FakeContainer(self._client, name, status)
+        return self._containers[name]
+
+    def create(self, image, name=None, **kwargs):
+        self._client.round_trips += 1
+        container = self.add(name, "created")
+        self._client.emit("create", name)
+        return container
+
+    def list(self, all=False, sparse=False):
+        self._client.round_trips += 1
+        return list(self._containers.values())
+
+    def get(self, name):
+        self._client.round_trips += 1
+        if name not in self._containers:
+            raise docker.errors.NotFound("No such container")
+        return self._containers[name]
+
+class FakeDockerClient():
+
+    def __init__(self):
+        self.round_trips = 0
+        self.pids = 1000
+        self.containers = FakeContainerCollection(self)
+        self._event_queues = []
+
+    # Returns (exit code, output) for exec_run. Override in tests as needed.
+    def exec_result(self, name, cmd):
+        return 0, b""
+
+    def emit(self, action, name):
+        event = {
+            "Type": "container",
+            "Action": action,
+            "Actor": {
+                "Attributes": {
+                    "name": name
+                }
+            }
+        }
+        for event_queue in self._event_queues:
+            event_queue.put(event)
+
+    # Blocks like the real stream. Putting None in the queue ends it.
+    def events(self, decode=False, since=None, until=None, filters=None):
+        event_queue = queue.Queue()
+        self._event_queues.append(event_queue)
+
+        def stream():
+            while True:
+                event = event_queue.get()
+                if event is None:
+                    self._event_queues.remove(event_queue)
+                    return
+                yield event
+        return stream()
+
+    def close_events(self):
+        for event_queue in list(self._event_queues):
+            event_queue.put(None)
+
+class FakeLXDResponse():
+
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return {"metadata": self._data}
+
+class FakeLXDContainersEndpoint():
+
+    def __init__(self, client):
+        self._client = client
+
+    def get(self, params=None):
+        self._client.round_trips += 1
+        return FakeLXDResponse(self._client.container_data)
+
+class FakeLXDAPI():
+
+    def __init__(self, client):
+        self.containers = FakeLXDContainersEndpoint(client)
+
+class FakeLXDErrorResponse():
+    status_code = 404
+    content = b"not found"
+
+    def json(self):
+        return {"error": "not found"}
+
+class FakeLXDState():
+
+    def __init__(self, status):
+        self.status = status
+
+class FakeLXDContainer():
+
+    def __init__(self, client, name, status):
+        self._client = client
+        self.name = name
+        self.status = status
+        self.exec_log = []
+
+    def state(self):
+        self._client.round_trips += 1
+        return FakeLXDState(self.status)
+
+    def start(self, wait=False):
+        self._client.round_trips += 1
+        self.status = "Running"
+
+    def delete(self, wait=False):
+        self._client.round_trips += 1
+        del self._client.containers._containers[self.name]
+
+    def execute(self, command):
+        self._client.round_trips += 1
+        self.exec_log.append(command)
+        return self._client.execute_result(self.name, command)
+
+class FakeLXDContainerCollection():
+
+    def __init__(self, client):
+        self._client = client
+        self._containers = {}
+
+    def add(self, name, status):
+        self._containers[name] = FakeLXDContainer(self._client, name, status)
+        return self._containers[name]
+
+    def exists(self, name):
+        self._client.round_trips += 1
+        return name in self._containers
+
+    def get(self, name):
+        self._client.round_trips += 1
+        if name not in self._containers:
+            raise pylxd.exceptions.NotFound(FakeLXDErrorResponse())
+        return self._containers[name]
+
+class FakeLXDClient():
+
+    def __init__(self):
+        self.round_trips = 0
+        self.container_data = []
+        self.api = FakeLXDAPI(self)
+        self.containers = FakeLXDContainerCollection(self)
+
+    # Returns (exit code, stdout, stderr) for execute. Override in tests as needed.
+    def execute_result(self, name, command):
+        return 0, "", ""
+
+# Records ovs-docker port changes instead of running them. delay stands in
+# for the time the real command takes.
+class FakeOVS():
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.ports = {}
+        self.calls = 0
+
+    def add_port(self, bridge, interface, container, ip_addr, gateway):
+        time.sleep(self.delay)
+        self.calls += 1
+        self.ports[(bridge, container)] = (interface, ip_addr, gateway)
+
+    def del_ports(self, bridge, container):
+        time.sleep(self.delay)
+        self.calls += 1
+        self.ports.pop((bridge, container), None)
+
+# Stands in for lib.container_net.Netlink, keeping the links of each network
+# namespace in memory. Namespaces are keyed by process ID, with None for the
+# host. Each call counts as one round trip to the kernel, and configure as
+# two since it looks up the interface first.
+class FakeNetlink():
+
+    def __init__(self):
+        self.links = {None: {}}
+        self.round_trips = 0
+
+    def available(self):
+        return True
+
+    def link(self, pid, name):
+        return self.links.get(pid, {}).get(name)
+
+    def create_veths(self, pairs):
+        self.round_trips += 1
+        created = []
+        for name, peer_name, pid in pairs:
+            if self.link(None, name) is not None or self.link(pid, peer_name) is not None:
+                self.delete_links(created)
+                return "Could not create veth {}: File exists".format(name), None
+            self.links[None][name] = {"peer": (pid, peer_name), "up": True, "address": None, "gateway": None}
+            self.links.setdefault(pid, {})[peer_name] = {"peer": (None, name), "up": False, "address": None, "gateway": None}
+            created.append(name)
+        return None, True
+
+    def configure(self, pid, interface, ip_addr, gateway):
+        self.round_trips += 2
+        link = self.link(pid, interface)
+        if link is None:
+            return "Could not configure {} in process {}: No such device".format(interface, pid), None
+        link['up'] = True
+        link['address'] = ip_addr
+        link['gateway'] = gateway
+        return None, True
+
+    def delete_links(self, names):
+        self.round_trips += 1
+        for name in names:
+            link = self.links[None].pop(name, None)
+            if link is not None:
+                pid, peer_name = link['peer']
+                self.links[pid].pop(peer_name, None)
+        return None, True
+
+class FakeDNSUpdateHandler(socketserver.BaseRequestHandler):
+
+    def _read(self, length):
+        data = b""
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if chunk == b"":
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        while True:
+            header = self._read(2)
+            if header is None:
+                return
+            wire = self._read(struct.unpack("!H", header)[0])
+            response = self.server.stub.handle(wire)
+            self.request.sendall(struct.pack("!H", len(response)) + response)
+
+# A DNS server on localhost that applies TSIG-signed DNS UPDATE messages for
+# its zones to records held in memory, and answers queries from them over
+# TCP. Stands in for BIND when testing dynamic updates.
+class FakeDNSUpdateServer():
+
+    def __init__(self, key_name, secret, zones):
+        self.keyring = dns.tsigkeyring.from_text({key_name: secret})
+        self.zones = [zone.rstrip(".").lower() + "." for zone in zones]
+        # (name, type) -> set of rdata text
+        self.records = {}
+        self.updates = 0
+        self._lock = threading.Lock()
+
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), FakeDNSUpdateHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def lookup(self, name, record_type):
+        with self._lock:
+            return sorted(self.records.get((name.lower(), record_type), set()))
+
+    def handle(self, wire):
+        try:
+            message = dns.message.from_wire(wire, keyring=self.keyring)
+        except dns.exception.DNSException:
+            # Unsigned or badly signed, answer with just a header
+            request_id, flags = struct.unpack("!HH", wire[:4])
+            return struct.pack("!HHHHHH", request_id, 0x8000 | (flags & 0x7800) | dns.rcode.NOTAUTH, 0, 0, 0, 0)
+
+        response = dns.message.make_response(message)
+        if message.opcode() == dns.opcode.UPDATE:
+            zone = message.zone[0].name.to_text().lower()
+            if zone not in self.zones:
+                response.set_rcode(dns.rcode.NOTAUTH)
+            else:
+                self._apply(message)
+        else:
+            question = message.question[0]
+            values = self.lookup(question.name.to_text(), dns.rdatatype.to_text(question.rdtype))
+            if len(values) == 0:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            else:
+                rrset = response.find_rrset(response.answer, question.name, dns.rdataclass.IN, question.rdtype, create=True)
+                for value in values:
+                    rrset.add(dns.rdata.from_text(dns.rdataclass.IN, question.rdtype, value))
+        return response.to_wire()
+
+    def _apply(self, message):
+        with self._lock:
+            self.updates += 1
+            for rrset in message.update:
+                key = (rrset.name.to_text().lower(), dns.rdatatype.to_text(rrset.rdtype))
+                if rrset.deleting == dns.rdataclass.ANY:
+                    for record_key in list(self.records.keys()):
+                        if record_key[0] == key[0] and (rrset.rdtype == dns.rdatatype.ANY or record_key == key):
+                            del self.records[record_key]
+                elif rrset.deleting == dns.rdataclass.NONE:
+                    values = self.records.get(key, set())
+                    for rdata in rrset:
+                        values.discard(rdata.to_text())
+                    if len(values) == 0:
+                        self.records.pop(key, None)
+                else:
+                    values = self.records.setdefault(key, set())
+                    for rdata in rrset:
+                        values.add(rdata.to_text())
+
+OVSDB_DEFAULTS = {
+    "Open_vSwitch": {"bridges": []},
+    "Bridge": {"name": "", "ports": [], "external_ids": {}},
+    "Port": {"name": "", "interfaces": [], "external_ids": {}},
+    "Interface": {"name": "", "type": "", "error": None, "external_ids": {}, "ofport": None}
+}
+OVSDB_UUID_SETS = ("bridges", "ports", "interfaces")
+OVSDB_OPTIONAL = ("error", "ofport")
+
+class FakeOVSDBHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        decoder = json.JSONDecoder()
+        buffer = ""
+        try:
+            while True:
+                data = self.request.recv(65536)
+                if data == b"":
+                    return
+                buffer += data.decode()
+                while True:
+                    buffer = buffer.lstrip()
+                    if buffer == "":
+                        break
+                    try:
+                        message, end = decoder.raw_decode(buffer)
+                    except ValueError:
+                        break
+                    buffer = buffer[end:]
+                    self.server.stub.handle(self.request, message)
+        finally:
+            self.server.stub.disconnect(self.request)
+
+# An ovsdb-server on a unix socket holding the bridge, port and interface
+# tables in memory. Handles the monitor, transact and echo JSON-RPC methods
+# with the insert, delete, mutate, update and select operations, and drops
+# bridges, ports and interfaces nothing refers to any more, like the real
+# server.
+class FakeOVSDBServer():
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = dict([(table, {}) for table in OVSDB_DEFAULTS])
+        self.tables["Open_vSwitch"][str(uuid.uuid4())] = {"bridges": []}
+        self.transactions = 0
+        self._monitors = {}
+        self._lock = threading.Lock()
+
+        self._server = socketserver.ThreadingUnixStreamServer(path, FakeOVSDBHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def find(self, table, name):
+        with self._lock:
+            for row_id, row in self.tables[table].items():
+                if row.get("name") == name:
+                    return row_id, row
+        return None
+
+    # Stands in for the kernel reporting an interface it can't open
+    def set_interface_error(self, name, error):
+        with self._lock:
+            before = copy.deepcopy(self.tables)
+            for row in self.tables["Interface"].values():
+                if row["name"] == name:
+                    row["error"] = error
+            self._notify(before)
+
+    def disconnect(self, sock):
+        with self._lock:
+            self._monitors.pop(sock, None)
+
+    def _send(self, sock, message):
+        try:
+            sock.sendall(json.dumps(message).encode())
+        except OSError:
+            pass
+
+    def _to_wire(self, column, value):
+        if column in OVSDB_UUID_SETS:
+            return ["set", [["uuid", item] for item in value]]
+        elif column == "external_ids":
+            return ["map", [[key, item] for key, item in value.items()]]
+        elif column in OVSDB_OPTIONAL and value is None:
+            return ["set", []]
+        return value
+
+    def _wire_row(self, row, columns=None):
+        return dict([(column, self._to_wire(column, value)) for column, value in row.items() if columns is None or column in columns])
+
+    def _from_wire(self, value, named):
+        if isinstance(value, list):
+            if value[0] == "uuid":
+                return value[1]
+            elif value[0] == "named-uuid":
+                return named[value[1]]
+            elif value[0] == "set":
+                return [self._from_wire(item, named) for item in value[1]]
+            elif value[0] == "map":
+                return dict([(key, self._from_wire(item, named)) for key, item in value[1]])
+        return value
+
+    def _set_column(self, row, column, value):
+        if column in OVSDB_UUID_SETS and not isinstance(value, list):
+            value = [value]
+        elif column in OVSDB_OPTIONAL and value == []:
+            value = None
+        row[column] = value
+
+    def _matches(self, tables, table, where, named):
+        found = []
+        for row_id, row in tables[table].items():
+            matched = True
+            for column, function, value in where:
+                value = self._from_wire(value, named)
+                current = row_id if column == "_uuid" else row.get(column)
+                if function != "==" or current != value:
+                    matched = False
+            if matched:
+                found.append((row_id, row))
+        return found
+
+    def _transact(self, operations):
+        tables = copy.deepcopy(self.tables)
+        named = {}
+        results = []
+        for operation in operations:
+            op = operation.get("op")
+            table = operation.get("table")
+            if op != "comment" and table not in tables:
+                results.append({"error": "unknown table", "details": str(table)})
+                return results, None
+
+            if op == "insert":
+                row_id = str(uuid.uuid4())
+                if "uuid-name" in operation:
+                    named[operation["uuid-name"]] = row_id
+                row = copy.deepcopy(OVSDB_DEFAULTS[table])
+                for column, value in operation.get("row", {}).items():
+                    self._set_column(row, column, self._from_wire(value, named))
+                tables[table][row_id] = row
+                results.append({"uuid": ["uuid", row_id]})
+            elif op == "delete":
+                found = self._matches(tables, table, operation.get("where", []), named)
+                for row_id, _ in found:
+                    del tables[table][row_id]
+                results.append({"count": len(found)})
+            elif op == "update":
+                found = self._matches(tables, table, operation.get("where", []), named)
+                for _, row in found:
+                    for column, value in operation.get("row", {}).items():
+                        self._set_column(row, column, self._from_wire(value, named))
+                results.append({"count": len(found)})
+            elif op == "mutate":
+                found = self._matches(tables, table, operation.get("where", []), named)
+                for _, row in found:
+                    for column, mutator, value in operation.get("mutations", []):
+                        value = self._from_wire(value, named)
+                        if not isinstance(value, list):
+                            value = [value]
+                        if mutator == "insert":
+                            row[column] = row[column] + [item for item in value if item not in row[column]]
+                        elif mutator == "delete":
+                            row[column] = [item for item in row[column] if item not in value]
+                        else:
+                            results.append({"error": "not supported", "details": mutator})
+                            return results, None
+                results.append({"count": len(found)})
+            elif op == "select":
+                found = self._matches(tables, table, operation.get("where", []), named)
+                columns = operation.get("columns")
+                rows = []
+                for row_id, row in found:
+                    wire = self._wire_row(row, columns)
+                    wire["_uuid"] = ["uuid", row_id]
+                    rows.append(wire)
+                results.append({"rows": rows})
+            elif op == "comment":
+                results.append({})
+            else:
+                results.append({"error": "unknown operation", "details": str(op)})
+                return results, None
+
+        # Drop rows nothing refers to
+        for table, parent, column in (("Bridge", "Open_vSwitch", "bridges"), ("Port", "Bridge", "ports"), ("Interface", "Port", "interfaces")):
+            used = set()
+            for row in tables[parent].values():
+                used.update(row[column])
+            for row_id in list(tables[table].keys()):
+                if row_id not in used:
+                    del tables[table][row_id]
+        return results, tables
+
+    # Called with self._lock held
+    def _notify(self, before):
+        for sock, (monitor_id, monitored) in self._monitors.items():
+            updates = {}
+            for table, columns in monitored.items():
+                changes = {}
+                for row_id in set(before[table].keys()) | set(self.tables[table].keys()):
+                    old = before[table].get(row_id)
+                    new = self.tables[table].get(row_id)
+                    if old == new:
+                        continue
+                    change = {}
+                    if old is not None:
+                        change["old"] = self._wire_row(old, columns)
+                    if new is not None:
+                        change["new"] = self._wire_row(new, columns)
+                    changes[row_id] = change
+                if len(changes) > 0:
+                    updates[table] = changes
+            if len(updates) > 0:
+                self._send(sock, {"method": "update", "params": [monitor_id, updates], "id": None})
+
+    def handle(self, sock, message):
+        method = message.get("method")
+        params = message.get("params", [])
+        with self._lock:
+            if method == "echo":
+                self._send(sock, {"id": message.get("id"), "result": params, "error": None})
+            elif method == "monitor":
+                monitored = {}
+                initial = {}
+                for table, request in params[2].items():
+                    columns = request.get("columns")
+                    monitored[table] = columns
+                    initial[table] = dict([(row_id, {"new": self._wire_row(row, columns)}) for row_id, row in self.tables[table].items()])
+                self._monitors[sock] = (params[1], monitored)
+                self._send(sock, {"id": message.get("id"), "result": initial, "error": None})
+            elif method == "transact":
+                results, tables = self._transact(params[1:])
+                if tables is not None:
+                    before = self.tables
+                    self.tables = tables
+                    self.transactions += 1
+                    self._notify(before)
+                self._send(sock, {"id": message.get("id"), "result": results, "error": None})
+            else:
+                self._send(sock, {"id": message.get("id"), "result": None, "error": "unknown method"})
+
+# An unprivileged stand-in for the privileged helper: the real
+# PrivilegedHelper on the given socket, allowing only the current user, but
+# recording each command instead of running it. Commands succeed with no
+# output unless set_result says otherwise.
+class FakePrivilegedHelper():
+
+    def __init__(self, path):
+        self.commands = []
+        self._results = []
+        self.helper = PrivilegedHelper(path, allowed_uids=[os.getuid()], tools=dict([(tool, tool) for tool in TOOLS]), runner=self._run)
+        self.helper.start()
+
+    # Answers commands starting with prefix, the most recently set first
+    def set_result(self, prefix, code, output="", error=""):
+        self._results.insert(0, (list(prefix), code, output, error))
+
+    def _run(self, argv):
+        self.commands.append(argv)
+        for prefix, code, output, error in self._results:
+            if argv[:len(prefix)] == prefix:
+                return code, output, error
+        return 0, "", ""
+
+    @property
+    def requests(self):
+        return self.helper.requests
+
+    def stop(self):
+        self.helper.stop()
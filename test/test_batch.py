@@ -0,0 +1,128 @@
+import unittest
+import os
+import sys
+import sqlite3
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+
+from lib.module_manager import ModuleManager, LockModule, BATCH_SKIPPED
+from lib.base_module import BaseModule
+
+class CounterModule(BaseModule):
+    __SHORTNAME__ = "counter"
+    __FUNCS__ = {
+        "add": {
+            "_desc": "Add to the counter",
+            "amount": "INTEGER"
+        },
+        "fail": {
+            "_desc": "Always fails"
+        }
+    }
+
+    def __init__(self, mm):
+        self.mm = mm
+        self.total = 0
+
+    def run(self, func, **kwargs):
+        if func == "add":
+            self.total += int(kwargs['amount'])
+            return None, self.total
+        elif func == "fail":
+            return "Failed on purpose", None
+        elif func == "internal":
+            return None, "internal"
+        return "Invalid function", None
+
+class FakeResponse():
+
+    def __init__(self, data, status_code=200):
+        self._data = data
+        self.status_code = status_code
+
+    def json(self):
+        return self._data
+
+# Stands in for the remote ModuleManager's session, answering _batch requests
+# with a local ModuleManager
+class FakeSession():
+
+    def __init__(self, local_mm):
+        self.local_mm = local_mm
+        self.posts = []
+
+    def post(self, url, data=None, json=None):
+        self.posts.append((url, json))
+        error, results = self.local_mm.run_batch(json['commands'], stop_on_error=json['stop_on_error'])
+        output = []
+        for error, result in results:
+            if error is None:
+                output.append({"ok": True, "output": result})
+            else:
+                output.append({"ok": False, "error": error})
+        return FakeResponse({"ok": True, "result": {"results": output}})
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient())
+        self.counter = CounterModule(self.mm)
+        self.mm.modules['counter'] = LockModule(self.counter, self.mm)
+
+    def test_local_batch(self):
+        commands = [
+            {"module": "counter", "func": "add", "args": {"amount": 1}},
+            {"module": "counter", "func": "fail"},
+            {"module": "nope", "func": "add", "args": {}},
+            {"module": "counter", "func": "internal", "args": {}},
+            {"module": "counter"},
+            "counter",
+            {"module": "counter", "func": "add", "args": [2]},
+            {"module": "counter", "func": "add", "args": {"amount": 2}},
+        ]
+        error, results = self.mm.run_batch(commands)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(len(results), len(commands))
+        self.assertEqual(results[0], (None, 1))
+        self.assertEqual(results[1], ("Failed on purpose", None))
+        for i in range(2, 6):
+            self.assertTrue(results[i][0] is not None)
+        self.assertEqual(results[6], ("Command key 'args' is not a JSON object", None))
+        self.assertEqual(results[7], (None, 3))
+
+    def test_stop_on_error(self):
+        commands = [
+            {"module": "counter", "func": "add", "args": {"amount": 1}},
+            {"module": "counter", "func": "fail", "args": {}},
+            {"module": "counter", "func": "add", "args": {"amount": 2}},
+        ]
+        error, results = self.mm.run_batch(commands, stop_on_error=True)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(results, [(None, 1), ("Failed on purpose", None), (BATCH_SKIPPED, None)])
+        self.assertEqual(self.counter.total, 1)
+
+    def test_remote_batch_single_request(self):
+        remote = ModuleManager(ip="127.0.0.1")
+        fake_session = FakeSession(self.mm)
+        remote._session = fake_session
+
+        commands = [{"module": "counter", "func": "add", "args": {"amount": 1}} for i in range(200)]
+        error, results = remote.run_batch(commands)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(results[-1], (None, 200))
+        self.assertEqual(len(fake_session.posts), 1)
+        self.assertTrue(fake_session.posts[0][0].endswith("/api/v1/_batch"))
+
+        error, result = remote.run_json_command({"module": "counter", "func": "fail"})
+        self.assertEqual(error, "Failed on purpose")
+        error, result = remote.run_json_command({"module": "counter", "func": "add", "args": {"amount": 1}})
+        self.assertEqual(result, 201)
+        self.assertEqual(len(fake_session.posts), 3)
+
+    def tearDown(self):
+        self.mm.jobs.shutdown()
+        self.mm.db.close()
@@ -0,0 +1,160 @@
+import unittest
+import os
+import sys
+import time
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient
+from benchmark import benchmark, report
+
+from lib.container_cache import ContainerStateCache
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def wait_until(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+class TestContainerStateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.docker = FakeDockerClient()
+        self.docker.containers.add("dns-server-1", "running")
+        self.docker.containers.add("minica-server-1", "exited")
+        self.clock = FakeClock()
+        self.cache = ContainerStateCache(self.docker, max_age=30, clock=self.clock)
+
+    def test_events_applied(self):
+        self.cache.resync()
+
+        self.assertEqual(self.cache.docker_status("dns-server-1"), (None, ("yes", "running")))
+        self.assertEqual(self.cache.docker_status("minica-server-1"), (None, ("yes", "exited")))
+
+        events = [
+            ("start", "minica-server-1", ("yes", "running")),
+            ("die", "dns-server-1", ("yes", "exited")),
+            ("create", "mattermost-server-1", ("yes", "created")),
+            ("start", "mattermost-server-1", ("yes", "running")),
+            ("stop", "mattermost-server-1", ("yes", "exited")),
+            ("destroy", "mattermost-server-1", ("no", "n/a")),
+        ]
+        for action, name, expected in events:
+            self.cache.apply_event({
+                "Type": "container",
+                "Action": action,
+                "Actor": {"Attributes": {"name": name}}
+            })
+            self.assertEqual(self.cache.docker_status(name), (None, expected))
+
+        # Unrelated events are ignored
+        self.cache.apply_event({"Type": "container", "Action": "exec_start: sh", "Actor": {"Attributes": {"name": "dns-server-1"}}})
+        self.cache.apply_event({"Type": "network", "Action": "connect", "Actor": {"Attributes": {"name": "dns-server-1"}}})
+        self.assertEqual(self.cache.docker_status("dns-server-1"), (None, ("yes", "exited")))
+
+    def test_staleness_fallback(self):
+        self.cache.resync()
+
+        # Changed behind the cache's back
+        self.docker.containers.get("minica-server-1").status = "running"
+        self.docker.round_trips = 0
+
+        self.assertEqual(self.cache.docker_status("minica-server-1"), (None, ("yes", "exited")))
+        self.assertEqual(self.docker.round_trips, 0)
+
+        # Past max_age without an event stream, reads go to Docker
+        self.clock.now += 31
+        self.assertFalse(self.cache.is_fresh())
+        self.assertEqual(self.cache.docker_status("minica-server-1"), (None, ("yes", "running")))
+        self.assertEqual(self.cache.docker_status("nope"), (None, ("no", "n/a")))
+        self.assertEqual(self.docker.round_trips, 2)
+
+    def test_unsynced_falls_back(self):
+        self.assertFalse(self.cache.is_fresh())
+        self.assertEqual(self.cache.docker_status("dns-server-1"), (None, ("yes", "running")))
+        self.assertEqual(self.docker.round_trips, 1)
+
+    def test_event_stream(self):
+        self.cache.start()
+        self.assertTrue(wait_until(lambda: self.cache.is_fresh() and len(self.docker._event_queues) > 0))
+
+        self.docker.containers.get("minica-server-1").start()
+        self.assertTrue(wait_until(lambda: self.cache.docker_status("minica-server-1") == (None, ("yes", "running"))))
+
+        self.docker.containers.get("dns-server-1").remove()
+        self.assertTrue(wait_until(lambda: self.cache.docker_status("dns-server-1") == (None, ("no", "n/a"))))
+
+        # Stale past max_age, but the stream is up so the cache is still trusted
+        self.clock.now += 1000
+        self.assertTrue(self.cache.is_fresh())
+
+        self.cache.stop()
+        self.docker.close_events()
+
+    def test_broken_stream(self):
+        from urllib3.exceptions import ProtocolError
+        streams = []
+
+        # The first stream breaks after one event, the next one stays up
+        def events(**kwargs):
+            streams.append(kwargs)
+            if len(streams) > 1:
+                return FakeDockerClient.events(self.docker, **kwargs)
+            def broken():
+                yield {"Type": "container", "Action": "start", "Actor": {"Attributes": {"name": "minica-server-1"}}}
+                raise ProtocolError("Connection broken: IncompleteRead")
+            return broken()
+        self.docker.events = events
+        self.cache.retry_delay = 0.01
+
+        self.cache.start()
+        self.assertTrue(wait_until(lambda: len(self.docker._event_queues) > 0))
+        self.assertEqual(len(streams), 2)
+        self.assertTrue(self.cache.is_fresh())
+
+        self.docker.containers.get("minica-server-1").start()
+        self.assertTrue(wait_until(lambda: self.cache.docker_status("minica-server-1") == (None, ("yes", "running"))))
+
+        # Without a stream, the cache is only trusted for max_age
+        self.docker.close_events()
+        self.cache.stop()
+        self.assertTrue(wait_until(lambda: not self.cache._thread.is_alive()))
+        self.clock.now += 1000
+        self.assertFalse(self.cache.is_fresh())
+
+    def test_reads_cached(self):
+        self.cache.resync()
+        self.docker.round_trips = 0
+
+        for i in range(100):
+            self.cache.docker_status("dns-server-1")
+        self.assertEqual(self.docker.round_trips, 0)
+
+    @benchmark
+    def test_read_speed(self):
+        self.cache.resync()
+        self.docker.round_trips = 0
+
+        reads = 100000
+        start = time.perf_counter()
+        for i in range(reads):
+            self.cache.docker_status("dns-server-1")
+        per_read = (time.perf_counter() - start) / reads
+
+        report("cached status read", "{:.2f} microseconds".format(per_read * 1000000))
+        self.assertEqual(self.docker.round_trips, 0)
+        self.assertTrue(per_read < 0.0001)
+
+    def tearDown(self):
+        self.cache.stop()
@@ -0,0 +1,227 @@
+import unittest
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import subprocess
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient, FakeOVSDBServer, FakeNetlink
+from benchmark import benchmark, report
+
+from modules.network_reservation import NetReservation
+from lib.module_manager import ModuleManager, LockModule
+from lib.base_module import DockerBaseModule
+from lib.container_net import ContainerPlumbing, Netlink
+from lib.ovsdb import OVSDBClient
+
+class PlainService(DockerBaseModule):
+    __SHORTNAME__ = "plainservice"
+    __SERVER_IMAGE_NAME__ = "fake-server"
+    __FUNCS__ = {}
+
+    def __init__(self, mm):
+        self.mm = mm
+
+class OVSDBTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.server = FakeOVSDBServer(os.path.join(self.base_dir, "db.sock"))
+        self.client = OVSDBClient(os.path.join(self.base_dir, "db.sock"))
+        error, _ = self.client.connect()
+        self.assertTrue(error is None, msg=error)
+        transaction = self.client.transaction()
+        transaction.add_bridge("br1")
+        transaction.commit()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.base_dir)
+
+class TestContainerPlumbing(OVSDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.netlink = FakeNetlink()
+        self.plumbing = ContainerPlumbing(self.client, self.netlink)
+
+    def test_attach(self):
+        error, name = self.plumbing.attach("web", 1001, "br1", "eth0", "172.16.3.10/24", "172.16.3.1")
+        self.assertTrue(error is None, msg=error)
+        self.assertTrue(len(name) <= 15)
+        self.assertEqual(self.netlink.link(1001, "eth0")['address'], "172.16.3.10/24")
+        self.assertEqual(self.netlink.link(1001, "eth0")['gateway'], "172.16.3.1")
+        self.assertTrue(self.netlink.link(1001, "eth0")['up'])
+        self.assertEqual(self.client.find("Interface", name)['external_ids'], {"container_id": "web", "container_iface": "eth0"})
+        self.assertEqual(self.plumbing.ports("web", "br1"), [name])
+        self.assertEqual(self.plumbing.ports("web", "br2"), [])
+        self.assertEqual(self.plumbing.ports("other", "br1"), [])
+
+        error, count = self.plumbing.detach("web", "br1")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(count, 1)
+        self.assertEqual(self.client.find("Port", name), None)
+        self.assertEqual(self.netlink.link(None, name), None)
+        self.assertEqual(self.netlink.link(1001, "eth0"), None)
+
+    def test_errors(self):
+        error, _ = self.plumbing.attach("web", 1001, "br2", "eth0", "172.16.3.10/24", "172.16.3.1")
+        self.assertEqual(error, "Switch br2 does not exist")
+        self.assertEqual(self.netlink.links[None], {})
+
+        # Configuring the second container fails, so neither is left behind
+        original = self.netlink.configure
+        self.netlink.configure = lambda pid, interface, ip_addr, gateway: original(pid, "eth1" if pid == 1002 else interface, ip_addr, gateway)
+        before = self.server.transactions
+        error, _ = self.plumbing.attach_many([
+            {"container": "web", "pid": 1001, "bridge": "br1", "interface": "eth0", "ip_addr": "172.16.3.10/24", "gateway": None},
+            {"container": "mail", "pid": 1002, "bridge": "br1", "interface": "eth0", "ip_addr": "172.16.3.11/24", "gateway": None}
+        ])
+        self.assertEqual(error, "Could not configure eth1 in process 1002: No such device")
+        self.assertEqual(self.netlink.links[None], {})
+        self.assertEqual(self.server.transactions, before)
+
+    def test_attach_many(self):
+        attachments = []
+        for i in range(20):
+            attachments.append({"container": "server{}".format(i), "pid": 2000 + i, "bridge": "br1", "interface": "eth0", "ip_addr": "172.16.3.{}/24".format(10 + i), "gateway": "172.16.3.1"})
+        before = self.server.transactions
+        error, names = self.plumbing.attach_many(attachments)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.server.transactions, before + 1)
+        self.assertEqual(len(set(names)), 20)
+        self.assertEqual(len(self.client.find("Bridge", "br1")['ports']), 21)
+        self.assertEqual(self.netlink.link(2005, "eth0")['address'], "172.16.3.15/24")
+
+class TestDockerPlumbing(OVSDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.docker = FakeDockerClient()
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.mm.ovsdb = self.client
+        self.netlink = FakeNetlink()
+        self.mm.plumbing = ContainerPlumbing(self.client, self.netlink)
+        netreserve = NetReservation(self.mm)
+        # Addresses on the switch are set with ip, which is not run here
+        netreserve._set_switch_ip = lambda switch, ip_addr: None
+        self.mm.modules['netreserve'] = LockModule(netreserve, self.mm)
+        self.mm['netreserve'].check()
+        error, _ = self.mm['netreserve'].run("add_network", net_addr="172.16.8.0/24", description="test", switch="test1")
+        self.assertTrue(error is None, msg=error)
+        self.service = PlainService(self.mm)
+
+    def test_start_stop(self):
+        self.docker.containers.add("plain-1", "exited")
+        error, _ = self.service.docker_start("plain-1", "172.16.8.10")
+        self.assertTrue(error is None, msg=error)
+        pid = self.docker.containers.get("plain-1").pid
+        self.assertEqual(self.netlink.link(pid, "eth0")['address'], "172.16.8.10/24")
+        self.assertEqual(self.netlink.link(pid, "eth0")['gateway'], "172.16.8.1")
+        self.assertEqual(len(self.mm.plumbing.ports("plain-1", "test1")), 1)
+
+        error, _ = self.service.docker_stop("plain-1", "172.16.8.10")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.mm.plumbing.ports("plain-1", "test1"), [])
+        self.assertEqual(self.netlink.links[None], {})
+
+    def test_start_many(self):
+        servers = []
+        for i in range(10):
+            self.docker.containers.add("plain-{}".format(i), "exited")
+            servers.append(("plain-{}".format(i), "172.16.8.{}".format(10 + i)))
+        before = self.server.transactions
+        error, _ = self.service.docker_start_many(servers)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.server.transactions, before + 1)
+        for container_name, server_ip in servers:
+            pid = self.docker.containers.get(container_name).pid
+            self.assertEqual(self.netlink.link(pid, "eth0")['address'], "{}/24".format(server_ip))
+
+        error, _ = self.service.docker_start_many([("plain-missing", "172.16.8.30")])
+        self.assertEqual(error, "Server not found in Docker")
+
+    def tearDown(self):
+        self.mm.jobs.shutdown()
+        self.db.close()
+        super().tearDown()
+
+# Against the kernel, with a process in its own network namespace standing in
+# for each container. Needs root.
+@unittest.skipUnless(Netlink().available() and shutil.which("unshare") is not None and shutil.which("ip") is not None, "needs CAP_NET_ADMIN and CAP_SYS_ADMIN")
+class TestNetlink(OVSDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.processes = []
+
+    def namespace(self):
+        process = subprocess.Popen(["unshare", "--net", "sleep", "60"])
+        self.processes.append(process)
+        # unshare has to switch namespaces before it runs sleep
+        own = os.readlink("/proc/self/ns/net")
+        deadline = time.monotonic() + 5
+        while os.readlink("/proc/{}/ns/net".format(process.pid)) == own and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return process.pid
+
+    def ip(self, pid, *args):
+        return subprocess.check_output(["nsenter", "-t", str(pid), "-n", "ip"] + list(args)).decode()
+
+    def test_attach(self):
+        pid = self.namespace()
+        plumbing = ContainerPlumbing(self.client, Netlink())
+        error, name = plumbing.attach("web", pid, "br1", "eth0", "10.99.0.5/24", "10.99.0.1")
+        self.assertTrue(error is None, msg=error)
+        self.assertTrue("10.99.0.5/24" in self.ip(pid, "addr", "show", "eth0"))
+        self.assertTrue("state UP" in self.ip(pid, "link", "show", "eth0"))
+        self.assertTrue("default via 10.99.0.1 dev eth0" in self.ip(pid, "route"))
+
+        # The name is taken now
+        error, _ = Netlink().create_veths([(name, "eth1", pid)])
+        self.assertEqual(error, "Could not create veth {}: File exists".format(name))
+
+        error, _ = plumbing.detach("web", "br1")
+        self.assertTrue(error is None, msg=error)
+        self.assertFalse("eth0" in self.ip(pid, "link"))
+
+    @benchmark
+    def test_benchmark(self):
+        pids = [self.namespace() for _ in range(20)]
+        plumbing = ContainerPlumbing(self.client, Netlink())
+
+        start = time.perf_counter()
+        error, names = plumbing.attach("single", pids[0], "br1", "eth0", "10.99.0.5/24", "10.99.0.1")
+        single_cost = time.perf_counter() - start
+        self.assertTrue(error is None, msg=error)
+
+        attachments = []
+        for i, pid in enumerate(pids[1:]):
+            attachments.append({"container": "server{}".format(i), "pid": pid, "bridge": "br1", "interface": "eth0", "ip_addr": "10.99.0.{}/24".format(10 + i), "gateway": "10.99.0.1"})
+        start = time.perf_counter()
+        error, names = plumbing.attach_many(attachments)
+        batch_cost = (time.perf_counter() - start) / len(attachments)
+        self.assertTrue(error is None, msg=error)
+
+        # ovs-docker add-port runs about ten commands like this one
+        start = time.perf_counter()
+        for _ in range(10):
+            subprocess.check_output(["ip", "link", "show", "lo"])
+        spawn_cost = time.perf_counter() - start
+
+        report("container attach", "{:.2f}ms, {:.2f}ms each for {} together; ten ip commands {:.2f}ms".format(
+            single_cost * 1000, batch_cost * 1000, len(attachments), spawn_cost * 1000))
+        self.assertTrue(single_cost < spawn_cost)
+
+    def tearDown(self):
+        for process in self.processes:
+            process.kill()
+            process.wait()
+        super().tearDown()
@@ -35,6 +35,8 @@ class TestDNS(unittest.TestCase):
     def test_dns_basic(self):
         error, _ = self.mm['dns'].run("add_host", fqdn="host1.test", ip_addr='172.16.3.20')
         self.assertTrue(error == None, msg=error)
+        error, _ = self.mm['dns'].run("flush")
+        self.assertTrue(error == None, msg=error)
 
         root_resolver = dns.resolver.Resolver()
         root_resolver.nameservers = [TEST_DNS_ROOT]
@@ -53,6 +55,8 @@ class TestDNS(unittest.TestCase):
 
         error, _ = self.mm['dns'].run("remove_host", fqdn="host1.test", ip_addr='172.16.3.20')
         self.assertTrue(error == None, msg=error)
+        error, _ = self.mm['dns'].run("flush")
+        self.assertTrue(error == None, msg=error)
 
         try:
             answers = root_resolver.query('host1.test', 'A')
@@ -0,0 +1,154 @@
+import unittest
+import os
+import sys
+import time
+import json
+import sqlite3
+import tempfile
+import shutil
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+import modules.dns_server
+from modules.dns_server import DNSServer
+from lib.module_manager import ModuleManager, LockModule
+import lib.easyzone as easyzone
+
+class TestDNSBulk(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.old_base_dir = modules.dns_server.DNS_BASE_DIR
+        modules.dns_server.DNS_BASE_DIR = self.base_dir
+
+        self.docker = FakeDockerClient()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.dns = DNSServer(self.mm)
+        self.mm.modules['dns'] = LockModule(self.dns, self.mm)
+
+        dbc = self.db.cursor()
+        dbc.execute("CREATE TABLE dns_server (server_id INTEGER PRIMARY KEY, server_ip TEXT, server_desc TEXT, server_domain TEXT);")
+        dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', ("10.0.0.2", "test", "test"))
+        self.db.commit()
+
+        server_dir = os.path.join(self.base_dir, "1")
+        os.mkdir(server_dir)
+        os.mkdir(os.path.join(server_dir, "conf"))
+        os.mkdir(os.path.join(server_dir, "zones"))
+        open(os.path.join(server_dir, "named.conf"), "w").close()
+        self.container = self.docker.containers.add("dns-server-1", "running")
+
+        error, _ = self.dns._add_zone(1, "test", "fwd")
+        self.assertTrue(error is None, msg=error)
+        self.dns.reloads.flush()
+        self.container.exec_log = []
+
+    def load_zone(self, zone, direction):
+        self.dns.zones.flush()
+        return easyzone.zone_from_file(zone, os.path.join(self.base_dir, "1", "zones", "{}.{}".format(zone, direction)))
+
+    def test_list(self):
+        error, result = self.mm['dns'].run("bulk_add_records", records=[
+            {"fqdn": "www.test", "type": "A", "value": "10.0.0.5"},
+            {"fqdn": "mail.test", "type": "mx", "value": "10 mx.test"},
+            {"fqdn": "alias.test", "type": "CNAME", "value": "www.test"},
+            {"fqdn": "info.test", "type": "TXT", "value": "hello"},
+            {"fqdn": "10.0.0.5", "type": "PTR", "value": "www.test"}
+        ])
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], 5)
+        self.assertEqual(result['failed'], 0)
+
+        fwd_zone = self.load_zone("test", "fwd")
+        self.assertEqual([item.to_text() for item in fwd_zone.get_name("www.test.").records("A")], ["10.0.0.5"])
+        self.assertEqual([item.to_text() for item in fwd_zone.get_name("alias.test.").records("CNAME")], ["www.test."])
+        self.assertEqual([item.to_text() for item in fwd_zone.get_name("mail.test.").records("MX")], ["10 mx.test."])
+
+        # PTR records by IP go in a new reverse zone
+        rev_zone = self.load_zone("0.0.10.in-addr.arpa", "rev")
+        self.assertEqual([item.to_text() for item in rev_zone.get_name("5.0.0.10.in-addr.arpa.").records("PTR")], ["www.test."])
+
+        error, result = self.mm['dns'].run("bulk_remove_records", records=[
+            {"fqdn": "www.test", "type": "A", "value": "10.0.0.5"},
+            {"fqdn": "10.0.0.5", "type": "PTR", "value": "www.test"},
+            {"fqdn": "nope.test", "type": "A", "value": "10.0.0.6"}
+        ])
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], 2)
+        self.assertEqual(result['results'][2], {"ok": False, "error": "nope.test. not in zone test"})
+        self.assertFalse(self.load_zone("test", "fwd").has_name("www.test."))
+
+    def test_csv_and_json(self):
+        csv_text = "fqdn,type,value\n# web servers\nweb1.test,A,10.0.0.11\nweb2.test, A ,10.0.0.12\n"
+        error, result = self.mm['dns'].run("bulk_add_records", records=csv_text)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], 2)
+
+        json_text = json.dumps({"records": [["web3.test", "A", "10.0.0.13"], {"fqdn": "web4.test", "type": "A", "value": "10.0.0.14"}]})
+        error, result = self.mm['dns'].run("bulk_add_records", records=json_text)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], 2)
+
+        fwd_zone = self.load_zone("test", "fwd")
+        for i in range(1, 5):
+            self.assertTrue(fwd_zone.has_name("web{}.test.".format(i)))
+
+        error, _ = self.mm['dns'].run("bulk_add_records", records="[not json")
+        self.assertTrue(error is not None)
+        error, _ = self.mm['dns'].run("bulk_add_records", records="")
+        self.assertTrue(error is not None)
+
+    def test_errors(self):
+        error, result = self.mm['dns'].run("bulk_add_records", records=[
+            {"fqdn": "good.test", "type": "A", "value": "10.0.0.20"},
+            {"fqdn": "bad.test", "type": "A", "value": "not-an-ip"},
+            {"fqdn": "other.example", "type": "A", "value": "10.0.0.21"},
+            {"fqdn": "weird.test", "type": "SRV", "value": "x"},
+            {"fqdn": "mx.test", "type": "MX", "value": "mx.test"},
+            "not a record"
+        ])
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], 1)
+        self.assertEqual(result['failed'], 5)
+        self.assertEqual([item['ok'] for item in result['results']], [True, False, False, False, False, False])
+        self.assertEqual(result['results'][2]['error'], "Could not find a parent domain for other.example")
+        self.assertTrue(self.load_zone("test", "fwd").has_name("good.test."))
+
+    def import_lines(self, count):
+        lines = ["fqdn,type,value"]
+        for i in range(count):
+            lines.append("host{}.test,A,10.1.{}.{}".format(i, i >> 8, i & 255))
+        return "\n".join(lines)
+
+    def test_large_import(self):
+        error, result = self.mm['dns'].run("bulk_add_records", records=self.import_lines(1000))
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], 1000)
+
+        # One reload for the whole import
+        self.assertEqual(self.container.exec_log, ["rndc status", "rndc reload test"])
+        self.assertTrue(self.load_zone("test", "fwd").has_name("host999.test."))
+
+    @benchmark
+    def test_large_import_benchmark(self):
+        records = self.import_lines(10000)
+        start = time.monotonic()
+        error, result = self.mm['dns'].run("bulk_add_records", records=records)
+        elapsed = time.monotonic() - start
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], 10000)
+        report("bulk import", "10000 records in {:.2f}s".format(elapsed))
+        self.assertTrue(elapsed < 30)
+
+    def tearDown(self):
+        self.dns.reloads.flush()
+        self.dns.zones.flush()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        modules.dns_server.DNS_BASE_DIR = self.old_base_dir
+        shutil.rmtree(self.base_dir)
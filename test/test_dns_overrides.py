@@ -0,0 +1,159 @@
+import unittest
+import os
+import sys
+import time
+import json
+import sqlite3
+import tempfile
+import shutil
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+import modules.dns_server
+from modules.dns_server import DNSServer
+from lib.module_manager import ModuleManager, LockModule
+import lib.easyzone as easyzone
+
+class TestDNSOverrides(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.old_base_dir = modules.dns_server.DNS_BASE_DIR
+        modules.dns_server.DNS_BASE_DIR = self.base_dir
+
+        self.docker = FakeDockerClient()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.dns = DNSServer(self.mm)
+        self.mm.modules['dns'] = LockModule(self.dns, self.mm)
+
+        dbc = self.db.cursor()
+        dbc.execute("CREATE TABLE dns_server (server_id INTEGER PRIMARY KEY, server_ip TEXT, server_desc TEXT, server_domain TEXT);")
+        dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', ("172.16.3.2", "test", "test"))
+        self.db.commit()
+
+        self.server_dir = os.path.join(self.base_dir, "1")
+        os.mkdir(self.server_dir)
+        os.mkdir(os.path.join(self.server_dir, "conf"))
+        os.mkdir(os.path.join(self.server_dir, "zones"))
+        open(os.path.join(self.server_dir, "named.conf"), "w").close()
+        self.container = self.docker.containers.add("dns-server-1", "running")
+
+        self.override_path = os.path.join(self.server_dir, "zones", "fn.rpz")
+        zone_file = open("./docker-images/dns/zone-template", "r").read()
+        zone_file = zone_file.replace("TEMPLATE.ZONE", "fn.rpz").replace("1.1.1.1", "127.0.0.1")
+        out_zone = open(self.override_path, "w")
+        out_zone.write(zone_file)
+        out_zone.write("\nlegacy.example 604800 IN A 172.16.3.9\n")
+        out_zone.close()
+
+    # Returns {name: [addresses]} from the override zone file
+    def read_overrides(self):
+        zone_file = easyzone.zone_from_file("fn.rpz", self.override_path)
+        overrides = {}
+        for name, record_type, _, value in zone_file.iter_records():
+            if record_type == "A" and name != "ns1.fn.rpz.":
+                overrides.setdefault(name[:-len(".fn.rpz.")], []).append(value)
+        return overrides
+
+    def test_single(self):
+        error, _ = self.mm['dns'].run("add_override", fqdn="example.com.", ip_addr="172.16.3.50")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.dns.reloads.pending(), {"1": ["fn.rpz"]})
+        # Overrides already in the file are kept
+        self.assertEqual(self.read_overrides(), {"example.com": ["172.16.3.50"], "legacy.example": ["172.16.3.9"]})
+
+        # A name has one override
+        error, _ = self.mm['dns'].run("add_override", fqdn="example.com", ip_addr="172.16.3.51")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.read_overrides()["example.com"], ["172.16.3.51"])
+
+        error, _ = self.mm['dns'].run("remove_override", fqdn="example.com", ip_addr="172.16.3.50")
+        self.assertEqual(error, "No override of example.com to 172.16.3.50")
+        error, _ = self.mm['dns'].run("remove_override", fqdn="example.com", ip_addr="172.16.3.51")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.read_overrides(), {"legacy.example": ["172.16.3.9"]})
+
+        error, result = self.mm['dns'].run("find_records", fqdn="fn.rpz", type="A", value="172.16.3.9")
+        self.assertEqual([row[2] for row in result['rows']], ["legacy.example.fn.rpz."])
+
+        # The server answers with a name server of its own
+        zone_file = easyzone.zone_from_file("fn.rpz", self.override_path)
+        self.assertEqual(zone_file.root.records("NS").items[0].to_text(), "ns1.fn.rpz.")
+
+    def test_bulk(self):
+        csv_text = "fqdn,ip_addr\n# Sinkholes\nbad1.example,10.0.0.1\nbad2.example,10.0.0.2\nbad3.example,nope\n"
+        error, result = self.mm['dns'].run("add_overrides", overrides=csv_text)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], 2)
+        self.assertEqual(result['failed'], 1)
+        self.assertFalse(result['results'][2]['ok'])
+
+        json_text = json.dumps({"overrides": [{"fqdn": "bad1.example", "ip_addr": "10.0.0.1"}, {"fqdn": "bad4.example", "ip_addr": "10.0.0.4"}]})
+        error, result = self.mm['dns'].run("remove_overrides", overrides=json_text)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], 1)
+        self.assertEqual(result['results'][1], {"ok": False, "error": "No override of bad4.example to 10.0.0.4"})
+        self.assertEqual(self.read_overrides(), {"bad2.example": ["10.0.0.2"], "legacy.example": ["172.16.3.9"]})
+
+        error, _ = self.mm['dns'].run("add_overrides", overrides={"fqdn": "x"})
+        self.assertTrue(error is not None)
+
+    def many_overrides(self, count):
+        overrides = []
+        for i in range(count):
+            overrides.append(["sinkhole{}.example".format(i), "10.{}.{}.{}".format(i >> 16, (i >> 8) & 255, i & 255)])
+        return overrides
+
+    def test_large_batch(self):
+        self.container.exec_log = []
+        error, result = self.mm['dns'].run("add_overrides", overrides=self.many_overrides(5000))
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], 5000)
+
+        # One reload of the policy zone for the whole batch
+        self.dns.reloads.flush()
+        self.assertEqual(self.container.exec_log, ["rndc status", "rndc reload fn.rpz"])
+        self.assertEqual(len(self.read_overrides()), 5000 + 1)
+
+    @benchmark
+    def test_benchmark(self):
+        count = 50000
+        overrides = self.many_overrides(count)
+
+        # The old add_override rewrote the whole file for every override
+        old_count = 1000
+        legacy_path = os.path.join(self.base_dir, "legacy.rpz")
+        shutil.copy(self.override_path, legacy_path)
+        start = time.perf_counter()
+        for fqdn, ip_addr in overrides[:old_count]:
+            override_file = open(legacy_path, "r")
+            lines = override_file.readlines()
+            override_file.close()
+            override_file = open(legacy_path, "w")
+            for line in lines:
+                override_file.write(line)
+            override_file.write(" ".join([fqdn, "604800", "IN", "A", ip_addr]) + "\n")
+            override_file.close()
+        old_cost = time.perf_counter() - start
+
+        start = time.perf_counter()
+        error, result = self.mm['dns'].run("add_overrides", overrides=overrides)
+        new_cost = time.perf_counter() - start
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['succeeded'], count)
+
+        report("overrides", "old way {:.2f}s for {}, batch {:.2f}s for {}".format(old_cost, old_count, new_cost, count))
+        self.assertTrue(new_cost < old_cost * count / old_count)
+
+    def tearDown(self):
+        self.dns.reloads.flush()
+        self.dns.zones.flush()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        modules.dns_server.DNS_BASE_DIR = self.old_base_dir
+        shutil.rmtree(self.base_dir)
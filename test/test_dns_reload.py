@@ -0,0 +1,178 @@
+import unittest
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import shutil
+import threading
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+
+import modules.dns_server
+from modules.dns_server import DNSServer
+from lib.module_manager import ModuleManager, LockModule
+from lib.reload_coalescer import ReloadCoalescer
+import lib.easyzone as easyzone
+
+class ReloadRecorder():
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = []
+
+    def __call__(self, server_id, zones):
+        with self._lock:
+            self.calls.append((server_id, zones))
+        return None, True
+
+class TestReloadCoalescer(unittest.TestCase):
+
+    def test_merge_and_flush(self):
+        recorder = ReloadRecorder()
+        reloads = ReloadCoalescer(recorder, debounce=60)
+        reloads.mark(1, "test")
+        reloads.mark("1", "other")
+        reloads.mark(1, "test")
+        reloads.mark(2, "example")
+        # A full reload covers any zones
+        reloads.mark(2)
+        reloads.mark(2, "more")
+        self.assertEqual(reloads.pending(), {"1": ["other", "test"], "2": None})
+
+        error, count = reloads.flush()
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(count, 2)
+        self.assertEqual(recorder.calls, [("1", ["other", "test"]), ("2", None)])
+        self.assertEqual(reloads.pending(), {})
+
+        reloads.mark(3)
+        reloads.discard(3)
+        self.assertEqual(reloads.flush(), (None, 0))
+
+    def test_debounce(self):
+        recorder = ReloadRecorder()
+        reloads = ReloadCoalescer(recorder, debounce=0.1)
+        for i in range(50):
+            reloads.mark(1, "zone{}".format(i % 5))
+        self.assertEqual(recorder.calls, [])
+
+        time.sleep(0.4)
+        self.assertEqual(recorder.calls, [("1", ["zone0", "zone1", "zone2", "zone3", "zone4"])])
+
+    def test_hold(self):
+        recorder = ReloadRecorder()
+        reloads = ReloadCoalescer(recorder, debounce=0.05)
+        with reloads.hold():
+            with reloads.hold():
+                reloads.mark(1, "test")
+            time.sleep(0.2)
+            self.assertEqual(recorder.calls, [])
+            self.assertTrue(reloads.is_held())
+        self.assertEqual(recorder.calls, [("1", ["test"])])
+        self.assertTrue(reloads.end_hold()[0] is not None)
+
+    def test_errors(self):
+        def failing_reload(server_id, zones):
+            if server_id == "2":
+                raise RuntimeError("container gone")
+            return "'rndc reload' failed", None
+
+        reloads = ReloadCoalescer(failing_reload, debounce=60)
+        reloads.mark(1)
+        reloads.mark(2)
+        error, _ = reloads.flush()
+        self.assertEqual(error, "Server 1: 'rndc reload' failed, Server 2: container gone")
+
+class TestDNSReloads(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.old_base_dir = modules.dns_server.DNS_BASE_DIR
+        modules.dns_server.DNS_BASE_DIR = self.base_dir
+
+        self.docker = FakeDockerClient()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.dns = DNSServer(self.mm)
+        self.mm.modules['dns'] = LockModule(self.dns, self.mm)
+
+        dbc = self.db.cursor()
+        dbc.execute("CREATE TABLE dns_server (server_id INTEGER PRIMARY KEY, server_ip TEXT, server_desc TEXT, server_domain TEXT);")
+        dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', ("10.0.0.2", "test", "test"))
+        self.db.commit()
+
+        server_dir = os.path.join(self.base_dir, "1")
+        os.mkdir(server_dir)
+        os.mkdir(os.path.join(server_dir, "conf"))
+        os.mkdir(os.path.join(server_dir, "zones"))
+        open(os.path.join(server_dir, "named.conf"), "w").close()
+        self.container = self.docker.containers.add("dns-server-1", "running")
+
+        error, _ = self.dns._add_zone(1, "test", "fwd")
+        self.assertTrue(error is None, msg=error)
+        self.dns.reloads.flush()
+        self.container.exec_log = []
+
+    def test_bulk_hosts_reload_once(self):
+        commands = []
+        for i in range(50):
+            commands.append({"module": "dns", "func": "add_host", "args": {"fqdn": "host{}.test".format(i), "ip_addr": "10.0.0.{}".format(i + 10)}})
+
+        error, results = self.mm.run_batch(commands)
+        self.assertTrue(error is None, msg=error)
+        for result in results:
+            self.assertEqual(result, (None, True))
+
+        # The reverse zone is new, so the whole server is reloaded, once
+        self.assertEqual(self.container.exec_log, ["rndc status", "rndc reload"])
+
+        # Zones were written out before the reload
+        fwd_zone = easyzone.zone_from_file("test", os.path.join(self.base_dir, "1", "zones", "test.fwd"))
+        self.assertTrue(fwd_zone.has_name("host49.test."))
+        rev_zone = easyzone.zone_from_file("0.0.10.in-addr.arpa", os.path.join(self.base_dir, "1", "zones", "0.0.10.in-addr.arpa.rev"))
+        self.assertTrue(rev_zone.has_name("59.0.0.10.in-addr.arpa."))
+
+        self.container.exec_log = []
+        with self.dns.reloads.hold():
+            for i in range(50, 60):
+                error, _ = self.mm['dns'].run("add_host", fqdn="host{}.test".format(i), ip_addr="10.0.0.{}".format(i + 10))
+                self.assertTrue(error is None, msg=error)
+            self.assertEqual(self.container.exec_log, [])
+
+        # Releasing the hold reloads what changed while it was held
+        self.assertEqual(self.container.exec_log, ["rndc status", "rndc reload 0.0.10.in-addr.arpa", "rndc reload test"])
+
+        error, _ = self.mm['dns'].run("remove_host", fqdn="host50.test", ip_addr="10.0.0.60")
+        self.assertTrue(error is None, msg=error)
+        self.mm['dns'].run("flush")
+        rev_zone = easyzone.zone_from_file("0.0.10.in-addr.arpa", os.path.join(self.base_dir, "1", "zones", "0.0.10.in-addr.arpa.rev"))
+        self.assertFalse(rev_zone.has_name("60.0.0.10.in-addr.arpa."))
+
+    def test_flush(self):
+        self.dns.reloads.debounce = 60
+        error, _ = self.mm['dns'].run("add_record", id=1, zone="test", direction="fwd", type="A", name="www.test", value="10.0.0.5")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.container.exec_log, [])
+
+        error, count = self.mm['dns'].run("flush")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(count, 1)
+        self.assertEqual(self.container.exec_log, ["rndc status", "rndc reload test"])
+
+        # Stopped servers pick up changes when they start
+        self.container.exec_log = []
+        self.container.status = "exited"
+        self.mm['dns'].run("remove_record", id=1, zone="test", direction="fwd", type="A", name="www.test", value="10.0.0.5")
+        self.assertEqual(self.mm['dns'].run("flush"), (None, 1))
+        self.assertEqual(self.container.exec_log, [])
+
+    def tearDown(self):
+        self.dns.reloads.flush()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        modules.dns_server.DNS_BASE_DIR = self.old_base_dir
+        shutil.rmtree(self.base_dir)
@@ -0,0 +1,199 @@
+import unittest
+import os
+import sys
+import sqlite3
+import tempfile
+import shutil
+
+import dns.flags
+import dns.rcode
+import dns.query
+import dns.message
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+import modules.dns_server
+from modules.dns_server import DNSServer
+from lib.module_manager import ModuleManager, LockModule
+from lib.dns_responder import DNSResponder
+from lib.dns_load import run_load, format_report
+
+SERVERS = [
+    ("172.16.3.2", "test", ["test"]),
+    ("172.16.3.3", "sub.test", ["sub.test"]),
+    ("172.16.3.4", "other", ["other"]),
+]
+
+class TestDNSResponder(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.old_base_dir = modules.dns_server.DNS_BASE_DIR
+        modules.dns_server.DNS_BASE_DIR = self.base_dir
+
+        self.docker = FakeDockerClient()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.dns = DNSServer(self.mm)
+        self.mm.modules['dns'] = LockModule(self.dns, self.mm)
+
+        dbc = self.db.cursor()
+        dbc.execute("CREATE TABLE dns_server (server_id INTEGER PRIMARY KEY, server_ip TEXT, server_desc TEXT, server_domain TEXT);")
+        for server_ip, domain, zones in SERVERS:
+            dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', (server_ip, "test", domain))
+            self.db.commit()
+            server_id = dbc.lastrowid
+
+            server_dir = os.path.join(self.base_dir, str(server_id))
+            os.mkdir(server_dir)
+            os.mkdir(os.path.join(server_dir, "conf"))
+            os.mkdir(os.path.join(server_dir, "zones"))
+            shutil.copy("./docker-images/dns/config-template", os.path.join(server_dir, "named.conf"))
+            open(os.path.join(server_dir, "conf", "forwarders.conf"), "w").close()
+            zone_file = open("./docker-images/dns/zone-template", "r").read()
+            zone_file = zone_file.replace("TEMPLATE.ZONE", "fn.rpz").replace("1.1.1.1", "127.0.0.1")
+            out_zone = open(os.path.join(server_dir, "zones", "fn.rpz"), "w")
+            out_zone.write(zone_file)
+            out_zone.close()
+            self.docker.containers.add("dns-server-{}".format(server_id), "running")
+
+            for zone in zones:
+                error, _ = self.dns._add_zone(server_id, zone, "fwd")
+                self.assertTrue(error is None, msg=error)
+
+        # sub.test is delegated, and other is forwarded
+        self.add_record(1, "test", "NS", "sub", "ns1.sub.test.")
+        self.add_record(1, "test", "A", "ns1.sub", "172.16.3.3")
+        self.dns._add_forwarding_zone(1, "other", "172.16.3.4")
+
+        self.add_record(1, "test", "A", "www", "172.16.3.10")
+        self.add_record(1, "test", "CNAME", "web", "www.test.")
+        self.add_record(2, "sub.test", "A", "host", "172.16.3.20")
+        self.add_record(3, "other", "A", "x", "172.16.3.30")
+        for i in range(60):
+            self.add_record(1, "test", "TXT", "big", "filler text number {} to make a large answer".format(i))
+        error, _ = self.mm['dns'].run("add_override", fqdn="example.com", ip_addr="172.16.3.50")
+        self.assertTrue(error is None, msg=error)
+
+        error, result = self.mm['dns'].run("start_simulation")
+        self.assertTrue(error is None, msg=error)
+        self.addresses = {}
+        for server_id, _, address in result['rows']:
+            host, _, port = address.partition(":")
+            self.addresses[server_id] = (host, int(port))
+
+    def add_record(self, server_id, zone, record_type, name, value):
+        error, _ = self.mm['dns'].run("add_record", id=server_id, zone=zone, direction="fwd", type=record_type, name=name, value=value)
+        self.assertTrue(error is None, msg=error)
+
+    def query(self, name, record_type, server_id=1, recursive=True, tcp=False):
+        query = dns.message.make_query(name, record_type)
+        if not recursive:
+            query.flags &= ~dns.flags.RD
+        host, port = self.addresses[server_id]
+        if tcp:
+            return dns.query.tcp(query, host, port=port, timeout=5)
+        return dns.query.udp(query, host, port=port, timeout=5)
+
+    def answers(self, response):
+        return [item.to_text() for rrset in response.answer for item in rrset]
+
+    def test_authoritative(self):
+        response = self.query("www.test", "A")
+        self.assertEqual(self.answers(response), ["172.16.3.10"])
+        self.assertTrue(response.flags & dns.flags.AA)
+
+        response = self.query("web.test", "A")
+        self.assertEqual(self.answers(response), ["www.test.", "172.16.3.10"])
+
+        response = self.query("nope.test", "A")
+        self.assertEqual(response.rcode(), dns.rcode.NXDOMAIN)
+        self.assertEqual(response.authority[0].rdtype, dns.rdatatype.SOA)
+
+        response = self.query("www.test", "MX")
+        self.assertEqual(response.rcode(), dns.rcode.NOERROR)
+        self.assertEqual(self.answers(response), [])
+
+        response = self.query("www.test", "A", tcp=True)
+        self.assertEqual(self.answers(response), ["172.16.3.10"])
+
+        # Too large for UDP, so the client is told to use TCP
+        response = self.query("big.test", "TXT")
+        self.assertTrue(response.flags & dns.flags.TC)
+        response = self.query("big.test", "TXT", tcp=True)
+        self.assertEqual(len(self.answers(response)), 60)
+
+    def test_hierarchy(self):
+        # Delegations are followed for recursive queries, and referred otherwise
+        response = self.query("host.sub.test", "A")
+        self.assertEqual(self.answers(response), ["172.16.3.20"])
+        response = self.query("host.sub.test", "A", recursive=False)
+        self.assertEqual([item.to_text() for item in response.authority[0]], ["ns1.sub.test."])
+        self.assertEqual([item.to_text() for item in response.additional[0]], ["172.16.3.3"])
+
+        response = self.query("x.other", "A")
+        self.assertEqual(self.answers(response), ["172.16.3.30"])
+        response = self.query("y.other", "A")
+        self.assertEqual(response.rcode(), dns.rcode.NXDOMAIN)
+
+        # Outside the lab there is nothing to forward to
+        response = self.query("example.org", "A")
+        self.assertEqual(response.rcode(), dns.rcode.SERVFAIL)
+        response = self.query("example.org", "A", recursive=False)
+        self.assertEqual(response.rcode(), dns.rcode.REFUSED)
+
+    def test_overrides_and_reloads(self):
+        response = self.query("example.com", "A")
+        self.assertEqual(self.answers(response), ["172.16.3.50"])
+        response = self.query("example.com", "AAAA")
+        self.assertEqual(self.answers(response), [])
+
+        # Changes are served once BIND would have reloaded them
+        self.add_record(1, "test", "A", "new", "172.16.3.11")
+        error, _ = self.mm['dns'].run("flush")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.answers(self.query("new.test", "A")), ["172.16.3.11"])
+
+        error, _ = self.mm['dns'].run("remove_override", fqdn="example.com", ip_addr="172.16.3.50")
+        self.assertTrue(error is None, msg=error)
+        self.mm['dns'].run("flush")
+        self.assertEqual(self.query("example.com", "A").rcode(), dns.rcode.SERVFAIL)
+
+    def test_standalone(self):
+        responder = DNSResponder(os.path.join(self.base_dir, "2"))
+        responder.start()
+        try:
+            response = dns.query.udp(dns.message.make_query("host.sub.test", "A"), responder.host, port=responder.port, timeout=5)
+            self.assertEqual(self.answers(response), ["172.16.3.20"])
+        finally:
+            responder.stop()
+        self.assertEqual(responder.queries, 1)
+
+    def test_load(self):
+        queries = [("www.test", "A"), ("host.sub.test", "A"), ("x.other", "A"), ("web.test", "A"), ("nope.test", "A")]
+        result = run_load(self.addresses[1], queries, count=200, concurrency=8)
+        self.assertEqual(result['answered'], 200)
+        self.assertEqual(result['timeouts'], 0)
+        self.assertEqual(sum(result['rcodes'].values()), 200)
+        self.assertTrue(result['latency_ms']['p50'] <= result['latency_ms']['p99'])
+        self.assertTrue("200 answered" in format_report(result))
+
+    @benchmark
+    def test_load_benchmark(self):
+        queries = [("www.test", "A"), ("host.sub.test", "A"), ("x.other", "A"), ("web.test", "A"), ("nope.test", "A")]
+        result = run_load(self.addresses[1], queries, count=2000, concurrency=8)
+        report("dns load", format_report(result))
+        self.assertEqual(result['answered'], 2000)
+
+    def tearDown(self):
+        self.mm['dns'].run("stop_simulation")
+        self.dns.reloads.flush()
+        self.dns.zones.flush()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        modules.dns_server.DNS_BASE_DIR = self.old_base_dir
+        shutil.rmtree(self.base_dir)
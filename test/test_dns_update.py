@@ -0,0 +1,147 @@
+import unittest
+import os
+import sys
+import sqlite3
+import tempfile
+import shutil
+
+import dns.message
+import dns.query
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient, FakeDNSUpdateServer
+
+import modules.dns_server
+from modules.dns_server import DNSServer
+from lib.module_manager import ModuleManager, LockModule
+import lib.dns_update as dns_update
+import lib.easyzone as easyzone
+
+class TestDNSUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.old_base_dir = modules.dns_server.DNS_BASE_DIR
+        self.old_port = modules.dns_server.DNS_UPDATE_PORT
+        modules.dns_server.DNS_BASE_DIR = self.base_dir
+
+        self.docker = FakeDockerClient()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.dns = DNSServer(self.mm)
+        self.mm.modules['dns'] = LockModule(self.dns, self.mm)
+
+        dbc = self.db.cursor()
+        dbc.execute("CREATE TABLE dns_server (server_id INTEGER PRIMARY KEY, server_ip TEXT, server_desc TEXT, server_domain TEXT);")
+        dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', ("127.0.0.1", "test", "test"))
+        self.db.commit()
+
+        self.server_dir = os.path.join(self.base_dir, "1")
+        os.mkdir(self.server_dir)
+        os.mkdir(os.path.join(self.server_dir, "conf"))
+        os.mkdir(os.path.join(self.server_dir, "zones"))
+        open(os.path.join(self.server_dir, "named.conf"), "w").close()
+        self.container = self.docker.containers.add("dns-server-1", "running")
+
+        error, _ = self.dns._add_zone(1, "test", "fwd")
+        self.assertTrue(error is None, msg=error)
+        self.dns.reloads.flush()
+
+        error, _ = self.mm['dns'].run("set_update_engine", id=1, engine="dynamic")
+        self.assertTrue(error is None, msg=error)
+
+        self.stub = FakeDNSUpdateServer(dns_update.UPDATE_KEY_NAME, self.dns._update_key(1), ["test", "0.0.10.in-addr.arpa"])
+        modules.dns_server.DNS_UPDATE_PORT = self.stub.port
+
+    def read_file(self, *path):
+        config_file = open(os.path.join(self.server_dir, *path), "r")
+        contents = config_file.read()
+        config_file.close()
+        return contents
+
+    def test_engine_config(self):
+        self.assertTrue('include "/etc/bind/conf/update.key";' in self.read_file("named.conf"))
+        self.assertTrue('allow-update { key "fn-update"; };' in self.read_file("conf", "test.conf"))
+        self.assertEqual(dns_update.parse_update_key(self.read_file("conf", "update.key")), self.dns._update_key(1))
+        self.assertEqual(self.container.exec_log[-3:], [
+            "chown -R named:named /etc/bind/zones /etc/bind/conf/update.key",
+            "rndc status",
+            "rndc reload"
+        ])
+
+        self.container.exec_log = []
+        error, _ = self.mm['dns'].run("set_update_engine", id=1, engine="file")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.container.exec_log, ["rndc sync -clean", "rndc status", "rndc reload"])
+        self.assertFalse(os.path.exists(os.path.join(self.server_dir, "conf", "update.key")))
+        self.assertFalse("update.key" in self.read_file("named.conf"))
+        self.assertFalse("allow-update" in self.read_file("conf", "test.conf"))
+        self.assertTrue(self.dns._update_key(1) is None)
+
+    def test_updates(self):
+        self.container.exec_log = []
+        error, _ = self.mm['dns'].run("add_record", id=1, zone="test", direction="fwd", type="A", name="www.test", value="10.0.0.5")
+        self.assertTrue(error is None, msg=error)
+        # Answered straight away, without waiting on a reload
+        response = dns.query.tcp(dns.message.make_query("www.test.", "A"), "127.0.0.1", port=self.stub.port)
+        self.assertEqual([item.to_text() for item in response.answer[0]], ["10.0.0.5"])
+        # No reload, and the zone file is left to BIND until a sync
+        self.assertEqual(self.container.exec_log, [])
+        self.assertEqual(self.dns.reloads.pending(), {})
+        self.assertEqual(self.dns.syncs.pending(), {"1": ["test"]})
+        self.assertFalse(easyzone.zone_from_file("test", os.path.join(self.server_dir, "zones", "test.fwd")).has_name("www.test."))
+
+        error, _ = self.mm['dns'].run("add_host", fqdn="host.test", ip_addr="10.0.0.6")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.stub.lookup("6.0.0.10.in-addr.arpa.", "PTR"), ["host.test."])
+
+        error, _ = self.mm['dns'].run("remove_record", id=1, zone="test", direction="fwd", type="A", name="www.test", value="10.0.0.5")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.stub.lookup("www.test.", "A"), [])
+
+        self.container.exec_log = []
+        error, _ = self.mm['dns'].run("flush")
+        self.assertTrue(error is None, msg=error)
+        self.assertTrue("rndc sync -clean test" in self.container.exec_log)
+        self.assertTrue("rndc sync -clean 0.0.10.in-addr.arpa" in self.container.exec_log)
+
+    def test_bulk(self):
+        records = []
+        for i in range(1500):
+            records.append({"fqdn": "host{}.test".format(i), "type": "A", "value": "10.0.{}.{}".format(i >> 8, i & 255)})
+        records.append({"fqdn": "10.0.0.1", "type": "PTR", "value": "host1.test"})
+
+        updates = self.stub.updates
+        error, result = self.mm['dns'].run("bulk_add_records", records=records)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['failed'], 0)
+        # One message per zone, with large zones split
+        self.assertEqual(self.stub.updates - updates, 3)
+        self.assertEqual(self.stub.lookup("host1499.test.", "A"), ["10.0.5.219"])
+
+    def test_stopped_and_errors(self):
+        # A stopped server gets its zone file changed instead
+        self.container.status = "exited"
+        error, _ = self.mm['dns'].run("add_record", id=1, zone="test", direction="fwd", type="A", name="www.test", value="10.0.0.5")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.stub.updates, 0)
+        self.dns.zones.flush()
+        self.assertTrue(easyzone.zone_from_file("test", os.path.join(self.server_dir, "zones", "test.fwd")).has_name("www.test."))
+
+        self.container.status = "running"
+        self.dns._update_keys["1"] = dns_update.make_update_key()
+        error, _ = self.mm['dns'].run("add_record", id=1, zone="test", direction="fwd", type="A", name="bad.test", value="10.0.0.7")
+        self.assertEqual(error, "Update for test refused: NOTAUTH")
+
+    def tearDown(self):
+        self.stub.stop()
+        self.dns.reloads.flush()
+        self.dns.syncs.flush()
+        self.dns.zones.flush()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        modules.dns_server.DNS_BASE_DIR = self.old_base_dir
+        modules.dns_server.DNS_UPDATE_PORT = self.old_port
+        shutil.rmtree(self.base_dir)
@@ -0,0 +1,203 @@
+import unittest
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import shutil
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+import modules.dns_server
+from modules.dns_server import DNSServer
+from lib.module_manager import ModuleManager, LockModule
+from lib.domain_index import DomainIndex
+import lib.easyzone as easyzone
+
+class TestDomainIndex(unittest.TestCase):
+
+    def test_find(self):
+        index = DomainIndex()
+        index.add("test", "fwd", 1)
+        index.add("b.test", "fwd", 1)
+        index.add("Sub.Test.", "fwd", 2)
+        index.add("test", "server", 1)
+        index.add("sub.test", "server", 2)
+        self.assertEqual(len(index), 5)
+
+        self.assertEqual(index.find("www.test", "fwd"), ("1", "test"))
+        self.assertEqual(index.find("test", "fwd"), ("1", "test"))
+        self.assertEqual(index.find("x.y.z.a.b.test.", "fwd"), ("1", "b.test"))
+        self.assertEqual(index.find("WWW.SUB.TEST", "fwd"), ("2", "Sub.Test."))
+        self.assertEqual(index.find("nope", "fwd"), (None, None))
+        self.assertEqual(index.find("btest", "fwd"), (None, None))
+
+        # Strict finds only look above the name
+        self.assertEqual(index.find("sub.test", "server", strict=True), ("1", "test"))
+        self.assertEqual(index.find("test", "server", strict=True), (None, None))
+        self.assertEqual(index.find("www.sub.test", "server", strict=True), ("2", "sub.test"))
+
+    def test_remove(self):
+        index = DomainIndex()
+        index.add("test", "fwd", 1)
+        index.add("a.b.c.test", "fwd", 2)
+        index.add("a.b.c.test", "fwd", 3)
+        index.add("a.b.c.test", "server", 2)
+        self.assertEqual(index.find("x.a.b.c.test", "fwd"), ("2", "a.b.c.test"))
+        self.assertEqual(index.get("a.b.c.test", "fwd"), {"2": "a.b.c.test", "3": "a.b.c.test"})
+
+        index.remove_owner(2)
+        self.assertEqual(index.find("x.a.b.c.test", "fwd"), ("3", "a.b.c.test"))
+        self.assertEqual(index.get("a.b.c.test", "server"), {})
+
+        index.remove("a.b.c.test", "fwd", "3")
+        index.remove("missing.test", "fwd", "3")
+        self.assertEqual(index.find("x.a.b.c.test", "fwd"), ("1", "test"))
+        self.assertEqual(len(index), 1)
+        # Empty branches are pruned
+        self.assertEqual(list(index._root.children["test"].children.keys()), [])
+
+class TestDNSDomainIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.old_base_dir = modules.dns_server.DNS_BASE_DIR
+        modules.dns_server.DNS_BASE_DIR = self.base_dir
+
+        self.docker = FakeDockerClient()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.dns = DNSServer(self.mm)
+        self.mm.modules['dns'] = LockModule(self.dns, self.mm)
+
+        dbc = self.db.cursor()
+        dbc.execute("CREATE TABLE dns_server (server_id INTEGER PRIMARY KEY, server_ip TEXT, server_desc TEXT, server_domain TEXT);")
+        self.db.commit()
+
+    def add_server(self, domain, zones):
+        dbc = self.db.cursor()
+        dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', ("10.0.0.2", "test", domain))
+        self.db.commit()
+        dns_server_id = dbc.lastrowid
+
+        server_dir = os.path.join(self.base_dir, str(dns_server_id))
+        os.mkdir(server_dir)
+        os.mkdir(os.path.join(server_dir, "conf"))
+        os.mkdir(os.path.join(server_dir, "zones"))
+        open(os.path.join(server_dir, "named.conf"), "w").close()
+        self.docker.containers.add("dns-server-{}".format(dns_server_id), "running")
+        for zone in zones:
+            error, _ = self.dns._add_zone(dns_server_id, zone, "fwd")
+            self.assertTrue(error is None, msg=error)
+        return dns_server_id
+
+    def test_nearest_zone(self):
+        self.add_server("test", ["test", "b.test"])
+        self.add_server("sub.test", ["sub.test"])
+
+        error, _ = self.mm['dns'].run("add_host", fqdn="x.y.a.b.test", ip_addr="10.0.0.5")
+        self.assertTrue(error is None, msg=error)
+        error, _ = self.mm['dns'].run("smart_add_record", fqdn="deep.name.sub.test", direction="fwd", type="A", value="10.0.0.6", autocreate=False)
+        self.assertTrue(error is None, msg=error)
+
+        self.dns.zones.flush()
+        zone_file = easyzone.zone_from_file("b.test", os.path.join(self.base_dir, "1", "zones", "b.test.fwd"))
+        self.assertTrue(zone_file.has_name("x.y.a.b.test."))
+        zone_file = easyzone.zone_from_file("sub.test", os.path.join(self.base_dir, "2", "zones", "sub.test.fwd"))
+        self.assertTrue(zone_file.has_name("deep.name.sub.test."))
+
+        self.assertEqual(self.mm['dns'].run("find_zone", fqdn="deep.name.sub.test"), (None, {"server_id": 2, "zone": "sub.test", "direction": "fwd", "forwarded_by": None}))
+        self.assertEqual(self.mm['dns'].run("find_zone", fqdn="5.0.0.10.in-addr.arpa")[1]['zone'], "0.0.10.in-addr.arpa")
+        self.assertTrue(self.mm['dns'].run("find_zone", fqdn="nope.example")[0] is not None)
+
+        error, _ = self.mm['dns'].run("remove_host", fqdn="x.y.a.b.test", ip_addr="10.0.0.5")
+        self.assertTrue(error is None, msg=error)
+
+    def test_rebuild(self):
+        self.add_server("test", ["test"])
+        self.add_server("sub.test", ["sub.test"])
+        self.dns._add_forwarding_zone(1, "other", "10.0.0.9")
+
+        # A new instance builds the index from the database and files
+        dns = DNSServer(self.mm)
+        self.assertEqual(dns._find_zone("www.sub.test", "fwd"), ("2", "sub.test"))
+        self.assertEqual(dns._get_dns_server("www.sub.test"), ("2", "sub.test"))
+        self.assertEqual(dns._domains().find("x.other", "forward"), ("1", "other"))
+        self.assertEqual(len(dns._domains()), 5)
+
+        self.dns._remove_forwarding_zone(1, "other")
+        self.assertEqual(self.dns._domains().find("x.other", "forward"), (None, None))
+
+    # Adds count servers, each with one empty zone, straight to the database
+    def add_many_zones(self, count):
+        dbc = self.db.cursor()
+        os.mkdir(os.path.join(self.base_dir, "1"))
+        zones_dir = os.path.join(self.base_dir, "1", "zones")
+        os.mkdir(zones_dir)
+        for i in range(count):
+            domain = "zone{}.test".format(i)
+            dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', ("10.0.0.2", "test", domain))
+            open(os.path.join(zones_dir, domain + ".fwd"), "w").close()
+        self.db.commit()
+        return zones_dir
+
+    def test_many_zones(self):
+        self.add_many_zones(500)
+        index = self.dns._domains()
+
+        # Once built, lookups don't touch the database
+        queries = []
+        self.db.set_trace_callback(queries.append)
+        for i in range(0, 500, 10):
+            self.assertEqual(index.find("host.a.b.c.zone{}.test".format(i), "fwd"), ("1", "zone{}.test".format(i)))
+        self.assertEqual(index.find("host.zone500.test", "fwd"), (None, None))
+        self.db.set_trace_callback(None)
+        self.assertEqual(queries, [])
+
+    @benchmark
+    def test_benchmark(self):
+        zone_count = 5000
+        zones_dir = self.add_many_zones(zone_count)
+        dbc = self.db.cursor()
+
+        names = []
+        for i in range(0, zone_count, 10):
+            names.append("host.a.b.c.zone{}.test".format(i))
+
+        # The old lookup: query the parent of each suffix, then check the zone file
+        start = time.perf_counter()
+        for name in names:
+            labels = name.split(".")
+            for counter in range(len(labels)):
+                parent = ".".join(labels[counter + 1:])
+                dbc.execute("SELECT * FROM dns_server WHERE server_domain=?", (parent,))
+                if dbc.fetchone() is not None:
+                    break
+            os.path.exists(os.path.join(zones_dir, parent + ".fwd"))
+        old_cost = (time.perf_counter() - start) / len(names)
+
+        start = time.perf_counter()
+        index = self.dns._domains()
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for name in names:
+            found = index.find(name, "fwd")
+        new_cost = (time.perf_counter() - start) / len(names)
+        self.assertEqual(found, ("1", "zone4990.test"))
+
+        report("zone lookup", "{} zones: scan {:.3f}ms, index {:.4f}ms, index built in {:.0f}ms".format(
+            zone_count, old_cost * 1000, new_cost * 1000, build_time * 1000))
+        self.assertTrue(new_cost * 10 < old_cost)
+
+    def tearDown(self):
+        self.dns.reloads.flush()
+        self.dns.zones.flush()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        modules.dns_server.DNS_BASE_DIR = self.old_base_dir
+        shutil.rmtree(self.base_dir)
@@ -3,6 +3,9 @@ import os
 import sys
 import subprocess
 import json
+import time
+import shutil
+import tempfile
 import dns.resolver
 
 from constants import *
@@ -11,14 +14,162 @@ parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parentdir)
 
 import lib.easyzone as easyzone
+from lib.zone_cache import ZoneCache
+from benchmark import benchmark, report
+
+# Copies the test zone, adding count A records
+def make_zone(path, count):
+    shutil.copy("./test/testzone", path)
+    zone_file = open(path, "a")
+    for i in range(count):
+        zone_file.write("host{}.test. 604800 IN A 10.{}.{}.{}\n".format(i, (i >> 16) & 255, (i >> 8) & 255, i & 255))
+    zone_file.close()
 
 class TestEasyZone(unittest.TestCase):
 
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.zone_path = os.path.join(self.work_dir, "test.fwd")
+        make_zone(self.zone_path, 10)
 
     def test_easyzone(self):
         zone_file = easyzone.zone_from_file("test", "./test/testzone")
         zone_file.save(autoserial=True)
-   
+
+    def test_names(self):
+        zone_file = easyzone.zone_from_file("test", self.zone_path)
+        self.assertEqual(zone_file.size, 12)
+        self.assertTrue(zone_file.has_name("host1.test."))
+        # Relative names are in the zone, like they are once saved and loaded again
+        self.assertTrue(zone_file.has_name("host1"))
+        self.assertFalse(zone_file.has_name("nope.test."))
+        self.assertEqual(zone_file.get_name("host1").name, "host1.test.")
+        self.assertTrue(zone_file.get_name("nope") is None)
+
+        zone_file.add_name("new")
+        zone_file.get_name("new").records("A", create=True).add("10.1.1.1")
+        self.assertTrue("new.test." in zone_file.get_names())
+
+    def test_cache(self):
+        cache = ZoneCache(write_delay=60)
+        key = ("1", "test", "fwd")
+        zone_file = cache.get(key, "test", self.zone_path)
+        self.assertTrue(cache.get(key, "test", self.zone_path) is zone_file)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        zone_file.add_name("cached.test.")
+        zone_file.get_name("cached.test.").records("A", create=True).add("10.2.2.2")
+        cache.mark_dirty(key)
+        self.assertFalse(easyzone.zone_from_file("test", self.zone_path).has_name("cached.test."))
+
+        error, written = cache.flush()
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(written, 1)
+        self.assertTrue(easyzone.zone_from_file("test", self.zone_path).has_name("cached.test."))
+        self.assertEqual(cache.flush(), (None, 0))
+
+        # Edits made outside of the cache are picked up
+        outside = easyzone.zone_from_file("test", self.zone_path)
+        outside.add_name("outside.test.")
+        outside.get_name("outside.test.").records("A", create=True).add("10.3.3.3")
+        outside.save(autoserial=True)
+        self.assertTrue(cache.get(key, "test", self.zone_path).has_name("outside.test."))
+
+        cache.discard(("1",))
+        cache.get(key, "test", self.zone_path)
+        self.assertEqual(cache.misses, 3)
+
+    def test_write_behind(self):
+        cache = ZoneCache(write_delay=0.1)
+        key = ("1", "test", "fwd")
+        zone_file = cache.get(key, "test", self.zone_path)
+        zone_file.delete_name("host1.test.")
+        cache.mark_dirty(key)
+        self.assertTrue(cache.is_dirty(key))
+
+        time.sleep(0.4)
+        self.assertFalse(cache.is_dirty(key))
+        self.assertFalse(easyzone.zone_from_file("test", self.zone_path).has_name("host1.test."))
+
+    def test_lru(self):
+        paths = []
+        for i in range(3):
+            path = os.path.join(self.work_dir, "zone{}.fwd".format(i))
+            make_zone(path, 100)
+            paths.append(path)
+
+        # Room for two zones
+        cache = ZoneCache(max_names=250, write_delay=60)
+        zone_file = cache.get(("1", "zone0"), "test", paths[0])
+        zone_file.delete_name("host5.test.")
+        cache.mark_dirty(("1", "zone0"))
+        cache.get(("1", "zone1"), "test", paths[1])
+        cache.get(("1", "zone2"), "test", paths[2])
+
+        # zone0 was least recently used, so it was written out and dropped
+        self.assertFalse(easyzone.zone_from_file("test", paths[0]).has_name("host5.test."))
+        cache.get(("1", "zone2"), "test", paths[2])
+        self.assertEqual(cache.misses, 3)
+        cache.get(("1", "zone0"), "test", paths[0])
+        self.assertEqual(cache.misses, 4)
+
+    def test_cached_changes(self):
+        path = os.path.join(self.work_dir, "large.fwd")
+        make_zone(path, 5000)
+
+        # Many changes to a large zone only parse and write it once
+        cache = ZoneCache(write_delay=60)
+        key = ("1", "large", "fwd")
+        for i in range(200):
+            zone_file = cache.get(key, "test", path)
+            zone_file.add_name("cached{}.test.".format(i))
+            zone_file.get_name("cached{}.test.".format(i)).records("A", create=True).add("10.9.9.9")
+            cache.mark_dirty(key)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(easyzone.zone_from_file("test", path).size, 5000 + 2)
+
+        cache.flush()
+        self.assertEqual(easyzone.zone_from_file("test", path).size, 5000 + 2 + 200)
+
+    @benchmark
+    def test_benchmark(self):
+        costs = {}
+        for size in (500, 5000):
+            path = os.path.join(self.work_dir, "bench{}.fwd".format(size))
+            make_zone(path, size)
+
+            # Parsing and writing the whole zone each time is slow, so only a few
+            uncached_changes = 5
+            start = time.perf_counter()
+            for i in range(uncached_changes):
+                zone_file = easyzone.zone_from_file("test", path)
+                zone_file.add_name("new{}.test.".format(i))
+                zone_file.get_name("new{}.test.".format(i)).records("A", create=True).add("10.9.9.9")
+                zone_file.save(autoserial=True)
+            uncached = (time.perf_counter() - start) / uncached_changes
+
+            cache = ZoneCache(write_delay=60)
+            key = ("1", "bench", "fwd")
+            cache.get(key, "test", path)
+            cached_changes = 200
+            start = time.perf_counter()
+            for i in range(cached_changes):
+                zone_file = cache.get(key, "test", path)
+                zone_file.add_name("cached{}.test.".format(i))
+                zone_file.get_name("cached{}.test.".format(i)).records("A", create=True).add("10.9.9.9")
+                cache.mark_dirty(key)
+            cached = (time.perf_counter() - start) / cached_changes
+            cache.flush()
+
+            costs[size] = (uncached, cached)
+            self.assertEqual(easyzone.zone_from_file("test", path).size, size + 2 + uncached_changes + cached_changes)
+
+        report("per-record zone change", "uncached / cached: 500 names {:.2f}ms / {:.3f}ms, 5000 names {:.2f}ms / {:.3f}ms".format(
+            costs[500][0] * 1000, costs[500][1] * 1000, costs[5000][0] * 1000, costs[5000][1] * 1000))
+
+        # Uncached changes cost more as the zone grows, cached ones stay flat
+        self.assertTrue(costs[5000][0] > costs[500][0] * 5)
+        self.assertTrue(costs[5000][1] < costs[500][1] * 3 + 0.0005)
 
     def tearDown(self):
-        pass
\ No newline at end of file
+        shutil.rmtree(self.work_dir)
@@ -0,0 +1,256 @@
+import unittest
+import os
+import sys
+import time
+import random
+import shutil
+import sqlite3
+import tempfile
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+from modules.network_reservation import NetReservation
+from modules.ip_reservation import IPReservation
+from lib.module_manager import ModuleManager, LockModule
+from lib.ip_bitmap import AddressBitmap
+from lib.database import ThreadLocalConnection
+
+class TestAddressBitmap(unittest.TestCase):
+
+    def test_allocate(self):
+        bitmap = AddressBitmap("10.0.0.0/29")
+        self.assertEqual(bitmap.free(), 8)
+        self.assertTrue(bitmap.reserve("10.0.0.0"))
+        self.assertFalse(bitmap.reserve("10.0.0.0"))
+        self.assertFalse(bitmap.reserve("10.0.1.0"))
+        self.assertEqual(str(bitmap.allocate()), "10.0.0.1")
+        self.assertEqual([str(ip) for ip in bitmap.allocate_block(3)], ["10.0.0.2", "10.0.0.3", "10.0.0.4"])
+        self.assertEqual(bitmap.allocate_block(4), None)
+        self.assertEqual(bitmap.free(), 3)
+
+        self.assertTrue(bitmap.release("10.0.0.2"))
+        self.assertFalse(bitmap.release("10.0.0.2"))
+        self.assertFalse(bitmap.is_reserved("10.0.0.2"))
+        self.assertEqual(str(bitmap.allocate()), "10.0.0.2")
+
+        # Reloaded from its bytes
+        copy = AddressBitmap("10.0.0.0/29", bitmap.data())
+        self.assertEqual(copy.free(), bitmap.free())
+        self.assertEqual([str(ip) for ip in copy.allocate_block(3)], ["10.0.0.5", "10.0.0.6", "10.0.0.7"])
+        self.assertEqual(copy.allocate(), None)
+
+    def test_random(self):
+        # Always the lowest free address, compared against a set
+        rng = random.Random(2)
+        network = ipaddress.ip_network("10.1.0.0/22")
+        base = int(network.network_address)
+        bitmap = AddressBitmap(network)
+        taken = set()
+        for _ in range(5000):
+            if len(taken) > 0 and rng.random() < 0.4:
+                index = rng.randrange(network.num_addresses)
+                self.assertEqual(bitmap.release(ipaddress.ip_address(base + index)), index in taken)
+                taken.discard(index)
+            else:
+                ip = bitmap.allocate()
+                free = [index for index in range(network.num_addresses) if index not in taken]
+                if len(free) == 0:
+                    self.assertEqual(ip, None)
+                else:
+                    self.assertEqual(int(ip) - base, free[0])
+                    taken.add(free[0])
+            self.assertEqual(bitmap.used, len(taken))
+
+class TestIPAllocation(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient())
+        self.ipreserve = IPReservation(self.mm)
+        self.mm.modules['netreserve'] = LockModule(NetReservation(self.mm), self.mm)
+        self.mm.modules['ipreserve'] = LockModule(self.ipreserve, self.mm)
+        self.mm['netreserve'].check()
+        self.mm['ipreserve'].check()
+
+    def add_network(self, net_addr):
+        error, net_id = self.mm['netreserve'].run("add_network", net_addr=net_addr, description="test", switch="")
+        self.assertTrue(error is None, msg=error)
+        return net_id
+
+    def test_allocate(self):
+        self.add_network("172.16.4.0/29")
+        error, _ = self.mm['ipreserve'].run("add_ip", ip_addr="172.16.4.3", description="by hand")
+        self.assertTrue(error is None, msg=error)
+
+        # .0, .7 and the gateway .1 are skipped, as is the IP taken by hand
+        error, ip = self.mm['ipreserve'].run("allocate_next", net_addr="172.16.4.0/29", description="first")
+        self.assertEqual(ip, "172.16.4.2")
+        error, ips = self.mm['ipreserve'].run("allocate_block", net_addr="172.16.4.0/29", count=3, description="block")
+        self.assertEqual(ips, ["172.16.4.4", "172.16.4.5", "172.16.4.6"])
+        error, _ = self.mm['ipreserve'].run("allocate_next", net_addr="172.16.4.0/29", description="full")
+        self.assertEqual(error, "Network 172.16.4.0/29 has 0 free IPs")
+        error, _ = self.mm['ipreserve'].run("add_ip", ip_addr="172.16.4.5", description="taken")
+        self.assertEqual(error, "IP already allocated")
+
+        error, _ = self.mm['ipreserve'].run("remove_ip", ip_addr="172.16.4.3")
+        self.assertTrue(error is None, msg=error)
+        error, ip = self.mm['ipreserve'].run("allocate_next", net_addr="172.16.4.0/29", description="again")
+        self.assertEqual(ip, "172.16.4.3")
+
+        error, result = self.mm['ipreserve'].run("list_ips")
+        self.assertEqual(sorted([row[1] for row in result['rows']]), ["172.16.4.{}".format(i) for i in range(2, 7)])
+
+        error, _ = self.mm['ipreserve'].run("allocate_next", net_addr="172.16.5.0/24", description="none")
+        self.assertEqual(error, "Network 172.16.5.0/24 is not reserved")
+        error, _ = self.mm['ipreserve'].run("allocate_next", net_addr="172.16.4.0/30", description="none")
+        self.assertEqual(error, "Network 172.16.4.0/30 is not reserved")
+
+    def test_reload(self):
+        self.add_network("172.16.4.0/24")
+        error, ips = self.mm['ipreserve'].run("allocate_block", net_addr="172.16.4.0/24", count=10, description="block")
+        self.assertEqual(ips[-1], "172.16.4.11")
+        self.mm['ipreserve'].run("remove_ip", ip_addr="172.16.4.5")
+
+        # A new module loads the stored bitmap
+        ipreserve = IPReservation(self.mm)
+        error, ips = ipreserve.run("allocate_block", net_addr="172.16.4.0/24", count=2, description="block")
+        self.assertEqual(ips, ["172.16.4.5", "172.16.4.12"])
+
+    def test_full_network(self):
+        net_addr = "10.10.0.0/20"
+        self.add_network(net_addr)
+
+        error, ips = self.mm['ipreserve'].run("allocate_block", net_addr=net_addr, count=4093, description="bulk")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(len(set(ips)), 4093)
+        error, _ = self.mm['ipreserve'].run("allocate_next", net_addr=net_addr, description="none")
+        self.assertEqual(error, "Network {} has 0 free IPs".format(net_addr))
+
+        # A freed address in the packed network is the next one handed out
+        bitmap = self.ipreserve._get_bitmap(1, ipaddress.ip_network(net_addr))
+        rng = random.Random(3)
+        for _ in range(200):
+            ip = rng.choice(ips)
+            bitmap.release(ip)
+            self.assertEqual(str(bitmap.allocate()), ip)
+
+        self.mm['ipreserve'].run("remove_ip", ip_addr=ips[-1])
+        error, ip = self.mm['ipreserve'].run("allocate_next", net_addr=net_addr, description="last")
+        self.assertEqual(ip, ips[-1])
+
+    @benchmark
+    def test_benchmark(self):
+        net_addr = "10.10.0.0/16"
+        self.add_network(net_addr)
+
+        start = time.perf_counter()
+        error, ips = self.mm['ipreserve'].run("allocate_block", net_addr=net_addr, count=65533, description="bulk")
+        bulk_cost = time.perf_counter() - start
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(len(set(ips)), 65533)
+
+        bitmap = self.ipreserve._get_bitmap(1, ipaddress.ip_network(net_addr))
+        self.assertEqual(bitmap.free(), 0)
+
+        # Free one address at a time in the packed network and take it back
+        rng = random.Random(3)
+        rounds = 2000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            ip = rng.choice(ips)
+            bitmap.release(ip)
+            self.assertEqual(str(bitmap.allocate()), ip)
+        packed_cost = (time.perf_counter() - start) / rounds
+
+        empty = AddressBitmap(net_addr)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            empty.release(empty.allocate())
+        empty_cost = (time.perf_counter() - start) / rounds
+
+        # Picking by hand: try each IP after the gateway until one is not in ip_list
+        dbc = self.db.cursor()
+        hosts = list(ipaddress.ip_network(net_addr).hosts())[1:]
+        self.mm['ipreserve'].run("remove_ip", ip_addr=ips[-1])
+        start = time.perf_counter()
+        for ip in hosts:
+            dbc.execute("SELECT * FROM ip_list WHERE ip=?", (str(ip),))
+            if dbc.fetchone() is None:
+                break
+        scan_cost = time.perf_counter() - start
+        self.assertEqual(str(ip), ips[-1])
+
+        error, ip = self.mm['ipreserve'].run("allocate_next", net_addr=net_addr, description="last")
+        self.assertEqual(ip, ips[-1])
+
+        report("ip allocation", "/16 network: {} IPs allocated in {:.0f}ms, release and allocate {:.2f}us packed, {:.2f}us empty, finding the free IP by hand {:.0f}ms".format(
+            len(ips), bulk_cost * 1000, packed_cost * 1000000, empty_cost * 1000000, scan_cost * 1000))
+        self.assertTrue(packed_cost < empty_cost * 3)
+
+    def tearDown(self):
+        self.mm.jobs.shutdown()
+        self.db.close()
+
+# The server runs calls on several threads, each with its own connection, and
+# fnconsole may be changing the same database from another process
+class TestIPAllocationThreads(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.base_dir, "fakernet.db")
+        self.db = ThreadLocalConnection(self.path)
+        self.mm, self.ipreserve = self.manager(self.db)
+        self.workers = [ThreadPoolExecutor(max_workers=1), ThreadPoolExecutor(max_workers=1)]
+        error, _ = self.mm['netreserve'].run("add_network", net_addr="172.16.4.0/24", description="test", switch="")
+        self.assertTrue(error is None, msg=error)
+
+    def manager(self, db):
+        mm = ModuleManager(db=db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient())
+        ipreserve = IPReservation(mm)
+        mm.modules['netreserve'] = LockModule(NetReservation(mm), mm)
+        mm.modules['ipreserve'] = LockModule(ipreserve, mm)
+        mm['netreserve'].check()
+        mm['ipreserve'].check()
+        return mm, ipreserve
+
+    def allocate(self, worker):
+        error, ip = self.workers[worker].submit(self.mm['ipreserve'].run, "allocate_next", net_addr="172.16.4.0/24", description="test").result()
+        self.assertTrue(error is None, msg=error)
+        return ip
+
+    def test_threads(self):
+        ips = [self.allocate(0)]
+        # The bitmap stays cached whichever thread the call is on
+        bitmap = self.ipreserve._bitmaps[1]
+        for i in range(10):
+            ips.append(self.allocate(i % 2))
+            self.assertTrue(self.ipreserve._bitmaps.get(1) is bitmap)
+        self.assertEqual(ips, ["172.16.4.{}".format(i) for i in range(2, 13)])
+
+        # Allocations by another process are seen from every thread
+        other_db = ThreadLocalConnection(self.path)
+        other_mm, other = self.manager(other_db)
+        error, ip = other_mm['ipreserve'].run("allocate_next", net_addr="172.16.4.0/24", description="other")
+        self.assertEqual(ip, "172.16.4.13")
+        self.assertEqual([self.allocate(0), self.allocate(1)], ["172.16.4.14", "172.16.4.15"])
+
+        dbc = self.db.cursor()
+        dbc.execute("SELECT ip FROM ip_list")
+        taken = [row[0] for row in dbc.fetchall()]
+        self.assertEqual(len(taken), len(set(taken)))
+        self.assertEqual(len(taken), 14)
+        other_mm.jobs.shutdown()
+        other_db.close()
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.shutdown()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        shutil.rmtree(self.base_dir)
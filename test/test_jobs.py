@@ -0,0 +1,138 @@
+import unittest
+import os
+import sys
+import time
+import sqlite3
+import threading
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+
+from lib.module_manager import ModuleManager, LockModule
+from lib.base_module import BaseModule
+from lib.jobs import JOB_DONE, JOB_ERROR
+
+# Counts jobs running at once, across modules
+class RunCounter():
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def enter(self):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def exit(self):
+        with self._lock:
+            self.running -= 1
+
+class SlowModule(BaseModule):
+    __FUNCS__ = {}
+
+    def __init__(self, mm, shortname, counter):
+        self.mm = mm
+        self.__SHORTNAME__ = shortname
+        self.counter = counter
+        self.release = threading.Event()
+
+    def run(self, func, **kwargs):
+        if func == "work":
+            self.counter.enter()
+            self.print("Starting {}".format(kwargs['id']))
+            time.sleep(0.05)
+            self.print("Finished {}".format(kwargs['id']))
+            self.counter.exit()
+            return None, int(kwargs['id']) * 2
+        elif func == "fail":
+            return "Failed on purpose", None
+        elif func == "crash":
+            raise ValueError("crashed")
+        elif func == "wait":
+            self.print("Waiting")
+            self.release.wait(5)
+            return None, True
+        return "Invalid function", None
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient(), job_workers=2)
+        self.counter = RunCounter()
+        self.slow = SlowModule(self.mm, "slow", self.counter)
+        self.mm.modules['slow'] = LockModule(self.slow, self.mm)
+        # Calls into one module are serialised, so spread jobs over several
+        self.others = []
+        for i in range(4):
+            other = SlowModule(self.mm, "slow{}".format(i), self.counter)
+            self.mm.modules[other.__SHORTNAME__] = LockModule(other, self.mm)
+            self.others.append(other.__SHORTNAME__)
+
+    def test_submit_and_gather(self):
+        job_ids = []
+        for i in range(6):
+            error, job_id = self.mm['slow'].submit("work", id=i)
+            self.assertTrue(error is None, msg=error)
+            job_ids.append(job_id)
+
+        results = self.mm.gather_jobs(job_ids, interval=0.01, timeout=10)
+        self.assertEqual(results, [(None, i * 2) for i in range(6)])
+
+        error, job = self.mm.get_job(job_ids[3])
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(job['status'], JOB_DONE)
+        self.assertEqual(job['progress'], ["Starting 3", "Finished 3"])
+        self.assertTrue(job['finished'] >= job['started'] >= job['created'])
+
+    def test_errors(self):
+        _, fail_id = self.mm['slow'].submit("fail")
+        _, crash_id = self.mm['slow'].submit("crash")
+        results = self.mm.gather_jobs([fail_id, crash_id, "nope"], interval=0.01, timeout=10)
+
+        self.assertEqual(results[0], ("Failed on purpose", None))
+        self.assertTrue("crashed" in results[1][0])
+        self.assertTrue("not found" in results[2][0])
+
+        _, job = self.mm.get_job(fail_id)
+        self.assertEqual(job['status'], JOB_ERROR)
+
+        error, _ = self.mm.jobs.submit("nope", "work", {})
+        self.assertTrue(error is not None)
+
+    def test_progress_stream(self):
+        _, job_id = self.mm['slow'].submit("wait")
+        _, job = self.mm.jobs.get(job_id)
+
+        messages, finished = job.wait_progress(0, timeout=5)
+        self.assertEqual(messages, ["Waiting"])
+        self.assertFalse(finished)
+
+        self.slow.release.set()
+        messages, finished = job.wait_progress(1, timeout=5)
+        self.assertEqual(messages, [])
+        self.assertTrue(finished)
+
+    def test_pool_is_bounded(self):
+        job_ids = [self.mm[self.others[i % 4]].submit("work", id=i)[1] for i in range(8)]
+        self.mm.gather_jobs(job_ids, interval=0.01, timeout=10)
+        self.assertEqual(self.counter.max_running, 2)
+
+    def test_finished_jobs_pruned(self):
+        self.mm.jobs.max_finished = 3
+        job_ids = [self.mm['slow'].submit("work", id=i)[1] for i in range(5)]
+        self.mm.gather_jobs(job_ids, interval=0.01, timeout=10)
+        self.mm['slow'].submit("work", id=99)
+
+        _, jobs = self.mm.jobs.list()
+        self.assertTrue(len(jobs) <= 4)
+        self.assertTrue(self.mm.get_job(job_ids[0])[0] is not None)
+
+    def tearDown(self):
+        self.slow.release.set()
+        self.mm.jobs.shutdown()
+        self.mm.db.close()
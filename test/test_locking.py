@@ -0,0 +1,376 @@
+import unittest
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor, wait
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient, FakeOVS
+from benchmark import benchmark, report
+
+from lib.module_manager import ModuleManager, LockModule
+from lib.base_module import BaseModule, DockerBaseModule
+from lib.locking import LockManager, resource_keys
+from lib.database import ThreadLocalConnection
+from modules.network_reservation import NetReservation
+
+OVS_DELAY = 0.05
+DNS_DELAY = 0.005
+SERVERS_PER_SERVICE = 10
+DNS_CALLS = 20
+
+# Records how many threads are inside the module at once
+class ProbeMixin():
+
+    def _probe_init(self, mm):
+        self.mm = mm
+        self._probe_lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def run(self, func, **kwargs):
+        with self._probe_lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            return self._run(func, **kwargs)
+        finally:
+            with self._probe_lock:
+                self.active -= 1
+
+class FakeNetReserve(ProbeMixin, BaseModule):
+    __SHORTNAME__ = "netreserve"
+    __FUNCS__ = {}
+
+    def __init__(self, mm):
+        self._probe_init(mm)
+
+    def _run(self, func, **kwargs):
+        if func == "list":
+            return None, {"rows": [[1, "172.16.0.0/16", "", "fakernet0"]]}
+        elif func == "get_ip_switch":
+            return None, "fakernet0"
+        elif func == "get_ip_network":
+            return None, ipaddress.ip_network(kwargs['ip_addr'] + "/24", strict=False)
+        return "Invalid function", None
+
+class FakeIPReserve(ProbeMixin, BaseModule):
+    __SHORTNAME__ = "ipreserve"
+    __FUNCS__ = {}
+
+    def __init__(self, mm):
+        self._probe_init(mm)
+        self.ips = set()
+
+    def _run(self, func, **kwargs):
+        if func == "add_ip":
+            err, _ = self.mm['netreserve'].run("list")
+            if err is not None:
+                return err, None
+            if kwargs['ip_addr'] in self.ips:
+                return "IP already allocated", None
+            self.ips.add(kwargs['ip_addr'])
+            return None, True
+        elif func == "remove_ip":
+            self.ips.discard(kwargs['ip_addr'])
+            return None, True
+        return "Invalid function", None
+
+class FakeDNS(ProbeMixin, BaseModule):
+    __SHORTNAME__ = "dns"
+    __FUNCS__ = {}
+
+    def __init__(self, mm):
+        self._probe_init(mm)
+        self.hosts = {}
+
+    def _run(self, func, **kwargs):
+        if func == "get_server":
+            return None, {"server_ip": "172.16.3.2"}
+        elif func == "add_host":
+            # Stands in for the zone write and reload
+            time.sleep(DNS_DELAY)
+            self.hosts[kwargs['fqdn']] = kwargs['ip_addr']
+            return None, True
+        elif func == "remove_host":
+            time.sleep(DNS_DELAY)
+            self.hosts.pop(kwargs['fqdn'], None)
+            return None, True
+        elif func == "call_service":
+            # Not allowed, dns is below service modules
+            return self.mm['svca'].run("list")
+        return "Invalid function", None
+
+class FakeService(ProbeMixin, DockerBaseModule):
+    __SERVER_IMAGE_NAME__ = "fake-server"
+    __FUNCS__ = {}
+
+    # Calls running at once across all services
+    _services_lock = threading.Lock()
+    services_active = 0
+    services_max_active = 0
+
+    def __init__(self, mm, shortname, ovs):
+        self._probe_init(mm)
+        self.__SHORTNAME__ = shortname
+        self.ovs = ovs
+
+    def ovs_set_ip(self, container, bridge, interface, ip_addr, gateway):
+        self.ovs.add_port(bridge, interface, container, ip_addr, gateway)
+        return None, True
+
+    def ovs_remove_ports(self, container, bridge):
+        self.ovs.del_ports(bridge, container)
+        return None, True
+
+    def run(self, func, **kwargs):
+        with FakeService._services_lock:
+            FakeService.services_active += 1
+            FakeService.services_max_active = max(FakeService.services_max_active, FakeService.services_active)
+        try:
+            return super().run(func, **kwargs)
+        finally:
+            with FakeService._services_lock:
+                FakeService.services_active -= 1
+
+    def _run(self, func, **kwargs):
+        if func == "list":
+            return None, []
+        elif func == "add_server":
+            ip_addr = kwargs['ip_addr']
+            container_name = "{}-{}".format(self.__SHORTNAME__, ip_addr)
+            err, _ = self.mm['ipreserve'].run("add_ip", ip_addr=ip_addr, description="test")
+            if err is not None:
+                return err, None
+            err, _ = self.mm['dns'].run("add_host", fqdn=kwargs['fqdn'], ip_addr=ip_addr)
+            if err is not None:
+                return err, None
+            err, _ = self.docker_create(container_name, {}, {})
+            if err is not None:
+                return err, None
+            return self.docker_start(container_name, ip_addr)
+        elif func == "remove_server":
+            ip_addr = kwargs['ip_addr']
+            container_name = "{}-{}".format(self.__SHORTNAME__, ip_addr)
+            err, _ = self.docker_stop(container_name, ip_addr)
+            if err is not None:
+                return err, None
+            self.mm['dns'].run("remove_host", fqdn=kwargs['fqdn'], ip_addr=ip_addr)
+            self.mm['ipreserve'].run("remove_ip", ip_addr=ip_addr)
+            return self.docker_delete(container_name)
+        return "Invalid function", None
+
+class TestLockManager(unittest.TestCase):
+
+    def test_resource_keys(self):
+        keys = resource_keys("dns", {"id": 1, "fqdn": "WWW.Test.", "ip_addr": "10.0.0.1", "description": "x"})
+        self.assertEqual(keys, ["dns:1", "ip:10.0.0.1", "name:www.test"])
+        self.assertEqual(resource_keys("svca", {"id": 1}), ["svca:1"])
+        self.assertEqual(resource_keys("dns", {}), [])
+
+    def test_check_order(self):
+        locks = LockManager()
+        self.assertTrue(locks.check_order("mattermost") is None)
+        with locks.hold("mattermost"):
+            self.assertTrue(locks.check_order("dns") is None)
+            self.assertTrue(locks.check_order("mattermost") is None)
+            self.assertTrue(locks.check_order("tinyproxy") is not None)
+            with locks.hold("dns"):
+                self.assertTrue(locks.check_order("ipreserve") is None)
+                self.assertTrue(locks.check_order("dns") is None)
+                self.assertTrue(locks.check_order("minica") is not None)
+            self.assertEqual(locks.depth(), 1)
+        self.assertEqual(locks.depth(), 0)
+
+    def test_resource_key_exclusion(self):
+        locks = LockManager()
+        inside = threading.Event()
+        release = threading.Event()
+        order = []
+
+        def first():
+            with locks.hold("svca", ["ip:10.0.0.1"]):
+                order.append("first")
+                inside.set()
+                release.wait(5)
+
+        def second():
+            with locks.hold("svcb", ["ip:10.0.0.1"]):
+                order.append("second")
+
+        t1 = threading.Thread(target=first)
+        t1.start()
+        inside.wait(5)
+        t2 = threading.Thread(target=second)
+        t2.start()
+        time.sleep(0.05)
+        self.assertEqual(order, ["first"])
+        release.set()
+        t1.join(5)
+        t2.join(5)
+        self.assertEqual(order, ["first", "second"])
+        self.assertEqual(locks._resource_locks, {})
+
+class TestConcurrentModules(unittest.TestCase):
+
+    def setUp(self):
+        self.docker = FakeDockerClient()
+        db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.ovs = FakeOVS(delay=OVS_DELAY)
+
+        self.fakes = [
+            FakeNetReserve(self.mm),
+            FakeIPReserve(self.mm),
+            FakeDNS(self.mm),
+            FakeService(self.mm, "svca", self.ovs),
+            FakeService(self.mm, "svcb", self.ovs)
+        ]
+        for fake in self.fakes:
+            self.mm.modules[fake.__SHORTNAME__] = LockModule(fake, self.mm)
+        FakeService.services_max_active = 0
+
+    def test_lock_order_violation(self):
+        error, _ = self.mm['dns'].run("call_service")
+        self.assertTrue(error is not None)
+        self.assertTrue("Lock order" in error, msg=error)
+
+    def _mixed_calls(self):
+        calls = []
+        for i, service in enumerate(["svca", "svcb"]):
+            for j in range(SERVERS_PER_SERVICE):
+                ip_addr = "172.16.{}.{}".format(i + 10, j + 2)
+                calls.append((service, "add_server", {"ip_addr": ip_addr, "fqdn": "{}{}.test".format(service, j)}))
+        for j in range(DNS_CALLS):
+            calls.append(("dns", "add_host", {"fqdn": "host{}.test".format(j), "ip_addr": "172.16.20.{}".format(j + 2)}))
+        # Two services fighting over the same IP
+        calls.append(("svca", "add_server", {"ip_addr": "172.16.30.2", "fqdn": "shared-a.test"}))
+        calls.append(("svcb", "add_server", {"ip_addr": "172.16.30.2", "fqdn": "shared-b.test"}))
+        return calls
+
+    def _run_calls(self, calls):
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            futures = [pool.submit(self.mm[module].run, func, **args) for module, func, args in calls]
+            done, not_done = wait(futures, timeout=30)
+            # Anything still running here is deadlocked
+            self.assertEqual(len(not_done), 0)
+        return [future.result() for future in futures]
+
+    def test_mixed_stress(self):
+        calls = self._mixed_calls()
+        results = self._run_calls(calls)
+
+        for (module, func, args), (error, _) in zip(calls[:-2], results[:-2]):
+            self.assertTrue(error is None, msg="{}.{}: {}".format(module, func, error))
+        shared_errors = [error for error, _ in results[-2:]]
+        self.assertEqual(shared_errors.count(None), 1)
+
+        # Each module runs one call at a time, but different services overlap
+        for fake in self.fakes:
+            self.assertEqual(fake.max_active, 1, msg=fake.__SHORTNAME__)
+        self.assertEqual(FakeService.services_max_active, 2)
+        self.assertEqual(len(self.mm['ipreserve'].ips), 2 * SERVERS_PER_SERVICE + 1)
+        self.assertEqual(len(self.ovs.ports), 2 * SERVERS_PER_SERVICE + 1)
+
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            futures = [pool.submit(self.mm[module].run, "remove_server", **args) for module, func, args in calls[:2 * SERVERS_PER_SERVICE]]
+            done, not_done = wait(futures, timeout=30)
+            self.assertEqual(len(not_done), 0)
+
+        for future in futures:
+            error, _ = future.result()
+            self.assertTrue(error is None, msg=error)
+        self.assertEqual(len(self.mm['ipreserve'].ips), 1)
+        self.assertEqual(self.mm.locks._resource_locks, {})
+
+    @benchmark
+    def test_mixed_benchmark(self):
+        calls = self._mixed_calls()
+
+        # What a single global lock would cost, at the least
+        serial_time = 2 * SERVERS_PER_SERVICE * OVS_DELAY + (2 * SERVERS_PER_SERVICE + DNS_CALLS) * DNS_DELAY
+
+        start = time.perf_counter()
+        self._run_calls(calls)
+        elapsed = time.perf_counter() - start
+
+        report("mixed calls", "{} calls: {:.3f}s concurrent, at least {:.3f}s with a global lock ({:.1f} calls/s)".format(
+            len(calls), elapsed, serial_time, len(calls) / elapsed))
+        self.assertTrue(elapsed < serial_time * 0.85)
+
+    def tearDown(self):
+        self.mm.db.close()
+
+class TestThreadLocalConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.db = ThreadLocalConnection(os.path.join(self.base_dir, "test.db"), timeout=1)
+        self.db.cursor().execute("CREATE TABLE item (name TEXT)")
+        self.db.commit()
+
+    def count(self):
+        dbc = self.db.cursor()
+        dbc.execute("SELECT COUNT(*) FROM item")
+        return dbc.fetchone()[0]
+
+    def test_separate_transactions(self):
+        written = threading.Event()
+        committed = threading.Event()
+
+        def half_done():
+            self.db.cursor().execute("INSERT INTO item (name) VALUES ('half')")
+            written.set()
+            committed.wait(5)
+            self.db.rollback()
+
+        thread = threading.Thread(target=half_done)
+        thread.start()
+        self.assertTrue(written.wait(5))
+        # Another module committing doesn't take the unfinished write with it
+        self.db.commit()
+        committed.set()
+        thread.join()
+        self.assertEqual(self.count(), 0)
+
+        def write():
+            self.db.cursor().execute("INSERT INTO item (name) VALUES ('done')")
+            self.db.commit()
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join()
+        self.assertEqual(self.count(), 1)
+        # The first thread had finished, so its connection was closed when the
+        # second one opened its own
+        self.assertEqual(len(self.db._connections), 2)
+
+    def test_netreserve_across_threads(self):
+        mm = ModuleManager(db=self.db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient())
+        mm.modules['netreserve'] = LockModule(NetReservation(mm), mm)
+        mm['netreserve'].check()
+        workers = [ThreadPoolExecutor(max_workers=1), ThreadPoolExecutor(max_workers=1)]
+        try:
+            error, _ = workers[0].submit(mm['netreserve'].run, "get_ip_network_info", ip_addr="10.9.0.5").result()
+            self.assertEqual(error, "Could not find network")
+
+            # Added and committed on one thread, then looked up on the other
+            error, _ = workers[1].submit(mm['netreserve'].run, "add_network", net_addr="10.9.0.0/24", description="test", switch="").result()
+            self.assertTrue(error is None, msg=error)
+            error, info = workers[0].submit(mm['netreserve'].run, "get_ip_network_info", ip_addr="10.9.0.5").result()
+            self.assertTrue(error is None, msg=error)
+            self.assertEqual(info['net_address'], "10.9.0.0/24")
+        finally:
+            for worker in workers:
+                worker.shutdown()
+            mm.jobs.shutdown()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.base_dir)
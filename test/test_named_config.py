@@ -0,0 +1,211 @@
+import unittest
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import shutil
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+import modules.dns_server
+from modules.dns_server import DNSServer
+from lib.module_manager import ModuleManager, LockModule
+from lib.named_config import NamedConfig
+
+LEGACY_CONFIG = """options {
+        directory "/var/bind";
+        include "/etc/bind/conf/forwarders.conf";
+        response-policy { zone "fn.rpz"; };
+};
+
+zone "fn.rpz" {
+    type master;
+    file "/etc/bind/zones/fn.rpz";
+};
+
+include "/etc/bind/conf/test.conf";
+
+include "/etc/bind/conf/forward-other.conf";
+
+include "/etc/bind/conf/update.key";
+"""
+
+class TestNamedConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.conf_dir = os.path.join(self.base_dir, "conf")
+        os.mkdir(self.conf_dir)
+        self.path = os.path.join(self.base_dir, "named.conf")
+        config_file = open(self.path, "w")
+        config_file.write(LEGACY_CONFIG)
+        config_file.close()
+
+    def read_file(self, path):
+        config_file = open(path, "r")
+        contents = config_file.read()
+        config_file.close()
+        return contents
+
+    def read_shards(self):
+        contents = ""
+        for filename in sorted(os.listdir(self.conf_dir)):
+            if filename.startswith("includes-"):
+                contents += self.read_file(os.path.join(self.conf_dir, filename))
+        return contents
+
+    def test_migrate(self):
+        config = NamedConfig(self.path, self.conf_dir, shards=4, top=("update.key",))
+        self.assertEqual(config.includes(), set(["test.conf", "forward-other.conf", "update.key"]))
+        self.assertTrue(config.is_dirty())
+        self.assertEqual(config.flush(), 5)
+        self.assertFalse(config.is_dirty())
+
+        named_conf = self.read_file(self.path)
+        # Includes inside blocks are left alone
+        self.assertTrue('        include "/etc/bind/conf/forwarders.conf";' in named_conf)
+        self.assertTrue('include "/etc/bind/conf/update.key";' in named_conf)
+        self.assertFalse('include "/etc/bind/conf/test.conf";' in named_conf)
+        for shard in range(4):
+            self.assertTrue('include "/etc/bind/conf/includes-{}.conf";'.format(shard) in named_conf)
+        self.assertTrue('include "/etc/bind/conf/test.conf";' in self.read_shards())
+        self.assertTrue('include "/etc/bind/conf/forward-other.conf";' in self.read_shards())
+
+        # Loading again gives the same config
+        config = NamedConfig(self.path, self.conf_dir, shards=4, top=("update.key",))
+        self.assertEqual(config.includes(), set(["test.conf", "forward-other.conf", "update.key"]))
+        self.assertFalse(config.is_dirty())
+        self.assertEqual(config.render(), named_conf)
+
+    def test_changes(self):
+        config = NamedConfig(self.path, self.conf_dir, shards=4, top=("update.key",))
+        config.flush()
+
+        # A zone change rewrites one shard, and named.conf stays the same
+        config.add_include("new.conf")
+        config.add_include("new.conf")
+        self.assertEqual(config.flush(), 1)
+        self.assertEqual(config.flush(), 0)
+
+        config.remove_include("test.conf")
+        config.remove_include("missing.conf")
+        config.remove_include("update.key")
+        self.assertEqual(config.flush(), 2)
+        self.assertFalse("test.conf" in self.read_shards())
+        self.assertFalse("update.key" in self.read_file(self.path))
+        self.assertTrue(config.has_include("new.conf"))
+        self.assertFalse(config.is_stale())
+
+        config_file = open(self.path, "a")
+        config_file.write("\n// Changed\n")
+        config_file.close()
+        self.assertTrue(config.is_stale())
+
+class TestDNSNamedConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.old_base_dir = modules.dns_server.DNS_BASE_DIR
+        modules.dns_server.DNS_BASE_DIR = self.base_dir
+
+        self.docker = FakeDockerClient()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.dns = DNSServer(self.mm)
+        self.mm.modules['dns'] = LockModule(self.dns, self.mm)
+
+        dbc = self.db.cursor()
+        dbc.execute("CREATE TABLE dns_server (server_id INTEGER PRIMARY KEY, server_ip TEXT, server_desc TEXT, server_domain TEXT);")
+        dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', ("172.16.3.2", "test", "test"))
+        self.db.commit()
+
+        self.server_dir = os.path.join(self.base_dir, "1")
+        os.mkdir(self.server_dir)
+        os.mkdir(os.path.join(self.server_dir, "conf"))
+        os.mkdir(os.path.join(self.server_dir, "zones"))
+        shutil.copy("./docker-images/dns/config-template", os.path.join(self.server_dir, "named.conf"))
+        self.container = self.docker.containers.add("dns-server-1", "running")
+
+    def includes(self):
+        config = NamedConfig(os.path.join(self.server_dir, "named.conf"), os.path.join(self.server_dir, "conf"), shards=modules.dns_server.NAMED_INCLUDE_SHARDS)
+        return config.includes()
+
+    def test_forwarding_zones(self):
+        error, _ = self.dns._add_zone(1, "test", "fwd")
+        self.assertTrue(error is None, msg=error)
+        # Written once the batch is reloaded
+        self.assertEqual(self.includes(), set())
+        self.dns._add_forwarding_zone(1, "other", "10.0.0.9")
+        self.dns.reloads.flush()
+        self.assertEqual(self.includes(), set(["test.conf", "forward-other.conf"]))
+        self.assertTrue('response-policy { zone "fn.rpz"; };' in open(os.path.join(self.server_dir, "named.conf"), "r").read())
+
+        self.dns._remove_forwarding_zone(1, "other")
+        self.dns.reloads.mark(1)
+        self.dns.reloads.flush()
+        self.assertEqual(self.includes(), set(["test.conf"]))
+        self.assertFalse(os.path.exists(os.path.join(self.server_dir, "conf", "forward-other.conf")))
+
+    def test_many_includes(self):
+        config = self.dns._named_config(1)
+        for i in range(3000):
+            config.add_include("zone{}.test.conf".format(i))
+        error, written = self.dns._flush_named_config(1)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(written, modules.dns_server.NAMED_INCLUDE_SHARDS + 1)
+        self.assertEqual(len(self.includes()), 3000)
+
+        # One more zone only rewrites the file holding it
+        config.add_include("one-more.test.conf")
+        error, written = self.dns._flush_named_config(1)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(written, 1)
+        self.assertEqual(len(self.includes()), 3001)
+
+    @benchmark
+    def test_benchmark(self):
+        zone_count = 3000
+        zones = ["zone{}.test".format(i) for i in range(zone_count)]
+
+        # The old way: scan named.conf for the include, then append it
+        legacy_path = os.path.join(self.base_dir, "legacy.conf")
+        shutil.copy("./docker-images/dns/config-template", legacy_path)
+        start = time.perf_counter()
+        for zone in zones:
+            main_config_contents = open(legacy_path, "r").read()
+            if not "include \"/etc/bind/conf/{}.conf\";\n".format(zone) in main_config_contents:
+                main_config_file = open(legacy_path, "a")
+                main_config_file.write("\ninclude \"/etc/bind/conf/{}.conf\";\n".format(zone))
+                main_config_file.close()
+        old_cost = time.perf_counter() - start
+
+        start = time.perf_counter()
+        config = self.dns._named_config(1)
+        for zone in zones:
+            config.add_include("{}.conf".format(zone))
+        error, written = self.dns._flush_named_config(1)
+        new_cost = time.perf_counter() - start
+        self.assertTrue(error is None, msg=error)
+
+        # Adding one more zone to a large config
+        start = time.perf_counter()
+        config.add_include("one-more.test.conf")
+        error, written = self.dns._flush_named_config(1)
+        one_cost = time.perf_counter() - start
+
+        report("named.conf includes", "{} zones: scan and append {:.0f}ms, batch {:.0f}ms, one more zone {:.2f}ms".format(
+            zone_count, old_cost * 1000, new_cost * 1000, one_cost * 1000))
+        self.assertTrue(new_cost < old_cost)
+
+    def tearDown(self):
+        self.dns.reloads.flush()
+        self.dns.zones.flush()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        modules.dns_server.DNS_BASE_DIR = self.old_base_dir
+        shutil.rmtree(self.base_dir)
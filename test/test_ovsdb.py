@@ -0,0 +1,187 @@
+import unittest
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import shutil
+import subprocess
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient, FakeOVSDBServer
+from benchmark import benchmark, report
+
+from modules.network_reservation import NetReservation
+from lib.module_manager import ModuleManager, LockModule
+from lib.ovsdb import OVSDBClient
+from lib.util import clean_ovs
+
+class TestOVSDB(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.server = FakeOVSDBServer(os.path.join(self.base_dir, "db.sock"))
+        self.client = OVSDBClient(os.path.join(self.base_dir, "db.sock"))
+        error, _ = self.client.connect()
+        self.assertTrue(error is None, msg=error)
+
+    def test_bridges(self):
+        transaction = self.client.transaction()
+        transaction.add_bridge("br1")
+        transaction.add_bridge("br2")
+        error, _ = transaction.commit()
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.server.transactions, 1)
+        self.assertEqual(self.client.bridges(), ["br1", "br2"])
+        self.assertTrue(self.client.bridge_exists("br1"))
+        self.assertFalse(self.client.bridge_exists("br3"))
+
+        transaction = self.client.transaction()
+        self.assertTrue(transaction.add_port("br1", "veth1", external_ids={"container_id": "web"}))
+        self.assertFalse(transaction.add_port("br3", "veth2"))
+        error, _ = transaction.commit()
+        self.assertTrue(error is None, msg=error)
+        port = self.client.find("Port", "veth1")
+        self.assertTrue(port['_uuid'] in self.client.find("Bridge", "br1")['ports'])
+        self.assertEqual(self.client.find("Interface", "veth1")['external_ids'], {"container_id": "web"})
+
+        # Ports and interfaces go with their bridge
+        transaction = self.client.transaction()
+        self.assertTrue(transaction.del_bridge("br1"))
+        self.assertFalse(transaction.del_bridge("br3"))
+        error, _ = transaction.commit()
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.client.bridges(), ["br2"])
+        self.assertEqual(self.client.find("Port", "veth1"), None)
+        self.assertEqual(self.server.find("Interface", "veth1"), None)
+
+        # A second client sees the same tables
+        other = OVSDBClient(self.client.path)
+        other.connect()
+        self.assertEqual(other.bridges(), ["br2"])
+        other.close()
+
+        error, _ = self.client.transact([{"op": "insert", "table": "Nope", "row": {}}])
+        self.assertTrue(error.startswith("OVSDB transaction failed"))
+
+    def test_clean_ovs(self):
+        transaction = self.client.transaction()
+        transaction.add_bridge("br1")
+        transaction.add_bridge("br2")
+        transaction.commit()
+        transaction = self.client.transaction()
+        for i in range(10):
+            transaction.add_port("br1" if i % 2 == 0 else "br2", "veth{}".format(i))
+        transaction.commit()
+
+        for i in range(0, 10, 3):
+            self.server.set_interface_error("veth{}".format(i), "could not open network device veth{} (No such device)".format(i))
+        deadline = time.monotonic() + 5
+        while len(self.client.stale_ports()) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sorted(self.client.stale_ports()), [("br1", "veth0"), ("br1", "veth6"), ("br2", "veth3"), ("br2", "veth9")])
+
+        # Every stale port goes in one transaction
+        before = self.server.transactions
+        clean_ovs(self.client)
+        self.assertEqual(self.server.transactions, before + 1)
+        self.assertEqual(self.client.stale_ports(), [])
+        self.assertEqual(self.client.find("Port", "veth3"), None)
+        self.assertTrue(self.client.find("Port", "veth4") is not None)
+
+        clean_ovs(self.client)
+        self.assertEqual(self.server.transactions, before + 1)
+
+    def test_netreserve(self):
+        db = sqlite3.connect(":memory:", check_same_thread=False)
+        mm = ModuleManager(db=db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient())
+        mm.ovsdb = self.client
+        netreserve = NetReservation(mm)
+        # Addresses on the switch are set with ip, which is not run here
+        switch_ips = []
+        netreserve._set_switch_ip = lambda switch, ip_addr: switch_ips.append((switch, ip_addr))
+        mm.modules['netreserve'] = LockModule(netreserve, mm)
+        mm['netreserve'].check()
+
+        error, net_id = mm['netreserve'].run("add_network", net_addr="172.16.8.0/24", description="test", switch="test1")
+        self.assertTrue(error is None, msg=error)
+        self.assertTrue(self.client.bridge_exists("test1"))
+        self.assertEqual(switch_ips, [("test1", "172.16.8.1/24")])
+        error, _ = mm['netreserve'].run("remove_network", id=net_id)
+        self.assertTrue(error is None, msg=error)
+        self.assertFalse(self.client.bridge_exists("test1"))
+        error, _ = mm['netreserve'].run("remove_network", id=net_id)
+        self.assertEqual(error, "Network does not exist")
+
+        mm.jobs.shutdown()
+        db.close()
+
+    def test_round_trips(self):
+        transaction = self.client.transaction()
+        transaction.add_bridge("br1")
+        transaction.commit()
+        before = self.server.transactions
+
+        # Reads come from the monitored cache
+        for _ in range(1000):
+            self.assertTrue(self.client.bridge_exists("br1"))
+        self.assertEqual(self.server.transactions, before)
+
+        for i in range(100):
+            transaction = self.client.transaction()
+            transaction.add_port("br1", "veth{}".format(i))
+            error, _ = transaction.commit()
+            self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.server.transactions, before + 100)
+
+        transaction = self.client.transaction()
+        for i in range(100):
+            transaction.del_port("br1", "veth{}".format(i))
+        error, _ = transaction.commit()
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.server.transactions, before + 101)
+        self.assertEqual(self.server.find("Interface", "veth99"), None)
+
+    @benchmark
+    def test_benchmark(self):
+        transaction = self.client.transaction()
+        transaction.add_bridge("br1")
+        transaction.commit()
+
+        rounds = 1000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            self.assertTrue(self.client.bridge_exists("br1"))
+        exists_cost = (time.perf_counter() - start) / rounds
+
+        start = time.perf_counter()
+        for i in range(100):
+            transaction = self.client.transaction()
+            transaction.add_port("br1", "veth{}".format(i))
+            error, _ = transaction.commit()
+        add_cost = (time.perf_counter() - start) / 100
+        self.assertTrue(error is None, msg=error)
+
+        transaction = self.client.transaction()
+        for i in range(100):
+            transaction.del_port("br1", "veth{}".format(i))
+        start = time.perf_counter()
+        error, _ = transaction.commit()
+        batch_cost = time.perf_counter() - start
+
+        # The least an ovs-vsctl call costs, before sudo and the OVSDB connection
+        start = time.perf_counter()
+        for _ in range(20):
+            subprocess.check_output(["/bin/true"])
+        spawn_cost = (time.perf_counter() - start) / 20
+
+        report("ovsdb", "br-exists {:.1f}us from the cache, add-port {:.2f}ms, 100 del-port in one transaction {:.2f}ms; spawning a process {:.2f}ms".format(
+            exists_cost * 1000000, add_cost * 1000, batch_cost * 1000, spawn_cost * 1000))
+        self.assertTrue(exists_cost < spawn_cost)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.base_dir)
@@ -0,0 +1,352 @@
+import unittest
+import os
+import sys
+import time
+import random
+import shutil
+import sqlite3
+import tempfile
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+from modules.network_reservation import NetReservation
+from modules.ip_reservation import IPReservation
+from lib.module_manager import ModuleManager, LockModule
+from lib.prefix_index import PrefixIndex
+from lib.database import ThreadLocalConnection
+import lib.validate as validate
+
+class TestPrefixIndex(unittest.TestCase):
+
+    def test_lookup(self):
+        index = PrefixIndex()
+        index.add("10.0.0.0/8", "big")
+        index.add("10.1.0.0/16", "middle")
+        index.add("10.1.2.0/24", "small")
+        index.add("10.1.2.7/32", "host")
+        index.add("192.168.0.0/24", "other")
+        index.add("fd00::/64", "six")
+        self.assertEqual(len(index), 6)
+
+        self.assertEqual(index.lookup("10.1.2.7")[1], "host")
+        self.assertEqual(index.lookup("10.1.2.8")[1], "small")
+        self.assertEqual(index.lookup("10.1.3.1")[1], "middle")
+        self.assertEqual(index.lookup("10.200.0.1"), (ipaddress.ip_network("10.0.0.0/8"), "big"))
+        self.assertEqual(index.lookup("192.168.0.255")[1], "other")
+        self.assertEqual(index.lookup("fd00::1")[1], "six")
+        self.assertEqual(index.lookup("192.168.1.1"), None)
+        self.assertEqual(index.lookup("11.0.0.1"), None)
+
+        self.assertEqual(index.overlapping("10.1.2.128/25")[1], "big")
+        self.assertEqual(index.overlapping("192.168.0.0/16")[1], "other")
+        self.assertEqual(index.overlapping("192.168.1.0/24"), None)
+
+        self.assertTrue(index.remove("10.1.0.0/16"))
+        self.assertFalse(index.remove("10.1.0.0/16"))
+        self.assertFalse(index.remove("172.16.0.0/12"))
+        self.assertEqual(index.lookup("10.1.3.1")[1], "big")
+        self.assertEqual(index.lookup("10.1.2.8")[1], "small")
+        index.remove("10.0.0.0/8")
+        self.assertEqual(index.lookup("10.1.3.1"), None)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(len(index.items()), 4)
+
+    def test_random(self):
+        # Compare against checking every network
+        rng = random.Random(4)
+        networks = set()
+        index = PrefixIndex()
+        for _ in range(500):
+            prefixlen = rng.randint(8, 30)
+            network = ipaddress.ip_network((rng.getrandbits(32) >> (32 - prefixlen) << (32 - prefixlen), prefixlen))
+            networks.add(network)
+            index.add(network, str(network))
+        for network in list(networks)[:100]:
+            networks.discard(network)
+            index.remove(network)
+
+        for _ in range(2000):
+            ip = ipaddress.ip_address(rng.getrandbits(32))
+            matching = [network for network in networks if ip in network]
+            found = index.lookup(ip)
+            if len(matching) == 0:
+                self.assertEqual(found, None)
+            else:
+                self.assertEqual(found[0], max(matching, key=lambda network: network.prefixlen))
+
+    def test_free_block(self):
+        index = PrefixIndex()
+        self.assertEqual(index.free_block("10.0.0.0/8", 24), ipaddress.ip_network("10.0.0.0/24"))
+        index.add("10.0.0.0/24", "first")
+        index.add("10.0.1.0/28", "org")
+        index.add("10.0.1.32/27", "org")
+        self.assertEqual(index.free_block("10.0.0.0/8", 28), ipaddress.ip_network("10.0.1.16/28"))
+        self.assertEqual(index.free_block("10.0.0.0/8", 27), ipaddress.ip_network("10.0.1.64/27"))
+        self.assertEqual(index.free_block("10.0.0.0/8", 24), ipaddress.ip_network("10.0.2.0/24"))
+        self.assertEqual(index.free_block("10.0.0.0/24", 28), None)
+        self.assertEqual(index.free_block("10.0.0.0/25", 26), None)
+        self.assertEqual(index.free_block("10.0.0.0/8", 7), None)
+        self.assertEqual(index.free_block("192.168.0.0/16", 24), ipaddress.ip_network("192.168.0.0/24"))
+
+        self.assertEqual(index.containing("10.0.0.128/25")[0], ipaddress.ip_network("10.0.0.0/24"))
+        self.assertEqual(index.containing("10.0.1.32/27")[0], ipaddress.ip_network("10.0.1.32/27"))
+        self.assertEqual(index.containing("10.0.1.0/24"), None)
+
+    def test_random_free_block(self):
+        # Compare against trying every block in turn
+        rng = random.Random(5)
+        supernet = ipaddress.ip_network("10.20.0.0/20")
+        networks = set()
+        index = PrefixIndex()
+        for round_number in range(300):
+            if len(networks) > 0 and rng.random() < 0.3:
+                network = rng.choice(sorted(networks))
+                networks.discard(network)
+                index.remove(network)
+            else:
+                prefixlen = rng.randint(22, 30)
+                network = ipaddress.ip_network((int(supernet.network_address) + rng.randrange(supernet.num_addresses), prefixlen), strict=False)
+                if not any([network.overlaps(other) for other in networks]):
+                    networks.add(network)
+                    index.add(network, str(network))
+
+            prefixlen = rng.randint(20, 30)
+            expected = None
+            for block in supernet.subnets(new_prefix=prefixlen):
+                if not any([block.overlaps(other) for other in networks]):
+                    expected = block
+                    break
+            self.assertEqual(index.free_block(supernet, prefixlen), expected, msg="round {}".format(round_number))
+
+class TestNetworkIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient())
+        self.netreserve = NetReservation(self.mm)
+        self.mm.modules['netreserve'] = LockModule(self.netreserve, self.mm)
+        self.mm.modules['ipreserve'] = LockModule(IPReservation(self.mm), self.mm)
+        self.netreserve.check()
+        self.mm['ipreserve'].check()
+
+    def test_lookups(self):
+        error, net_id = self.mm['netreserve'].run("add_network", net_addr="172.16.4.0/24", description="test", switch="")
+        self.assertTrue(error is None, msg=error)
+        error, _ = self.mm['netreserve'].run("add_network", net_addr="172.16.4.128/25", description="test", switch="")
+        self.assertEqual(error, "172.16.4.128/25 network is already part of network 172.16.4.0/24")
+
+        error, network = self.mm['netreserve'].run("get_ip_network", ip_addr="172.16.4.9")
+        self.assertEqual(network, ipaddress.ip_network("172.16.4.0/24"))
+        error, info = self.mm['netreserve'].run("get_ip_network_info", ip_addr="172.16.4.9")
+        self.assertEqual(info, {"net_id": net_id, "net_address": "172.16.4.0/24", "net_desc": "test", "switch": "", "is_hop": False})
+        error, _ = self.mm['netreserve'].run("get_ip_switch", ip_addr="172.16.5.9")
+        self.assertEqual(error, "Could not find network")
+
+        error, result = self.mm['ipreserve'].run("add_ip", ip_addr="172.16.4.9", description="test")
+        self.assertEqual(result, (net_id, "172.16.4.9"))
+        error, _ = self.mm['ipreserve'].run("add_ip", ip_addr="172.16.5.9", description="test")
+        self.assertEqual(error, "IP not in any allocated networks")
+
+        # Rows written outside the module are seen once the index is dropped
+        dbc = self.db.cursor()
+        dbc.execute('INSERT INTO networks (net_address, net_desc, switch_name, is_hop_network) VALUES (?, ?, ?, ?)', ("172.16.5.0/24", "hop", "hop1", 1))
+        self.db.commit()
+        self.netreserve._invalidate_index()
+        error, info = self.mm['netreserve'].run("get_ip_network_info", ip_addr="172.16.5.9")
+        self.assertEqual((info['switch'], info['is_hop']), ("hop1", True))
+
+        error, _ = self.mm['netreserve'].run("remove_network", id=net_id)
+        self.assertTrue(error is None, msg=error)
+        error, _ = self.mm['ipreserve'].run("add_ip", ip_addr="172.16.4.10", description="test")
+        self.assertEqual(error, "IP not in any allocated networks")
+
+    def test_allocate_subnet(self):
+        error, _ = self.mm['netreserve'].run("add_network", net_addr="172.16.0.0/28", description="taken", switch="")
+        self.assertTrue(error is None, msg=error)
+
+        error, result = self.mm['netreserve'].run("allocate_subnet", supernet="172.16.0.0/26", prefixlen=28, description="org", switch="")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['net_address'], "172.16.0.16/28")
+        error, info = self.mm['netreserve'].run("get_ip_network_info", ip_addr="172.16.0.17")
+        self.assertEqual(info['net_id'], result['net_id'])
+
+        error, result = self.mm['netreserve'].run("allocate_subnet", supernet="172.16.0.0/26", prefixlen=27, description="org", switch="")
+        self.assertEqual(result['net_address'], "172.16.0.32/27")
+        error, _ = self.mm['netreserve'].run("allocate_subnet", supernet="172.16.0.0/26", prefixlen=28, description="org", switch="")
+        self.assertEqual(error, "No free /28 left in 172.16.0.0/26")
+        error, _ = self.mm['netreserve'].run("allocate_subnet", supernet="172.16.0.0/26", prefixlen=24, description="org", switch="")
+        self.assertEqual(error, "Prefix length must be between 26 and 32")
+
+        error, _ = self.mm['netreserve'].run("remove_network", id=1)
+        error, result = self.mm['netreserve'].run("allocate_subnet", supernet="172.16.0.0/26", prefixlen=29, description="org", switch="")
+        self.assertEqual(result['net_address'], "172.16.0.0/29")
+
+    def test_many_subnets(self):
+        supernet = ipaddress.ip_network("10.64.0.0/12")
+        error, result = self.mm['netreserve'].run("allocate_subnet", supernet=str(supernet), prefixlen=28, description="org 0", switch="")
+        self.assertTrue(error is None, msg=error)
+        index = self.netreserve._prefix_index
+
+        # Each add updates the index in place rather than rebuilding it
+        for i in range(1, 400):
+            error, result = self.mm['netreserve'].run("allocate_subnet", supernet=str(supernet), prefixlen=28, description="org {}".format(i), switch="")
+            self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['net_address'], "10.64.24.240/28")
+        self.assertTrue(self.netreserve._prefix_index is index)
+        self.assertEqual(index.free_block(supernet, 28), ipaddress.ip_network("10.64.25.0/28"))
+
+    # Adds count /24 networks straight to the database
+    def add_many_networks(self, count):
+        dbc = self.db.cursor()
+        networks = []
+        for i in range(count):
+            net_address = "10.{}.{}.0/24".format(i // 256, i % 256)
+            networks.append((net_address, "net {}".format(i), "sw{}".format(i), i % 2))
+        dbc.executemany('INSERT INTO networks (net_address, net_desc, switch_name, is_hop_network) VALUES (?, ?, ?, ?)', networks)
+        self.db.commit()
+
+    def test_many_networks(self):
+        self.add_many_networks(1000)
+        self.netreserve._network_index()
+
+        # Once built, a lookup only checks the generation
+        queries = []
+        self.db.set_trace_callback(queries.append)
+        rng = random.Random(1)
+        for i in [rng.randrange(1000) for _ in range(200)]:
+            error, switch = self.mm['netreserve'].run("get_ip_switch", ip_addr="10.{}.{}.{}".format(i // 256, i % 256, rng.randint(1, 254)))
+            self.assertEqual(switch, "sw{}".format(i))
+        self.db.set_trace_callback(None)
+        self.assertEqual(len(queries), 200)
+        self.assertTrue(all([query.startswith("SELECT generation") for query in queries]))
+
+    @benchmark
+    def test_benchmark_add(self):
+        subnet_count = 4000
+        supernet = ipaddress.ip_network("10.64.0.0/12")
+
+        # The old way: parse and compare against every network on each add,
+        # timed for fewer networks as it grows with the square
+        existing = []
+        start = time.perf_counter()
+        for block in list(supernet.subnets(new_prefix=28))[:300]:
+            new_network_obj = ipaddress.ip_network(str(block))
+            for network in existing:
+                if new_network_obj.overlaps(ipaddress.ip_network(network)):
+                    break
+            existing.append(str(block))
+        scan_cost = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(subnet_count):
+            error, result = self.mm['netreserve'].run("allocate_subnet", supernet=str(supernet), prefixlen=28, description="org {}".format(i), switch="")
+            self.assertTrue(error is None, msg=error)
+        allocate_cost = time.perf_counter() - start
+        self.assertEqual(result['net_address'], "10.64.249.240/28")
+
+        index = self.netreserve._network_index()
+        start = time.perf_counter()
+        for i in range(subnet_count):
+            self.assertTrue(index.free_block(supernet, 28) is not None)
+        free_cost = (time.perf_counter() - start) / subnet_count
+
+        report("adding /28s", "scanning 300 networks {:.0f}ms, allocate_subnet {} networks {:.0f}ms, free block lookup {:.2f}us".format(
+            scan_cost * 1000, subnet_count, allocate_cost * 1000, free_cost * 1000000))
+
+    @benchmark
+    def test_benchmark(self):
+        network_count = 10000
+        lookup_count = 100000
+        self.add_many_networks(network_count)
+        dbc = self.db.cursor()
+
+        rng = random.Random(1)
+        ips = ["10.{}.{}.{}".format(i // 256, i % 256, rng.randint(1, 254)) for i in [rng.randrange(network_count) for _ in range(lookup_count)]]
+
+        # The old way: scan every network for each IP, so only a sample is timed
+        sample = ips[:20]
+        start = time.perf_counter()
+        for ip in sample:
+            dbc.execute("SELECT * FROM networks")
+            for network in dbc.fetchall():
+                if validate.is_ip_in_network(ip, network[1]):
+                    break
+        scan_cost = (time.perf_counter() - start) / len(sample)
+
+        start = time.perf_counter()
+        index = self.netreserve._network_index()
+        build_cost = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for ip in ips:
+            self.assertTrue(index.lookup(ip) is not None)
+        index_cost = (time.perf_counter() - start) / lookup_count
+
+        start = time.perf_counter()
+        for ip in ips[:10000]:
+            error, switch = self.mm['netreserve'].run("get_ip_switch", ip_addr=ip)
+        module_cost = (time.perf_counter() - start) / 10000
+        self.assertTrue(error is None, msg=error)
+
+        report("network lookup", "{} networks: scan {:.2f}ms per IP, index built in {:.0f}ms, {:.2f}us per lookup ({} lookups), get_ip_switch {:.2f}us".format(
+            network_count, scan_cost * 1000, build_cost * 1000, index_cost * 1000000, lookup_count, module_cost * 1000000))
+        self.assertTrue(index_cost * 100 < scan_cost)
+
+    def tearDown(self):
+        self.mm.jobs.shutdown()
+        self.db.close()
+
+# The server runs calls on several threads, each with its own connection
+class TestNetworkIndexThreads(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.base_dir, "fakernet.db")
+        self.db = ThreadLocalConnection(self.path)
+        self.mm = ModuleManager(db=self.db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient())
+        self.netreserve = NetReservation(self.mm)
+        self.mm.modules['netreserve'] = LockModule(self.netreserve, self.mm)
+        self.netreserve.check()
+        self.workers = [ThreadPoolExecutor(max_workers=1), ThreadPoolExecutor(max_workers=1)]
+
+    def lookup(self, worker, ip_addr):
+        return self.workers[worker].submit(self.mm['netreserve'].run, "get_ip_network_info", ip_addr=ip_addr).result()
+
+    def test_threads(self):
+        error, _ = self.workers[0].submit(self.mm['netreserve'].run, "add_network", net_addr="10.8.0.0/24", description="test", switch="").result()
+        self.assertTrue(error is None, msg=error)
+        self.lookup(0, "10.8.0.5")
+        index = self.netreserve._prefix_index
+
+        # A commit to another table doesn't make the index look out of date
+        self.workers[1].submit(lambda: (self.db.cursor().execute("CREATE TABLE other (name TEXT)"), self.db.commit())).result()
+        for i in range(100):
+            error, info = self.lookup(i % 2, "10.8.0.5")
+            self.assertEqual(info['net_address'], "10.8.0.0/24")
+        self.assertTrue(self.netreserve._prefix_index is index)
+
+        # A network added by another process is seen from every thread
+        other_db = ThreadLocalConnection(self.path)
+        other_mm = ModuleManager(db=other_db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient())
+        other = NetReservation(other_mm)
+        error, _ = other.run("add_network", net_addr="10.9.0.0/24", description="other", switch="")
+        self.assertTrue(error is None, msg=error)
+        for worker in range(2):
+            error, info = self.lookup(worker, "10.9.0.5")
+            self.assertTrue(error is None, msg=error)
+            self.assertEqual(info['net_address'], "10.9.0.0/24")
+        other_mm.jobs.shutdown()
+        other_db.close()
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.shutdown()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        shutil.rmtree(self.base_dir)
@@ -0,0 +1,220 @@
+import unittest
+import os
+import sys
+import time
+import shutil
+import select
+import sqlite3
+import tempfile
+import subprocess
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient, FakePrivilegedHelper
+from benchmark import benchmark, report
+
+from modules.network_reservation import NetReservation
+import modules.iptables
+from modules.iptables import Iptables
+from lib.module_manager import ModuleManager, LockModule
+from lib.priv_helper import PrivilegedHelper, PrivilegedClient
+
+class ListLogger():
+
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+class TestPrivilegedHelper(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.base_dir, "run", "helper.sock")
+        # Harmless commands in place of the real tools
+        self.tools = {"iptables": "/bin/echo", "ip": "/bin/false"}
+        self.helper = PrivilegedHelper(self.path, allowed_uids=[os.getuid()], tools=self.tools)
+        self.helper.start()
+        self.client = PrivilegedClient(self.path)
+
+    def test_run(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        error, output = self.client.run("iptables", ["-L", "with space"])
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(output, "-L with space\n")
+
+        error, results = self.client.run_batch([("iptables", ["a"]), ("ip", ["link"]), ("iptables", ["b"])])
+        self.assertEqual(error, "'ip link' failed: exit code 1")
+        self.assertEqual(len(results), 2)
+        error, results = self.client.run_batch([("iptables", ["a"]), ("ip", ["link"]), ("iptables", ["b"])], stop_on_error=False)
+        self.assertEqual([result['code'] for result in results], [0, 1, 0])
+
+        error, _ = self.client.run("ovs-vsctl", ["show"])
+        self.assertEqual(error, "'ovs-vsctl show' failed: Tool ovs-vsctl is not allowed")
+        error, _ = self.client.run("sh", ["-c", "id"])
+        self.assertEqual(error, "'sh -c id' failed: Tool sh is not allowed")
+
+        # Every request went over one connection
+        self.assertEqual(len(self.client._idle), 1)
+        self.assertEqual(self.helper.requests, 5)
+
+    def test_refused(self):
+        self.helper.stop()
+        logger = ListLogger()
+        self.helper = PrivilegedHelper(self.path, allowed_uids=[os.getuid() + 1], tools=self.tools, logger=logger)
+        self.helper.start()
+        refusal = "User {} is not allowed to use the helper".format(os.getuid())
+
+        # The request may go out before or after the helper has answered
+        for _ in range(10):
+            error, _ = self.client.run("iptables", ["-L"])
+            self.assertEqual(error, refusal)
+
+        # Always after: the connection is left until the helper has closed it,
+        # so sending the request fails
+        for _ in range(10):
+            self.assertTrue(self.client.ensure_connected() is None)
+            poller = select.poll()
+            poller.register(self.client._idle[-1][0], select.POLLRDHUP)
+            self.assertTrue(len(poller.poll(5000)) > 0)
+            error, _ = self.client.run("iptables", ["-L"])
+            self.assertEqual(error, refusal)
+
+        # One connection each time, with nothing tried again or run with sudo
+        self.assertEqual(len(logger.messages), 20)
+        self.assertEqual(self.helper.requests, 0)
+        self.assertEqual(self.client._idle, [])
+
+    def test_restart(self):
+        self.client.run("iptables", ["-L"])
+        self.helper.stop()
+        self.helper = PrivilegedHelper(self.path, allowed_uids=[os.getuid()], tools=self.tools)
+        self.helper.start()
+        # The old connection is gone, so the request goes on a new one
+        error, output = self.client.run("iptables", ["again"])
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(output, "again\n")
+
+    def test_fallback(self):
+        client = PrivilegedClient(os.path.join(self.base_dir, "missing.sock"))
+        self.assertTrue(client.ensure_connected() is not None)
+        # Without the helper, sudo is run instead, which either fails to run
+        # here or fails without a password
+        error, _ = client.run("ip", ["link", "set", "nothing-here", "up"])
+        self.assertTrue(error.startswith("'ip link set nothing-here up' failed: "))
+        self.assertEqual(self.helper.requests, 0)
+
+    def test_requests(self):
+        fake = FakePrivilegedHelper(os.path.join(self.base_dir, "fake.sock"))
+        client = PrivilegedClient(os.path.join(self.base_dir, "fake.sock"))
+
+        # One connection serves every request, and a batch is one request
+        for _ in range(100):
+            error, _ = client.run("ip", ["link", "set", "br1", "up"])
+            self.assertTrue(error is None, msg=error)
+        error, _ = client.run_batch([("iptables", ["-I", "FORWARD", "1", "-j", "ACCEPT"])] * 100)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(len(fake.commands), 200)
+        self.assertEqual(fake.requests, 101)
+        client.close()
+        fake.stop()
+
+    @benchmark
+    def test_benchmark(self):
+        fake = FakePrivilegedHelper(os.path.join(self.base_dir, "fake.sock"))
+        client = PrivilegedClient(os.path.join(self.base_dir, "fake.sock"))
+        client.run("ip", ["link"])
+
+        rounds = 1000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            error, _ = client.run("ip", ["link", "set", "br1", "up"])
+        helper_cost = (time.perf_counter() - start) / rounds
+        self.assertTrue(error is None, msg=error)
+
+        start = time.perf_counter()
+        error, _ = client.run_batch([("iptables", ["-I", "FORWARD", "1", "-j", "ACCEPT"])] * 100)
+        batch_cost = time.perf_counter() - start
+        self.assertTrue(error is None, msg=error)
+
+        # The least sudo could cost, before it runs PAM and then the tool
+        start = time.perf_counter()
+        for _ in range(20):
+            subprocess.run(["/bin/true"])
+        spawn_cost = (time.perf_counter() - start) / 20
+
+        report("privileged helper", "{:.0f}us a request, 100 operations in one request {:.2f}ms; spawning a process {:.2f}ms".format(
+            helper_cost * 1000000, batch_cost * 1000, spawn_cost * 1000))
+        self.assertTrue(helper_cost < spawn_cost)
+        client.close()
+        fake.stop()
+
+    def tearDown(self):
+        self.client.close()
+        self.helper.stop()
+        shutil.rmtree(self.base_dir)
+
+class TestModulesWithHelper(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.fake = FakePrivilegedHelper(os.path.join(self.base_dir, "helper.sock"))
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient())
+        self.mm.privileged = PrivilegedClient(os.path.join(self.base_dir, "helper.sock"))
+        # OVS goes through ovs-vsctl here
+        self.mm.ovsdb = None
+        self.mm.modules['netreserve'] = LockModule(NetReservation(self.mm), self.mm)
+        self.mm['netreserve'].check()
+
+    def test_netreserve(self):
+        self.fake.set_result(["ovs-vsctl", "br-exists"], 2)
+        error, _ = self.mm['netreserve'].run("add_network", net_addr="172.16.8.0/24", description="test", switch="test1")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.fake.commands, [
+            ["ovs-vsctl", "br-exists", "test1"],
+            ["ovs-vsctl", "add-br", "test1"],
+            ["ip", "addr", "show", "dev", "test1"],
+            ["ip", "link", "set", "test1", "up"],
+            ["ip", "addr", "add", "172.16.8.1/24", "dev", "test1"]
+        ])
+        # Setting the switch up and its address was one request
+        self.assertEqual(self.fake.requests, 4)
+
+        self.fake.set_result(["ip", "link", "set", "hop1"], 1, error="Cannot find device")
+        error, _ = self.mm['netreserve'].run("add_hop_network", net_addr="172.16.9.0/24", description="hop", switch="hop1")
+        self.assertEqual(error, "Failed to set hop switch to up")
+
+    def test_iptables(self):
+        self.storage_existed = os.path.exists(modules.iptables.STORAGE_DIR)
+        iptables = Iptables(self.mm)
+        self.mm.modules['iptables'] = LockModule(iptables, self.mm)
+        self.mm['iptables'].check()
+
+        for i in range(5):
+            error, _ = self.mm['iptables'].run("add_raw", cmd="-s 10.0.0.{} -j ACCEPT".format(i), chain="FORWARD")
+            self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.fake.commands[-1], ["iptables", "-I", "FORWARD", "1", "-s", "10.0.0.4", "-j", "ACCEPT", "-m", "comment", "--comment", "FakerNet Iptables rule 5"])
+
+        self.fake.set_result(["iptables", "-I"], 1, error="iptables: No chain/target/match by that name.")
+        error, _ = self.mm['iptables'].run("add_raw", cmd="-j NOPE", chain="FORWARD")
+        self.assertEqual(error, "Command failed: iptables -I FORWARD 1 -j NOPE -m comment --comment FakerNet Iptables rule 6")
+
+        # Every rule is put back in one request on start, past the ones that fail
+        before = self.fake.requests
+        self.fake.commands = []
+        iptables.check()
+        self.assertEqual(self.fake.requests, before + 1)
+        self.assertEqual(len(self.fake.commands), 12)
+        self.assertEqual(self.fake.commands[0][:3], ["iptables", "-D", "FORWARD"])
+
+    def tearDown(self):
+        if hasattr(self, "storage_existed") and not self.storage_existed:
+            shutil.rmtree(modules.iptables.STORAGE_DIR, ignore_errors=True)
+        self.mm.privileged.close()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        self.fake.stop()
+        shutil.rmtree(self.base_dir)
@@ -0,0 +1,136 @@
+import unittest
+import os
+import sys
+import socket
+import sqlite3
+import threading
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+
+from lib.module_manager import ModuleManager
+from lib.base_module import wait_for, port_open, DockerBaseModule, LXDBaseModule
+
+# A clock that only moves when sleep is called
+class FakeClock():
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class ProbeModule(DockerBaseModule, LXDBaseModule):
+    __SHORTNAME__ = "probe"
+
+    def __init__(self, mm):
+        self.mm = mm
+
+# Fails a command until it has been run a number of times
+class ReadyAfter():
+
+    def __init__(self, attempts):
+        self.attempts = attempts
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+        return self.calls >= self.attempts
+
+class TestReadiness(unittest.TestCase):
+
+    def setUp(self):
+        self.docker = FakeDockerClient()
+        self.lxd = FakeLXDClient()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=self.lxd)
+        self.module = ProbeModule(self.mm)
+
+    def test_backoff(self):
+        fake = FakeClock()
+        ready = ReadyAfter(5)
+        error, attempts = wait_for(ready, timeout=30, initial_delay=0.1, max_delay=0.5, clock=fake.clock, sleep=fake.sleep)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(attempts, 5)
+        self.assertEqual(fake.sleeps, [0.1, 0.2, 0.4, 0.5])
+
+    def test_timeout(self):
+        fake = FakeClock()
+
+        def broken():
+            raise RuntimeError("agent not answering")
+
+        error, _ = wait_for(broken, timeout=3, initial_delay=1, max_delay=10, clock=fake.clock, sleep=fake.sleep)
+        self.assertTrue("agent not answering" in error)
+        # Never sleeps past the deadline
+        self.assertEqual(fake.sleeps, [1, 2])
+        self.assertEqual(fake.now, 3)
+
+        error, _ = wait_for(lambda: False, timeout=1, clock=fake.clock, sleep=fake.sleep)
+        self.assertEqual(error, "Timed out after 1 seconds")
+
+    def test_port_open(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        self.assertFalse(port_open("127.0.0.1", port))
+
+        # Start listening a little later, the probe should pick it up
+        timer = threading.Timer(0.2, listener.listen)
+        timer.start()
+        try:
+            error, _ = self.module.wait_for_port("127.0.0.1", port, timeout=5)
+            self.assertTrue(error is None, msg=error)
+            self.assertTrue(port_open("127.0.0.1", port))
+        finally:
+            timer.join()
+            listener.close()
+
+    def test_docker_exec_probe(self):
+        self.docker.containers.add("dns-server-1", "running")
+        ready = ReadyAfter(3)
+        self.docker.exec_result = lambda name, cmd: (0 if ready() else 1, b"")
+
+        error, _ = self.module.docker_wait_exec("dns-server-1", "rndc status", timeout=5)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(ready.calls, 3)
+
+        error, _ = self.module.docker_wait_running("missing", timeout=0.3)
+        self.assertTrue(error.startswith("Waiting for missing to run"))
+
+    def test_rndc_reload(self):
+        from modules.dns_server import DNSServer
+
+        container = self.docker.containers.add("dns-server-1", "running")
+        dns = DNSServer(self.mm)
+        error, _ = dns._rndc_reload(1)
+        self.assertTrue(error is None, msg=error)
+        # named answered straight away, so it was only asked once
+        self.assertEqual(container.exec_log, ["rndc status", "rndc reload"])
+
+    def test_lxd_probes(self):
+        container = self.lxd.containers.add("nethop-1", "Stopped")
+        threading.Timer(0.2, container.start).start()
+
+        error, _ = self.module.lxd_wait_ready("nethop-1", timeout=5)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(container.exec_log[-1], ["/bin/sh", "-c", "ip link show eth0"])
+
+        self.lxd.execute_result = lambda name, command: (1, "", "")
+        error, _ = self.module.lxd_wait_ready("nethop-1", timeout=0.3)
+        self.assertTrue(error is not None)
+
+        self.module.lxd_delete("nethop-1")
+        error, _ = self.module.lxd_wait_deleted("nethop-1", timeout=1)
+        self.assertTrue(error is None, msg=error)
+
+    def tearDown(self):
+        self.mm.jobs.shutdown()
+        self.db.close()
@@ -0,0 +1,221 @@
+import unittest
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import shutil
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+import modules.dns_server
+from modules.dns_server import DNSServer
+from lib.module_manager import ModuleManager, LockModule
+from lib.record_store import RecordStore, reversed_name
+import lib.easyzone as easyzone
+
+ZONE_FILE = """test. 604800 IN SOA test. root.test. 2019071600 604800 86400 2419200 604800
+test. 604800 IN NS ns1.test.
+ns1.test. 604800 IN A 172.16.3.2
+WWW.test. 300 IN A 172.16.3.5
+mail.test. 604800 IN MX 10 www.test.
+"""
+
+class TestRecordStore(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.old_base_dir = modules.dns_server.DNS_BASE_DIR
+        modules.dns_server.DNS_BASE_DIR = self.base_dir
+
+        self.docker = FakeDockerClient()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.dns = DNSServer(self.mm)
+        self.mm.modules['dns'] = LockModule(self.dns, self.mm)
+
+        dbc = self.db.cursor()
+        dbc.execute("CREATE TABLE dns_server (server_id INTEGER PRIMARY KEY, server_ip TEXT, server_desc TEXT, server_domain TEXT);")
+        dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', ("172.16.3.2", "test", "test"))
+        self.db.commit()
+
+        self.server_dir = os.path.join(self.base_dir, "1")
+        os.mkdir(self.server_dir)
+        os.mkdir(os.path.join(self.server_dir, "conf"))
+        os.mkdir(os.path.join(self.server_dir, "zones"))
+        open(os.path.join(self.server_dir, "named.conf"), "w").close()
+        self.container = self.docker.containers.add("dns-server-1", "running")
+
+    def read_zone(self, zone, direction):
+        self.dns.zones.flush()
+        return easyzone.zone_from_file(zone, os.path.join(self.server_dir, "zones", "{}.{}".format(zone, direction)))
+
+    def test_reversed_name(self):
+        self.assertEqual(reversed_name("WWW.Test."), "test.www.")
+        self.assertEqual(reversed_name("test"), "test.")
+
+    def test_migration(self):
+        # Zone files from before the table existed are imported on first use
+        zone_file = open(os.path.join(self.server_dir, "zones", "test.fwd"), "w")
+        zone_file.write(ZONE_FILE)
+        zone_file.close()
+
+        error, result = self.mm['dns'].run("find_records", fqdn="test", type="", value="")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['rows'], [
+            (1, "test", "test.", "NS", "ns1.test."),
+            (1, "test", "mail.test.", "MX", "10 www.test."),
+            (1, "test", "ns1.test.", "A", "172.16.3.2"),
+            (1, "test", "www.test.", "A", "172.16.3.5"),
+        ])
+        self.assertEqual(self.dns._record_store().zone_records(1, "test", "fwd")[-1], ("www.test.", "A", "172.16.3.5", 300))
+
+        # Only done once
+        self.assertFalse(RecordStore(self.db).ensure_schema())
+
+    def test_queries(self):
+        error, _ = self.dns._add_zone(1, "test", "fwd")
+        self.assertTrue(error is None, msg=error)
+        for i in range(2, 7):
+            error, _ = self.mm['dns'].run("add_host", fqdn="host{}.test".format(i), ip_addr="172.16.3.{}".format(i + 10))
+            self.assertTrue(error is None, msg=error)
+        error, _ = self.mm['dns'].run("add_host", fqdn="other.test", ip_addr="10.0.0.5")
+        self.assertTrue(error is None, msg=error)
+        error, _ = self.mm['dns'].run("add_host", fqdn="www.test", ip_addr="172.16.3.15")
+        self.assertTrue(error is None, msg=error)
+
+        error, result = self.mm['dns'].run("find_records", fqdn="", type="", value="172.16.3.15")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual([row[2] for row in result['rows']], ["host5.test.", "www.test."])
+
+        error, result = self.mm['dns'].run("find_records", fqdn="10.in-addr.arpa", type="PTR", value="")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(result['rows'], [(1, "0.0.10.in-addr.arpa", "5.0.0.10.in-addr.arpa.", "PTR", "other.test.")])
+
+        # Names are matched by whole labels
+        error, result = self.mm['dns'].run("find_records", fqdn="3.16.172.in-addr.arpa", type="PTR", value="www.test")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual([row[2] for row in result['rows']], ["15.3.16.172.in-addr.arpa."])
+        error, result = self.mm['dns'].run("find_records", fqdn="6.172.in-addr.arpa", type="", value="")
+        self.assertEqual(result['rows'], [])
+
+    def test_consistency(self):
+        error, _ = self.dns._add_zone(1, "test", "fwd")
+        self.assertTrue(error is None, msg=error)
+        error, _ = self.mm['dns'].run("add_record", id=1, zone="test", direction="fwd", type="A", name="www", value="172.16.3.5")
+        self.assertTrue(error is None, msg=error)
+        error, _ = self.mm['dns'].run("add_record", id=1, zone="test", direction="fwd", type="TXT", name="www", value="hello there")
+        self.assertTrue(error is None, msg=error)
+        error, _ = self.mm['dns'].run("add_record", id=1, zone="test", direction="fwd", type="A", name="bad", value="not-an-ip")
+        self.assertTrue(error.startswith("Invalid record"))
+
+        store = self.dns._record_store()
+        zone_file = self.read_zone("test", "fwd")
+        self.assertEqual(sorted([(name, record_type, value) for name, record_type, _, value in zone_file.iter_records()]),
+            sorted([(name, record_type, value) for name, record_type, value, _ in store.zone_records(1, "test", "fwd")]))
+
+        error, _ = self.mm['dns'].run("remove_record", id=1, zone="test", direction="fwd", type="A", name="www.test", value="172.16.3.6")
+        self.assertEqual(error, "Value '172.16.3.6' not in records")
+        error, _ = self.mm['dns'].run("remove_record", id=1, zone="test", direction="fwd", type="A", name="nope.test", value="172.16.3.6")
+        self.assertEqual(error, "nope.test. not in zone test")
+
+        error, _ = self.mm['dns'].run("remove_record", id=1, zone="test", direction="fwd", type="A", name="www.test", value="172.16.3.5")
+        self.assertTrue(error is None, msg=error)
+        self.assertFalse(store.has_record(1, "test", "www.test.", "A", "172.16.3.5"))
+        self.assertTrue(store.has_record(1, "test", "www.test.", "TXT", '"hello there"'))
+        self.assertEqual(self.read_zone("test", "fwd").get_name("www.test.").records("A"), None)
+
+    def test_render(self):
+        error, _ = self.dns._add_zone(1, "test", "fwd")
+        self.assertTrue(error is None, msg=error)
+        error, result = self.mm['dns'].run("bulk_add_records", records=[
+            {"fqdn": "www.test", "type": "A", "value": "172.16.3.5"},
+            {"fqdn": "172.16.3.5", "type": "PTR", "value": "www.test"},
+        ])
+        self.assertTrue(error is None, msg=error)
+        self.dns.reloads.flush()
+
+        # Lose the zone files, then write them again from the database
+        shutil.rmtree(os.path.join(self.server_dir, "zones"))
+        os.mkdir(os.path.join(self.server_dir, "zones"))
+        self.dns.zones.discard(("1",))
+        open(os.path.join(self.server_dir, "named.conf"), "w").close()
+        self.container.exec_log = []
+
+        error, count = self.mm['dns'].run("render_zones", id=1)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(count, 2)
+        self.assertEqual(self.container.exec_log, ["rndc status", "rndc reload"])
+
+        self.assertEqual(self.read_zone("test", "fwd").get_name("www.test.").records("A").items[0].to_text(), "172.16.3.5")
+        self.assertEqual(self.read_zone("3.16.172.in-addr.arpa", "rev").get_name("5.3.16.172.in-addr.arpa.").records("PTR").items[0].to_text(), "www.test.")
+        includes = ""
+        for filename in os.listdir(os.path.join(self.server_dir, "conf")):
+            if filename.startswith("includes-"):
+                includes += open(os.path.join(self.server_dir, "conf", filename), "r").read()
+        self.assertTrue('include "/etc/bind/conf/3.16.172.in-addr.arpa.conf";' in includes)
+        self.assertTrue(os.path.exists(os.path.join(self.server_dir, "conf", "test.conf")))
+
+        error, _ = self.mm['dns'].run("set_update_engine", id=1, engine="dynamic")
+        self.assertTrue(error is None, msg=error)
+        error, _ = self.mm['dns'].run("render_zones", id=1)
+        self.assertTrue(error is not None)
+
+    def add_many_records(self, count):
+        error, _ = self.dns._add_zone(1, "test", "fwd")
+        self.assertTrue(error is None, msg=error)
+        records = []
+        for i in range(count):
+            records.append({"fqdn": "host{}.test".format(i), "type": "A", "value": "10.{}.{}.{}".format(i >> 16, (i >> 8) & 255, i & 255)})
+        error, result = self.mm['dns'].run("bulk_add_records", records=records)
+        self.assertTrue(error is None, msg=error)
+        self.dns.zones.flush()
+
+    def test_find_by_value(self):
+        self.add_many_records(1000)
+
+        queries = []
+        self.db.set_trace_callback(queries.append)
+        error, result = self.mm['dns'].run("find_records", fqdn="", type="A", value="10.0.3.231")
+        self.db.set_trace_callback(None)
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual([row[2] for row in result['rows']], ["host999.test."])
+
+        # One query, looked up by the value index rather than a scan
+        selects = [query for query in queries if query.startswith("SELECT")]
+        self.assertEqual(len(selects), 1)
+        plan = " ".join(str(row[-1]) for row in self.db.execute("EXPLAIN QUERY PLAN " + selects[0]).fetchall())
+        self.assertTrue("dns_record_value" in plan, msg=plan)
+
+    @benchmark
+    def test_benchmark(self):
+        record_count = 10000
+        self.add_many_records(record_count)
+
+        # Without the table, finding a value means parsing the zone files
+        start = time.perf_counter()
+        zone_file = easyzone.zone_from_file("test", os.path.join(self.server_dir, "zones", "test.fwd"))
+        found = [name for name, _, _, value in zone_file.iter_records() if value == "10.0.39.15"]
+        scan_cost = time.perf_counter() - start
+        self.assertEqual(found, ["host9999.test."])
+
+        start = time.perf_counter()
+        error, result = self.mm['dns'].run("find_records", fqdn="", type="A", value="10.0.39.15")
+        query_cost = time.perf_counter() - start
+        self.assertEqual([row[2] for row in result['rows']], ["host9999.test."])
+
+        report("find by value", "{} records: zone file {:.1f}ms, database {:.2f}ms".format(record_count, scan_cost * 1000, query_cost * 1000))
+        self.assertTrue(query_cost * 10 < scan_cost)
+
+    def tearDown(self):
+        self.dns.reloads.flush()
+        self.dns.syncs.flush()
+        self.dns.zones.flush()
+        self.mm.jobs.shutdown()
+        self.db.close()
+        modules.dns_server.DNS_BASE_DIR = self.old_base_dir
+        shutil.rmtree(self.base_dir)
@@ -0,0 +1,121 @@
+import unittest
+import os
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from benchmark import benchmark, report
+
+from lib.module_manager import ModuleManager, RemoteModule
+
+CALLS = 100
+
+# A stand-in FakerNet API server that counts the connections made to it
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, which Nagle would hold up on a kept-alive connection
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.count_lock:
+            self.server.connections += 1
+
+    def _reply(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.gets += 1
+        if self.server.fail_gets > 0:
+            self.server.fail_gets -= 1
+            self._reply({"ok": False, "error": "unavailable"}, status=503)
+        else:
+            self._reply({"ok": True, "result": {"version": "test"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.server.posts += 1
+        if self.server.fail_posts > 0:
+            self.server.fail_posts -= 1
+            self._reply({"ok": False, "error": "unavailable"}, status=503)
+        else:
+            self._reply({"ok": True, "result": {"output": True}})
+
+    def log_message(self, format, *args):
+        pass
+
+class TestRemoteSession(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.count_lock = threading.Lock()
+        self.server.connections = 0
+        self.server.gets = 0
+        self.server.posts = 0
+        self.server.fail_gets = 0
+        self.server.fail_posts = 0
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        self.mm = ModuleManager(ip="127.0.0.1", user="test", password="test", retry_backoff=0.01)
+        self.mm._port = self.server.server_address[1]
+        self.module = RemoteModule(self.mm, self.mm._get_url(), requests, "dns", {})
+
+    def test_connection_reuse(self):
+        # The old way: a new connection for every call
+        url = self.mm._get_url() + "/dns/run/list"
+        for i in range(CALLS):
+            requests.post(url, auth=("test", "test"), data={})
+        self.assertEqual(self.server.connections, CALLS)
+
+        self.server.connections = 0
+        for i in range(CALLS):
+            error, result = self.module.run("list")
+            self.assertTrue(error is None, msg=error)
+        self.assertEqual(self.server.connections, 1)
+
+    @benchmark
+    def test_connection_reuse_benchmark(self):
+        url = self.mm._get_url() + "/dns/run/list"
+        start = time.perf_counter()
+        for i in range(CALLS):
+            requests.post(url, auth=("test", "test"), data={})
+        unpooled_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(CALLS):
+            self.module.run("list")
+        pooled_time = time.perf_counter() - start
+
+        report("remote calls", "{} calls: {:.3f}s without a session, {:.3f}s with one".format(
+            CALLS, unpooled_time, pooled_time))
+
+    def test_get_retries(self):
+        self.server.fail_gets = 2
+        self.assertEqual(self.mm.get_version(), "test")
+        self.assertEqual(self.server.gets, 3)
+
+    def test_post_not_retried(self):
+        self.server.fail_posts = 1
+        error, _ = self.module.run("list")
+        self.assertEqual(error, "unavailable")
+        self.assertEqual(self.server.posts, 1)
+
+    def tearDown(self):
+        self.mm._session.close()
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,149 @@
+import unittest
+import os
+import sys
+import time
+import json
+import sqlite3
+import tempfile
+import shutil
+import threading
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+import lib.module_manager
+from lib.module_manager import ModuleManager, LockModule
+from lib.base_module import BaseModule
+from lib.restore_scheduler import RestoreScheduler
+
+START_DELAY = 0.1
+
+# Records when each server's restore ran
+class RestoreLog():
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.entries = []
+        self.running = 0
+        self.max_running = 0
+
+    def start(self):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            return time.monotonic()
+
+    def finish(self, shortname, server_id, started):
+        with self._lock:
+            self.running -= 1
+            self.entries.append((shortname, server_id, started, time.monotonic()))
+
+class SlowRestoreModule(BaseModule):
+    __FUNCS__ = {}
+
+    def __init__(self, mm, shortname, log, fail_id=None):
+        self.mm = mm
+        self.__SHORTNAME__ = shortname
+        self.log = log
+        self.fail_id = fail_id
+
+    def run(self, func, **kwargs):
+        return "Invalid function", None
+
+    def restore(self, restore_data):
+        for server_data in restore_data:
+            started = self.log.start()
+            time.sleep(START_DELAY)
+            self.log.finish(self.__SHORTNAME__, server_data[0], started)
+            if server_data[0] == self.fail_id:
+                raise RuntimeError("Could not start")
+
+class TestRestoreScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=FakeDockerClient(), lxd_client=FakeLXDClient())
+        self.log = RestoreLog()
+        for shortname in ["mattermost", "tinyproxy", "minica", "dns", "netreserve"]:
+            fail_id = 3 if shortname == "tinyproxy" else None
+            self.mm.modules[shortname] = LockModule(SlowRestoreModule(self.mm, shortname, self.log, fail_id), self.mm)
+
+        self.save_data = {
+            "dns": [[1, "running"], [2, "running"]],
+            "minica": [[1, "running"]],
+            "mattermost": [[i, "running"] for i in range(1, 6)],
+            "tinyproxy": [[i, "running"] for i in range(1, 6)],
+            "missing": [[1, "running"]]
+        }
+
+    def test_plan(self):
+        stages = RestoreScheduler(self.mm).plan(self.save_data)
+        self.assertEqual([sorted(set(task[0] for task in stage)) for stage in stages], [["dns"], ["minica"], ["mattermost", "tinyproxy"]])
+        self.assertEqual(len(stages[2]), 10)
+        self.assertEqual(stages[0][1], ("dns", 2, [[2, "running"]]))
+
+    def test_run(self):
+        timings = RestoreScheduler(self.mm, workers=4).run(self.save_data)
+
+        self.assertEqual(len(timings), 13)
+        # The two services restore side by side
+        self.assertEqual(self.log.max_running, 2)
+
+        # Each stage finishes before the next starts
+        ends = {}
+        starts = {}
+        for shortname, server_id, started, finished in self.log.entries:
+            ends[shortname] = max(ends.get(shortname, 0), finished)
+            starts[shortname] = min(starts.get(shortname, float("inf")), started)
+        self.assertTrue(ends['dns'] <= starts['minica'])
+        self.assertTrue(ends['minica'] <= starts['mattermost'])
+        self.assertTrue(ends['minica'] <= starts['tinyproxy'])
+
+        # A module's servers never restore at the same time
+        for shortname in ends:
+            entries = sorted([entry for entry in self.log.entries if entry[0] == shortname], key=lambda entry: entry[2])
+            for before, after in zip(entries, entries[1:]):
+                self.assertTrue(before[3] <= after[2])
+
+        for timing in timings:
+            self.assertTrue(timing['seconds'] >= START_DELAY)
+            if timing['module'] == "tinyproxy" and timing['server'] == 3:
+                self.assertEqual(timing['error'], "Could not start")
+            else:
+                self.assertTrue(timing['error'] is None)
+
+    @benchmark
+    def test_run_benchmark(self):
+        start = time.monotonic()
+        RestoreScheduler(self.mm, workers=4).run(self.save_data)
+        elapsed = time.monotonic() - start
+
+        serial_time = 13 * START_DELAY
+        # dns (2 servers in turn), minica (1), then the two services side by
+        # side, 5 servers each
+        critical_path = 8 * START_DELAY
+        report("restore", "13 servers in {:.2f}s, {:.2f}s one at a time".format(elapsed, serial_time))
+        self.assertTrue(elapsed < critical_path + 0.3)
+
+    def test_restore_state(self):
+        saves_dir = tempfile.mkdtemp()
+        old_saves_dir = lib.module_manager.SAVES_DIR
+        lib.module_manager.SAVES_DIR = saves_dir
+        try:
+            save_file = open(os.path.join(saves_dir, "default.json"), "w")
+            save_file.write(json.dumps(self.save_data))
+            save_file.close()
+
+            error, _ = self.mm.restore_state()
+            self.assertTrue(error is None, msg=error)
+            self.assertEqual(len(self.mm.last_restore_timings), 13)
+        finally:
+            lib.module_manager.SAVES_DIR = old_saves_dir
+            shutil.rmtree(saves_dir)
+
+    def tearDown(self):
+        self.mm.jobs.shutdown()
+        self.db.close()
@@ -0,0 +1,177 @@
+import unittest
+import os
+import sys
+import json
+import time
+import sqlite3
+import tempfile
+import shutil
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+import lib.module_manager
+from lib.module_manager import ModuleManager, LockModule
+from lib.base_module import BaseModule
+
+class NoteModule(BaseModule):
+    __SHORTNAME__ = "notes"
+    __FUNCS__ = {
+        "list": {},
+        "add_note": {
+            "note": "TEXT"
+        }
+    }
+
+    def __init__(self, mm):
+        self.mm = mm
+        self.notes = []
+        self.save_calls = 0
+
+    def run(self, func, **kwargs):
+        if func == "list":
+            return None, list(self.notes)
+        elif func == "add_note":
+            self.notes.append(kwargs['note'])
+            return None, True
+        return "Invalid function", None
+
+    def save(self):
+        self.save_calls += 1
+        return list(self.notes)
+
+class TestSaveState(unittest.TestCase):
+
+    def setUp(self):
+        self.saves_dir = tempfile.mkdtemp()
+        self.old_saves_dir = lib.module_manager.SAVES_DIR
+        lib.module_manager.SAVES_DIR = self.saves_dir
+
+        self.docker = FakeDockerClient()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.mm = ModuleManager(db=self.db, docker_client=self.docker, lxd_client=FakeLXDClient())
+        self.notes = NoteModule(self.mm)
+        self.mm.modules['notes'] = LockModule(self.notes, self.mm)
+
+    def add_dns_servers(self, count):
+        from modules.dns_server import DNSServer
+
+        dbc = self.db.cursor()
+        dbc.execute("CREATE TABLE dns_server (server_id INTEGER PRIMARY KEY, server_ip TEXT, server_desc TEXT, server_domain TEXT);")
+        for i in range(1, count+1):
+            dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', ("10.{}.{}.2".format(i // 256, i % 256), "bench", "zone{}".format(i)))
+            self.docker.containers.add("dns-server-{}".format(i), "running" if i % 2 else "exited")
+        self.db.commit()
+        self.mm.modules['dns'] = LockModule(DNSServer(self.mm), self.mm)
+        self.mm.container_cache.resync()
+
+    def read_save(self, filename="default.json"):
+        save_file = open(os.path.join(self.saves_dir, filename))
+        data = save_file.read()
+        save_file.close()
+        return data
+
+    def test_output_format(self):
+        self.add_dns_servers(5)
+        self.mm['notes'].run("add_note", note="first")
+
+        error, _ = self.mm.save_state()
+        self.assertTrue(error is None, msg=error)
+
+        data = self.read_save()
+        expected = {
+            "dns": [[1, "running"], [2, "stopped"], [3, "running"], [4, "stopped"], [5, "running"]],
+            "notes": ["first"]
+        }
+        self.assertEqual(data, json.dumps(expected, sort_keys=True, indent=4, separators=(',', ': ')))
+
+        self.mm['notes'].run("add_note", note="second")
+        self.mm.save_state()
+        self.assertEqual(json.loads(self.read_save())['notes'], ["first", "second"])
+        self.assertEqual(json.loads(self.read_save("default.json.last"))['notes'], ["first"])
+        # No temp files left behind
+        self.assertEqual(sorted(os.listdir(self.saves_dir)), ["default.json", "default.json.last"])
+
+    def test_only_changed_modules_saved(self):
+        self.mm.save_state()
+        self.assertEqual(self.notes.save_calls, 1)
+
+        self.mm.save_state()
+        self.assertEqual(self.notes.save_calls, 1)
+
+        # Read-only calls don't count as changes
+        self.mm['notes'].run("list")
+        self.mm.save_state()
+        self.assertEqual(self.notes.save_calls, 1)
+
+        self.mm['notes'].run("add_note", note="x")
+        self.mm.save_state(save_name="other")
+        self.assertEqual(self.notes.save_calls, 2)
+        self.assertEqual(json.loads(self.read_save("other.json"))['notes'], ["x"])
+
+        # A restore invalidates everything
+        self.mm.restore_state(save_name="other")
+        self.mm.save_state()
+        self.assertEqual(self.notes.save_calls, 3)
+
+    def test_container_change_resaves(self):
+        self.add_dns_servers(3)
+        self.mm.save_state()
+        self.assertEqual(json.loads(self.read_save())['dns'][1], [2, "stopped"])
+
+        # Changed outside of FakerNet, seen through the container cache
+        self.mm.container_cache.set_status("dns-server-2", "running")
+        self.mm.save_state()
+        self.assertEqual(json.loads(self.read_save())['dns'][1], [2, "running"])
+
+    def test_large_incremental_save(self):
+        self.add_dns_servers(1000)
+        self.mm.save_state()
+
+        # Only the notes changed, so nothing asks Docker for statuses again
+        self.mm['notes'].run("add_note", note="change")
+        self.docker.round_trips = 0
+        self.mm.save_state()
+        self.assertEqual(self.docker.round_trips, 0)
+        self.assertEqual(len(json.loads(self.read_save())['dns']), 1000)
+
+    @benchmark
+    def test_save_benchmark(self):
+        timings = {}
+        for count in (10, 1000):
+            self.tearDown()
+            self.setUp()
+            self.add_dns_servers(count)
+
+            # Best of a few runs, so a busy machine doesn't skew the comparison
+            full_time = None
+            incremental_time = None
+            for i in range(3):
+                self.mm.forget_saved()
+                start = time.perf_counter()
+                self.mm.save_state()
+                elapsed = time.perf_counter() - start
+                full_time = elapsed if full_time is None else min(full_time, elapsed)
+
+                self.mm['notes'].run("add_note", note="change")
+                start = time.perf_counter()
+                self.mm.save_state()
+                elapsed = time.perf_counter() - start
+                incremental_time = elapsed if incremental_time is None else min(incremental_time, elapsed)
+
+            timings[count] = (full_time, incremental_time)
+
+        report("save_state", "full / incremental: 10 servers {:.4f}s / {:.4f}s, 1000 servers {:.4f}s / {:.4f}s".format(
+            timings[10][0], timings[10][1], timings[1000][0], timings[1000][1]))
+
+        # The incremental save of the big lab shouldn't cost like a full one
+        self.assertTrue(timings[1000][1] < timings[1000][0] / 3)
+
+    def tearDown(self):
+        self.mm.jobs.shutdown()
+        self.db.close()
+        lib.module_manager.SAVES_DIR = self.old_saves_dir
+        shutil.rmtree(self.saves_dir)
@@ -0,0 +1,96 @@
+import unittest
+import os
+import sys
+import time
+import sqlite3
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from fake_backends import FakeDockerClient, FakeLXDClient
+from benchmark import benchmark, report
+
+from lib.module_manager import ModuleManager, LockModule
+from lib.status_snapshot import StatusSnapshot
+
+SERVER_COUNT = 1000
+
+class TestStatusSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.docker = FakeDockerClient()
+        self.lxd = FakeLXDClient()
+
+    def test_snapshot_lookup(self):
+        self.docker.containers.add("dns-server-1", "running")
+        self.docker.containers.add("minica-server-1", "exited")
+        self.lxd.container_data.append({"name": "lxd1-test", "status": "Running"})
+
+        snapshot = StatusSnapshot(self.docker, self.lxd).load()
+
+        self.assertEqual(snapshot.docker_status("dns-server-1"), (None, ("yes", "running")))
+        self.assertEqual(snapshot.docker_status("minica-server-1"), (None, ("yes", "exited")))
+        self.assertEqual(snapshot.docker_status("dns-server-2"), (None, ("no", "n/a")))
+
+        error, status = snapshot.lxd_status("lxd1-test")
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(status, ("yes", "running"))
+        error, status = snapshot.lxd_status("lxd2-test")
+        self.assertTrue(error is not None)
+        self.assertEqual(status, ("no", "unknown"))
+
+        self.assertEqual(self.docker.round_trips, 1)
+        self.assertEqual(self.lxd.round_trips, 1)
+
+    def _dns_servers(self):
+        from modules.dns_server import DNSServer
+
+        db = sqlite3.connect(":memory:")
+        mm = ModuleManager(db=db, docker_client=self.docker, lxd_client=self.lxd)
+
+        dbc = db.cursor()
+        dbc.execute("CREATE TABLE dns_server (server_id INTEGER PRIMARY KEY, server_ip TEXT, server_desc TEXT, server_domain TEXT);")
+        for i in range(1, SERVER_COUNT+1):
+            dbc.execute('INSERT INTO dns_server (server_ip, server_desc, server_domain) VALUES (?, ?, ?)', ("10.{}.{}.2".format(i // 256, i % 256), "bench", "zone{}".format(i)))
+            self.docker.containers.add("dns-server-{}".format(i), "running")
+        db.commit()
+
+        mm.modules['dns'] = LockModule(DNSServer(mm), mm)
+        return mm
+
+    def test_list_all_servers(self):
+        mm = self._dns_servers()
+
+        self.docker.round_trips = 0
+        per_server_list = mm['dns'].get_list()
+        per_server_trips = self.docker.round_trips
+
+        self.docker.round_trips = 0
+        self.lxd.round_trips = 0
+        error, full_list = mm.list_all_servers()
+        snapshot_trips = self.docker.round_trips + self.lxd.round_trips
+
+        self.assertTrue(error is None, msg=error)
+        self.assertEqual(per_server_list, full_list)
+        self.assertEqual(len(full_list), SERVER_COUNT)
+        self.assertEqual(per_server_trips, SERVER_COUNT)
+        self.assertEqual(snapshot_trips, 2)
+
+    @benchmark
+    def test_list_all_servers_benchmark(self):
+        mm = self._dns_servers()
+
+        start = time.perf_counter()
+        mm['dns'].get_list()
+        per_server_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        error, full_list = mm.list_all_servers()
+        snapshot_time = time.perf_counter() - start
+
+        self.assertTrue(error is None, msg=error)
+        report("list_all_servers", "{} servers: per-server status {:.4f}s, snapshot {:.4f}s".format(
+            SERVER_COUNT, per_server_time, snapshot_time))
+
+    def tearDown(self):
+        pass
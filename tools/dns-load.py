@@ -0,0 +1,83 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import sys
+import os
+import argparse
+import sqlite3
+
+import dns.rdatatype
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from lib.dns_responder import DNSLab, ServerData
+from lib.dns_load import run_load, format_report
+
+# Returns (name, type) for every A, CNAME, MX, TXT and PTR record in the lab
+def lab_queries(db, base_dir, servers):
+    queries = []
+    dbc = db.cursor()
+    dbc.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='dns_record';")
+    if dbc.fetchone() is not None:
+        dbc.execute("SELECT DISTINCT name, type FROM dns_record WHERE type IN ('A', 'CNAME', 'MX', 'TXT', 'PTR') AND direction != 'rpz';")
+        queries = dbc.fetchall()
+    else:
+        for server_id in servers:
+            data = ServerData(os.path.join(base_dir, str(server_id)))
+            for zone in data.zones.values():
+                for name, rdataset in zone.iterate_rdatasets():
+                    if rdataset.rdtype in (dns.rdatatype.A, dns.rdatatype.CNAME, dns.rdatatype.MX, dns.rdatatype.TXT, dns.rdatatype.PTR):
+                        queries.append((name.to_text(), rdataset.rdtype))
+    return queries
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Send queries for the names in the lab's DNS servers and report the rate and latency")
+    parser.add_argument('-d', '--database', default="fakernet.db", help="FakerNet database to read the DNS servers and records from")
+    parser.add_argument('-b', '--base-dir', default="./work/dns", help="Directory of the DNS server configs")
+    parser.add_argument('-s', '--server', default="1", help="ID of the DNS server to query")
+    parser.add_argument('-t', '--target', help="Query this running server (ip[:port]) instead of in-process responders")
+    parser.add_argument('-n', '--count', type=int, default=10000, help="Number of queries to send")
+    parser.add_argument('--duration', type=float, help="Send queries for this many seconds instead")
+    parser.add_argument('-c', '--concurrency', type=int, default=16, help="Queries in flight at once")
+    parser.add_argument('--allow-network', action='store_true', help="Let responders forward to servers outside the lab")
+
+    args = parser.parse_args()
+
+    db = sqlite3.connect(args.database)
+    dbc = db.cursor()
+    dbc.execute("SELECT server_id, server_ip FROM dns_server;")
+    servers = dict(dbc.fetchall())
+    if len(servers) == 0:
+        print("No DNS servers in {}".format(args.database))
+        sys.exit(1)
+
+    queries = lab_queries(db, args.base_dir, servers)
+    db.close()
+    if len(queries) == 0:
+        print("No records to query")
+        sys.exit(1)
+
+    lab = None
+    if args.target is not None:
+        host, _, port = args.target.partition(":")
+        address = (host, int(port) if port != "" else 53)
+    else:
+        lab = DNSLab(args.base_dir, servers, allow_network=args.allow_network)
+        lab.start()
+        address = lab.addresses().get(str(args.server))
+        if address is None:
+            lab.stop()
+            print("DNS server {} does not exist".format(args.server))
+            sys.exit(1)
+
+    print("Querying {} names on {}:{}...".format(len(queries), address[0], address[1]))
+    try:
+        report = run_load(address, queries, count=None if args.duration else args.count, duration=args.duration, concurrency=args.concurrency)
+    finally:
+        if lab is not None:
+            lab.stop()
+
+    print(format_report(report))
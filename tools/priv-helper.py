@@ -0,0 +1,42 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import sys
+import os
+import pwd
+import argparse
+import logging
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from lib.priv_helper import PrivilegedHelper, HELPER_SOCKET
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run the helper FakerNet uses to run iptables, ip and Open vSwitch commands as root instead of sudo. Run this as root.")
+    parser.add_argument('-u', '--user', required=True, help="User FakerNet runs as, the only one besides root allowed to connect")
+    parser.add_argument('-s', '--socket', default=HELPER_SOCKET, help="Path of the socket to listen on")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print("The helper must be run as root")
+        sys.exit(1)
+
+    try:
+        uid = pwd.getpwnam(args.user).pw_uid
+    except KeyError:
+        print("No user named {}".format(args.user))
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    helper = PrivilegedHelper(args.socket, allowed_uids=[0, uid], logger=logging.getLogger("fakernet-helper"))
+    helper.listen(owner_uid=uid)
+    print("Listening on {} for {}".format(args.socket, args.user))
+    try:
+        helper.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        helper.stop()
@@ -8,13 +8,15 @@ import sys
 import logging
 import platform
 import os
+import json
 
-from flask import Flask, g, jsonify, current_app, request, render_template, send_from_directory
+from flask import Flask, g, jsonify, current_app, request, render_template, send_from_directory, Response, stream_with_context
 from flask_httpauth import HTTPBasicAuth
 
 import psutil
 
 from lib.module_manager import ModuleManager
+from lib.database import ThreadLocalConnection
 from lib.version import FAKERNET_VERSION
 
 from flask.logging import default_handler
@@ -24,7 +26,7 @@ def create_app():
     app.secret_key = os.environ['FLASK_KEY']
 
     with app.app_context():
-        current_app.db = sqlite3.connect('fakernet.db')
+        current_app.db = ThreadLocalConnection('fakernet.db')
         current_app.mm = ModuleManager(db=current_app.db)
         current_app.mm.load()
 
@@ -106,6 +108,24 @@ def status_data():
         }
     }
 
+def get_function_args(fnmodule, function):
+    args = {}
+    # Check if a no-parameter function
+    if len(fnmodule.__FUNCS__[function]) == 0 or len(fnmodule.__FUNCS__[function]) == 1 and "_desc" in fnmodule.__FUNCS__[function]:
+        return args
+
+    json_data = request.get_json()
+    if json_data is not None:
+        for item in json_data:
+            args[item] = json_data[item]
+    else:
+        for item in request.form:
+            args[item] = request.form[item]
+        # Uploaded files, such as for DATA parameters, are passed as text
+        for item in request.files:
+            args[item] = request.files[item].read().decode("utf-8", errors="replace")
+    return args
+
 @app.route('/api/v1/<module_name>/run/<function>', methods = ['POST'])
 @auth.login_required
 def run_command(module_name, function):
@@ -118,45 +138,123 @@ def run_command(module_name, function):
     if function not in fnmodule.__FUNCS__:
         return jsonify({"ok": False, "error": "Invalid function"})
 
+    args = get_function_args(fnmodule, function)
+
+    app.logger.info("%s called %s.%s, args=%s", request.remote_addr, module_name, function, str(args))
+
+    error, result = fnmodule.run(function, **args)
+    if error is None:
+        return jsonify({
+            "ok": True,
+            "result": {
+                "output": result
+            }
+        }) 
+    else:
+        return jsonify({"ok": False, "error": error})
+
+@app.route('/api/v1/<module_name>/submit/<function>', methods = ['POST'])
+@auth.login_required
+def submit_command(module_name, function):
+    
+    if not module_name in current_app.mm.list_modules():
+        return jsonify({"ok": False, "error": "Invalid module"})
     
+    fnmodule = current_app.mm[module_name]
 
-    # Check if a no-parameter function
-    if len(fnmodule.__FUNCS__[function]) == 0 or len(fnmodule.__FUNCS__[function]) == 1 and "_desc" in fnmodule.__FUNCS__[function]:
-        app.logger.info("%s called %s.%s, args=", request.remote_addr, module_name, function)
-        error, result = fnmodule.run(function)
-        if error is None:
-            return jsonify({
-                "ok": True,
-                "result": {
-                    "output": result
-                }
-            }) 
-        else:
-            return jsonify({"ok": False, "error": error})
+    if function not in fnmodule.__FUNCS__:
+        return jsonify({"ok": False, "error": "Invalid function"})
+
+    args = get_function_args(fnmodule, function)
+
+    app.logger.info("%s submitted %s.%s, args=%s", request.remote_addr, module_name, function, str(args))
+
+    error, job_id = fnmodule.submit(function, **args)
+    if error is None:
+        return jsonify({
+            "ok": True,
+            "result": {
+                "job_id": job_id
+            }
+        }) 
     else:
-        args = {}
-        json_data = request.get_json()
-        if json_data is not None:
-            for item in json_data:
-                args[item] = json_data[item]
-        else:
-            for item in request.form:
-                args[item] = request.form[item]
+        return jsonify({"ok": False, "error": error})
+
+# Runs a list of {module, func, args} commands in order in one request
+@app.route('/api/v1/_batch', methods = ['POST'])
+@auth.login_required
+def run_batch():
+    json_data = request.get_json()
+    if not isinstance(json_data, dict) or not isinstance(json_data.get('commands'), list):
+        return jsonify({"ok": False, "error": "'commands' list is required"})
+
+    commands = json_data['commands']
+    stop_on_error = json_data.get('stop_on_error', False) is True
 
-        app.logger.info("%s called %s.%s, args=%s", request.remote_addr, module_name, function, str(args))
+    app.logger.info("%s called batch of %d commands", request.remote_addr, len(commands))
 
-        error, result = fnmodule.run(function, **args)
+    error, results = current_app.mm.run_batch(commands, stop_on_error=stop_on_error)
+    if error is not None:
+        return jsonify({"ok": False, "error": error})
+
+    output = []
+    for error, result in results:
         if error is None:
-            return jsonify({
-                "ok": True,
-                "result": {
-                    "output": result
-                }
-            }) 
+            output.append({"ok": True, "output": result})
         else:
-            return jsonify({"ok": False, "error": error})
-    
-    return jsonify({"ok": True})
+            output.append({"ok": False, "error": error})
+
+    return jsonify({
+        "ok": True,
+        "result": {
+            "results": output
+        }
+    })
+
+@app.route('/api/v1/_jobs', methods = ['GET'])
+@auth.login_required
+def list_jobs():
+    error, jobs = current_app.mm.jobs.list()
+    if error is not None:
+        return jsonify({"ok": False, "error": error})
+    return jsonify({
+        "ok": True,
+        "result": {
+            "jobs": jobs
+        }
+    })
+
+@app.route('/api/v1/_jobs/<job_id>', methods = ['GET'])
+@auth.login_required
+def get_job(job_id):
+    error, job = current_app.mm.get_job(job_id)
+    if error is not None:
+        return jsonify({"ok": False, "error": error})
+    return jsonify({
+        "ok": True,
+        "result": job
+    })
+
+# Streams a job's progress messages as they happen, one JSON object per line,
+# finishing with the job's final state
+@app.route('/api/v1/_jobs/<job_id>/stream', methods = ['GET'])
+@auth.login_required
+def stream_job(job_id):
+    error, job = current_app.mm.jobs.get(job_id)
+    if error is not None:
+        return jsonify({"ok": False, "error": error})
+
+    def generate():
+        seen = 0
+        finished = False
+        while not finished:
+            messages, finished = job.wait_progress(seen, timeout=15)
+            seen += len(messages)
+            for message in messages:
+                yield json.dumps({"progress": message}) + "\n"
+        yield json.dumps({"ok": True, "result": job.to_dict()}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 @app.route('/api/v1/_version')
 @auth.login_required